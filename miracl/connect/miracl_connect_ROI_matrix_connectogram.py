@@ -16,6 +16,8 @@ from allensdk.core.mouse_connectivity_cache import MouseConnectivityCache
 from lightning import Lightning
 from scipy import ndimage
 
+from miracl.lbls.miracl_lbls_ontology import load_ontology
+
 
 # ---------
 # help fn
@@ -88,15 +90,15 @@ def initialize():
 
     miracl_home = os.environ['MIRACL_HOME']
 
-    annot_csv = pd.read_csv('%s/atlases/ara/ara_mouse_structure_graph_hemi_split.csv' % miracl_home)
+    ontology = load_ontology(csv='%s/atlases/ara/ara_mouse_structure_graph_hemi_split.csv' % miracl_home)
 
     # read atlas annotations
     atlas_lbls = np.loadtxt('%s/atlases/ara/annotation/annotation_hemi_split_10um_labels.txt' % miracl_home)
 
     # major labels to exclude (ie root,grey,etc) @ depth < 5 or grap order < 6
-    exclude = np.array(annot_csv[(annot_csv["depth"] < 5) | (annot_csv["graph_order"] < 6)].id)
+    exclude = ontology.ids[(ontology.depths < 5) | (ontology.column("graph_order", ontology.ids) < 6)]
 
-    return cutoff, maxannot, miracl_home, annot_csv, atlas_lbls, exclude
+    return cutoff, maxannot, miracl_home, ontology, atlas_lbls, exclude
 
 
 # ---------------
@@ -190,18 +192,15 @@ def exlude_maj_lbls(in_lbls, exclude):
 # ---------------
 # get parent labels for ones w/out inj exp
 
-def get_parentlbl(inj_exps, masked_lbls, annot_csv, exclude):
+def get_parentlbl(inj_exps, masked_lbls, ontology, exclude):
     """ gets parent labels for labels
     without injection experiements in Allen atlas
     """
     masked_lbls_prt = masked_lbls
 
-    for i in range(inj_exps.shape[0]):
-        if inj_exps[i] == 0:
-            l = masked_lbls[i]
-            # get parent label
-            pid = annot_csv.parent_structure_id[annot_csv.id == l].values[0]
-            masked_lbls_prt[i] = pid
+    # get parent labels
+    noinj = inj_exps == 0
+    masked_lbls_prt[noinj] = ontology.parent(masked_lbls[noinj])
 
     unq, ind = np.unique(masked_lbls_prt, return_index=True)
     indsort = np.sort(ind)
@@ -263,7 +262,7 @@ def query_connect(uniq_lbls, projexps, cutoff, exclude, mcc):
 # ---------------
 # save connected ids & abreviations as csv 
 
-def saveconncsv(conn_ids, annot_csv, num_out_lbl):
+def saveconncsv(conn_ids, ontology, num_out_lbl):
     """ Saves connectivity ids (primary structures & targets)
     as a csv file with their ontology atlas ID number
     """
@@ -280,7 +279,7 @@ def saveconncsv(conn_ids, annot_csv, num_out_lbl):
     export_connect.to_csv('connected_ids_%d_labels.csv' % num_out_lbl, index=False)
 
     # export acronynms
-    dic = annot_csv.set_index('id')['acronym'].to_dict()
+    dic = ontology.mapping('acronym')
 
     export_connect_abv = export_connect.replace(dic)
     export_connect_abv.to_csv('connected_abrvs_%d_labels.csv' % num_out_lbl, index=False)
@@ -399,7 +398,7 @@ def exportheatmap(num_out_lbl, conn_ids, all_norm_proj, uniq_lbls, export_connec
 # ---------------
 # compute & save connectivity graph
 
-def createconnectogram(num_out_lbl, heatmap, annot_csv, uniq_lbls, targ, dic):
+def createconnectogram(num_out_lbl, heatmap, ontology, uniq_lbls, targ, dic):
     """ Generates & saves the connectome graph of the connectiviy matrix
     """
 
@@ -439,15 +438,12 @@ def createconnectogram(num_out_lbl, heatmap, annot_csv, uniq_lbls, targ, dic):
     alllbls_abrv = np.array(alllbls_abrv[0])
 
     # get grand parents ids for groups
-    ggp_parents = np.array(
-        [annot_csv['parent_structure_id'][annot_csv['id'] == lbl].item() for l, lbl in enumerate(alllbls)])
+    ggp_parents = ontology.parent(alllbls)
 
     parent_grps = ggp_parents
 
     for i in range(2):
-        parent_grps = np.array(
-            [annot_csv['parent_structure_id'][annot_csv['id'] == lbl].item() if (lbl != 997) else 997 for
-             l, lbl in enumerate(parent_grps)])
+        parent_grps = np.where(parent_grps != 997, ontology.parent(parent_grps), 997)
 
     # make dic
     repl = np.unique(ggp_parents)
@@ -486,7 +482,7 @@ def main(args):
 
     print("\n Reading input mask (ROI) and Allen annotations")
 
-    [cutoff, maxannot, miracl_home, annot_csv, atlas_lbls, exclude] = initialize()
+    [cutoff, maxannot, miracl_home, ontology, atlas_lbls, exclude] = initialize()
 
     # Get 'histogram' of masked labels
     print("\n Getting histogram of included labels in mask & sorting by volume")
@@ -515,7 +511,7 @@ def main(args):
     # get parent labels for ones w/out inj exp
     print("\n Getting parent labels for labels without injection experiments")
 
-    uniq_lbls = get_parentlbl(inj_exps, masked_lbls, annot_csv, exclude)
+    uniq_lbls = get_parentlbl(inj_exps, masked_lbls, ontology, exclude)
 
     # check all labels have inj exps
     print("\n Checking that all parent labels have injection exps")
@@ -523,7 +519,7 @@ def main(args):
     inj_exps = check_inj_exp(uniq_lbls, projexps)
 
     while len(inj_exps) != sum(inj_exps):
-        uniq_lbls = get_parentlbl(inj_exps, uniq_lbls, annot_csv, exclude)
+        uniq_lbls = get_parentlbl(inj_exps, uniq_lbls, ontology, exclude)
         inj_exps = check_inj_exp(uniq_lbls, projexps)
 
     # Restrict to n labels
@@ -554,7 +550,7 @@ def main(args):
     # ---------------        
 
     # save csv     
-    [export_connect_abv, dic] = saveconncsv(conn_ids, annot_csv, num_out_lbl)
+    [export_connect_abv, dic] = saveconncsv(conn_ids, ontology, num_out_lbl)
 
     # compute & save proj map
     names = exportprojmap(all_norm_proj, num_out_lbl, export_connect_abv)
@@ -563,7 +559,7 @@ def main(args):
     [heatmap, targ] = exportheatmap(num_out_lbl, conn_ids, all_norm_proj, uniq_lbls, export_connect_abv, dic, names)
 
     # compute & save connectivity graph
-    createconnectogram(num_out_lbl, heatmap, annot_csv, uniq_lbls, targ, dic)
+    createconnectogram(num_out_lbl, heatmap, ontology, uniq_lbls, targ, dic)
 
 
 # Call main function
@@ -17,6 +17,7 @@ import seaborn as sns
 import tifffile as tiff
 from allensdk.core.mouse_connectivity_cache import MouseConnectivityCache
 
+from miracl.lbls.miracl_lbls_ontology import load_ontology
 from miracl.utilfn.depends_manager import add_paths
 
 warnings.filterwarnings("ignore")
@@ -109,15 +110,15 @@ def initialize():
 
     miracl_home = os.environ['MIRACL_HOME']
 
-    annot_csv = pd.read_csv('%s/atlases/ara/ara_mouse_structure_graph_hemi_split.csv' % miracl_home)
+    ontology = load_ontology(csv='%s/atlases/ara/ara_mouse_structure_graph_hemi_split.csv' % miracl_home)
 
     # read atlas annotations
     # atlas_lbls = np.loadtxt('%s/ara/annotation/annotation_hemi_split_10um_labels.txt' % miracl_home)
 
     # major labels to exclude (ie root,grey,etc) @ depth < 5 or grap order < 6
-    exclude = np.array(annot_csv[(annot_csv["depth"] < 5) | (annot_csv["graph_order"] < 6)].id)
+    exclude = ontology.ids[(ontology.depths < 5) | (ontology.column("graph_order", ontology.ids) < 6)]
 
-    return cutoff, miracl_home, annot_csv, exclude
+    return cutoff, miracl_home, ontology, exclude
 
 
 # ---------------
@@ -225,7 +226,7 @@ def query_connect(exp_id, cutoff, exclude, mcc, projmet):
 # ---------------
 # save connected ids & abreviations as csv
 
-def saveconncsv(conn_ids, annot_csv, lbl_abrv, inj_exp, projmet):
+def saveconncsv(conn_ids, ontology, lbl_abrv, inj_exp, projmet):
     """ Saves connectivity ids (primary structures & targets)
     as a csv file with their ontology atlas ID number
     """
@@ -242,7 +243,7 @@ def saveconncsv(conn_ids, annot_csv, lbl_abrv, inj_exp, projmet):
     export_connect.to_csv('%s_exp%s_connected_ids_sorted_by_%s.csv' % (lbl_abrv, inj_exp, projmet), index=False)
 
     # export acronynms
-    dic = annot_csv.set_index('id')['acronym'].to_dict()
+    dic = ontology.mapping('acronym')
 
     export_connect_abv = export_connect.replace(dic)
     export_connect_abv.to_csv('%s_exp%s_connected_abrvs_sorted_by_%s.csv' % (lbl_abrv, inj_exp, projmet), index=False)
@@ -294,7 +295,7 @@ def main(args):
     parser = parsefn()
     lbl, trans, projmet = parse_inputs(parser, args)
 
-    [cutoff, miracl_home, annot_csv, exclude] = initialize()
+    [cutoff, miracl_home, ontology, exclude] = initialize()
 
     mcc = MouseConnectivityCache(
         manifest_file='%s/connect/connectivity_exps/mouse_connectivity_manifest.json' % miracl_home)
@@ -327,7 +328,7 @@ def main(args):
     inj_exp = projexps[projexps['structure-abbrev'] == lbl].id.index[0]
 
     while inj_exp is None:
-        pid = annot_csv.parent_structure_id[annot_csv.id == lbl].values[0]
+        pid = ontology.parent(lbl)
         inj_exp = projexps[projexps['structure-id'] == pid].id.index[0]
 
     # ---------------
@@ -366,7 +367,7 @@ def main(args):
     [all_connect_ids, all_norm_proj] = query_connect(inj_exp, cutoff, exclude, mcc, projmet)
 
     # save csv
-    export_connect_abv = saveconncsv(all_connect_ids, annot_csv, lbl, inj_exp, projmet)
+    export_connect_abv = saveconncsv(all_connect_ids, ontology, lbl, inj_exp, projmet)
 
     # compute & save proj map
     exportprojmap(all_norm_proj, export_connect_abv, lbl, inj_exp, projmet)
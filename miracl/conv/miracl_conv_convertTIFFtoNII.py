@@ -5,14 +5,14 @@
 
 import argparse
 from PyQt5.QtWidgets import *
-import glob
 import logging
 import multiprocessing
 import os
-import re
 import sys
 import warnings
 from argparse import RawTextHelpFormatter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
@@ -22,8 +22,11 @@ import numpy as np
 import scipy.ndimage
 from PyQt5.QtGui import *
 from joblib import Parallel, delayed
+from nibabel.openers import ImageOpener
 
 from miracl.conv import miracl_conv_gui_options as gui_opts
+from miracl.utilfn.miracl_utilfn_chunked_volume import slices_to_volume
+from miracl.utilfn.miracl_utilfn_virtual_stack import VirtualStack
 
 warnings.simplefilter("ignore", UserWarning)
 
@@ -60,6 +63,8 @@ def helpmsg(name=None):
       -dz , --downzdim      Down-sample in z dimension, binary argument, (default: 1) => yes
       -pd , --prevdown      Previous down-sample ratio, if already downs-sampled
       -pct, --percentile_thr Percentile value for thresholding extreme values (default: 0)
+      -st, --stream         Streaming conversion with bounded memory (z down-sampling by block averaging), binary argument, (default: 0) => no
+      -cv, --chunked_volume Also save the full resolution data as a chunked multi-resolution volume (.zarr), binary argument, (default: 0) => no
       -h, --help            Show this help message and exit
 
     '''
@@ -118,6 +123,10 @@ def parsefn():
         optional.add_argument('-pd', '--prevdown', type=int, metavar='',
                               help="Previous down-sample ratio, if already downs-sampled")
         optional.add_argument('-pct', '--percentile_thr', type=float, metavar="", help="Percentile value for thresholding extreme values (default: None)")
+        optional.add_argument('-st', '--stream', type=int, metavar='',
+                              help="Streaming conversion with bounded memory (z down-sampling by block averaging), binary argument, (default: 0) => no")
+        optional.add_argument('-cv', '--chunked_volume', type=int, metavar='',
+                              help="Also save the full resolution data as a chunked multi-resolution volume (.zarr), binary argument, (default: 0) => no")
 
         # optional.add_argument("-h", "--help", action="help", help="Show this help message and exit")
 
@@ -179,6 +188,10 @@ def parse_inputs(parser, args):
 
         pct_thr = float(linedits[fields[11]].text()) if linedits[fields[11]].text() else 0.0
 
+        stream = 0
+
+        chunked = 0
+
     else:
 
         print("\n running in script mode")
@@ -252,11 +265,15 @@ def parse_inputs(parser, args):
 
         pct_thr = 0 if args.percentile_thr is None else args.percentile_thr
 
+        stream = 0 if getattr(args, 'stream', None) is None else args.stream
+
+        chunked = 0 if getattr(args, 'chunked_volume', None) is None else args.chunked_volume
+
     # make res in um
     vx /= float(1000)  # in um
     vz /= float(1000)
 
-    return indir, work_dir, outnii, d, chann, chanp, chan, vx, vz, cent, downz, pd, pct_thr
+    return indir, work_dir, outnii, d, chann, chanp, chan, vx, vz, cent, downz, pd, pct_thr, stream, chunked
 
 
 # ---------
@@ -298,18 +315,7 @@ def scriptlog(logname):
 
 # ---------
 
-# sort fn
-
-def numericalsort(value):
-    numbers = re.compile(r'(\d+)')
-    parts = numbers.split(value)
-    parts[1::2] = map(int, parts[1::2])
-    return parts
-
-
-# ---------
-
-def converttiff2nii(d, i, x, newdata, tifx):
+def converttiff2nii(d, i, stack, newdata, tifx):
     """
     """
 
@@ -319,7 +325,7 @@ def converttiff2nii(d, i, x, newdata, tifx):
     sys.stdout.write("\r processing slice %d ..." % i)
     sys.stdout.flush()
 
-    m = cv2.imread(x, -1)
+    m = stack.read_slice(i)
 
     # nearest neighbour for very large data sets
     inter = cv2.INTER_CUBIC if tifx < 5000 else cv2.INTER_NEAREST
@@ -345,23 +351,12 @@ def savenii(newdata, d, outnii, downz, vx=None, vz=None, cent=None):
     # array type
     # data_array = np.array(mres, dtype='int16')
 
-    outvox = vx * d
-    dz = d if vx <= vz else int(d * float(vx / vz))
-
-    if downz == 1:
-        outz = vz * dz
-    else:
-        outz = vz
+    outvox, outz, dz = get_out_res(d, downz, vx, vz)
 
     vs = [outvox, outvox, outz]
 
     # Create nifti
-    mat = np.eye(4) * outvox
-    mat[0, 3] = cent[0]
-    mat[1, 3] = cent[1]
-    mat[2, 3] = cent[2]
-    mat[2, 2] = outz
-    mat[3, 3] = 1
+    mat = get_affine(outvox, outz, cent)
 
     # roll dimensions
     data_array = np.rollaxis(newdata, 0, 3)
@@ -389,13 +384,224 @@ def savenii(newdata, d, outnii, downz, vx=None, vz=None, cent=None):
     nib.save(nii, outnii)
 
 
+# ---------
+# streaming conversion
+
+class StreamingHistogram(object):
+    """
+    Histogram of a stream of arrays for estimating percentiles with bounded memory
+
+    Exact (one bin per value) for 8/16 bit integer data. For other data, a fixed
+    number of bins is used whose range is doubled (merging pairs of bins) when
+    new values fall outside of it.
+    """
+
+    def __init__(self, dtype, nbins=65536):
+        self.dtype = np.dtype(dtype)
+        self.exact = self.dtype.kind in 'ui' and self.dtype.itemsize <= 2
+        self.nbins = 2 ** (8 * self.dtype.itemsize) if self.exact else nbins
+        self.counts = np.zeros(self.nbins, dtype=np.int64)
+        self.lo = int(np.iinfo(self.dtype).min) if self.exact else None
+        self.width = 1.0
+        self.vmin = np.inf
+        self.vmax = -np.inf
+
+    def update(self, data):
+        self.vmin = min(self.vmin, float(data.min()))
+        self.vmax = max(self.vmax, float(data.max()))
+
+        if self.exact:
+            self.counts += np.bincount((data.ravel().astype(np.int64) - self.lo), minlength=self.nbins)
+            return
+
+        if self.lo is None:
+            self.lo = self.vmin
+            self.width = max(self.vmax - self.vmin, 1e-6) / self.nbins
+        # grow the range to fit the data
+        while self.vmax >= self.lo + self.nbins * self.width:
+            self.counts = np.concatenate([self.counts[0::2] + self.counts[1::2],
+                                          np.zeros(self.nbins // 2, dtype=np.int64)])
+            self.width *= 2
+        while self.vmin < self.lo:
+            self.counts = np.concatenate([np.zeros(self.nbins // 2, dtype=np.int64),
+                                          self.counts[0::2] + self.counts[1::2]])
+            self.lo -= self.nbins * self.width
+            self.width *= 2
+
+        idx = ((data.ravel() - self.lo) / self.width).astype(np.int64)
+        self.counts += np.bincount(np.clip(idx, 0, self.nbins - 1), minlength=self.nbins)
+
+    def percentile(self, q):
+        """
+        Percentile with linear interpolation between ranks (as np.percentile)
+        """
+        cum = np.cumsum(self.counts)
+        rank = (cum[-1] - 1) * q / 100.0
+        below, above = int(np.floor(rank)), int(np.ceil(rank))
+
+        # value (bin) holding the element of each rank
+        values = np.searchsorted(cum, [below + 1, above + 1])
+        values = self.lo + values * self.width
+        if not self.exact:
+            # center of the bin within the data range
+            values = np.clip(values + self.width / 2.0, self.vmin, self.vmax)
+
+        return float(values[0] + (values[1] - values[0]) * (rank - below))
+
+
+def get_out_res(d, downz, vx, vz):
+    """
+    Output voxel sizes and z down-sample ratio
+    """
+    outvox = vx * d
+    dz = d if vx <= vz else int(d * float(vx / vz))
+
+    if downz == 1:
+        outz = vz * dz
+    else:
+        outz = vz
+
+    return outvox, outz, dz
+
+
+def get_affine(outvox, outz, cent):
+    """
+    Nifti affine from output voxel sizes & center
+    """
+    mat = np.eye(4) * outvox
+    mat[0, 3] = cent[0]
+    mat[1, 3] = cent[1]
+    mat[2, 3] = cent[2]
+    mat[2, 2] = outz
+    mat[3, 3] = 1
+
+    return mat
+
+
+def downsample_slice(d, stack, i, tifx):
+    """
+    Reads & down-samples a slice in x-y (same interpolation as converttiff2nii)
+    """
+    m = stack.read_slice(i)
+    inter = cv2.INTER_CUBIC if tifx < 5000 else cv2.INTER_NEAREST
+
+    return cv2.resize(m, (0, 0), fx=1.0 / int(d), fy=1.0 / int(d), interpolation=inter)
+
+
+def stream_slices(stack, d, tifx, ncpus, buffer):
+    """
+    Yields the down-sampled slices in order, reading up to `buffer` slices ahead in //
+    """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=ncpus) as executor:
+        for i in range(len(stack)):
+            pending.append(executor.submit(downsample_slice, d, stack, i, tifx))
+            if len(pending) >= buffer:
+                yield pending.popleft().result()
+            sys.stdout.write("\r processing slice %d ..." % i)
+            sys.stdout.flush()
+        while pending:
+            yield pending.popleft().result()
+
+
+def streamconvert(stack, d, stackname, downz, vx, vz, cent, pct_thr, ncpus, tmpdir):
+    """
+    Converts tiff slices to a nifti with bounded memory
+
+    Slices are down-sampled in x-y as they are read & in z by averaging blocks of
+    ~dz slices, percentiles are estimated from a streaming histogram & the nifti
+    is written in z-chunks. Peak memory is O(slice x dz), the intermediate data
+    keeps the dtype of the input.
+    """
+    outvox, outz, dz = get_out_res(d, downz, vx, vz)
+    if downz != 1:
+        dz = 1
+
+    tifx = stack.slice_shape[0]
+    dtype = stack.dtype
+
+    nz = len(stack)
+    nzd = max(1, int(round(nz / float(dz))))
+    # output slice k averages input slices [bounds[k], bounds[k + 1])
+    bounds = (np.arange(nzd + 1) * nz) // nzd
+
+    if downz == 1:
+        print("\n down-sampling in the z dimension by averaging blocks of %d slices" % dz)
+
+    hist = StreamingHistogram(dtype) if pct_thr > 0 else None
+    memap = '%s/tmp_array_memmap.map' % tmpdir
+    newdata = None
+
+    k = 0
+    acc = None
+    for i, img in enumerate(stream_slices(stack, d, tifx, ncpus, max(dz, ncpus) + ncpus)):
+        if newdata is None:
+            newdata = np.memmap(memap, dtype=dtype, shape=(nzd,) + img.shape, mode='w+')
+            acc = np.zeros(img.shape, dtype=np.float64)
+        if hist is not None:
+            hist.update(img)
+
+        acc += img
+        if i + 1 == bounds[k + 1]:
+            mean = acc / (bounds[k + 1] - bounds[k])
+            if dtype.kind in 'ui':
+                mean = np.rint(mean)
+            newdata[k] = mean.astype(dtype)
+            acc[:] = 0
+            k += 1
+
+    vmin, vmax = float(newdata.min()), float(newdata.max())
+    if hist is not None:
+        lo, hi = hist.percentile(pct_thr), hist.percentile(100 - pct_thr)
+        print("\n thresholding extreme values outside of [%s, %s]" % (lo, hi))
+        vmin, vmax = max(vmin, lo), min(vmax, hi)
+    else:
+        lo, hi = None, None
+
+    # int16 scaling (slope only, as nibabel) unless data fits
+    if dtype.kind in 'ui' and vmin >= -32768 and vmax <= 32767:
+        slope = 1.0
+    else:
+        slope = max(abs(vmin), abs(vmax), 1e-12) / 32767.0
+
+    # nifti is (x, y, z) with x = tif rows
+    hdr = nib.Nifti1Header()
+    hdr.set_data_shape((newdata.shape[1], newdata.shape[2], nzd))
+    hdr.set_data_dtype(np.int16)
+    hdr.set_qform(get_affine(outvox, outz, cent), code=1)
+    hdr.set_sform(get_affine(outvox, outz, cent), code=2)
+    hdr.set_zooms([outvox, outvox, outz])
+    hdr.set_slope_inter(slope, 0.0)
+    hdr.set_xyzt_units('mm')
+
+    print("\n saving nifti stack in z-chunks")
+
+    chunk = max(dz, 1)
+    with ImageOpener(stackname, 'wb') as f:
+        hdr.write_to(f)
+        f.write(b'\x00' * (int(hdr.get_data_offset()) - f.tell()))
+        for z0 in range(0, nzd, chunk):
+            block = np.asarray(newdata[z0:z0 + chunk], dtype=np.float32)
+            if lo is not None:
+                block = np.clip(block, lo, hi)
+            if slope != 1.0:
+                block = block / slope
+            block = np.clip(np.rint(block), -32768, 32767).astype('<i2')
+            # x fastest on disk
+            f.write(np.ascontiguousarray(block.transpose(0, 2, 1)).tobytes())
+
+    del newdata
+    os.remove(memap)
+
+
 # ---------
 
 def main(args):
     starttime = datetime.now()
 
     parser = parsefn()
-    indir, work_dir, outnii, d, chann, chanp, chan, vx, vz, cent, downz, pd, pct_thr = parse_inputs(parser, args)
+    indir, work_dir, outnii, d, chann, chanp, chan, vx, vz, cent, downz, pd, pct_thr, stream, chunked = \
+        parse_inputs(parser, args)
 
     print("\n Converting with the following settings:")
     print(f"  indir:      {indir}")
@@ -411,18 +617,21 @@ def main(args):
     print(f"  downz:      {downz}")
     print(f"  pd:         {pd}")
     print(f"  pct_thr:    {pct_thr}")
+    print(f"  stream:     {stream}")
+    print(f"  chunked:    {chunked}")
 
     cpuload = 0.95
     cpus = multiprocessing.cpu_count()
-    ncpus = int(cpuload * cpus)
+    ncpus = max(1, int(cpuload * cpus))
 
     # Get file list
 
-    # sort files
+    # sort files (slices are decoded when they are read)
     if chanp is None:
-        file_list = sorted(glob.glob("%s/*.tif*" % indir), key=numericalsort)
+        stack = VirtualStack.from_folder(indir, sort="numerical")
     else:
-        file_list = sorted(glob.glob("%s/*%s%01d*.tif*" % (indir, chanp, chann)), key=numericalsort)
+        stack = VirtualStack.from_folder(indir, pattern="*%s%01d*" % (chanp, chann), sort="numerical")
+    file_list = stack.files
 
     # make out dir
     # If function is called as part of the ACE workflow, the output directory
@@ -434,22 +643,39 @@ def main(args):
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
+    # for prev down-sampled
+    nd = d * pd
+
+    stackname = '%s/%s_%02dx_down_%s_chan.nii.gz' % (outdir, outnii, nd, chan)
+
+    nvx = vx * pd
+    nvz = vz * pd
+
+    if chunked == 1:
+        # full resolution data (sub-blocks & down-sampled levels can be read by later stages)
+        chunkedname = '%s/%s_%s_chan.zarr' % (outdir, outnii, chan)
+        print("\n saving full resolution chunked volume: %s" % chunkedname)
+        slices_to_volume(file_list, chunkedname, voxel_size=(nvz * 1000, nvx * 1000, nvx * 1000), n_threads=ncpus)
+
+    if stream == 1:
+        print("\n converting TIFF images to NII with bounded memory using %02d cpus \n" % ncpus)
+        streamconvert(stack, d, stackname, downz, nvx, nvz, cent, pct_thr, ncpus, outdir)
+        print("\n conversion done in %s ... Have a good day!\n" % (datetime.now() - starttime))
+        return
+
     # convert tiff files in //
     print("\n converting TIFF images to NII in parallel using %02d cpus \n" % ncpus)
 
     memap = '%s/tmp_array_memmap.map' % outdir
 
-    tif = cv2.imread(file_list[0], -1)
-
-    tifx = tif.shape[0]
-    tify = tif.shape[1]
+    tifx, tify = stack.slice_shape[:2]
     tifxd = int(round(float(tifx) / d))
     tifyd = int(round(float(tify) / d))
 
     newdata = np.memmap(memap, dtype=float, shape=(len(file_list), tifxd, tifyd), mode='w+')
 
     Parallel(n_jobs=ncpus, backend="threading")(
-        delayed(converttiff2nii)(d, i, x, newdata, tifx) for i, x in enumerate(file_list))
+        delayed(converttiff2nii)(d, i, stack, newdata, tifx) for i in range(len(stack)))
 
     # stack slices
 
@@ -457,14 +683,6 @@ def main(args):
     #                  stdout=subprocess.PIPE,
     #                  stderr=subprocess.PIPE)
 
-    # for prev down-sampled
-    nd = d * pd
-
-    stackname = '%s/%s_%02dx_down_%s_chan.nii.gz' % (outdir, outnii, nd, chan)
-
-    nvx = vx * pd
-    nvz = vz * pd
-    
     newdata = percentile_threshold(newdata, pct_thr) if pct_thr > 0 else newdata
     savenii(newdata, d, stackname, downz, nvx, nvz, cent)
 
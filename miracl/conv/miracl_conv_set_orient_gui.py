@@ -21,9 +21,9 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationTool
 from matplotlib.backend_bases import key_press_handler
 from matplotlib.figure import Figure
 from PyQt5 import QtCore, QtGui, QtWidgets
-import glob
 from cv2 import cv2
 from miracl_conv_set_orient_qt_gui import Ui_MainWindow
+from miracl.utilfn.miracl_utilfn_virtual_stack import VirtualStack
 
 
 
@@ -154,7 +154,7 @@ class ApplicationWindow(QtWidgets.QMainWindow):
             
             self.figureView = Figure(figsize=(8, 8), dpi=100, facecolor='royalblue', edgecolor='white', linewidth=2)
             self.axis = self.figureView.add_subplot(111)
-            self.img = cv2.imread(self.flist[self.index], 0)
+            self.img = self.readimg(self.index)
             self.clahe = cv2.createCLAHE(clipLimit=5.0, tileGridSize=(8, 8))
             self.cl = self.clahe.apply(self.img)
             self.axis.imshow(self.cl, 'gray')
@@ -210,8 +210,12 @@ class ApplicationWindow(QtWidgets.QMainWindow):
                 QtWidgets.QMessageBox.critical(None, "Path not found", "%s does not exist. Please check path and rerun script" % self.indir, QtWidgets.QMessageBox.Ok)
                 sys.exit(0)
 
-            self.flist = glob.glob(os.path.join(self.indir, '*.tif*'))
-            self.flist.sort()
+            # slices are decoded when browsed, the last viewed ones are kept in memory
+            try:
+                self.stack = VirtualStack.from_folder(self.indir, cache_size=8)
+                self.flist = self.stack.files
+            except FileNotFoundError:
+                self.flist = []
         except BaseException as ex:
             if isinstance(ex, SystemExit):
                 raise ex
@@ -526,6 +530,17 @@ class ApplicationWindow(QtWidgets.QMainWindow):
         self.ui.image_number_spinBox.setValue( self.ui.image_number_spinBox.value() -1)
   
 
+    '''
+    Reads slice [0...n-1] as an 8-bit image (as cv2.imread(fname, 0))
+    '''
+    def readimg(self, index):
+        img = self.stack.read_slice(index)
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        if img.dtype == 'uint16':
+            img = (img >> 8).astype('uint8')
+        return img.astype('uint8', copy=False)
+
     '''
     Loads image identified by value [1...n]
     '''
@@ -535,7 +550,7 @@ class ApplicationWindow(QtWidgets.QMainWindow):
                 raise TypeError("value is not of a type int")
 
             self.index = self.nextframe(imgnum=value)
-            self.img = cv2.imread(self.flist[self.index], 0)
+            self.img = self.readimg(self.index)
             self.clahe = cv2.createCLAHE(clipLimit=5.0, tileGridSize=(8, 8))
             self.cl = self.clahe.apply(self.img)
             self.axis.imshow(self.cl, 'gray')
@@ -146,6 +146,11 @@ optional voxelization arguments:
                         voxel size (x, y dims) in um (default: 1)
   -rvavz RVA_VZ_RES, --rva_vz_res RVA_VZ_RES
                         voxel size (z dim) in um (default: 1)
+  -rvam {peaks,voxels,cells}, --rva_mode {peaks,voxels,cells}
+                        voxelization mode: peaks of the convolved segmentation
+                        detected slice by slice, number of segmented voxels or
+                        exact number of cells (3D connected components) in
+                        each voxel (default: peaks)
 
 optional warping arguments:
   -rwcr RWC_INPUT_FOLDER, --rwc_input_folder RWC_INPUT_FOLDER
@@ -1,19 +1,30 @@
 import argparse
+import contextlib
+import datetime
+import hashlib
+import json
+import multiprocessing
 import os
 import pathlib
 import re
 import shutil
 import subprocess
+import sys
+import traceback
 import typing
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from typing import List, Optional
 
 from miracl import miracl_logger
 from miracl.flow import miracl_workflow_ace_parser
-from miracl.seg import ace_interface, miracl_instance_segmentation_interface
+from miracl.seg import (ace_interface, miracl_instance_segmentation_interface,
+                        miracl_seg_stack_tiffs)
 from miracl.stats import (miracl_stats_ace_interface,
                           miracl_stats_ace_validate_clusters)
+from miracl.utilfn.miracl_utilfn_chunked_volume import (chunked_volume_path,
+                                                         is_chunked_volume)
 
 logger = miracl_logger.logger
 
@@ -47,7 +58,7 @@ class Registration(ABC):
 
 class Voxelization(ABC):
     @abstractmethod
-    def voxelize(self, args, stacked_tif):
+    def voxelize(self, args, seg_input, **kwargs):
         pass
 
 
@@ -101,7 +112,11 @@ class ACESegmentation(Segmentation):
         print("  segmenting...")
         logger.debug("Calling ace_interface fn here")
         logger.debug(f"Example args: {args.sa_model_type}")
-        ace_interface.main(args=args)
+        # the instance segmentation reads the output patches (only saved on request in streaming mode)
+        ace_interface.main(
+            args=args,
+            output_patches=not getattr(args, "no_instance_segmentation", False),
+        )
 
 class ACEInstanceSegmentation(InstanceSegmentation):
     """ACE Instance Segmentation module used for segmenting the input images
@@ -161,7 +176,8 @@ class ACEConversion(Conversion):
         --center {' '.join(map(str, args.ctn_center))} \
         --downzdim {args.ctn_downzdim} \
         --prevdown {args.ctn_prevdown} \
-        --percentile_thr {args.ctn_percentile_thr}"
+        --percentile_thr {args.ctn_percentile_thr} \
+        --stream {args.ctn_stream}"
         subprocess.Popen(conv_cmd, shell=True).wait()
         logger.debug("Calling conversion fn here")
         logger.debug(f"Example args: {args.ctn_down}")
@@ -197,22 +213,43 @@ class ACEVoxelization(Voxelization):
     :type Voxelization: ABC
     """
 
-    def voxelize(self, args: argparse.Namespace, stacked_tif: pathlib.Path):
+    def voxelize(
+        self,
+        args: argparse.Namespace,
+        seg_input: pathlib.Path,
+        slice_filter: str = "",
+        out_dir: Optional[pathlib.Path] = None,
+    ):
         """Main method for voxelization module. Calls `miracl seg voxelize` module.
 
         :param args: command line arguments needed for MIRACL seg module.
         :type args: argparse.Namespace
-        :param stacked_tif: path to the stacked tif file ('stacked_seg_tif.tif')
-        :type stacked_tif: pathlib.Path
+        :param seg_input: path to the stacked tif file ('stacked_seg_tif.tif')
+            or to the folder of segmented slices ('seg_final/'), which are
+            read lazily without stacking them first, or to their chunked
+            volume ('seg_final_out.zarr')
+        :type seg_input: pathlib.Path
+        :param slice_filter: prefix of the slices to read from the folder
+            (e.g. 'out_' or 'MC_')
+        :type slice_filter: str
+        :param out_dir: output folder (default: folder of seg_input)
+        :type out_dir: pathlib.Path, optional
         """
         x_vox, y_vox, z_vox = args.sa_resolution
-        print("  voxelizing stacked tif...")
+        print("  voxelizing segmentation...")
         vox_cmd = f"miracl seg voxelize \
-        --seg {stacked_tif} \
+        --seg {seg_input} \
         --res {args.rca_voxel_size} \
         --down {args.rva_downsample} \
         -vx {x_vox} \
         -vz {z_vox}"
+        vox_mode = getattr(args, "rva_mode", "peaks")
+        if vox_mode != "peaks":
+            vox_cmd += f" --mode {vox_mode}"
+        if slice_filter:
+            vox_cmd += f" --filter {slice_filter}"
+        if out_dir is not None:
+            vox_cmd += f" --outdir {out_dir}"
         subprocess.Popen(vox_cmd, shell=True).wait()
         logger.debug("Calling voxelization fn here")
         logger.debug(f"ctn_down in voxelization: {args.ctn_down}")
@@ -378,6 +415,16 @@ class ACEWorkflows:
     :type heatmap: Heatmap
     """
 
+    # path args used by the per-subject steps, made absolute for the subjects
+    # running in their own folder
+    SUBJECT_PATH_ARGS = [
+        "rca_allen_label",
+        "rca_allen_atlas",
+        "rwc_input_folder",
+        "rwc_input_nii",
+        "u_atlas_dir",
+    ]
+
     def __init__(
         self,
         segmentation: Segmentation,
@@ -453,15 +500,18 @@ class ACEWorkflows:
             args.sa_output_folder, "warp_final"
         )
 
+        stage_cache = StageCache(args.sa_output_folder)
+
         rerun_seg = SegmentationChecker.check_segmentation(
-            args, ace_flow_seg_output_folder
+            args, ace_flow_seg_output_folder, stage_cache
         )
 
         if rerun_seg:
             self.segmentation.segment(args)
+        stage_cache.record("segmentation", args, rerun_seg)
 
         rerun_conv = ConversionChecker.check_conversion(
-            args, ace_flow_conv_output_folder
+            args, ace_flow_conv_output_folder, stage_cache
         )
 
         if rerun_conv:
@@ -470,8 +520,10 @@ class ACEWorkflows:
         converted_nii_file = GetConverterdNifti.get_nifti_file(
             ace_flow_conv_output_folder
         )
+        stage_cache.record("conversion", args, rerun_conv)
+
         rerun_subject = RegistrationChecker.check_registration(
-            args, ace_flow_reg_output_folder
+            args, ace_flow_reg_output_folder, stage_cache
         )
         if rerun_subject:
             reg_cmd = RegistrationChecker.get_registration_cmd(
@@ -479,15 +531,67 @@ class ACEWorkflows:
                 converted_nii_file=converted_nii_file,
             )
             self.registration.register(args, reg_cmd)
+        stage_cache.record("registration", args, rerun_subject)
+
+        self._voxelize_and_warp(
+            args,
+            stage_cache,
+            ace_flow_seg_output_folder,
+            ace_flow_reg_output_folder,
+            ace_flow_vox_output_folder,
+            ace_flow_warp_output_folder,
+        )
+
+    def _voxelize_and_warp(
+        self,
+        args: argparse.Namespace,
+        stage_cache: "StageCache",
+        ace_flow_seg_output_folder: pathlib.Path,
+        ace_flow_reg_output_folder: pathlib.Path,
+        ace_flow_vox_output_folder: pathlib.Path,
+        ace_flow_warp_output_folder: pathlib.Path,
+    ):
+        """Private method for voxelizing the segmentation and warping it to
+        the atlas. Each step is skipped if its stage cache record is still
+        valid and its output exists.
 
-        # Stack tiff files for use in voxelization method
-        fiji_file = ace_flow_vox_output_folder / "stack_seg_tifs.ijm"
-        stacked_tif = ace_flow_vox_output_folder / "stacked_seg_tif.tif"
-        StackTiffs.check_folders(fiji_file, stacked_tif)
-        StackTiffs.stacking(
-            fiji_file, stacked_tif, ace_flow_seg_output_folder, args.sa_monte_carlo > 0
+        :param args: command line arguments of the subject
+        :type args: argparse.Namespace
+        :param stage_cache: stage cache of the subject
+        :type stage_cache: StageCache
+        """
+        rerun_vox = not (
+            stage_cache.is_valid("voxelization", args)
+            and list(ace_flow_vox_output_folder.glob("voxelized_seg_*.nii.gz"))
         )
-        self.voxelization.voxelize(args, stacked_tif)
+        if rerun_vox:
+            # Clear outputs of previous runs (incl. stacked tifs of older versions)
+            fiji_file = ace_flow_vox_output_folder / "stack_seg_tifs.ijm"
+            stacked_tif = ace_flow_vox_output_folder / "stacked_seg_tif.tif"
+            StackTiffs.check_folders(fiji_file, stacked_tif)
+            for file in ace_flow_vox_output_folder.glob("voxelized_seg_*"):
+                file.unlink()
+            # The segmented slices are read lazily by voxelization (no stacked tif),
+            # or their chunked volume if it was saved by the segmentation
+            seg_input = ace_flow_seg_output_folder
+            slice_filter = StackTiffs.get_slice_filter(args.sa_monte_carlo > 0)
+            chunked_volumes = sorted(
+                ace_flow_seg_output_folder.parent.glob(
+                    chunked_volume_path(
+                        ace_flow_seg_output_folder.name, slice_filter, wildcard=True
+                    )
+                )
+            )
+            if getattr(args, "sa_chunked_volume", False) and chunked_volumes:
+                seg_input, slice_filter = chunked_volumes[0], ""
+            self.voxelization.voxelize(
+                args,
+                seg_input,
+                slice_filter=slice_filter,
+                out_dir=ace_flow_vox_output_folder,
+            )
+        else:
+            print("  Skipping voxelization (cached)...")
 
         (
             voxelized_segmented_tif,
@@ -495,24 +599,43 @@ class ACEWorkflows:
         ) = GetVoxSegTif.check_warping_requirements(
             ace_flow_vox_output_folder, ace_flow_warp_output_folder
         )
+        stage_cache.record("voxelization", args, rerun_vox)
 
-        GetVoxSegTif.create_orientation_file(
-            orientation_file,
-            ace_flow_warp_output_folder,
-            args.rca_orient_code,
-        )
-        self.warping.warp(
-            args,
-            ace_flow_reg_output_folder.parent / "clar_allen_reg",
-            voxelized_segmented_tif,
-            orientation_file,
+        rerun_warp = not (
+            stage_cache.is_valid("warping", args)
+            and list(ace_flow_warp_output_folder.glob("*voxelized_*.nii.gz"))
         )
+        if rerun_warp:
+            GetVoxSegTif.create_orientation_file(
+                orientation_file,
+                ace_flow_warp_output_folder,
+                args.rca_orient_code,
+            )
+            self.warping.warp(
+                args,
+                ace_flow_reg_output_folder.parent / "clar_allen_reg",
+                voxelized_segmented_tif,
+                orientation_file,
+            )
+        else:
+            print("  Skipping warping (cached)...")
+
+        if not list(ace_flow_warp_output_folder.glob("*voxelized_*.nii.gz")):
+            raise FileNotFoundError(
+                f"No warped voxelized nifti found in: {ace_flow_warp_output_folder}"
+            )
+        stage_cache.record("warping", args, rerun_warp)
 
     def _execute_comparison_workflow(self, args: argparse.Namespace, **kwargs):
         """Private method for executing the comparison workflow.
 
+        The per-subject steps (segmentation to warping) are independent across
+        subjects and are run by the `SubjectScheduler`. Group stats start once
+        the last subject has been warped.
+
         :param args: arguments needed for comparison workflow
         :type args: argparse.Namespace
+        :raises RuntimeError: If the per-subject steps failed for any subject
         """
 
         overall_save_folder = args.sa_output_folder
@@ -527,8 +650,7 @@ class ACEWorkflows:
             args.sa_output_folder, "neuron_info_json"
         )
 
-        nifti_save_location = {}
-
+        jobs = []
         for type_ in ["control", "treated"]:
             tiff_template = Path(args_dict[type_][1])
             base_dir = Path(args_dict[type_][0])
@@ -539,100 +661,51 @@ class ACEWorkflows:
             for subject in subject_folders:
                 save_folder = (
                     (subject / tiff_extension).parent / per_subject_final_folder
-                ).as_posix()
-
-                args.sa_output_folder = save_folder
-
-                ace_flow_seg_output_folder = FolderCreator.create_folder(
-                    args.sa_output_folder, "seg_final"
-                )
-                ace_flow_conv_output_folder = FolderCreator.create_folder(
-                    args.sa_output_folder, "conv_final"
-                )
-                ace_flow_reg_output_folder = FolderCreator.create_folder(
-                    args.sa_output_folder, "reg_final"
-                )
-                ace_flow_vox_output_folder = FolderCreator.create_folder(
-                    args.sa_output_folder, "vox_final"
-                )
-                ace_flow_warp_output_folder = FolderCreator.create_folder(
-                    args.sa_output_folder, "warp_final"
-                )
-
-                args.single = base_dir / subject.stem / tiff_extension
-
-                rerun_seg = SegmentationChecker.check_segmentation(
-                    args, ace_flow_seg_output_folder
-                )
-
-                if rerun_seg:
-                    self.segmentation.segment(args)
-
-                run_instance_seg = InstanceSegmentationChecker.check_instance_segmentation(
-                    args, ace_flow_seg_output_folder
+                ).absolute()
+
+                # each subject gets its own copy of the args
+                subject_args = argparse.Namespace(**vars(args))
+                subject_args.sa_output_folder = save_folder.as_posix()
+                subject_args.single = (base_dir / subject.stem / tiff_extension).absolute()
+                for name in self.SUBJECT_PATH_ARGS:
+                    value = getattr(subject_args, name, None)
+                    if value not in (None, "None"):
+                        setattr(subject_args, name, os.path.abspath(value))
+
+                jobs.append(
+                    {
+                        "type": type_,
+                        "subject": subject.name,
+                        "args": subject_args,
+                        "work_dir": save_folder,
+                        "log_file": save_folder / "ace_flow_subject.log",
+                        "neuron_info_json_folder": neuron_info_json_folder.absolute(),
+                    }
                 )
 
-                if run_instance_seg:
-                    self.instance_segmentation.segment(
-                        args,
-                        ace_flow_seg_output_folder
-                    )
-
-                rerun_conv = ConversionChecker.check_conversion(
-                    args, ace_flow_conv_output_folder
-                )
-
-                if rerun_conv:
-                    self.conversion.convert(args)
-
-                converted_nii_file = GetConverterdNifti.get_nifti_file(
-                    ace_flow_conv_output_folder
-                )
-
-                rerun_subject = RegistrationChecker.check_registration(
-                    args, ace_flow_reg_output_folder
-                )
-                if rerun_subject:
-                    reg_cmd = RegistrationChecker.get_registration_cmd(
-                        args,
-                        converted_nii_file=converted_nii_file,
-                    )
-                    self.registration.register(args, reg_cmd)
-                # Stack tiff files for use in voxelization method
-                fiji_file = ace_flow_vox_output_folder / "stack_seg_tifs.ijm"
-                stacked_tif = ace_flow_vox_output_folder / "stacked_seg_tif.tif"
-                StackTiffs.check_folders(fiji_file, stacked_tif)
-                StackTiffs.stacking(fiji_file, stacked_tif, ace_flow_seg_output_folder, args.sa_monte_carlo > 0)
-                self.voxelization.voxelize(args, stacked_tif)
-
-                (
-                    voxelized_segmented_tif,
-                    orientation_file,
-                ) = GetVoxSegTif.check_warping_requirements(
-                    ace_flow_vox_output_folder, ace_flow_warp_output_folder
-                )
-
-                GetVoxSegTif.create_orientation_file(
-                    orientation_file,
-                    ace_flow_warp_output_folder,
-                    args.rca_orient_code,
-                )
-                self.warping.warp(
-                    args,
-                    ace_flow_reg_output_folder.parent / "clar_allen_reg",
-                    voxelized_segmented_tif,
-                    orientation_file,
-                )
-
-                # copy neuron info to the neuron_info_json folder
-                neuron_info_json_file = list(
-                    ace_flow_seg_output_folder.rglob("neuron_info_final.json")
-                )[0]
-                shutil.copy(neuron_info_json_file, neuron_info_json_folder / f"{subject.name}_neuron_info.json")
+        scheduler = SubjectScheduler(
+            max_subjects=args.ps_subjects,
+            resource_caps={
+                "segmentation": args.ps_segmentation,
+                "registration": args.ps_registration or args.ps_subjects,
+            },
+        )
+        results = scheduler.run(self._process_subject, jobs)
+
+        failed = [
+            f"{job['type']}/{job['subject']} (log: {job['log_file']})"
+            for job, result in zip(jobs, results)
+            if result["status"] != "done"
+        ]
+        if failed:
+            raise RuntimeError(
+                f"{len(failed)} of {len(jobs)} subjects failed, skipping group stats:\n  "
+                + "\n  ".join(failed)
+            )
 
-            nifti_save_location[type_] = list(
-                ace_flow_warp_output_folder.glob("*voxelized_*.nii.gz")
-            )[0]
+        nifti_save_location = {}
+        for job, result in zip(jobs, results):
+            nifti_save_location[job["type"]] = result["result"]
 
         # reset the save folder to the original provided arg
         args.sa_output_folder = overall_save_folder
@@ -674,6 +747,234 @@ class ACEWorkflows:
                 ace_output_extension=str(Path(tiff_extension).parent / per_subject_final_folder),
             )
 
+    def _process_subject(self, job: dict, resources: dict) -> pathlib.Path:
+        """Private method running the per-subject steps of the comparison
+        workflow (segmentation to warping) for one subject.
+
+        :param job: subject job created by `_execute_comparison_workflow`
+        :type job: dict
+        :param resources: lock (semaphore) per resource class, used to cap the
+            number of subjects running segmentation or registration at once
+        :type resources: dict
+        :return: path to the warped voxelized nifti of the subject
+        :rtype: pathlib.Path
+        """
+        args = job["args"]
+        print(f"Processing {job['type']} subject: {job['subject']}")
+
+        ace_flow_seg_output_folder = FolderCreator.create_folder(
+            args.sa_output_folder, "seg_final"
+        )
+        ace_flow_conv_output_folder = FolderCreator.create_folder(
+            args.sa_output_folder, "conv_final"
+        )
+        ace_flow_reg_output_folder = FolderCreator.create_folder(
+            args.sa_output_folder, "reg_final"
+        )
+        ace_flow_vox_output_folder = FolderCreator.create_folder(
+            args.sa_output_folder, "vox_final"
+        )
+        ace_flow_warp_output_folder = FolderCreator.create_folder(
+            args.sa_output_folder, "warp_final"
+        )
+
+        stage_cache = StageCache(args.sa_output_folder)
+
+        with resources["segmentation"]:
+            rerun_seg = SegmentationChecker.check_segmentation(
+                args, ace_flow_seg_output_folder, stage_cache
+            )
+
+            if rerun_seg:
+                self.segmentation.segment(args)
+            stage_cache.record("segmentation", args, rerun_seg)
+
+            run_instance_seg = InstanceSegmentationChecker.check_instance_segmentation(
+                args, ace_flow_seg_output_folder, stage_cache
+            )
+
+            if run_instance_seg:
+                self.instance_segmentation.segment(
+                    args,
+                    ace_flow_seg_output_folder
+                )
+            if not args.no_instance_segmentation:
+                stage_cache.record("instance_segmentation", args, run_instance_seg)
+
+        rerun_conv = ConversionChecker.check_conversion(
+            args, ace_flow_conv_output_folder, stage_cache
+        )
+
+        if rerun_conv:
+            self.conversion.convert(args)
+
+        converted_nii_file = GetConverterdNifti.get_nifti_file(
+            ace_flow_conv_output_folder
+        )
+        stage_cache.record("conversion", args, rerun_conv)
+
+        rerun_subject = RegistrationChecker.check_registration(
+            args, ace_flow_reg_output_folder, stage_cache
+        )
+        if rerun_subject:
+            reg_cmd = RegistrationChecker.get_registration_cmd(
+                args,
+                converted_nii_file=converted_nii_file,
+            )
+            with resources["registration"]:
+                self.registration.register(args, reg_cmd)
+        stage_cache.record("registration", args, rerun_subject)
+
+        self._voxelize_and_warp(
+            args,
+            stage_cache,
+            ace_flow_seg_output_folder,
+            ace_flow_reg_output_folder,
+            ace_flow_vox_output_folder,
+            ace_flow_warp_output_folder,
+        )
+
+        # copy neuron table to the neuron_info_json folder
+        neuron_info_file = list(
+            ace_flow_seg_output_folder.rglob("neuron_info_final.npz")
+        )[0]
+        shutil.copy(
+            neuron_info_file,
+            job["neuron_info_json_folder"] / f"{job['subject']}_neuron_info.npz",
+        )
+
+        return list(ace_flow_warp_output_folder.glob("*voxelized_*.nii.gz"))[0]
+
+class SubjectScheduler:
+    """Class for running independent subjects concurrently in a process pool.
+
+    The number of subjects running a resource heavy step at the same time is
+    capped per resource class (e.g. 'segmentation' on the GPU/CPU and
+    'registration' on the CPU) with shared semaphores. When run in parallel,
+    each subject runs in its own folder (its path args must be absolute), with
+    its output (incl. subprocesses) going to its own log file. A failing
+    subject does not stop the others.
+
+    :param max_subjects: number of subjects processed at the same time
+    :type max_subjects: int
+    :param resource_caps: max number of subjects per resource class
+    :type resource_caps: typing.Dict[str, int]
+    """
+
+    def __init__(
+        self,
+        max_subjects: int = 1,
+        resource_caps: Optional[typing.Dict[str, int]] = None,
+    ):
+        """Constructor method"""
+        self.max_subjects = max(1, max_subjects)
+        self.resource_caps = resource_caps or {}
+
+    def run(self, fn: typing.Callable, jobs: List[dict]) -> List[dict]:
+        """Runs `fn(job, resources)` for every job and waits for all of them.
+
+        :param fn: picklable function running the steps of one subject
+        :type fn: typing.Callable
+        :param jobs: one dict per subject with at least 'subject', 'work_dir'
+            and 'log_file'
+        :type jobs: List[dict]
+        :return: one dict per job (same order) with 'status' ('done' or
+            'failed') and 'result' (return value of fn) or 'error' (traceback)
+        :rtype: List[dict]
+        """
+        if self.max_subjects == 1 or len(jobs) < 2:
+            resources = {
+                name: contextlib.nullcontext() for name in self.resource_caps
+            }
+            results = []
+            for job in jobs:
+                result = SubjectScheduler._run_job(fn, job, resources, False)
+                SubjectScheduler._report(job, result)
+                results.append(result)
+            return results
+
+        n_workers = min(self.max_subjects, len(jobs))
+        print(f"  Running {len(jobs)} subjects, {n_workers} at a time...")
+        results = [None] * len(jobs)
+
+        with multiprocessing.Manager() as manager:
+            resources = {
+                name: manager.BoundedSemaphore(max(1, cap))
+                for name, cap in self.resource_caps.items()
+            }
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = {
+                    executor.submit(
+                        SubjectScheduler._run_job, fn, job, resources, True
+                    ): i
+                    for i, job in enumerate(jobs)
+                }
+                for future in as_completed(futures):
+                    i = futures[future]
+                    try:
+                        results[i] = future.result()
+                    except Exception:
+                        # e.g. worker killed (out of memory)
+                        results[i] = {
+                            "status": "failed",
+                            "error": traceback.format_exc(),
+                        }
+                    SubjectScheduler._report(jobs[i], results[i])
+
+        return results
+
+    @staticmethod
+    def _run_job(
+        fn: typing.Callable, job: dict, resources: dict, redirect_output: bool
+    ) -> dict:
+        """Runs one job (inside its folder in parallel) and catches its errors."""
+        Path(job["work_dir"]).mkdir(parents=True, exist_ok=True)
+        if redirect_output:
+            context = SubjectScheduler._subject_context(job["work_dir"], job["log_file"])
+        else:
+            context = contextlib.nullcontext()
+        with context:
+            try:
+                return {"status": "done", "result": fn(job, resources)}
+            except Exception:
+                error = traceback.format_exc()
+                print(error, file=sys.stderr)
+                return {"status": "failed", "error": error}
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _subject_context(work_dir: pathlib.Path, log_file: pathlib.Path):
+        """Changes into the subject folder (subjects running at the same time
+        do not share the outputs `warp_clar` writes to the cwd) and redirects
+        stdout/stderr at the file descriptor level (to catch subprocesses) to
+        the subject log.
+        """
+        prev_cwd = os.getcwd()
+        os.chdir(work_dir)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_fds = [os.dup(1), os.dup(2)]
+        with open(log_file, "a", buffering=1) as log:
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+            try:
+                with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+                    yield
+            finally:
+                os.chdir(prev_cwd)
+                for fd, saved_fd in zip([1, 2], saved_fds):
+                    os.dup2(saved_fd, fd)
+                    os.close(saved_fd)
+
+    @staticmethod
+    def _report(job: dict, result: dict):
+        """Prints the outcome of one job."""
+        if result["status"] == "done":
+            print(f"  Finished subject: {job['subject']}")
+        else:
+            print(f"  Failed subject: {job['subject']} (see {job['log_file']})")
+            logger.debug(result["error"])
+
 
 class FolderCreator:
     """Class used for creating folders."""
@@ -728,7 +1029,7 @@ class StackTiffs:
     def check_folders(fiji_file: pathlib.Path, stacked_tif: pathlib.Path):
         """Checks if folders exist and deletes them if they do.
 
-        :param fiji_file: path to the fiji file ('vox_final/stack_seg_tifs.ijm')
+        :param fiji_file: path to the fiji macro written by older versions ('vox_final/stack_seg_tifs.ijm')
         :type fiji_file: pathlib.Path
         :param stacked_tif: path to the stacked tif file ('vox_final/stacked_seg_tif.tif')
         :type stacked_tif: pathlib.Path
@@ -740,40 +1041,41 @@ class StackTiffs:
         if stacked_tif.is_file():
             stacked_tif.unlink()
 
+    @staticmethod
+    def get_slice_filter(is_MC: bool) -> str:
+        """Returns the prefix of the segmented slices to stack.
+
+        :param is_MC: flag for Monte Carlo or not
+        :type is_MC: bool
+        :return: 'MC_' for Monte Carlo outputs, else 'out_'
+        :rtype: str
+        """
+        return "MC_" if is_MC else "out_"
+
     @staticmethod
     def stacking(
-        fiji_file: pathlib.Path,
         stacked_tif: pathlib.Path,
         seg_output_dir: pathlib.Path,
         is_MC: bool,
-    ):
-        """Writes a Fiji macro and runs it to stack the segmented tif files.
-        Needed to run before voxelization.
+    ) -> pathlib.Path:
+        """Streams the segmented tif slices into a (memory-mapped) BigTIFF
+        z-stack with bounded memory. Not needed by the workflow, where
+        voxelization reads the slices directly.
 
-        :param fiji_file: path to the fiji file ('vox_final/stack_seg_tifs.ijm')
-        :type fiji_file: pathlib.Path
         :param stacked_tif: path to the stacked tif file ('vox_final/stacked_seg_tif.tif')
         :type stacked_tif: pathlib.Path
         :param seg_output_dir: path to the segmented tif files ('seg_final/')
         :type seg_output_dir: pathlib.Path
         :param is_MC: flag for Monte Carlo or not
         :type is_MC: bool
+        :return: path to the stacked tif file
+        :rtype: pathlib.Path
         """
         print("  stacking segmented tifs...")
-        filter = "MC_" if is_MC else "out_"
-        with open(fiji_file, "w") as file:
-            file.write(
-                f'File.openSequence("{seg_output_dir}", "virtual filter={filter}");\n'
-            )
-            file.write(f'saveAs("Tiff", "{stacked_tif}");\n')
-            file.write("close();\n")
-
-        fiji_stack_cmd = f"Fiji \
-                --headless \
-                --console \
-                -macro \
-                {fiji_file}"
-        subprocess.Popen(fiji_stack_cmd, shell=True).wait()
+        slices = miracl_seg_stack_tiffs.find_slices(
+            seg_output_dir, StackTiffs.get_slice_filter(is_MC)
+        )
+        return miracl_seg_stack_tiffs.stack_slices(slices, stacked_tif)
 
 
 class GetVoxSegTif:
@@ -933,6 +1235,7 @@ class RegistrationChecker:
     def check_registration(
         args: argparse.Namespace,
         reg_folder: Path,
+        cache: Optional["StageCache"] = None,
     ) -> bool:
         """Checks if registration needs to be run based on user input and the file structure.
         If the user want to run registration (with the --rerun-registration flag), we run it. 
@@ -943,6 +1246,9 @@ class RegistrationChecker:
         :type args: argparse.Namespace
         :param reg_folder: path to reg output folder (reg_final/)
         :type reg_folder: Path
+        :param cache: stage cache of the subject; if registration has a record,
+            it decides instead of the checks on the file structure
+        :type cache: StageCache, optional
         :return: Whether or no registration needs to be re-run
         :rtype: bool
         """
@@ -950,6 +1256,15 @@ class RegistrationChecker:
             RegistrationChecker._clear_reg_folders(reg_folder)
             return True
 
+        cached = cache.is_valid("registration", args) if cache is not None else None
+        if cached is False:
+            print("  Registration inputs or parameters changed...")
+            RegistrationChecker._clear_reg_folders(reg_folder)
+            return True
+        elif cached and reg_folder.is_dir():
+            print("  Skipping registration (cached)...")
+            return False
+
         # check for reg_final/ and clar_allen_reg/
         if (
             not reg_folder.is_dir()
@@ -1042,6 +1357,7 @@ class SegmentationChecker:
     def check_segmentation(
         args: argparse.Namespace,
         seg_folder: Path,
+        cache: Optional["StageCache"] = None,
     ) -> bool:
         """Checks if segmentation needs to be run based on user input and the file structure.
         If the user wants to run seg (with the --rerun-segmentation flag), we run it.
@@ -1052,6 +1368,9 @@ class SegmentationChecker:
         :type args: argparse.Namespace
         :param seg_folder: path to seg output folder (seg_final/)
         :type seg_folder: Path
+        :param cache: stage cache of the subject; if segmentation has a record,
+            it decides instead of the checks on the file structure
+        :type cache: StageCache, optional
         :return: whether or not segmentation needs to be re-run
         :rtype: bool
         """
@@ -1060,6 +1379,24 @@ class SegmentationChecker:
             SegmentationChecker._clear_seg_folders(seg_folder)
             return True
 
+        # the chunked volume (-sacv) does not change the slices, so it is not part
+        # of the stage key, but segmentation is re-run if it was not saved
+        if seg_folder.is_dir() and SegmentationChecker._missing_chunked_volume(
+            args, seg_folder
+        ):
+            print("  Segmentation chunked volume missing...")
+            SegmentationChecker._clear_seg_folders(seg_folder)
+            return True
+
+        cached = cache.is_valid("segmentation", args) if cache is not None else None
+        if cached is False:
+            print("  Segmentation inputs or parameters changed...")
+            SegmentationChecker._clear_seg_folders(seg_folder)
+            return True
+        elif cached and seg_folder.is_dir():
+            print("  Skipping segmentation (cached)...")
+            return False
+
         # check for seg_final/
         if not seg_folder.is_dir():
             SegmentationChecker._clear_seg_folders(seg_folder)
@@ -1071,7 +1408,13 @@ class SegmentationChecker:
             return True
 
         # check if generated_patches is empty
-        if not sorted(seg_folder.glob("generated_patches/*.tiff")):  # doule check names
+        # (in streaming mode, patches are only saved for the instance segmentation)
+        patches_saved = (
+            not getattr(args, "sa_stream", False)
+            or not getattr(args, "no_instance_segmentation", False)
+            or getattr(args, "sa_keep_patches", False)
+        )
+        if patches_saved and not sorted(seg_folder.glob("generated_patches/*.tiff")):  # doule check names
             SegmentationChecker._clear_seg_folders(seg_folder)
             return True
 
@@ -1083,6 +1426,30 @@ class SegmentationChecker:
         print("  Skipping segmentation...")
         return False
 
+    @staticmethod
+    def _missing_chunked_volume(args: argparse.Namespace, seg_folder: Path) -> bool:
+        """Checks if the chunked volume of the segmentation is requested
+        (--sa_chunked_volume) but not saved next to the segmentation folder.
+
+        :param args: command line args from ACE parser
+        :type args: argparse.Namespace
+        :param seg_folder: path to seg output folder (seg_final/)
+        :type seg_folder: Path
+        :return: whether the chunked volume is missing
+        :rtype: bool
+        """
+        if not getattr(args, "sa_chunked_volume", False):
+            return False
+        slice_filter = StackTiffs.get_slice_filter(
+            getattr(args, "sa_monte_carlo", 0) > 0
+        )
+        return not any(
+            is_chunked_volume(path)
+            for path in seg_folder.parent.glob(
+                chunked_volume_path(seg_folder.name, slice_filter, wildcard=True)
+            )
+        )
+
     @staticmethod
     def _clear_seg_folders(seg_folder: Path):
         """Clears the results from the segmentation folder.
@@ -1113,6 +1480,7 @@ class InstanceSegmentationChecker:
     def check_instance_segmentation(
         args: argparse.Namespace,
         seg_folder: Path,
+        cache: Optional["StageCache"] = None,
     ) -> bool:
         """Checks if instance segmentation needs to be run based on user input and the file structure.
         If the user wants to run seg (with the --rerun-segmentation flag), we run it.
@@ -1123,6 +1491,9 @@ class InstanceSegmentationChecker:
         :type args: argparse.Namespace
         :param seg_folder: path to seg output folder (seg_final/)
         :type seg_folder: Path
+        :param cache: stage cache of the subject; if instance segmentation has
+            a record, it decides instead of the checks on the file structure
+        :type cache: StageCache, optional
         :return: whether or not instance segmentation needs to be re-run
         :rtype: bool
         """
@@ -1135,6 +1506,17 @@ class InstanceSegmentationChecker:
             InstanceSegmentationChecker._clear_instance_seg_folders(seg_folder)
             return True
 
+        cached = (
+            cache.is_valid("instance_segmentation", args) if cache is not None else None
+        )
+        if cached is False:
+            print("  Instance segmentation inputs or parameters changed...")
+            InstanceSegmentationChecker._clear_instance_seg_folders(seg_folder)
+            return True
+        elif cached and (seg_folder / "cc_slices").is_dir():
+            print("  Skipping instance segmentation (cached)...")
+            return False
+
         # check for seg_final/
         if not seg_folder.is_dir():
             InstanceSegmentationChecker._clear_instance_seg_folders(seg_folder)
@@ -1155,8 +1537,8 @@ class InstanceSegmentationChecker:
             InstanceSegmentationChecker._clear_instance_seg_folders(seg_folder)
             return True
         
-        # check for json in cc_patches
-        if not sorted(seg_folder.glob("generated_patches/cc_patches/*.json")):
+        # check for the neuron table in cc_patches
+        if not (seg_folder / "generated_patches" / "cc_patches" / "neuron_info_final.npz").is_file():
             InstanceSegmentationChecker._clear_instance_seg_folders(seg_folder)
             return True
         
@@ -1195,6 +1577,7 @@ class ConversionChecker:
     def check_conversion(
         args: argparse.Namespace,
         conv_folder: Path,
+        cache: Optional["StageCache"] = None,
     ) -> bool:
         """Checks if conversion needs to be run based on user input and the file structure.
         If the user wants to run conv (with the --rerun-conversion flag), we run it.
@@ -1205,6 +1588,9 @@ class ConversionChecker:
         :type args: argparse.Namespace
         :param conv_folder: path to conv output folder (conv_final/)
         :type conv_folder: Path
+        :param cache: stage cache of the subject; if conversion has a record,
+            it decides instead of the checks on the file structure
+        :type cache: StageCache, optional
         :return: whether or not conversion needs to be re-run
         :rtype: bool
         """
@@ -1213,6 +1599,15 @@ class ConversionChecker:
             ConversionChecker._clear_conv_folders(conv_folder)
             return True
 
+        cached = cache.is_valid("conversion", args) if cache is not None else None
+        if cached is False:
+            print("  Conversion inputs or parameters changed...")
+            ConversionChecker._clear_conv_folders(conv_folder)
+            return True
+        elif cached and conv_folder.is_dir():
+            print("  Skipping conversion (cached)...")
+            return False
+
         # check for conv_final/
         if not conv_folder.is_dir():
             ConversionChecker._clear_conv_folders(conv_folder)
@@ -1239,6 +1634,176 @@ class ConversionChecker:
         conv_folder.mkdir(parents=True, exist_ok=True)
 
 
+class StageCache:
+    """Class for caching the stages of the ACE flow for one subject.
+
+    Each stage is keyed by a hash of its input file manifest (paths, sizes and
+    mtimes of the raw tiff files), all of its parameters and the records of its
+    upstream stages. A changed stage therefore only invalidates its downstream
+    stages. The records are saved as a manifest JSON in the output folder.
+
+    :param output_folder: subject output folder the manifest is saved in
+    :type output_folder: str
+    """
+
+    MANIFEST_NAME = "ace_flow_stage_cache.json"
+
+    # stage: (parameter prefixes, extra parameters, upstream stages)
+    STAGES = {
+        "segmentation": (["sa_"], [], []),
+        "instance_segmentation": (
+            [],
+            ["sa_percentage_brain_patch_skip"],
+            ["segmentation"],
+        ),
+        "conversion": (["ctn_"], ["sa_resolution"], []),
+        "registration": (["rca_"], [], ["conversion"]),
+        "voxelization": (
+            ["rva_"],
+            ["sa_resolution", "sa_monte_carlo", "rca_voxel_size"],
+            ["segmentation"],
+        ),
+        "warping": (["rwc_"], ["rca_orient_code"], ["registration", "voxelization"]),
+    }
+
+    # stages reading the raw tiff files
+    RAW_INPUT_STAGES = ["segmentation", "conversion"]
+
+    # parameters that do not change the outputs of a stage (a missing chunked
+    # volume is checked by the `SegmentationChecker`)
+    IGNORED_PARAMS = [
+        "sa_output_folder",
+        "sa_gpu_index",
+        "sa_nr_workers",
+        "sa_cache_rate",
+        "sa_batch_size",
+        "sa_visualize_results",
+        "sa_cpu_threads",
+        "sa_cpu_compile",
+        "sa_benchmark",
+        "sa_stream",
+        "sa_keep_patches",
+        "sa_stacking_memory",
+        "sa_chunked_volume",
+        "rwc_input_folder",
+        "rwc_input_nii",
+        "rwc_seg_channel",
+    ]
+
+    def __init__(self, output_folder: str):
+        """Constructor method"""
+        self.manifest_file = Path(output_folder) / StageCache.MANIFEST_NAME
+        self.stages = {}
+        self._input_manifests = {}
+        if self.manifest_file.is_file():
+            try:
+                with open(self.manifest_file, "r") as f:
+                    self.stages = json.load(f)["stages"]
+            except (ValueError, KeyError):
+                logger.debug(f"Ignoring corrupt stage cache: {self.manifest_file}")
+
+    def is_valid(self, stage: str, args: argparse.Namespace) -> Optional[bool]:
+        """Checks the cached record of a stage against its current key.
+
+        :param stage: name of the stage (key of `StageCache.STAGES`)
+        :type stage: str
+        :param args: command line args from ACE parser
+        :type args: argparse.Namespace
+        :return: None if the stage has no record (e.g. outputs of an older
+            version), else whether the record matches the current key
+        :rtype: Optional[bool]
+        """
+        if stage not in self.stages:
+            return None
+        return self.stages[stage]["key"] == self.key(stage, args)
+
+    def record(self, stage: str, args: argparse.Namespace, ran: bool):
+        """Records a completed (or validly skipped) stage in the manifest.
+
+        A stage that was (re-)run gets a new record, which changes the key of
+        all of its downstream stages.
+
+        :param stage: name of the stage (key of `StageCache.STAGES`)
+        :type stage: str
+        :param args: command line args from ACE parser
+        :type args: argparse.Namespace
+        :param ran: whether the stage was (re-)run
+        :type ran: bool
+        """
+        key = self.key(stage, args)
+        if not ran and self.stages.get(stage, {}).get("key") == key:
+            return
+
+        self.stages[stage] = {
+            "key": key,
+            "finished": datetime.datetime.now().isoformat(),
+            "params": self.params(stage, args),
+            "inputs": self.inputs(stage, args),
+            "upstream": self.STAGES[stage][2],
+        }
+        tmp_file = self.manifest_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump({"stages": self.stages}, f, indent=2, default=str)
+        os.replace(tmp_file, self.manifest_file)
+
+    def key(self, stage: str, args: argparse.Namespace) -> str:
+        """Hash of the inputs, parameters and upstream records of a stage.
+
+        :param stage: name of the stage (key of `StageCache.STAGES`)
+        :type stage: str
+        :param args: command line args from ACE parser
+        :type args: argparse.Namespace
+        :return: hex digest of the stage key
+        :rtype: str
+        """
+        upstream = {
+            name: {
+                "key": self.stages.get(name, {}).get("key"),
+                "finished": self.stages.get(name, {}).get("finished"),
+            }
+            for name in self.STAGES[stage][2]
+        }
+        content = json.dumps(
+            {
+                "params": self.params(stage, args),
+                "inputs": self.inputs(stage, args),
+                "upstream": upstream,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def params(self, stage: str, args: argparse.Namespace) -> dict:
+        """Parameters of a stage from the command line args."""
+        prefixes, extra, _ = self.STAGES[stage]
+        return {
+            name: value
+            for name, value in sorted(vars(args).items())
+            if name not in self.IGNORED_PARAMS
+            and (name in extra or any(name.startswith(p) for p in prefixes))
+        }
+
+    def inputs(self, stage: str, args: argparse.Namespace) -> dict:
+        """Manifest (paths, sizes, mtimes) of the raw tiff files of a stage."""
+        if stage not in self.RAW_INPUT_STAGES:
+            return {}
+
+        folder = Path(args.single).absolute()
+        if folder not in self._input_manifests:
+            files = sorted(
+                (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+                for entry in os.scandir(folder)
+                if entry.is_file()
+            )
+            self._input_manifests[folder] = {
+                "path": folder.as_posix(),
+                "n_files": len(files),
+                "hash": hashlib.sha256(json.dumps(files).encode()).hexdigest(),
+            }
+        return self._input_manifests[folder]
+
+
 def main(args):
     segmentation = ACESegmentation()
     instance_segmentation = ACEInstanceSegmentation()
@@ -96,6 +96,7 @@ class ACEWorkflowParser:
         optional_args = parser.add_argument_group("optional arguments")
         stats_args = parser.add_argument_group("optional statistics arguments")
         validate_clusters_args = parser.add_argument_group("optional validate clusters arguments")
+        sched_args = parser.add_argument_group("optional subject scheduling arguments")
 
         # INFO: ACE main parser
 
@@ -321,6 +322,78 @@ class ACEWorkflowParser:
             default=0.0,
             help="percentage threshold of patch that is brain to skip during segmentation (type: %(type)s between 0 and 100; default: %(default)s)",
         )
+        # Parser for inference device
+        seg_args.add_argument(
+            "-sad",
+            "--sa_device",
+            type=str,
+            choices=["gpu", "cpu"],
+            required=False,
+            default="gpu",
+            help="device used for inference (default: %(default)s)",
+        )
+        # Parser for number of cpu threads
+        seg_args.add_argument(
+            "-sact",
+            "--sa_cpu_threads",
+            type=int,
+            required=False,
+            default=None,
+            help="number of torch threads for cpu inference (type: %(type)s; default: all available cores)",
+        )
+        # Parser for cpu precision
+        seg_args.add_argument(
+            "-sacp",
+            "--sa_cpu_precision",
+            type=str,
+            choices=["fp32", "bf16", "int8"],
+            required=False,
+            default="fp32",
+            help="precision for cpu inference; int8 dynamically quantizes linear layers (default: %(default)s)",
+        )
+        # Parser for cpu model compilation
+        seg_args.add_argument(
+            "-sacm",
+            "--sa_cpu_compile",
+            type=str,
+            choices=["none", "trace", "compile"],
+            required=False,
+            default="none",
+            help="TorchScript trace or torch.compile the model for cpu inference (default: %(default)s)",
+        )
+        # Parser for streaming mode
+        seg_args.add_argument(
+            "-sastr",
+            "--sa_stream",
+            action="store_true",
+            default=False,
+            help="read, segment and stack the image slabs in a single streaming pass; the output patches are only saved for the instance segmentation (default: %(default)s)",
+        )
+        # Parser for keeping the patches in streaming mode
+        seg_args.add_argument(
+            "-sakp",
+            "--sa_keep_patches",
+            action="store_true",
+            default=False,
+            help="save the input and output patches to generated_patches/ in streaming mode, e.g. for debugging (default: %(default)s)",
+        )
+        # Parser for the memory used to stack the output patches
+        seg_args.add_argument(
+            "-sasm",
+            "--sa_stacking_memory",
+            type=float,
+            required=False,
+            default=8.0,
+            help="memory (GB) used to stack the output patches into slices (also the slabs held by --sa_stream); lower it on nodes with little RAM (type: %(type)s; default: %(default)s)",
+        )
+        # Parser for saving the outputs as chunked volumes
+        seg_args.add_argument(
+            "-sacv",
+            "--sa_chunked_volume",
+            action="store_true",
+            default=False,
+            help="also save the output slices as chunked multi-resolution volumes (seg_final_<output>.zarr) (default: %(default)s)",
+        )
 
         # INFO: Conversion parser
 
@@ -423,6 +496,14 @@ class ACEWorkflowParser:
             default=0.01,
             help="Percentile threshold for intensity correction (default: %(default)s)",
         )
+        conv_args.add_argument(
+            "-ctnst",
+            "--ctn_stream",
+            type=int,
+            metavar="",
+            default=0,
+            help="Streaming conversion with bounded memory (z down-sampling by block averaging), binary argument, (default: %(default)s) => no",
+        )
 
         # INFO: Registration parser
 
@@ -537,6 +618,14 @@ class ACEWorkflowParser:
             type=float,
             help="voxel size (z dim) in um (default: %(default)s)",
         )
+        vox_args.add_argument(
+            "-rvam",
+            "--rva_mode",
+            type=str,
+            default="peaks",
+            choices=["peaks", "voxels", "cells"],
+            help="voxelization mode: peaks of the convolved segmentation detected slice by slice, number of segmented voxels or exact number of cells (3D connected components) in each voxel (default: %(default)s)",
+        )
 
         # vox_args.add_argument(
         #     "-rvas",
@@ -653,6 +742,33 @@ class ACEWorkflowParser:
             default=95,
         )
 
+        # INFO: Subject scheduling parser (comparison workflow)
+
+        sched_args.add_argument(
+            "-pss",
+            "--ps_subjects",
+            type=int,
+            help="number of subjects processed in parallel; each subject logs to "
+            "'ace_flow_subject.log' in its output folder (type: %(type)s; default: %(default)s)",
+            default=1,
+        )
+        sched_args.add_argument(
+            "-psg",
+            "--ps_segmentation",
+            type=int,
+            help="max number of subjects segmented at the same time on the gpu/cpu "
+            "(type: %(type)s; default: %(default)s)",
+            default=1,
+        )
+        sched_args.add_argument(
+            "-psr",
+            "--ps_registration",
+            type=int,
+            help="max number of subjects registered at the same time "
+            "(type: %(type)s; default: same as -pss)",
+            default=None,
+        )
+
         # INFO: Corrlation parser
 
         corr_args.add_argument(
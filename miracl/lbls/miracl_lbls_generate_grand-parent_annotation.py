@@ -5,7 +5,6 @@
 
 import argparse
 import os
-import re
 import sys
 from datetime import datetime
 from os.path import basename
@@ -13,9 +12,10 @@ from subprocess import call
 
 import nibabel as nib
 import numpy as np
-import pandas as pd
 
 from miracl.utilfn.depends_manager import add_paths
+from miracl.lbls.miracl_lbls_generate_parents_at_depth import getlblparents, relabel
+from miracl.lbls.miracl_lbls_ontology import load_ontology
 
 
 # ---------
@@ -88,37 +88,13 @@ def getalllbls(data):
     return lbls
 
 
-def getlblparent(clarinfo, lbls, pl, parentdata, lblsplit, maxannotlbl):
-    for l in range(len(lbls)):
+def getlblparent(ontology, lbls, pl, parentdata, lblsplit, maxannotlbl):
+    # parent of every ontology label at the parent level
+    ids, parents = getlblparents(ontology, pl, lblsplit, maxannotlbl)
 
-        lbl = lbls[l]
-
-        # path id
-        path = clarinfo.structure_id_path[clarinfo.id == lbl]
-
-        # remove /
-        numpath = re.sub("[/]", ' ', str(path))
-
-        # get digits
-        digpath = [int(s) for s in numpath.split() if s.isdigit()]
-        digpath = digpath[1:]  # drop 1st index
-
-        # get parent
-        if len(path) == 0:
-            parent = lbl
-        elif len(digpath) < pl:
-            parent = digpath[0]
-        else:
-            parent = digpath[-pl]
-
-        # if np.max(lbls) > lblsplit:
-        parent = parent + lblsplit if lbl > maxannotlbl else parent
-
-        sys.stdout.write("\r processing label: %d ... its grand-parent label: %d " % (lbl, parent))
-        sys.stdout.flush()
-
-        # replace val
-        parentdata[parentdata == lbl] = parent
+    # replace vals of the annotation lbls
+    inlbls = np.isin(ids, lbls)
+    parentdata = relabel(parentdata, ids[inlbls], parents[inlbls])
 
     return parentdata
 
@@ -158,17 +134,14 @@ def main(args):
     # load structure graph
     print("Reading ARA ontology structure_graph")
     arastrctcsv = "%s/atlases/ara/ara_mouse_structure_graph_hemi_split.csv" % miracl_home
-    aragraph = pd.read_csv(arastrctcsv)
+    aragraph = load_ontology(csv=arastrctcsv)
 
     # get lbls
     lbls = getalllbls(data)
 
-    # loop over intensities
-    parentdata = np.copy(data)
-
     print("Computing parent labels at parent-level/generation %d" % pl)
 
-    parentdata = getlblparent(aragraph, lbls, pl, parentdata, lblsplit, maxannotlbl)
+    parentdata = getlblparent(aragraph, lbls, pl, data, lblsplit, maxannotlbl)
 
     vx = img.header.get_zooms()[0]
     orgname = basename(nii).split('.')[0]
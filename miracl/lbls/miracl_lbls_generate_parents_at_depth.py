@@ -5,7 +5,6 @@
 
 import argparse
 import os
-import re
 import sys
 from datetime import datetime
 from os.path import basename
@@ -13,10 +12,10 @@ from subprocess import call
 
 import nibabel as nib
 import numpy as np
-import pandas as pd
 
 from miracl.utilfn.depends_manager import add_paths
 from miracl import ATLAS_DIR
+from miracl.lbls.miracl_lbls_ontology import load_ontology
 
 # ---------
 # help fn
@@ -107,24 +106,9 @@ def getalllbls(data):
     return lbls
 
 
-def getlblparent(clarinfo, lbl, pl, lblsplit, maxannotlbl):
-    # path id
-    path = clarinfo.structure_id_path[clarinfo.id == lbl]
-
-    # remove /
-    numpath = re.sub("[/]", ' ', str(path))
-
-    # get digits
-    digpath = [int(s) for s in numpath.split() if s.isdigit()]
-    digpath = digpath[1:]  # drop 1st index
-
-    # get parent
-    if len(path) == 0:
-        parent = lbl
-    elif len(digpath) < pl:
-        parent = digpath[0]
-    else:
-        parent = digpath[-pl]
+def getlblparent(ontology, lbl, pl, lblsplit, maxannotlbl):
+    # get parent (pl levels up the path id)
+    parent = int(ontology.ancestor_at_level(lbl, pl))
 
     # if np.max(lbls) > lblsplit:
     parent = parent + lblsplit if lbl > maxannotlbl else parent
@@ -132,18 +116,41 @@ def getlblparent(clarinfo, lbl, pl, lblsplit, maxannotlbl):
     return parent
 
 
-# get all labels past depth
-def getpastlabelsdepth(clarinfo, alllbls, chosendepth, lblsplit, maxannotlbl):
-    pastparents = {}
+def getlblparents(ontology, pl, lblsplit, maxannotlbl):
+    '''
+    Parents of all the ontology labels (vectorized getlblparent): the id pl
+    levels up the structure id path of each label (pl: int or one level per label)
+
+    Returns the label ids and their parents
+    '''
+    ids = ontology.ids
+    parents = ontology.ancestor_at_level(ids, pl)
+
+    parents = np.where(ids > maxannotlbl, parents + lblsplit, parents)
 
-    for l, lbl in enumerate(alllbls):
+    return ids, parents
 
-        lbldepth = clarinfo.depth[clarinfo.id == lbl].values
-        if lbldepth > chosendepth:
-            depthdiff = int(lbldepth - chosendepth) + 1
-            pastparents[lbl] = getlblparent(clarinfo, lbl, depthdiff, lblsplit, maxannotlbl)
 
-    return pastparents
+def getparentlut(ontology, chosendepth, lblsplit, maxannotlbl):
+    '''
+    Lookup table of the parents at the chosen depth: labels past the depth are
+    mapped to their parent at the depth, other labels to themselves
+
+    Returns the label ids and their parents
+    '''
+    ids = ontology.ids
+    parents = ontology.ancestor_at_depth(ids, chosendepth)
+    parents = np.where(ids > maxannotlbl, parents + lblsplit, parents)
+
+    return ids, np.where(ontology.depths > chosendepth, parents, ids)
+
+
+# get all labels past depth
+def getpastlabelsdepth(ontology, alllbls, chosendepth, lblsplit, maxannotlbl):
+    ids, parents = getparentlut(ontology, chosendepth, lblsplit, maxannotlbl)
+    past = np.isin(ids, alllbls) & (ontology.depths > chosendepth)
+
+    return dict(zip(ids[past], parents[past]))
 
 
 # replace vals
@@ -153,6 +160,41 @@ def replacechildren(data, parentdata, pastlbl, pastparent):
     return parentdata
 
 
+def relabel(data, ids, values, fill=None, dtype=None, slab=64):
+    '''
+    Remaps the labels of data with a lookup table in one pass: voxels labelled
+    ids[i] get values[i] (the last one for repeated ids), other voxels keep
+    their label (or get fill if given)
+
+    The table is indexed by the (sparse) unique labels of data and applied by
+    slabs of the first axis
+
+    Returns the relabelled copy of data (of type dtype, default: data.dtype)
+    '''
+    data = np.asanyarray(data)
+    ids = np.asarray(ids).ravel()
+    values = np.asarray(values).ravel()
+    dtype = data.dtype if dtype is None else dtype
+
+    # last value of each id
+    uids, last = np.unique(ids[::-1], return_index=True)
+    uvalues = values[::-1][last]
+
+    # lookup table of the labels of data (positive labels only)
+    lbls = np.unique(data)
+    lut = lbls.astype(dtype) if fill is None else np.full(lbls.shape, fill, dtype=dtype)
+    if len(uids):
+        pos = np.searchsorted(uids, lbls).clip(max=len(uids) - 1)
+        found = (uids[pos] == lbls) & (lbls > 0)
+        lut[found] = uvalues[pos[found]]
+
+    out = np.empty(data.shape, dtype=dtype)
+    for z0 in range(0, out.shape[0], slab):
+        out[z0:z0 + slab] = lut[np.searchsorted(lbls, data[z0:z0 + slab])]
+
+    return out
+
+
 def saveniiparents(parentdata, vx, outnii):
     # save parent data as nifti
     mat = np.eye(4) * vx
@@ -186,21 +228,12 @@ def get_parent_data(depth, inlbls='Allen', hemi='combined', res=25):
 
     # load structure graph
     print("Reading ARA ontology structure_graph")
-    arastrctcsv = "%s/ara/ara_mouse_structure_graph_hemi_split.csv" % ATLAS_DIR
-    aragraph = pd.read_csv(arastrctcsv)
-
-    # get lbls
-    lbls = getalllbls(data)
-
-    # loop over intensities
-    parentdata = np.copy(data)
+    aragraph = load_ontology("split")
 
     print("Computing parent labels at depth %d" % depth)
 
-    pastparents = getpastlabelsdepth(aragraph, lbls, depth, lblsplit, maxannotlbl)
-
-    for pastlbl, pastparent in pastparents.items():
-        replacechildren(data, parentdata, pastlbl, pastparent)
+    ids, parents = getparentlut(aragraph, depth, lblsplit, maxannotlbl)
+    parentdata = relabel(data, ids, parents)
 
     return parentdata
 
@@ -231,21 +264,12 @@ def main(args):
 
     # load structure graph
     print("Reading ARA ontology structure_graph")
-    arastrctcsv = "%s/ara/ara_mouse_structure_graph_hemi_split.csv" % ATLAS_DIR
-    aragraph = pd.read_csv(arastrctcsv)
-
-    # get lbls
-    lbls = getalllbls(data)
-
-    # loop over intensities
-    parentdata = np.copy(data)
+    aragraph = load_ontology("split")
 
     print("Computing parent labels at depth %d" % d)
 
-    pastparents = getpastlabelsdepth(aragraph, lbls, d, lblsplit, maxannotlbl)
-
-    for pastlbl, pastparent in pastparents.items():
-        replacechildren(data, parentdata, pastlbl, pastparent)
+    ids, parents = getparentlut(aragraph, d, lblsplit, maxannotlbl)
+    parentdata = relabel(data, ids, parents)
 
     vx = img.header.get_zooms()[0]
     orgname = basename(nii).split('.')[0]
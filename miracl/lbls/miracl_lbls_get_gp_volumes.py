@@ -5,13 +5,13 @@
 
 import argparse
 import os
-import re
 import sys
 from datetime import datetime
 import nibabel as nib
 import numpy as np
 import pandas as pd
 
+from miracl.lbls.miracl_lbls_ontology import load_ontology
 from miracl.utilfn import miracl_utilfn_endstatement as endstatement
 
 # ---------
@@ -73,39 +73,19 @@ def parse_inputs(parser, args):
 
 
 def getalllbls(data):
-    # get unique lblsfsl
-    lbls = np.unique(list(data))
-    lbls = lbls[lbls > 0]  # discard negative lbls
+    # get unique lbls and their volumes (# of voxels)
+    lbls, counts = np.unique(data, return_counts=True)
+    pos = lbls > 0  # discard negative lbls
 
-    return lbls
+    return lbls[pos], counts[pos]
 
 
-# get lbl volume if has chosenid as parent
-def getlblvolume(atlasinfo, flatdata, inlblid, imglbl):
-    # path id
-    path = atlasinfo.structure_id_path[atlasinfo.id == imglbl]
-
-    # remove /
-    numpath = re.sub("[/]", ' ', str(path))
-
-    # get digits
-    digpath = [int(s) for s in numpath.split() if s.isdigit()]
-    digpath = digpath[1:]  # drop 1st index
-
-    return np.count_nonzero(flatdata == imglbl) if inlblid in digpath else 0
-
-
-def computevolumes(aragraph, dataflat, inlbl, imglbls, metric):
-    volumes = []
+def computevolumes(aragraph, lblcounts, inlbl, imglbls, metric):
     # lbl id
-    inlblid = aragraph.id[aragraph['%s' % metric] == inlbl].values[0]
-
-    # loop over labels
-    for l, imglbl in enumerate(imglbls):
-        volume = getlblvolume(aragraph, dataflat, inlblid, imglbl)
-        volumes.append(volume)
+    inlblid = aragraph.id_of(inlbl, metric)
 
-    return sum(volumes)
+    # sum volumes of lbls that have chosenid in their path
+    return int(lblcounts[aragraph.is_descendant(imglbls, inlblid)].sum())
 
 
 def main(args):
@@ -123,19 +103,16 @@ def main(args):
     print("Reading ARA ontology structure_graph")
     miracl_home = os.environ['MIRACL_HOME']
     arastrctcsv = "%s/atlases/ara/ara_mouse_structure_graph_hemi_combined.csv" % miracl_home
-    aragraph = pd.read_csv(arastrctcsv)
+    aragraph = load_ontology(csv=arastrctcsv)
 
     # get lbls
-    imglbls = getalllbls(data)
-
-    # flatten
-    dataflat = data.flatten()
+    imglbls, lblcounts = getalllbls(data)
 
     lblvols = []
 
     print("Computing volumes for input labels...")
     for i, inlbl in enumerate(inlbls):
-        vol = computevolumes(aragraph, dataflat, inlbl, imglbls, metric)
+        vol = computevolumes(aragraph, lblcounts, inlbl, imglbls, metric)
         lblvols.append(vol)
 
     df = pd.DataFrame([inlbls, lblvols])
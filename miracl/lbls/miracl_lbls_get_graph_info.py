@@ -9,7 +9,7 @@ import sys
 import numpy as np
 import pandas as pd
 
-from miracl import ATLAS_DIR
+from miracl.lbls.miracl_lbls_ontology import load_ontology, ontology_csv
 
 
 # from IPython.display import HTML, display
@@ -46,24 +46,16 @@ def get_lbl_info(lbl):
     ''' Given lbl, which is either an acronym, or a fully titled region in the Allen atlas, return a series of information
     about the region. 
     '''
-    # read graph
-    arastrctcsv = "%s/ara/ara_mouse_structure_graph_hemi_combined.csv" % ATLAS_DIR
-    aragraph = pd.read_csv(arastrctcsv)
+    # read graph (once per process)
+    arastrctcsv = ontology_csv("combined")
+    aragraph = load_ontology(csv=arastrctcsv)
 
     try:  # get the data from the atlas, exit if the label doesnt match
-        if isinstance(lbl, int) and int(lbl) in aragraph.id.values:
-            lblinfo = aragraph[aragraph.id == int(lbl)]
-        elif lbl in aragraph.name.values:
-            lblinfo = aragraph[aragraph.name == lbl]
-        elif lbl in aragraph.acronym.values:
-            lblinfo = aragraph[aragraph.acronym == lbl]
-        else:
-            raise ValueError('Error: {} is not a label id, label name, OR label acronym. Please consult {} to see possible values\n'.format(lbl, arastrctcsv))
-    except Exception as e:
-        exit(e)
-        #exit('Could not complete request.')
+        lblinfo = aragraph.info(lbl)
+    except KeyError:
+        exit('Error: {} is not a label id, label name, OR label acronym. Please consult {} to see possible values\n'.format(lbl, arastrctcsv))
 
-    return lblinfo.to_dict(orient='list')
+    return lblinfo
 
 
 
@@ -72,21 +64,16 @@ def main(args):
     lbl = parse_inputs(parser, args)
 
     # read graph
-    arastrctcsv = "%s/ara/ara_mouse_structure_graph_hemi_combined.csv" % ATLAS_DIR
-    aragraph = pd.read_csv(arastrctcsv)
+    arastrctcsv = ontology_csv("combined")
+    aragraph = load_ontology(csv=arastrctcsv)
+
+    # label ids are given as strings on the command line
+    lbl = int(lbl) if isinstance(lbl, str) and lbl.isdigit() and int(lbl) in aragraph else lbl
 
     try:  # get the data from the atlas, exit if the label doesnt match
-        if isinstance(lbl, int) and int(lbl) in aragraph.id.values:
-            lblinfo = aragraph[aragraph.id == int(lbl)]
-        elif lbl in aragraph.name.values:
-            lblinfo = aragraph[aragraph.name == lbl]
-        elif lbl in aragraph.acronym.values:
-            lblinfo = aragraph[aragraph.acronym == lbl]
-        else:
-            raise ValueError('Error: {} is not a label id, label name, OR label acronym. Please consult {} to see possible values\n'.format(lbl, arastrctcsv))
-    except Exception as e:
-        exit(e)
-        #exit('Could not complete request.')
+        lblinfo = pd.DataFrame(aragraph.info(lbl))
+    except KeyError:
+        exit('Error: {} is not a label id, label name, OR label acronym. Please consult {} to see possible values\n'.format(lbl, arastrctcsv))
 
     # print
     # print(lblinfo.to_string(index=False))
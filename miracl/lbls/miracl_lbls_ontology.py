@@ -0,0 +1,347 @@
+"""
+Indexed Allen atlas ontology (ara_mouse_structure_graph_hemi_*.csv)
+
+The structure graph is read once per process and cached next to the csv in a
+binary sidecar (<csv>.npz, rebuilt when the csv changes). Lookups by id,
+acronym or name are O(1), structure id paths are pre-parsed into an
+(labels x depth) ancestor matrix and queries accept numpy arrays of ids:
+
+    ontology = load_ontology("combined")
+    ontology.id_of("CP")                       # id of an acronym or name
+    ontology.name(lbls, default="unknown")     # names of an array of ids
+    ontology.depth(lbls), ontology.parent(lbls)
+    ontology.path(672)                         # ancestors from the root to 672
+    ontology.ancestor_at_depth(lbls, 6)        # parents of lbls at depth 6
+    ontology.is_descendant(lbls, 477)          # lbls within striatum
+    ontology.df                                # the graph as a DataFrame
+"""
+
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from miracl import ATLAS_DIR
+
+ONTOLOGY_CSV = "ara_mouse_structure_graph_hemi_%s.csv"
+SIDECAR_SUFFIX = ".npz"
+SIDECAR_VERSION = 2
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+class StaleSidecarError(ValueError):
+    """
+    The binary sidecar was written for another version of the csv
+    """
+
+
+def ontology_csv(hemi="combined"):
+    """
+    Path of the structure graph csv of the atlas (hemi: combined or split)
+    """
+    return os.path.join(ATLAS_DIR, "ara", ONTOLOGY_CSV % hemi)
+
+
+def parse_paths(paths):
+    """
+    Parses structure id paths (e.g. /997/8/567/) into a matrix of ids padded
+    with 0 (one row per path, root first) and the path lengths
+    """
+    paths = [[int(p) for p in str(path).split("/") if p] if pd.notna(path) else [] for path in paths]
+    pathlens = np.array([len(path) for path in paths], dtype=np.int64)
+    pathmat = np.zeros((len(paths), max(pathlens.max(initial=0), 1)), dtype=np.int64)
+    for i, path in enumerate(paths):
+        pathmat[i, :len(path)] = path
+
+    return pathmat, pathlens
+
+
+class Ontology:
+    """
+    Allen ontology structure graph indexed by label id, acronym and name
+
+    Vectorized queries take an id or an array of ids and return a value or an
+    array of the same shape; ids missing from the ontology get the default
+    value (or raise a KeyError if there is none)
+
+    :param df: structure graph (id, name, acronym, parent_structure_id,
+        structure_id_path, depth, ...)
+    :param pathmat: pre-parsed ancestor matrix (see parse_paths)
+    :param pathlens: path lengths
+    """
+
+    def __init__(self, df, pathmat=None, pathlens=None):
+        self._df = df.reset_index(drop=True)
+        if pathmat is None:
+            pathmat, pathlens = parse_paths(self._df.structure_id_path)
+        self.pathmat, self.pathlens = pathmat, pathlens
+
+        self.ids = self._df.id.values.astype(np.int64)
+        self.depths = self._df.depth.values.astype(np.int64)
+        parents = self._df.parent_structure_id
+        self.parents = parents.fillna(-1).values.astype(np.int64)
+
+        # sorted ids for vectorized lookups, dicts for scalar ones
+        self._order = np.argsort(self.ids, kind="stable")
+        self._sorted_ids = self.ids[self._order]
+        self._rows = {lbl: row for row, lbl in enumerate(self.ids.tolist())}
+        self._keys = {}
+        for column in ("name", "acronym"):
+            keys = self._keys[column] = {}
+            for row, key in enumerate(self._df[column].tolist()):
+                keys.setdefault(key, row)
+        self._mappings = {}
+
+    # --- construction / cache ---
+
+    @classmethod
+    def from_csv(cls, csv, sidecar=True):
+        """
+        Reads the ontology from its csv, through the binary sidecar if it is up
+        to date (the sidecar is written if possible when it is not)
+        """
+        stat = os.stat(csv)
+        npz = str(csv) + SIDECAR_SUFFIX
+        stamp = np.array([SIDECAR_VERSION, stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+        if sidecar and os.path.isfile(npz):
+            try:
+                return cls.from_npz(npz, stamp)
+            except (OSError, StaleSidecarError):
+                pass  # stale or unreadable sidecar: rebuilt from the csv
+
+        ontology = cls(pd.read_csv(csv))
+        if sidecar:
+            try:
+                ontology.to_npz(npz, stamp)
+            except OSError:
+                pass  # read-only atlas folder: cache in memory only
+
+        return ontology
+
+    @classmethod
+    def from_npz(cls, npz, stamp=None):
+        """
+        Reads an ontology sidecar (StaleSidecarError if its stamp does not match)
+        """
+        with np.load(npz, allow_pickle=False) as f:
+            if stamp is not None and not np.array_equal(f["_stamp"], stamp):
+                raise StaleSidecarError("Ontology sidecar %s is out of date" % npz)
+            columns = [str(c) for c in f["_columns"]]
+            df = pd.DataFrame({c: f["col_" + c] for c in columns})
+            for c in columns:
+                if "na_" + c in f:
+                    df[c] = df[c].mask(f["na_" + c])
+            return cls(df, f["_pathmat"], f["_pathlens"])
+
+    def to_npz(self, npz, stamp):
+        """
+        Writes the ontology columns and ancestor matrix to a binary sidecar
+        """
+        arrays = {"_stamp": stamp, "_columns": np.array(self._df.columns, dtype=str),
+                  "_pathmat": self.pathmat, "_pathlens": self.pathlens}
+        for c in self._df.columns:
+            col = self._df[c]
+            if col.dtype == object or pd.api.types.is_string_dtype(col.dtype):
+                # fixed-width unicode: object arrays would need pickling to be read back
+                arrays["na_" + c] = col.isna().to_numpy()
+                arrays["col_" + c] = col.fillna("").to_numpy(dtype=str)
+            else:
+                arrays["col_" + c] = col.to_numpy()
+
+        tmp = "%s.%d.tmp" % (npz, os.getpid())
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, npz)
+
+    # --- lookups ---
+
+    @property
+    def df(self):
+        """Copy of the structure graph as a DataFrame"""
+        return self._df.copy()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, lbl):
+        try:
+            self.row(lbl)
+        except KeyError:
+            return False
+        return True
+
+    def __repr__(self):
+        return "Ontology(%d labels, max depth %d)" % (len(self), self.depths.max(initial=0))
+
+    def row(self, lbl, column=None):
+        """
+        Row of a label id, name or acronym (KeyError if it is not in the ontology)
+
+        :param lbl: label id, name or acronym
+        :param column: only look up lbl in this column (name or acronym)
+        """
+        if column is None and isinstance(lbl, (int, np.integer)) and int(lbl) in self._rows:
+            return self._rows[int(lbl)]
+        for col in (column,) if column is not None else ("name", "acronym"):
+            if lbl in self._keys[col]:
+                return self._keys[col][lbl]
+        raise KeyError("%s is not a label id, label name, OR label acronym" % lbl)
+
+    def id_of(self, lbl, column=None):
+        """
+        Id of a label id, name or acronym (see row)
+        """
+        return int(self.ids[self.row(lbl, column)])
+
+    def info(self, lbl):
+        """
+        Row of a label as a dict of lists (column -> [value])
+        """
+        return self._df.iloc[[self.row(lbl)]].to_dict(orient="list")
+
+    def rows(self, lbls):
+        """
+        Rows of an array of ids (-1 for ids not in the ontology)
+        """
+        lbls = np.asarray(lbls)
+        pos = np.searchsorted(self._sorted_ids, lbls).clip(max=len(self.ids) - 1)
+        found = self._sorted_ids[pos] == lbls
+
+        return np.where(found, self._order[pos], -1)
+
+    def contains(self, lbls):
+        """
+        Whether each id of an array is in the ontology
+        """
+        return self.rows(lbls) >= 0
+
+    def column(self, column, lbls, default=None):
+        """
+        Values of a column for an id or an array of ids
+        """
+        values = self._df[column].to_numpy()
+        return self._take(values, lbls, default)
+
+    def mapping(self, column):
+        """
+        Dict id -> column value (cached)
+        """
+        if column not in self._mappings:
+            self._mappings[column] = dict(zip(self.ids.tolist(), self._df[column].tolist()))
+        return self._mappings[column]
+
+    def name(self, lbls, default=None):
+        return self._take(self._df.name.to_numpy(), lbls, default)
+
+    def acronym(self, lbls, default=None):
+        return self._take(self._df.acronym.to_numpy(), lbls, default)
+
+    def depth(self, lbls, default=None):
+        return self._take(self.depths, lbls, default)
+
+    def parent(self, lbls, default=None):
+        """
+        Parent ids (-1 for the root)
+        """
+        return self._take(self.parents, lbls, default)
+
+    def _take(self, values, lbls, default):
+        rows = self.rows(lbls)
+        missing = rows < 0
+        if np.any(missing):
+            if default is None:
+                raise KeyError("Labels not in the ontology: %s" % np.unique(np.asarray(lbls)[missing]))
+            out = np.where(missing, default, values[np.maximum(rows, 0)])
+        else:
+            # (object values of a single id are returned as is by numpy)
+            out = np.asarray(values[rows], dtype=values.dtype)
+
+        return out[()] if out.ndim == 0 else out
+
+    # --- ancestors / descendants ---
+
+    def path(self, lbl):
+        """
+        Ids from the root to the label (structure id path)
+        """
+        row = self.row(lbl)
+        return self.pathmat[row, :self.pathlens[row]].copy()
+
+    def ancestors(self, lbl):
+        """
+        Ancestor ids of a label, from its parent to the root
+        """
+        return self.path(lbl)[-2::-1]
+
+    def ancestor_at_level(self, lbls, level):
+        """
+        Ancestors `level` generations up the structure id path (level 1: the
+        label itself, 2: its parent, ...; the root if the path is shorter);
+        ids not in the ontology are returned unchanged
+
+        :param lbls: id or array of ids
+        :param level: level (int or array broadcastable to lbls)
+        """
+        lbls = np.asarray(lbls, dtype=np.int64)
+        rows = self.rows(lbls)
+        found = (rows >= 0) & (self.pathlens[np.maximum(rows, 0)] > 0)
+        pathlens = self.pathlens[np.maximum(rows, 0)]
+        level = np.broadcast_to(np.asarray(level, dtype=np.int64), lbls.shape)
+        col = np.where(pathlens < level, 0, pathlens - level)
+
+        out = np.where(found, self.pathmat[np.maximum(rows, 0), col], lbls)
+        return out[()] if out.ndim == 0 else out
+
+    def ancestor_at_depth(self, lbls, depth):
+        """
+        Ancestors at depth of the labels deeper than depth (other labels and
+        ids not in the ontology are returned unchanged)
+        """
+        lbls = np.asarray(lbls, dtype=np.int64)
+        lbldepths = self.depth(lbls, default=-1)
+        deeper = lbldepths > depth
+        out = np.where(deeper, self.ancestor_at_level(lbls, np.where(deeper, lbldepths - depth + 1, 1)), lbls)
+
+        return out[()] if out.ndim == 0 else out
+
+    def is_descendant(self, lbls, ancestor, inclusive=True):
+        """
+        Whether each label is a descendant of ancestor (an id, name or acronym)
+        """
+        anc = self.id_of(ancestor)
+        lbls = np.asarray(lbls, dtype=np.int64)
+        rows = self.rows(lbls)
+        out = (rows >= 0) & np.any(self.pathmat[np.maximum(rows, 0)] == anc, axis=-1)
+        if not inclusive:
+            out &= lbls != anc
+
+        return out[()] if out.ndim == 0 else out
+
+    def descendants(self, ancestor, inclusive=True):
+        """
+        Ids of the descendants of ancestor (an id, name or acronym)
+        """
+        return self.ids[self.is_descendant(self.ids, ancestor, inclusive)]
+
+
+def load_ontology(hemi="combined", csv=None, sidecar=True):
+    """
+    Ontology of the atlas structure graph csv (default: the ARA graph of hemi),
+    read once per process (until the csv changes)
+
+    :param hemi: combined or split
+    :param csv: structure graph csv (overrides hemi)
+    :param sidecar: read / write the binary sidecar next to the csv
+    """
+    csv = os.path.abspath(str(csv if csv is not None else ontology_csv(hemi)))
+    stat = os.stat(csv)
+    key = (csv, stat.st_mtime_ns, stat.st_size)
+
+    with _cache_lock:
+        if key not in _cache:
+            _cache[key] = Ontology.from_csv(csv, sidecar)
+        return _cache[key]
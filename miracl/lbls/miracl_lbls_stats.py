@@ -7,16 +7,16 @@ import argparse
 import os
 import subprocess
 import sys
-import scipy as sp
 import numpy as np
 import pandas as pd
 from PyQt5.QtWidgets import QApplication
 from miracl.conv import miracl_conv_gui_options as gui_opts
 from miracl.utilfn.depends_manager import add_paths
+from miracl.lbls.miracl_lbls_ontology import load_ontology
+from miracl.utilfn.miracl_utilfn_resampled_labels import ResampledLabels
 
 import nibabel as nib
 
-from miracl import ATLAS_DIR
 
 def helpmsg():
     return '''Usage: miracl_lbls_stats.py 
@@ -139,70 +139,8 @@ def parse_inputs(parser, args):
 # ---------
 
 def upsampleswplbls(seg, lbls):
-    segx = seg.shape[1]
-    segy = seg.shape[2]
-    segz = seg.shape[0]
-
-    lblsx = lbls.shape[1]
-    lblsy = lbls.shape[2]
-    lblsz = lbls.shape[0]
-
-    if segx != lblsx:
-
-        if segx == lblsy:
-
-            print('Swapping x-y')
-            reslbls = np.swapaxes(lbls, 1, 2)
-
-        else:
-
-            if segx > lblsx:
-
-                print('Upsampling labels to clarity resolution')
-
-            else:
-
-                print('Downsampling labels to voxelized clarity resolution')
-
-            rx = float(segx) / lblsx
-            ry = float(segy) / lblsy
-            rz = float(segz) / lblsz
-
-            reslbls = sp.ndimage.zoom(lbls, (rz, rx, ry), order=0)
-
-            print('Segmentation shape:', seg.shape)
-
-            print('Resampled labels shape:', reslbls.shape)
-
-            resx = reslbls.shape[1]
-
-            if segx != resx:
-                print('Swapping x-y')
-                reslbls = np.swapaxes(reslbls, 1, 2)
-
-    else:
-
-        if segz != lblsz:
-
-            if segx > lblsx:
-
-                print('Upsampling labels to clarity resolution')
-
-            else:
-
-                print('Downsampling labels to voxelized clarity resolution')
-
-            rx = float(segx) / lblsx
-            ry = float(segy) / lblsy
-            rz = float(segz) / lblsz
-
-            reslbls = sp.ndimage.zoom(lbls, (rz, rx, ry), order=0)
-
-        else:
-
-            reslbls = lbls
-
-    return reslbls
+    # lazy view of the labels upsampled (or swapped) to the segmentation, read by slabs
+    return ResampledLabels(lbls, seg.shape)
 
 
 def get_count_stats(invol, lbls):
@@ -276,10 +214,7 @@ def main(args):
     out_stats = pd.read_csv('%s' % outfile)
 
     # read Allen ontology -- combined or split labels
-    if hemi == "combined":
-        annot_csv = pd.read_csv('%s/ara/ara_mouse_structure_graph_hemi_combined.csv' % ATLAS_DIR)
-    else:
-        annot_csv = pd.read_csv('%s/ara/ara_mouse_structure_graph_hemi_split.csv' % ATLAS_DIR)
+    annot_csv = load_ontology("combined" if hemi == "combined" else "split").df
 
     # extract labels at certain depth only
     if label_depth is not None:
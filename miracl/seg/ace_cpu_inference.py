@@ -0,0 +1,126 @@
+"""
+This code prepares the ACE models (unet, unetr, ensemble) for inference on CPU-only nodes
+
+The models are run with multi-threaded torch on channels-last 3D tensors and can
+optionally be:
+    converted to bfloat16 (bf16) or dynamically quantized to int8 (int8; nn.Linear layers)
+    traced with TorchScript (trace) or compiled with torch.compile (compile)
+
+It also provides a throughput benchmark (patches/sec) of the sliding window
+inference path used by ace_deploy_model, to size CPU clusters (or compare with GPU).
+"""
+# load libraries
+import os
+import time
+
+import numpy as np
+import torch
+from monai.inferers import sliding_window_inference
+
+CPU_PRECISIONS = ["fp32", "bf16", "int8"]
+CPU_COMPILE_MODES = ["none", "trace", "compile"]
+
+
+# -------------------------------------------------------
+# CPU set up
+# -------------------------------------------------------
+def configure_threads(num_threads=None):
+    """Set the number of intra-op torch threads (default: all available cores)"""
+    if not num_threads:
+        num_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    torch.set_num_threads(num_threads)
+    print(f"  CPU inference using {torch.get_num_threads()} threads")
+
+    return num_threads
+
+
+class CPUPredictor(torch.nn.Module):
+    """Feeds channels-last inputs in the model dtype and returns float32 outputs"""
+
+    def __init__(self, model, dtype):
+        super().__init__()
+        self.model = model
+        self.dtype = dtype
+
+    def forward(self, x):
+        x = x.to(self.dtype).contiguous(memory_format=torch.channels_last_3d)
+        return self.model(x).float()
+
+
+def prepare_cpu_model(model, roi_size, sw_batch_size, precision="fp32", compile_mode="none"):
+    """
+    Returns a callable for sliding_window_inference running the (already loaded) model on CPU
+
+    :param model: model with its trained weights loaded
+    :param roi_size: sliding window size of the model
+    :param sw_batch_size: number of windows run through the model at once
+    :param precision: fp32, bf16 or int8 (dynamic quantization of the linear layers)
+    :param compile_mode: none, trace (TorchScript) or compile (torch.compile)
+    """
+    if precision not in CPU_PRECISIONS:
+        raise ValueError(f"CPU precision must be one of {CPU_PRECISIONS}, got: {precision}")
+    if compile_mode not in CPU_COMPILE_MODES:
+        raise ValueError(f"CPU compile mode must be one of {CPU_COMPILE_MODES}, got: {compile_mode}")
+
+    model = model.to(memory_format=torch.channels_last_3d)
+    dtype = torch.float32
+
+    if precision == "bf16":
+        model = model.to(torch.bfloat16)
+        dtype = torch.bfloat16
+    elif precision == "int8":
+        # only nn.Linear layers (e.g. unetr transformer blocks) are dynamically quantized
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    if compile_mode == "trace":
+        example = torch.zeros((sw_batch_size, 1, *roi_size), dtype=dtype)
+        example = example.contiguous(memory_format=torch.channels_last_3d)
+        with torch.no_grad():
+            model = torch.jit.trace(model, example, check_trace=False)
+    elif compile_mode == "compile":
+        if not hasattr(torch, "compile"):
+            raise ValueError("torch.compile requires PyTorch >= 2.0, use compile mode 'trace' instead")
+        model = torch.compile(model)
+
+    return CPUPredictor(model, dtype)
+
+
+# -------------------------------------------------------
+# throughput benchmark
+# -------------------------------------------------------
+def benchmark_throughput(
+    predictor, roi_size, sw_batch_size, patch_size=(512, 512, 512), n_patches=2, warmup=1, device="cpu"
+):
+    """
+    Times sliding_window_inference over random patches (same settings as ace_deploy_model)
+
+    returns: dict with patches/sec, windows/sec and sec/patch
+    """
+    n_windows = int(np.prod([np.ceil(p / r) for p, r in zip(patch_size, roi_size)]))
+    patch = torch.rand((1, 1, *patch_size), device=device)
+
+    with torch.no_grad():
+        for _ in range(warmup):
+            sliding_window_inference(patch, roi_size, sw_batch_size, predictor, 0.0)
+
+        if patch.is_cuda:
+            torch.cuda.synchronize(patch.device)
+        start = time.perf_counter()
+        for _ in range(n_patches):
+            sliding_window_inference(patch, roi_size, sw_batch_size, predictor, 0.0)
+        if patch.is_cuda:
+            torch.cuda.synchronize(patch.device)
+        elapsed = time.perf_counter() - start
+
+    results = {
+        "patches_per_sec": n_patches / elapsed,
+        "windows_per_sec": n_patches * n_windows / elapsed,
+        "sec_per_patch": elapsed / n_patches,
+    }
+    print(
+        f"  patch size {patch_size}, roi {roi_size}: {results['patches_per_sec']:.4f} patches/sec, "
+        f"{results['windows_per_sec']:.2f} windows/sec ({results['sec_per_patch']:.1f} sec/patch) "
+        f"on {device}"
+    )
+
+    return results
@@ -42,13 +42,16 @@ import yaml
 import tifffile
 
 # from prepare_model_transform import generate_model_transforms
-from miracl.seg import ace_prepare_model_transform
+from miracl.seg import ace_prepare_model_transform, ace_cpu_inference, miracl_seg_patch_manifest
 from pathlib import Path
 import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# image patch size (generate_patch.py zero pads all patches to this size)
+PATCH_SIZE = 512
+
 # def deploy_functions(chosen_model, patch_dir_var, monte_var):
 #     # Define global vars
 #     model_name = chosen_model
@@ -129,11 +132,80 @@ def save_tiff_MC_dropout(img_list, output_path, path, model_name):
         )
 
 
+# this class is used by the functions generating the model outputs to save the output of each patch
+# (the streaming pipeline in ace_stream_inference stacks them in memory instead)
+class TiffPatchSaver:
+    def save_tiff(self, img_list, output_path, path):
+        save_tiff(img_list, output_path, path)
+
+    def save_tiff_MC_dropout(self, img_list, output_path, path, model_name):
+        save_tiff_MC_dropout(img_list, output_path, path, model_name)
+
+
 # -------------------------------------------------------
 # functions for generating model output
 # -------------------------------------------------------
 
 
+# this function returns the callable used by sliding_window_inference
+# on CPU the model is wrapped for channels-last / bf16 / int8 / traced inference
+def get_predictor(model, roi_size, sw_batch_size, cpu_opts):
+    if cpu_opts is None:
+        return model
+    return ace_cpu_inference.prepare_cpu_model(model, roi_size, sw_batch_size, **cpu_opts)
+
+
+# this class runs several MC dropout passes of the model on each sliding window at once
+# the windows are repeated along the batch dimension (each replica gets its own dropout mask)
+# and the outputs of the replicas are returned as channels: (windows, replicas * classes, H, W, D)
+class ReplicatedPredictor:
+    def __init__(self, predictor, n_replicas):
+        self.predictor = predictor
+        self.n_replicas = n_replicas
+
+    def __call__(self, x):
+        outputs = self.predictor(x.repeat_interleave(self.n_replicas, dim=0))
+        return outputs.reshape(x.shape[0], self.n_replicas * outputs.shape[1], *outputs.shape[2:])
+
+
+# this function returns the mean (all classes) and the variance (foreground class 1) of the
+# model outputs over forward_passes MC dropout passes
+# up to sw_batch_size passes are run as a single sliding window sweep (the model still sees at
+# most sw_batch_size windows at once); the outputs are stitched on the cpu and the mean and
+# variance are accumulated online (Welford), so the outputs of all the passes are never stored
+def mc_dropout_statistics(val_inputs, roi_size, sw_batch_size, predictor, forward_passes):
+    passes_per_sweep = min(forward_passes, sw_batch_size)
+    count = 0
+    mean = None
+    m2 = None
+    while count < forward_passes:
+        n_replicas = min(passes_per_sweep, forward_passes - count)
+        val_outputs = sliding_window_inference(
+            val_inputs,
+            roi_size,
+            max(1, sw_batch_size // n_replicas),
+            ReplicatedPredictor(predictor, n_replicas),
+            0.0,
+            device="cpu",
+        )
+        # (batch, replicas * classes, H, W, D) -> (batch, replicas, classes, H, W, D)
+        val_outputs = val_outputs.reshape(
+            val_outputs.shape[0], n_replicas, -1, *val_outputs.shape[2:]
+        )
+        if mean is None:
+            mean = torch.zeros_like(val_outputs[:, 0])
+            m2 = torch.zeros_like(val_outputs[:, 0, 1])
+
+        for r in range(n_replicas):
+            count += 1
+            delta = val_outputs[:, r] - mean
+            mean += delta / count
+            m2 += delta[:, 1] * (val_outputs[:, r, 1] - mean[:, 1])
+        del val_outputs
+
+    return mean, m2 / count
+
+
 # this function generates outputs using the trained model
 def generate_output_single(
         model_name,
@@ -144,13 +216,16 @@ def generate_output_single(
         post_pred,
         cfg,
         device,
-        val_loader
+        val_loader,
+        cpu_opts=None,
+        saver=None,
     ):
+    saver = saver or TiffPatchSaver()
     def model_loader(model, trained_model_path):
         # move the models to gpu
         model.to(device)
         # load trained model
-        model.load_state_dict(torch.load(trained_model_path))
+        model.load_state_dict(torch.load(trained_model_path, map_location=device))
         # set model to eval mode
         model.eval()
         print("Trained model(s) are loaded!")
@@ -160,11 +235,13 @@ def generate_output_single(
         roi_size = (128, 128, 128)
         sw_batch_size = sw_batch_size_internal
         model_loader(model_out, cfg["general"].get("model_unet_trained_path"))
+        predictor = get_predictor(model_out, roi_size, sw_batch_size, cpu_opts)
     if model_name == "unetr":
         # definde crop size / what is used during training
         roi_size = (96, 96, 96)
         sw_batch_size = sw_batch_size_internal
         model_loader(model_out, cfg["general"].get("model_unetr_trained_path"))
+        predictor = get_predictor(model_out, roi_size, sw_batch_size, cpu_opts)
 
     with torch.no_grad():
         RI_subj_id = 1
@@ -174,14 +251,14 @@ def generate_output_single(
             val_inputs = (val_data["image"].to(device)).float()
 
             val_outputs = sliding_window_inference(
-                val_inputs, roi_size, sw_batch_size, model_out
+                val_inputs, roi_size, sw_batch_size, predictor
             )
             val_outputs = F.softmax(val_outputs, dim=1)[:,1:,...]
             val_outputs = [post_pred(z) for z in decollate_batch(val_outputs)]
             # save the images as .tiff file readable by Fiji
             for j in range(len(val_outputs)):
                 img_list = [val_outputs[j][1, :, :, :].detach().cpu()]
-                save_tiff(img_list, input_path, data_dicts_test[RI_subj_id - 1])
+                saver.save_tiff(img_list, input_path, data_dicts_test[RI_subj_id - 1])
                 RI_subj_id += 1
 
 
@@ -197,8 +274,11 @@ def generate_output_MC(
         post_pred,
         cfg,
         device,
-        val_loader
+        val_loader,
+        cpu_opts=None,
+        saver=None,
     ):
+    saver = saver or TiffPatchSaver()
     batch_size = batch_size_internal
 
     # number of forward pass
@@ -216,7 +296,7 @@ def generate_output_MC(
         # move the models to gpu
         model.to(device)
         # load trained model
-        model.load_state_dict(torch.load(trained_model_path))
+        model.load_state_dict(torch.load(trained_model_path, map_location=device))
         # set up the model
         model.eval()
         enable_dropout(model)
@@ -233,83 +313,39 @@ def generate_output_MC(
         sw_batch_size = sw_batch_size_internal
         model_loader(model_out, cfg["general"].get("model_unetr_trained_path"))
 
+    predictor = get_predictor(model_out, roi_size, sw_batch_size, cpu_opts)
+
     with torch.no_grad():
         RI_subj_id = 1
 
         for i, val_data in enumerate(val_loader):
             print("Data #", RI_subj_id, ", ", data_dicts_test[RI_subj_id - 1])
-            # val_outputs_list = []
-
-            # these are needed to calculate mean and var iteratively --> less memory needed
-            H, W, D = val_data["image"].shape[2], val_data["image"].shape[3], val_data["image"].shape[4]
-            sum_voxels = np.zeros((batch_size, 2, H, W, D))
-            sum_squared_voxels = np.zeros((batch_size, 2, H, W, D))
-
-            for f in range(forward_passes):
-                val_inputs = (val_data["image"].to(device)).float()
-
-                # check if the size of val_input is less than 512^3
-                sum_voxels = sum_voxels[
-                    :,
-                    :,
-                    : val_inputs.shape[2],
-                    : val_inputs.shape[3],
-                    : val_inputs.shape[4],
-                ]
-                sum_squared_voxels = sum_squared_voxels[
-                    :,
-                    :,
-                    : val_inputs.shape[2],
-                    : val_inputs.shape[3],
-                    : val_inputs.shape[4],
-                ]
-
-                val_outputs = sliding_window_inference(
-                    val_inputs, roi_size, sw_batch_size, model_out, 0.0
-                )
-
-                # val_outputs_list.append(val_outputs[0].detach().cpu())
-                for j in range(len(val_outputs)):
-                    sum_voxels[j] = np.add(sum_voxels[j], val_outputs[j].detach().cpu())
-                    sum_squared_voxels[j] = np.add(
-                        sum_squared_voxels[j], val_outputs[j].detach().cpu() ** 2
-                    )
-
-            # stack all the forward passes together
-            # use compute_variance function to calculate the uncertainty
-            # the should be [N, C, H, W, D] or [N, C, H, W] or [N, C, H] where N is repeats,
-            # C is channels and H, W, D stand for Height, Width & Depth
-
-            # val_outputs_stack = np.stack(val_outputs_list, axis=0)
+            val_inputs = (val_data["image"].to(device)).float()
 
-            # clear val_output_list for memory efficiency
-            # del val_outputs_list
+            # mean and variance of the forward passes, accumulated online --> less memory needed
+            mean_voxels, var_voxels = mc_dropout_statistics(
+                val_inputs, roi_size, sw_batch_size, predictor, forward_passes
+            )
 
             # calculate the uncertainty; channel 0 is background so, we don't want it
-            # uncertainty = np.var(val_outputs_stack, axis=0)[1, :, :, :]
-            for j in range(len(val_outputs)):
-                uncertainty = (
-                    sum_squared_voxels[j] / forward_passes
-                    - (sum_voxels[j] / forward_passes) ** 2
-                )
-                uncertainty = uncertainty[1, :, :, :]
+            for j in range(len(mean_voxels)):
+                uncertainty = var_voxels[j].detach().cpu().numpy()
 
                 # get the average of MC_dropout and send it to GPU for calculating the new dice score
-                # MC_outputs = torch.Tensor(np.mean(val_outputs_stack, axis=0)).to(device)
-                MC_outputs = torch.Tensor(sum_voxels[j] / forward_passes).to(device)
+                MC_outputs = mean_voxels[j].to(device)
 
                 # clear val_outputs_stack for memory efficiency
                 # del val_outputs_stack
-                MC_outputs = F.softmax(MC_outputs, dim=1)[:,1:,...]
+                MC_outputs = F.softmax(MC_outputs.unsqueeze(0), dim=1)[:,1:,...]
                 # prepare the MC outputs for calculating the metrics
                 MC_outputs = [
-                    post_pred(z) for z in decollate_batch(MC_outputs.unsqueeze(0))
+                    post_pred(z) for z in decollate_batch(MC_outputs)
                 ]
 
                 # save the images as .tiff file readable by Fiji
                 img_list = [uncertainty, MC_outputs[0][1, :, :, :].detach().cpu()]
 
-                save_tiff_MC_dropout(
+                saver.save_tiff_MC_dropout(
                     img_list,
                     input_path,
                     data_dicts_test[RI_subj_id - 1],
@@ -328,15 +364,18 @@ def generate_output_ensemble(
         post_pred,
         cfg,
         device,
-        val_loader
+        val_loader,
+        cpu_opts=None,
+        saver=None,
     ):
+    saver = saver or TiffPatchSaver()
     sw_batch_size = sw_batch_size_internal
 
     def model_loader(model, trained_model_path):
         # move the models to gpu
         model.to(device)
         # load trained model
-        model.load_state_dict(torch.load(trained_model_path))
+        model.load_state_dict(torch.load(trained_model_path, map_location=device))
         # set up the model
         model.eval()
 
@@ -344,11 +383,13 @@ def generate_output_ensemble(
     roi_size_unet = (128, 128, 128)
     model_unet = model_out[0]
     model_loader(model_unet, cfg["general"].get("model_unet_trained_path"))
+    model_unet = get_predictor(model_unet, roi_size_unet, sw_batch_size, cpu_opts)
 
     # model 2
     roi_size_unetr = (96, 96, 96)
     model_unetr = model_out[1]
     model_loader(model_unetr, cfg["general"].get("model_unetr_trained_path"))
+    model_unetr = get_predictor(model_unetr, roi_size_unetr, sw_batch_size, cpu_opts)
 
     with torch.no_grad():
         RI_subj_id = 1
@@ -385,7 +426,7 @@ def generate_output_ensemble(
 
                 # save the images as .tiff file readable by Fiji
                 img_list = [val_outputs[0][1, :, :, :].detach().cpu()]
-                save_tiff(img_list, input_path, data_dicts_test[RI_subj_id - 1])
+                saver.save_tiff(img_list, input_path, data_dicts_test[RI_subj_id - 1])
 
                 RI_subj_id += 1
 
@@ -401,8 +442,11 @@ def generate_output_ensemble_of_ensembles(
         post_pred,
         cfg,
         device,
-        val_loader
+        val_loader,
+        cpu_opts=None,
+        saver=None,
     ):
+    saver = saver or TiffPatchSaver()
     # number of forward pass
     # forward_passes = 5
     forward_passes = forward_passes_internal
@@ -421,7 +465,7 @@ def generate_output_ensemble_of_ensembles(
         # move the models to gpu
         model.to(device)
         # load trained model
-        model.load_state_dict(torch.load(trained_model_path))
+        model.load_state_dict(torch.load(trained_model_path, map_location=device))
         # set up the model
         model.eval()
         enable_dropout(model)
@@ -434,115 +478,34 @@ def generate_output_ensemble_of_ensembles(
     roi_size_unet = (128, 128, 128)
     model_unet = model_out[0]
     model_loader(model_unet, cfg["general"].get("model_unet_trained_path"))
+    model_unet = get_predictor(model_unet, roi_size_unet, sw_batch_size, cpu_opts)
 
     # model 2
     roi_size_unetr = (96, 96, 96)
     model_unetr = model_out[1]
     model_loader(model_unetr, cfg["general"].get("model_unetr_trained_path"))
+    model_unetr = get_predictor(model_unetr, roi_size_unetr, sw_batch_size, cpu_opts)
 
     with torch.no_grad():
         RI_subj_id = 1
         for i, val_data in enumerate(val_loader):
             print("Data #", RI_subj_id, ", ", data_dicts_test[RI_subj_id - 1])
-            # val_outputs_list1 = []
-            # val_outputs_list2 = []
-
-            # these are needed to calculate mean and var iteratively --> less memory needed
-            H, W, D = val_data["image"].shape[2], val_data["image"].shape[3], val_data["image"].shape[4]
-            sum_voxels1 = np.zeros((batch_size, 2, H, W, D))
-            sum_squared_voxels1 = np.zeros((batch_size, 2, H, W, D))
-            sum_voxels2 = np.zeros((batch_size, 2, H, W, D))
-            sum_squared_voxels2 = np.zeros((batch_size, 2, H, W, D))
-
-            for f in range(forward_passes):
-                val_inputs = (val_data["image"].to(device)).float()
-
-                # check if the size of val_input is less than 512^3
-                sum_voxels1 = sum_voxels1[
-                    :,
-                    :,
-                    : val_inputs.shape[2],
-                    : val_inputs.shape[3],
-                    : val_inputs.shape[4],
-                ]
-                sum_voxels2 = sum_voxels2[
-                    :,
-                    :,
-                    : val_inputs.shape[2],
-                    : val_inputs.shape[3],
-                    : val_inputs.shape[4],
-                ]
-                sum_squared_voxels1 = sum_squared_voxels1[
-                    :,
-                    :,
-                    : val_inputs.shape[2],
-                    : val_inputs.shape[3],
-                    : val_inputs.shape[4],
-                ]
-                sum_squared_voxels2 = sum_squared_voxels2[
-                    :,
-                    :,
-                    : val_inputs.shape[2],
-                    : val_inputs.shape[3],
-                    : val_inputs.shape[4],
-                ]
-
-                # move the model1 to gpu
-                # model_loader(model_unet, cfg['general'].get('model_unet_trained_path'))
-                val_outputs1 = sliding_window_inference(
-                    val_inputs, roi_size_unet, sw_batch_size, model_unet, 0.0
-                )
-                # move model1 to cpu
-                # model_move_cpu(model_unet)
+            val_inputs = (val_data["image"].to(device)).float()
 
-                # move the model2 to gpu
-                # model_loader(model_unetr, cfg['general'].get('model_unetr_trained_path'))
-                val_outputs2 = sliding_window_inference(
-                    val_inputs, roi_size_unetr, sw_batch_size, model_unetr, 0.0
-                )
-                # move model1 to cpu
-                # model_move_cpu(model_unetr)
-
-                # val_outputs_list1.append(val_outputs1[0].detach().cpu())
-                # val_outputs_list2.append(val_outputs2[0].detach().cpu())
-                for j in range(len(val_outputs1)):
-                    sum_voxels1[j] = np.add(
-                        sum_voxels1[j], val_outputs1[j].detach().cpu()
-                    )
-                    sum_voxels2[j] = np.add(
-                        sum_voxels2[j], val_outputs2[j].detach().cpu()
-                    )
-
-                    sum_squared_voxels1[j] = np.add(
-                        sum_squared_voxels1[j], val_outputs1[j].detach().cpu() ** 2
-                    )
-                    sum_squared_voxels2[j] = np.add(
-                        sum_squared_voxels2[j], val_outputs2[j].detach().cpu() ** 2
-                    )
-
-            # val_outputs_stack1 = np.stack(val_outputs_list1, axis=0)
-            # val_outputs_stack2 = np.stack(val_outputs_list2, axis=0)
-
-            # clear val_output_list for memory efficiency
-            # del val_outputs_list1
-            # del val_outputs_list2
+            # mean and variance of the forward passes of each model, accumulated online --> less memory needed
+            mean_voxels1, var_voxels1 = mc_dropout_statistics(
+                val_inputs, roi_size_unet, sw_batch_size, model_unet, forward_passes
+            )
+            mean_voxels2, var_voxels2 = mc_dropout_statistics(
+                val_inputs, roi_size_unetr, sw_batch_size, model_unetr, forward_passes
+            )
 
             # calculate the uncertainity of model1 and model2
             # then I get the mean of two uncertainty for the final uncertainty
             # calculate the uncertainty; channel 0 is background so, we don't want it
-            # uncertainty1 = np.var(val_outputs_stack1, axis=0)[1, :, :, :]
-            # uncertainty2 = np.var(val_outputs_stack2, axis=0)[1, :, :, :]
-            for j in range(len(val_outputs1)):
-                uncertainty1 = (
-                    sum_squared_voxels1[j] / forward_passes
-                    - (sum_voxels1[j] / forward_passes) ** 2
-                )
-                uncertainty1 = uncertainty1[1, :, :, :]
-                uncertainty2 = (
-                    sum_squared_voxels2[j] / forward_passes
-                    - (sum_voxels2[j] / forward_passes) ** 2
-                )
-                uncertainty2 = uncertainty2[1, :, :, :]
+            for j in range(len(mean_voxels1)):
+                uncertainty1 = var_voxels1[j].detach().cpu().numpy()
+                uncertainty2 = var_voxels2[j].detach().cpu().numpy()
 
                 uncertainty_stack = np.stack([uncertainty1, uncertainty2], axis=0)
                 uncertainty = np.mean(uncertainty_stack, axis=0)
@@ -552,8 +515,8 @@ def generate_output_ensemble_of_ensembles(
                 # MC_outputs1 = np.mean(val_outputs_stack1, axis=0)
                 # MC_outputs2 = np.mean(val_outputs_stack2, axis=0)
 
-                MC_outputs1 = torch.Tensor(sum_voxels1[j] / forward_passes).to(device)
-                MC_outputs2 = torch.Tensor(sum_voxels2[j] / forward_passes).to(device)
+                MC_outputs1 = mean_voxels1[j].to(device)
+                MC_outputs2 = mean_voxels2[j].to(device)
 
                 # clear val_outputs_stack for memory efficiency
                 # del val_outputs_stack1
@@ -562,15 +525,15 @@ def generate_output_ensemble_of_ensembles(
                 # save each model's output
                 # MC_outputs1_temp = torch.Tensor(MC_outputs1).to(device)
                 # prepare the MC outputs for calculating the metrics
-                MC_outputs1_temp = F.softmax(MC_outputs1, dim=1)[:,1:,...]
+                MC_outputs1_temp = F.softmax(MC_outputs1.unsqueeze(0), dim=1)[:,1:,...]
                 MC_outputs1_temp = [
-                    post_pred(z) for z in decollate_batch(MC_outputs1.unsqueeze(0))
+                    post_pred(z) for z in decollate_batch(MC_outputs1_temp)
                 ]
                 # MC_outputs2_temp = torch.Tensor(MC_outputs2).to(device)
                 # prepare the MC outputs for calculating the metrics
-                MC_outputs2_temp = F.softmax(MC_outputs2, dim=1)[:,1:,...]
+                MC_outputs2_temp = F.softmax(MC_outputs2.unsqueeze(0), dim=1)[:,1:,...]
                 MC_outputs2_temp = [
-                    post_pred(z) for z in decollate_batch(MC_outputs2.unsqueeze(0))
+                    post_pred(z) for z in decollate_batch(MC_outputs2_temp)
                 ]
 
                 # save the images as .tiff file readable by Fiji
@@ -601,15 +564,15 @@ def generate_output_ensemble_of_ensembles(
                 del val_outputs_stack
 
                 # prepare the MC outputs for calculating the metrics
-                val_outputs = F.softmax(val_outputs, dim=1)[:,1:,...]
+                val_outputs = F.softmax(val_outputs.unsqueeze(0), dim=1)[:,1:,...]
                 val_outputs = [
-                    post_pred(i) for i in decollate_batch(val_outputs.unsqueeze(0))
+                    post_pred(i) for i in decollate_batch(val_outputs)
                 ]
 
                 # save the images as .tiff file readable by Fiji
                 img_list = [uncertainty, val_outputs[0][1, :, :, :].detach().cpu()]
 
-                save_tiff_MC_dropout(
+                saver.save_tiff_MC_dropout(
                     img_list, input_path, data_dicts_test[RI_subj_id - 1], "ensemble_"
                 )
 
@@ -617,100 +580,130 @@ def generate_output_ensemble_of_ensembles(
 
 
 # -------------------------------------------------------
-# deployment of functions
+# device selection
 # -------------------------------------------------------
-def deploy_functions(
+def select_device(device_type, gpu_index, cfg, cpu_threads=None):
+    if device_type == "cpu":
+        ace_cpu_inference.configure_threads(cpu_threads)
+        return torch.device("cpu")
+
+    print(f"number of available gpus: {torch.cuda.device_count()}")
+    gpu_opt = cfg["general"].get("GPU", "single")
+    if gpu_opt == "single":
+        if torch.cuda.device_count() <= gpu_index:
+            raise ValueError(f"Selected GPU index ({gpu_index}) is not available. Available GPUs: {torch.cuda.device_count()}")
+        device = torch.device(f"cuda:{gpu_index}")
+    else:
+        raise NotImplementedError("multi-gpu is not implemented yet")
+        device = torch.device("cuda:0")
+        # model = torch.nn.DataParallel(model)
+        # model.to(device)
+
+    return device
+
+
+# -------------------------------------------------------
+# throughput benchmark of the sliding window inference
+# -------------------------------------------------------
+def benchmark_functions(
     chosen_model,
-    patch_dir_var,
-    batch_size_var,
-    cache_rate_var,
-    num_workers_var,
-    forward_passes_var,
+    n_patches,
     gpu_index,
-    binarization_threshold,
-    percentage_brain_patch_skip,
+    device_type="gpu",
+    cpu_threads=None,
+    cpu_precision="fp32",
+    cpu_compile="none",
 ):
-    # Define vars
-    model_name = chosen_model
-    input_path = patch_dir_var
     CFG_PATH = Path(os.environ["MIRACL_HOME"]) / "seg/config_unetr.yml"
-    MC_flag = True if forward_passes_var > 0 else False
-    batch_size_internal = batch_size_var
     sw_batch_size_internal = 4
-    forward_passes_internal = forward_passes_var
 
-    # -------------------------------------------------------
-    # Read generate_patch directory / created by generate_patch.py
-    # -------------------------------------------------------
-    print("preparing dataset!")
-
-    images_val = []
-
-    with os.scandir(input_path) as entries:
-        for entry in entries:
-            if entry.is_file() and entry.name.lower().endswith((".tif", ".tiff")):
-                images_val.append(entry.name)
+    model_out, _ = ace_prepare_model_transform.generate_model_transforms(chosen_model, CFG_PATH)
+    with open(CFG_PATH, "r") as ymlfile:
+        cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
 
-    # load in percentage_brain_patch.json
-    with open(os.path.join(input_path, "percentage_brain_patch.json")) as f:
-        percentage_brain_patch = json.load(f)
+    device = select_device(device_type, gpu_index, cfg, cpu_threads)
+    cpu_opts = None
+    if device_type == "cpu":
+        cpu_opts = {"precision": cpu_precision, "compile_mode": cpu_compile}
+
+    models = {
+        "unet": [(model_out, (128, 128, 128), "model_unet_trained_path")],
+        "unetr": [(model_out, (96, 96, 96), "model_unetr_trained_path")],
+    }.get(
+        chosen_model,
+        [
+            (model_out[0], (128, 128, 128), "model_unet_trained_path"),
+            (model_out[1], (96, 96, 96), "model_unetr_trained_path"),
+        ],
+    )
 
-    # filter through images val based on percentage threshold
-    images_val_non_empty = [
-        os.path.join(input_path, image)
-        for image in images_val
-        if percentage_brain_patch[image] > percentage_brain_patch_skip
-    ]
-    images_val_non_empty.sort()
+    results = {}
+    for model, roi_size, weights_key in models:
+        model.to(device)
+        # speed does not depend on the weights, but int8 quantization needs the trained ranges
+        trained_model_path = cfg["general"].get(weights_key)
+        if trained_model_path and os.path.isfile(trained_model_path):
+            model.load_state_dict(torch.load(trained_model_path, map_location=device))
+        model.eval()
 
-    images_val_empty = [
-        os.path.join(input_path, image)
-        for image in images_val
-        if percentage_brain_patch[image] <= percentage_brain_patch_skip
-    ]
-    images_val_empty.sort()
+        predictor = get_predictor(model, roi_size, sw_batch_size_internal, cpu_opts)
+        results[weights_key] = ace_cpu_inference.benchmark_throughput(
+            predictor, roi_size, sw_batch_size_internal, n_patches=n_patches, device=device
+        )
 
-    images_val = images_val_non_empty
+    return results
 
-    data_dicts_test = [{"image": image_name} for image_name in images_val]
-    print("data dicts are ready!")
-    print(f"some samples from data dicts: {data_dicts_test[:3]}")
-    print(f"in total we have {len(data_dicts_test)} data dicts")
 
-    # -------------------------------------------------------
-    # prepare models, transforms, and data loader
-    # -------------------------------------------------------
+# -------------------------------------------------------
+# preparation of the models and transforms
+# -------------------------------------------------------
+def prepare_inference(
+    model_name,
+    cfg_path,
+    binarization_threshold,
+    gpu_index,
+    device_type="gpu",
+    cpu_threads=None,
+    cpu_precision="fp32",
+    cpu_compile="none",
+):
     model_out, test_transforms = ace_prepare_model_transform.generate_model_transforms(
-        model_name, CFG_PATH
+        model_name, cfg_path
     )
     post_pred = Compose([EnsureType(), AsDiscrete(threshold=binarization_threshold), AsDiscrete(to_onehot=2)])
 
-    with open(CFG_PATH, "r") as ymlfile:
+    with open(cfg_path, "r") as ymlfile:
         cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
 
-    # GPU selection
-    print(f"number of available gpus: {torch.cuda.device_count()}")
-    gpu_opt = cfg["general"].get("GPU", "single")
-    if gpu_opt == "single":
-        if torch.cuda.device_count() <= gpu_index:
-            raise ValueError(f"Selected GPU index ({gpu_index}) is not available. Available GPUs: {torch.cuda.device_count()}")
-        device = torch.device(f"cuda:{gpu_index}")
-    else:
-        raise NotImplementedError("multi-gpu is not implemented yet")
-        device = torch.device("cuda:0")
-        # model = torch.nn.DataParallel(model)
-        # model.to(device)
+    # CPU / GPU selection
+    device = select_device(device_type, gpu_index, cfg, cpu_threads)
+    cpu_opts = None
+    if device_type == "cpu":
+        cpu_opts = {"precision": cpu_precision, "compile_mode": cpu_compile}
+        print(f"running inference on cpu (precision: {cpu_precision}, compile: {cpu_compile})")
 
-    # define dataloader
-    val_ds = CacheDataset(
-        data=data_dicts_test,
-        transform=test_transforms,
-        cache_rate=cache_rate_var,
-        num_workers=num_workers_var,
-    )
-    # val_ds = Dataset(data=data_dicts_val, transform=val_transforms)
-    val_loader = DataLoader(val_ds, batch_size=batch_size_internal, num_workers=num_workers_var)
+    return model_out, test_transforms, post_pred, cfg, device, cpu_opts
 
+
+# -------------------------------------------------------
+# generation of the model outputs of the selected model
+# -------------------------------------------------------
+def run_inference(
+    model_name,
+    MC_flag,
+    model_out,
+    input_path,
+    batch_size_internal,
+    sw_batch_size_internal,
+    forward_passes_internal,
+    data_dicts_test,
+    post_pred,
+    cfg,
+    device,
+    val_loader,
+    cpu_opts=None,
+    saver=None,
+):
     # unet alone
     if model_name == "unet" and not MC_flag:
         generate_output_single(
@@ -722,7 +715,9 @@ def deploy_functions(
             post_pred,
             cfg,
             device,
-            val_loader
+            val_loader,
+            cpu_opts=cpu_opts,
+            saver=saver,
         )
     # unetr alone
     elif model_name == "unetr" and not MC_flag:
@@ -735,7 +730,9 @@ def deploy_functions(
             post_pred,
             cfg,
             device,
-            val_loader
+            val_loader,
+            cpu_opts=cpu_opts,
+            saver=saver,
         )
     # unet alone + MC dropout
     elif model_name == "unet" and MC_flag:
@@ -750,7 +747,9 @@ def deploy_functions(
             post_pred,
             cfg,
             device,
-            val_loader
+            val_loader,
+            cpu_opts=cpu_opts,
+            saver=saver,
         )
     # unetr alone + MC dropout
     elif model_name == "unetr" and MC_flag:
@@ -765,7 +764,9 @@ def deploy_functions(
             post_pred,
             cfg,
             device,
-            val_loader
+            val_loader,
+            cpu_opts=cpu_opts,
+            saver=saver,
         )
     # unet + unetr
     elif model_name == "ensemble" and not MC_flag:
@@ -777,7 +778,9 @@ def deploy_functions(
             post_pred,
             cfg,
             device,
-            val_loader
+            val_loader,
+            cpu_opts=cpu_opts,
+            saver=saver,
         )
     # unet + unetr + MC dropout
     elif model_name == "ensemble" and MC_flag:
@@ -791,53 +794,122 @@ def deploy_functions(
             post_pred,
             cfg,
             device,
-            val_loader
+            val_loader,
+            cpu_opts=cpu_opts,
+            saver=saver,
         )
     else:
         raise ValueError("Selected model is invalid")
 
-    logging.debug("deploy_model called")
 
-    # for the images in images_val
+# -------------------------------------------------------
+# deployment of functions
+# -------------------------------------------------------
+def deploy_functions(
+    chosen_model,
+    patch_dir_var,
+    batch_size_var,
+    cache_rate_var,
+    num_workers_var,
+    forward_passes_var,
+    gpu_index,
+    binarization_threshold,
+    percentage_brain_patch_skip,
+    device_type="gpu",
+    cpu_threads=None,
+    cpu_precision="fp32",
+    cpu_compile="none",
+):
+    # Define vars
+    model_name = chosen_model
+    input_path = patch_dir_var
+    CFG_PATH = Path(os.environ["MIRACL_HOME"]) / "seg/config_unetr.yml"
+    MC_flag = True if forward_passes_var > 0 else False
+    batch_size_internal = batch_size_var
+    sw_batch_size_internal = 4
+    forward_passes_internal = forward_passes_var
+
+    # -------------------------------------------------------
+    # Read generate_patch directory / created by generate_patch.py
+    # -------------------------------------------------------
+    print("preparing dataset!")
+
+    # load in percentage_brain_patch.json (lists all the patches, patches
+    # with too little brain may not have been saved by generate_patch.py)
+    with open(os.path.join(input_path, "percentage_brain_patch.json")) as f:
+        percentage_brain_patch = json.load(f)
+
+    images_val = list(percentage_brain_patch.keys())
+
+    # filter through images val based on percentage threshold
+    images_val_non_empty = [
+        os.path.join(input_path, image)
+        for image in images_val
+        if percentage_brain_patch[image] > percentage_brain_patch_skip
+    ]
+    images_val_non_empty.sort()
+
+    images_val_empty = [
+        os.path.join(input_path, image)
+        for image in images_val
+        if percentage_brain_patch[image] <= percentage_brain_patch_skip
+    ]
+    images_val_empty.sort()
+
+    images_val = images_val_non_empty
+
+    data_dicts_test = [{"image": image_name} for image_name in images_val]
+    print("data dicts are ready!")
+    print(f"some samples from data dicts: {data_dicts_test[:3]}")
+    print(f"in total we have {len(data_dicts_test)} data dicts")
+
+    # -------------------------------------------------------
+    # prepare models, transforms, and data loader
+    # -------------------------------------------------------
+    model_out, test_transforms, post_pred, cfg, device, cpu_opts = prepare_inference(
+        model_name,
+        CFG_PATH,
+        binarization_threshold,
+        gpu_index,
+        device_type=device_type,
+        cpu_threads=cpu_threads,
+        cpu_precision=cpu_precision,
+        cpu_compile=cpu_compile,
+    )
+
     # define dataloader
-    data_dicts_test_empty = [{"image": image_name} for image_name in images_val_empty]
-    val_ds_empty = CacheDataset(
-        data=data_dicts_test_empty,
+    val_ds = CacheDataset(
+        data=data_dicts_test,
         transform=test_transforms,
         cache_rate=cache_rate_var,
         num_workers=num_workers_var,
     )
     # val_ds = Dataset(data=data_dicts_val, transform=val_transforms)
-    val_loader_empty = DataLoader(val_ds_empty, batch_size=batch_size_internal, num_workers=num_workers_var)
-    RI_subj_id = 1
-    for i, val_data in enumerate(val_loader_empty):
-        H, W, D = val_data["image"].shape[2], val_data["image"].shape[3], val_data["image"].shape[4]
-        curr_batch_size = val_data["image"].shape[0]
-        val_outputs = [np.zeros((H, W, D)) for b in range(curr_batch_size)]
-
-        if MC_flag:
-            uncertainty = [np.zeros((H, W, D)) for b in range(curr_batch_size)]
-
-        # save the images as .tiff file readable by Fiji
-        for j in range(len(val_outputs)):
-            
-
-            if (model_name == "unet" or model_name == "unetr") and not MC_flag:
-                img_list = [val_outputs[j]]
-                save_tiff(img_list, input_path, data_dicts_test_empty[RI_subj_id - 1])
-                RI_subj_id += 1
+    val_loader = DataLoader(val_ds, batch_size=batch_size_internal, num_workers=num_workers_var)
 
-            elif model_name == "ensemble" and not MC_flag:
-                img_list = [val_outputs[j]]
-                save_tiff(img_list, input_path, data_dicts_test_empty[RI_subj_id - 1])
-                RI_subj_id += 1
+    run_inference(
+        model_name,
+        MC_flag,
+        model_out,
+        input_path,
+        batch_size_internal,
+        sw_batch_size_internal,
+        forward_passes_internal,
+        data_dicts_test,
+        post_pred,
+        cfg,
+        device,
+        val_loader,
+        cpu_opts=cpu_opts,
+    )
 
-            elif model_name == "ensemble" and MC_flag:
-                img_list = [uncertainty[j], val_outputs[j]]
-                save_tiff_MC_dropout(img_list, input_path, data_dicts_test_empty[RI_subj_id - 1], model_name+"_")
-                RI_subj_id += 1
+    logging.debug("deploy_model called")
 
-            elif (model_name == "unet" or model_name == "unetr") and MC_flag:
-                img_list = [uncertainty[j], val_outputs[j]]
-                save_tiff_MC_dropout(img_list, input_path, data_dicts_test_empty[RI_subj_id - 1], model_name+"_")
-                RI_subj_id += 1
+    # for the images in images_val_empty
+    # the outputs are all zero: nothing is loaded or saved, the patches are
+    # listed in empty_patches.json (read as zeros by the patch stacking)
+    print(f"{len(images_val_empty)} empty patches listed in {miracl_seg_patch_manifest.EMPTY_PATCHES_JSON}")
+    miracl_seg_patch_manifest.save_empty_patches(
+        input_path,
+        {image_name: (PATCH_SIZE, PATCH_SIZE, PATCH_SIZE) for image_name in images_val_empty},
+    )
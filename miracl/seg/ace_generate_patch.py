@@ -20,7 +20,6 @@ output:
 # import libraries
 #######################################
 
-import skimage.io as io
 import os
 # import fnmatch
 import numpy as np
@@ -32,6 +31,9 @@ from skimage.filters import threshold_otsu
 from scipy.ndimage import binary_fill_holes
 import json
 
+from miracl.utilfn.miracl_utilfn_parallel import parallel_map
+from miracl.utilfn.miracl_utilfn_virtual_stack import VirtualStack
+
 # def generate_patch_main(input_folder, output_folder):
 #     input_path = input_folder
 #     output_path = output_folder
@@ -43,11 +45,114 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+# function to the windowing
+def blockshaped(arr, nrows, ncols):
+    """
+    Return an array of shape (n, nrows, ncols) where
+    n * nrows * ncols = arr.size
+    If arr is a 2D array, the returned array should look like n subblocks with
+    each subblock preserving the "physical" layout of arr.
+    """
+    h, w = arr.shape
+    assert h % nrows == 0, "{} rows is not evenly divisble by {}".format(h, nrows)
+    assert w % ncols == 0, "{} cols is not evenly divisble by {}".format(w, ncols)
+    return (
+        arr.reshape(h // nrows, nrows, -1, ncols)
+        .swapaxes(1, 2)
+        .reshape(-1, nrows, ncols)
+    )
+
+
+# function to create the brain mask of a slice and split the (zero padded) slice into patches
+def tile_slice(img, batch_size):
+    """
+    Returns the (n, batch_size, batch_size) patches of the zero padded slice
+    and of its brain mask (otsu threshold)
+    """
+    # create a brain mask for the img
+    threshold = threshold_otsu(img)
+    img_binary = img > threshold
+    img_binary = binary_fill_holes(img_binary)
+
+    # check if the img needs zero padding
+    if (img.shape[0] % batch_size) != 0:
+        img_height = (floor(img.shape[0] / batch_size) + 1) * batch_size
+    else:
+        img_height = img.shape[0]
+
+    if (img.shape[1] % batch_size) != 0:
+        img_width = (floor(img.shape[1] / batch_size) + 1) * batch_size
+    else:
+        img_width = img.shape[1]
+
+    img_padding = np.zeros((img_height, img_width), dtype=img.dtype)
+    img_padding_binary = np.zeros((img_height, img_width), dtype=np.bool_)
+    img_padding[: img.shape[0], : img.shape[1]] = img
+    img_padding_binary[: img.shape[0], : img.shape[1]] = img_binary
+
+    batch_arr_img = blockshaped(img_padding, batch_size, batch_size)
+    batch_arr_img_binary = blockshaped(img_padding_binary, batch_size, batch_size)
+
+    return batch_arr_img, batch_arr_img_binary
+
+
+# function to read a slice, create its brain mask and copy its patches into the slab
+def _read_slice(stack, z_input_img, slab, z, batch_size):
+    img = stack.read_slice(z_input_img)
+
+    # brain mask and zero padded patches of the slice
+    batch_arr_img, batch_arr_img_binary = tile_slice(img, batch_size)
+    slab[: batch_arr_img.shape[0], z] = batch_arr_img
+
+    # number of brain voxels of each patch
+    return batch_arr_img_binary.reshape(batch_arr_img_binary.shape[0], -1).sum(axis=1)
+
+
+# function to create the patches of a slab of (at most batch_size) slices
+def read_slab(stack, z0, batch_size, n_workers=4):
+    """
+    Returns the (n, batch_size, batch_size, batch_size) zero padded patches (ZYX, uint16)
+    of the slab of slices z0 .. z0 + batch_size of the (virtual) stack and the
+    percentage of brain of each patch.
+    The slab is allocated once and the slices are read and masked in a thread pool.
+    """
+    # patches of the zero padded slices (as tile_slice)
+    height, width = stack.slice_shape[:2]
+    n_patches = -(-height // batch_size) * -(-width // batch_size)
+
+    slab = np.zeros((n_patches, batch_size, batch_size, batch_size), dtype=np.uint16)
+    brain_voxels = parallel_map(
+        _read_slice,
+        ((stack, z, slab, z - z0, batch_size) for z in range(z0, min(z0 + batch_size, len(stack)))),
+        n_workers=n_workers,
+        backend="thread",
+    )
+    percentage_brain = 100 * np.sum(brain_voxels, axis=0) / (batch_size**3)
+
+    return slab, percentage_brain
+
+
+# function to save a patch (ZYX)
+def save_patch(fname_output_img, img_batch_single, batch_size):
+    tifffile.imwrite(
+        fname_output_img,
+        img_batch_single.astype("uint16"),
+        metadata={
+            "DimensionOrder": "ZYX",
+            "SizeC": 1,
+            "SizeT": 1,
+            "SizeX": batch_size,
+            "SizeY": batch_size,
+            "SizeZ": batch_size,
+        },
+    )
+
+
 #######################################
 # inputs
 #######################################
 
-def generate_patch_main(input_folder, output_folder):
+def generate_patch_main(input_folder, output_folder, percentage_brain_patch_skip=0.0, n_workers=4):
     input_path = input_folder
     output_path = Path(output_folder)
     output_dir_subfolder = "generated_patches"
@@ -68,40 +173,17 @@ def generate_patch_main(input_folder, output_folder):
     # create and saved patches
     #######################################
 
-    # function to the windowing
-    def blockshaped(arr, nrows, ncols):
-        """
-        Return an array of shape (n, nrows, ncols) where
-        n * nrows * ncols = arr.size
-        If arr is a 2D array, the returned array should look like n subblocks with
-        each subblock preserving the "physical" layout of arr.
-        """
-        h, w = arr.shape
-        assert h % nrows == 0, "{} rows is not evenly divisble by {}".format(h, nrows)
-        assert w % ncols == 0, "{} cols is not evenly divisble by {}".format(w, ncols)
-        return (
-            arr.reshape(h // nrows, nrows, -1, ncols)
-            .swapaxes(1, 2)
-            .reshape(-1, nrows, ncols)
-        )
-
     # batch size will be 512 * 512 * 512
     batch_size = 512
 
     print(f"  \nSubject: {input_path} has been found!")
 
-    # read all the slices in the input directory
+    # read all the slices in the input directory (decoded when the slabs are read)
     # img_list_name = fnmatch.filter(os.listdir(input_path), "*.tif*")
     # img_list_name.sort()
 
-    img_list_name = []
-
-    with os.scandir(input_path) as entries:
-        for entry in entries:
-            if entry.is_file() and entry.name.lower().endswith((".tif", ".tiff")):
-                img_list_name.append(entry.name)
-
-    img_list_name.sort()
+    input_stack = VirtualStack.from_folder(input_path)
+    img_list_name = [file.name for file in input_stack.files]
 
     # create equal size image slices for third dimension of batch - the last stack might have size of less than batch_size
     stack_index_img = [
@@ -117,117 +199,48 @@ def generate_patch_main(input_folder, output_folder):
 
     # def print_dim(idx):
     #     return ["Z", "Y", "X"][idx]
+    output_dir_img = Path(output_path) / output_dir_subfolder
+    if not output_dir_img.is_dir():
+        output_dir_img.mkdir(parents=True)
+        print(f"output_dir: {output_dir_img}")
+
     percentage_brain_patch = {}
     for idx1, stack in enumerate(stack_index_img):
-        img_list = []
-        img_list_binary = []
-
         print(f"  \nProcessing image slices for Z-dim...\n")
-        for idx2, file in enumerate(stack):
-            print("  Slice: ", file)
-            fname_input_img = os.path.join(input_path, file)
-            img = io.imread(fname_input_img)
-
-            # create a brain mask for the img
-            threshold = threshold_otsu(img)
-            img_binary = img > threshold
-            img_binary = binary_fill_holes(img_binary)
-
-            # check if the img needs zero padding
-            if (img.shape[0] % batch_size) != 0:
-                img_height = (floor(img.shape[0] / batch_size) + 1) * batch_size
-            else:
-                img_height = img.shape[0]
-
-            if (img.shape[1] % batch_size) != 0:
-                img_width = (floor(img.shape[1] / batch_size) + 1) * batch_size
-            else:
-                img_width = img.shape[1]
-
-            img_padding = np.zeros((img_height, img_width), dtype=img.dtype)
-            img_padding_binary = np.zeros((img_height, img_width), dtype=np.bool_)
-            img_padding[: img.shape[0], : img.shape[1]] = img
-            img_padding_binary[: img.shape[0], : img.shape[1]] = img_binary
-
-            batch_arr_img = blockshaped(img_padding, batch_size, batch_size)
-            batch_arr_img_binary = blockshaped(img_padding_binary, batch_size, batch_size)
-
-            img_list.append(batch_arr_img)
-            img_list_binary.append(batch_arr_img_binary)
-
-        img_batch = np.stack(img_list, axis=1)
-        img_batch_binary = np.stack(img_list_binary, axis=1)
+        print(f"  Slices: {stack[0]} ... {stack[-1]}")
+        # zero padded patches of the slab (the last slab may have less than batch_size slices)
+        img_batch, percentage_brain = read_slab(
+            input_stack,
+            idx1 * batch_size,
+            batch_size,
+            n_workers=n_workers,
+        )
 
         # save each data with size of 512 * 512 * 512
         print(
             f" \nSaving patches for Z-dim to '{output_path}/{output_dir_subfolder}/'..."
         )
-        
-        for i in range(img_batch.shape[0]):
-            img_batch_single = img_batch[i, :, :, :]
-            img_batch_single_binary = img_batch_binary[i, :, :, :]
 
-            # img_batch_single_normalized = (img_batch_single - img_batch_single.min()) / (img_batch_single.max() - img_batch_single.min())
+        patches_to_save = []
+        for i in range(img_batch.shape[0]):
             file_img = "patch_" + str(idx1) + "_" + str(i) + ".tiff"
+            percentage_brain_patch[file_img] = percentage_brain[i]
+
+            # patches with too little brain are not segmented (see ace_deploy_model), no need to save them
+            if percentage_brain[i] <= percentage_brain_patch_skip:
+                continue
+            patches_to_save.append((os.path.join(output_dir_img, file_img), img_batch[i], batch_size))
 
-            # output_dir_img = os.path.join(output_path, output_dir_subfolder)
-            output_dir_img = Path(output_path) / output_dir_subfolder
-            # isExist = os.path.exists(output_dir_img)
-            if not output_dir_img.is_dir():
-                # os.mkdir(output_dir_img)
-                output_dir_img.mkdir(parents=True)
-                print(f"output_dir: {output_dir_img}")
-            fname_output_img = os.path.join(output_dir_img, file_img)
-
-            # check if the image depth is less than 512 and zero-pad
-            if img_batch_single.shape[0] < batch_size:
-                img_batch_single = np.pad(
-                    img_batch_single,
-                    ((0, batch_size - img_batch_single.shape[0]), (0, 0), (0, 0)),
-                    mode="constant",
-                    constant_values=0,
-                )
-            
-            # check the image width is less than 512 and zero-pad
-            if img_batch_single.shape[1] < batch_size:
-                img_batch_single = np.pad(
-                    img_batch_single,
-                    ((0, 0), (0, batch_size - img_batch_single.shape[1]), (0, 0)),
-                    mode="constant",
-                    constant_values=0,
-                )
-            
-            # check the image width is less than 512 and zero-pad
-            if img_batch_single.shape[2] < batch_size:
-                img_batch_single = np.pad(
-                    img_batch_single,
-                    ((0, 0), (0, 0), (0, batch_size - img_batch_single.shape[2])),
-                    mode="constant",
-                    constant_values=0,
-                )
-
-
-            tifffile.imwrite(
-                fname_output_img,
-                img_batch_single.astype("uint16"),
-                metadata={
-                    "DimensionOrder": "ZYX",
-                    "SizeC": 1,
-                    "SizeT": 1,
-                    "SizeX": batch_size,
-                    "SizeY": batch_size,
-                    "SizeZ": batch_size,
-                },
-            )
-
-            percentage_brain_patch[Path(fname_output_img).name] = 100 * img_batch_single_binary.sum() / (batch_size**3)
+        parallel_map(save_patch, patches_to_save, n_workers=n_workers, backend="thread")
+        print(f"  {len(patches_to_save)} / {img_batch.shape[0]} patches saved")
+        del img_batch
 
     # save percentage of brain in each patch as json
     with open(output_dir_img / "percentage_brain_patch.json", "w") as f:
         json.dump(percentage_brain_patch, f, indent=4)
 
     print(
-        f"  \nIn total, {len(percentage_brain_patch)} patches have been saved to '{output_path}/{output_dir_subfolder}/'!"
+        f"  \nIn total, {len(percentage_brain_patch)} patches have been generated in '{output_path}/{output_dir_subfolder}/'!"
     )
 
     logging.debug("generate_patch_main called")
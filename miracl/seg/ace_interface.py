@@ -2,92 +2,160 @@
 # import os
 import torch
 from pathlib import Path
-from miracl.seg import ace_generate_patch, ace_deploy_model, ace_patch_stacking
+from miracl.seg import ace_generate_patch, ace_deploy_model, ace_patch_stacking, ace_stream_inference
 import sys
 
 
-def main(args):
+def main(args, output_patches=False):
 
-    if torch.cuda.is_available():
+    device_arg = args.sa_device
+
+    if device_arg == "gpu":
+        if not torch.cuda.is_available():
+            raise ValueError("No GPU support detected in Docker container. \
+Please install MIRACL with GPU passthrough as explained in our docs \
+or run the segmentation on cpu with: -sad cpu")
         print("CUDA available!")
 
-        input_folder_arg = args.single
-        output_folder_arg = Path(args.sa_output_folder) / "seg_final"
-        model_type_arg = args.sa_model_type
-        voxel_resolutions_arg = args.sa_resolution
-        image_sizes_arg = args.sa_image_size
-        number_workers_arg = args.sa_nr_workers
-        cache_rate_arg = args.sa_cache_rate
-        batch_size_arg = args.sa_batch_size
-        visualize_results_arg = args.sa_visualize_results
-        uncertainty_map_arg = args.sa_uncertainty_map
-        forward_passes_arg = args.sa_monte_carlo
-        gpu_index_arg = args.sa_gpu_index
-        binarization_threshold_arg = args.sa_binarization_threshold
-        percentage_brain_patch_skip_arg = args.sa_percentage_brain_patch_skip
-
-        print("The following parameters will be used:\n")
-        print(f"  Input folder:      {input_folder_arg}")
-        print(f"  Output folder:     {output_folder_arg}")
-        print(f"  Model type:        {model_type_arg}")
-        print(f"  Voxel resolutions: {voxel_resolutions_arg}")
-        print(f"  Image sizes:       {image_sizes_arg}")
-        print(f"  Number workers:    {number_workers_arg}")
-        print(f"  Cache rate:        {cache_rate_arg}")
-        print(f"  sw batch size:     {batch_size_arg}")
-        print(f"  Visualize results: {visualize_results_arg}")
-        print(f"  Uncertainty map:   {uncertainty_map_arg}\n")
-        print(f"  Forward passes:    {forward_passes_arg}\n")
+    input_folder_arg = args.single
+    output_folder_arg = Path(args.sa_output_folder) / "seg_final"
+    model_type_arg = args.sa_model_type
+    voxel_resolutions_arg = args.sa_resolution
+    image_sizes_arg = args.sa_image_size
+    number_workers_arg = args.sa_nr_workers
+    cache_rate_arg = args.sa_cache_rate
+    batch_size_arg = args.sa_batch_size
+    visualize_results_arg = args.sa_visualize_results
+    uncertainty_map_arg = args.sa_uncertainty_map
+    forward_passes_arg = args.sa_monte_carlo
+    gpu_index_arg = args.sa_gpu_index
+    binarization_threshold_arg = args.sa_binarization_threshold
+    percentage_brain_patch_skip_arg = args.sa_percentage_brain_patch_skip
+    cpu_threads_arg = args.sa_cpu_threads
+    cpu_precision_arg = args.sa_cpu_precision
+    cpu_compile_arg = args.sa_cpu_compile
+    # benchmark is only available from `miracl seg ace`
+    benchmark_arg = getattr(args, "sa_benchmark", 0)
+    stream_arg = getattr(args, "sa_stream", False)
+    keep_patches_arg = getattr(args, "sa_keep_patches", False)
+    stacking_memory_arg = getattr(args, "sa_stacking_memory", ace_patch_stacking.STACKING_MEMORY_GB)
+    chunked_volume_arg = getattr(args, "sa_chunked_volume", False)
+    # voxel size (ZYX) of the chunked volumes
+    voxel_size_arg = tuple(voxel_resolutions_arg[::-1]) if voxel_resolutions_arg else (1.0, 1.0, 1.0)
+
+    print("The following parameters will be used:\n")
+    print(f"  Input folder:      {input_folder_arg}")
+    print(f"  Output folder:     {output_folder_arg}")
+    print(f"  Model type:        {model_type_arg}")
+    print(f"  Voxel resolutions: {voxel_resolutions_arg}")
+    print(f"  Image sizes:       {image_sizes_arg}")
+    print(f"  Number workers:    {number_workers_arg}")
+    print(f"  Cache rate:        {cache_rate_arg}")
+    print(f"  sw batch size:     {batch_size_arg}")
+    print(f"  Visualize results: {visualize_results_arg}")
+    print(f"  Uncertainty map:   {uncertainty_map_arg}\n")
+    print(f"  Forward passes:    {forward_passes_arg}\n")
+    print(f"  Device:            {device_arg}\n")
+    if device_arg == "gpu":
         print(f"  GPU index:         {gpu_index_arg}\n")
-        print(f"  Binarization threshold: {binarization_threshold_arg}\n")
-        print(f"  Percentage brain patch skip: {percentage_brain_patch_skip_arg}\n")
+    else:
+        print(f"  CPU threads:       {cpu_threads_arg if cpu_threads_arg else 'all'}")
+        print(f"  CPU precision:     {cpu_precision_arg}")
+        print(f"  CPU compile:       {cpu_compile_arg}\n")
+    print(f"  Binarization threshold: {binarization_threshold_arg}\n")
+    print(f"  Percentage brain patch skip: {percentage_brain_patch_skip_arg}\n")
+    print(f"  Streaming:         {stream_arg}\n")
+    print(f"  Chunked volume:    {chunked_volume_arg}\n")
+
+    if benchmark_arg > 0:
+        print(f"Benchmarking inference throughput on {benchmark_arg} random patches...")
+        ace_deploy_model.benchmark_functions(
+            chosen_model=model_type_arg,
+            n_patches=benchmark_arg,
+            gpu_index=gpu_index_arg,
+            device_type=device_arg,
+            cpu_threads=cpu_threads_arg,
+            cpu_precision=cpu_precision_arg,
+            cpu_compile=cpu_compile_arg,
+        )
+        return
 
-        # TODO: Add program logic here
+    # TODO: Add program logic here
 
-        # tmp_in, tmp_out = ace_generate_patch.main(args.input_folder, args.output_folder)
-        #
-        # print(f"In: {tmp_in}")
-        # print(f"Out: {tmp_out}")
+    # tmp_in, tmp_out = ace_generate_patch.main(args.input_folder, args.output_folder)
+    #
+    # print(f"In: {tmp_in}")
+    # print(f"Out: {tmp_out}")
 
-        # INFO: ace_generate_patch.py
-        if not output_folder_arg.exists():
-            output_folder_arg.mkdir(parents=True)
+    # INFO: ace_generate_patch.py
+    if not output_folder_arg.exists():
+        output_folder_arg.mkdir(parents=True)
 
-        patches_folder = ace_generate_patch.generate_patch_main(
+    # INFO: ace_stream_inference.py (patch generation, inference and stacking in one pass)
+    if stream_arg:
+        patches_folder = ace_stream_inference.run_streaming(
             input_folder=input_folder_arg,
-            output_folder=output_folder_arg
-        )
-
-        print(f"Patches folder path is: {patches_folder}")
-
-        # INFO: ace_deploy_model.py
-        # INFO: ace_prepare_model_transform.py is called from within ace_deploy_model.py
-
-        ace_deploy_model.deploy_functions(
+            output_folder=output_folder_arg,
             chosen_model=model_type_arg,
-            patch_dir_var=patches_folder,
             batch_size_var=batch_size_arg,
-            cache_rate_var=cache_rate_arg,
-            num_workers_var=number_workers_arg,
             forward_passes_var=forward_passes_arg,
             gpu_index=gpu_index_arg,
             binarization_threshold=binarization_threshold_arg,
-            percentage_brain_patch_skip=percentage_brain_patch_skip_arg
+            percentage_brain_patch_skip=percentage_brain_patch_skip_arg,
+            device_type=device_arg,
+            cpu_threads=cpu_threads_arg,
+            cpu_precision=cpu_precision_arg,
+            cpu_compile=cpu_compile_arg,
+            keep_patches=keep_patches_arg,
+            output_patches=output_patches,
+            memory_gb=stacking_memory_arg,
+            chunked_volume=chunked_volume_arg,
+            voxel_size=voxel_size_arg,
         )
-
-        # INFO: ace_patch_stacking.py
-
-        ace_patch_stacking.run_stacking(
-                patches_path=patches_folder,
-                main_input_folder_path=input_folder_arg,
-                output_folder_path=output_folder_arg,
-                monte_carlo=True if forward_passes_arg > 0 else False,
-                model_name_var=model_type_arg
-                )
-
-    else:
-        raise ValueError("No GPU support detected in Docker container. \
-Please install MIRACL with GPU passthrough as explained in our docs.")
+        print(f"Patches folder path is: {patches_folder}")
+        return
+
+    patches_folder = ace_generate_patch.generate_patch_main(
+        input_folder=input_folder_arg,
+        output_folder=output_folder_arg,
+        percentage_brain_patch_skip=percentage_brain_patch_skip_arg,
+        n_workers=number_workers_arg,
+    )
+
+    print(f"Patches folder path is: {patches_folder}")
+
+    # INFO: ace_deploy_model.py
+    # INFO: ace_prepare_model_transform.py is called from within ace_deploy_model.py
+
+    ace_deploy_model.deploy_functions(
+        chosen_model=model_type_arg,
+        patch_dir_var=patches_folder,
+        batch_size_var=batch_size_arg,
+        cache_rate_var=cache_rate_arg,
+        num_workers_var=number_workers_arg,
+        forward_passes_var=forward_passes_arg,
+        gpu_index=gpu_index_arg,
+        binarization_threshold=binarization_threshold_arg,
+        percentage_brain_patch_skip=percentage_brain_patch_skip_arg,
+        device_type=device_arg,
+        cpu_threads=cpu_threads_arg,
+        cpu_precision=cpu_precision_arg,
+        cpu_compile=cpu_compile_arg,
+    )
+
+    # INFO: ace_patch_stacking.py
+
+    ace_patch_stacking.run_stacking(
+            patches_path=patches_folder,
+            main_input_folder_path=input_folder_arg,
+            output_folder_path=output_folder_arg,
+            monte_carlo=True if forward_passes_arg > 0 else False,
+            model_name_var=model_type_arg,
+            n_workers=number_workers_arg,
+            memory_gb=stacking_memory_arg,
+            chunked_volume=chunked_volume_arg,
+            voxel_size=voxel_size_arg,
+            )
 
 
 if __name__ == "__main__":
@@ -149,6 +149,87 @@ class aceParser:
             default=0.0,
             help="percentage threshold of patch that is brain to skip during segmentation (between 0 and 1; type: %(type)s; default: %(default)s)",
         )
+        # Parser for inference device
+        parser.add_argument(
+            "-sad",
+            "--sa_device",
+            type=str,
+            choices=["gpu", "cpu"],
+            required=False,
+            default="gpu",
+            help="device used for inference (default: %(default)s)",
+        )
+        # Parser for number of cpu threads
+        parser.add_argument(
+            "-sact",
+            "--sa_cpu_threads",
+            type=int,
+            required=False,
+            default=None,
+            help="number of torch threads for cpu inference (type: %(type)s; default: all available cores)",
+        )
+        # Parser for cpu precision
+        parser.add_argument(
+            "-sacp",
+            "--sa_cpu_precision",
+            type=str,
+            choices=["fp32", "bf16", "int8"],
+            required=False,
+            default="fp32",
+            help="precision for cpu inference; int8 dynamically quantizes linear layers (default: %(default)s)",
+        )
+        # Parser for cpu model compilation
+        parser.add_argument(
+            "-sacm",
+            "--sa_cpu_compile",
+            type=str,
+            choices=["none", "trace", "compile"],
+            required=False,
+            default="none",
+            help="TorchScript trace or torch.compile the model for cpu inference (default: %(default)s)",
+        )
+        # Parser for throughput benchmark
+        parser.add_argument(
+            "-sabm",
+            "--sa_benchmark",
+            type=int,
+            required=False,
+            default=0,
+            help="only benchmark inference throughput (patches/sec) on this number of random 512^3 patches and exit (type: %(type)s; default: %(default)s)",
+        )
+        # Parser for streaming mode
+        parser.add_argument(
+            "-sastr",
+            "--sa_stream",
+            action="store_true",
+            default=False,
+            help="read, segment and stack the image slabs in a single streaming pass without saving the patches (default: %(default)s)",
+        )
+        # Parser for keeping the patches in streaming mode
+        parser.add_argument(
+            "-sakp",
+            "--sa_keep_patches",
+            action="store_true",
+            default=False,
+            help="save the input and output patches to generated_patches/ in streaming mode, e.g. for debugging (default: %(default)s)",
+        )
+        # Parser for the memory used to stack the output patches
+        parser.add_argument(
+            "-sasm",
+            "--sa_stacking_memory",
+            type=float,
+            required=False,
+            default=8.0,
+            help="memory (GB) used to stack the output patches into slices (also the slabs held by --sa_stream); lower it on nodes with little RAM (type: %(type)s; default: %(default)s)",
+        )
+        # Parser for saving the outputs as chunked volumes
+        parser.add_argument(
+            "-sacv",
+            "--sa_chunked_volume",
+            action="store_true",
+            default=False,
+            help="also save the output slices as chunked multi-resolution volumes (seg_final_<output>.zarr) (default: %(default)s)",
+        )
         return parser
 
     # def parse_args(self) -> argparse.Namespace:
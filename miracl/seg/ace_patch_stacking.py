@@ -3,21 +3,90 @@ This code is written by Ahmadreza Attarpour, a.attarpour@mail.utoronto.ca
 
 This code reads the model's output and stack them together to create a large 3D whole brain data and then save the image slice by slice
 
+The slices of each depth of patches are stacked in chunks of slices that fit in the memory
+budget: the patches of a chunk are read in parallel (memory-mapped, only the slices of the
+chunk) while the slices of the previous chunk are saved by a pool of writer threads.
+
 """
 # load libraries
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 # from monai.handlers.utils import from_engine
 import numpy as np
 import tifffile
 from math import floor
 
+from miracl.seg import miracl_seg_patch_manifest
+from miracl.utilfn.miracl_utilfn_chunked_volume import ChunkedVolume, chunked_volume_path
+from miracl.utilfn.miracl_utilfn_parallel import parallel_map
+from miracl.utilfn.miracl_utilfn_virtual_stack import VirtualStack
+
+# default memory (GB) used for the stacked slices
+STACKING_MEMORY_GB = 8.0
+# number of resolution levels of the chunked volumes of the outputs
+CHUNKED_VOLUME_LEVELS = 4
+
+
+# this function creates the chunked volume of an output (e.g. seg_final_out.zarr next to seg_final/)
+def create_chunked_volume(output_path, image_mode, image_type, shape, voxel_size):
+    path = chunked_volume_path(output_path, image_mode)
+    print(f"  saving chunked volume: {path}")
+    # segmentations are down-sampled with max to keep the sparse neurons in the low resolution levels
+    return ChunkedVolume.create(
+        path,
+        shape,
+        image_type,
+        voxel_size=voxel_size,
+        downsampling="mean" if np.dtype(image_type).kind == "f" else "max",
+    )
+
+
+# this function reads the slices z0:z1 of a patch into its place in the chunk of stacked slices
+def read_patch_chunk(filename, img, h, w, z0, z1, empty_patches, patch_size):
+    if miracl_seg_patch_manifest.patch_name(filename) in empty_patches:
+        patch = miracl_seg_patch_manifest.read_patch(filename, empty_patches, img.dtype)
+    else:
+        try:
+            patch = tifffile.memmap(filename, mode="r")
+        except ValueError:
+            # compressed or non-contiguous patch
+            patch = tifffile.imread(filename)
+
+    img[
+        :,
+        h * patch_size:h * patch_size + patch_size,
+        w * patch_size:w * patch_size + patch_size,
+    ] = patch[z0:z1]
+    del patch
+
+
+# this function saves a stacked slice
+def save_slice(img_filename, img_main, image_type, width, height):
+    print("saving img: ", img_filename)
+    tifffile.imwrite(
+        img_filename,
+        img_main.astype(image_type),
+        metadata={
+            "DimensionOrder": "YX",
+            "SizeC": 1,
+            "SizeT": 1,
+            "SizeX": width,
+            "SizeY": height,
+        },
+    )
+
+
 def run_stacking(
     patches_path,
     main_input_folder_path,
     output_folder_path,
     monte_carlo,
     model_name_var,
+    n_workers=4,
+    memory_gb=STACKING_MEMORY_GB,
+    chunked_volume=False,
+    voxel_size=(1.0, 1.0, 1.0),
 ):
     input_path = patches_path
     main_input_path = main_input_folder_path
@@ -28,24 +97,15 @@ def run_stacking(
     print("  calling patch_stacking")
     print(f"  MC_flag: {MC_flag}")
 
-    # read all the slices in the input directory
-    img_list_name = []
-
-    with os.scandir(main_input_path) as entries:
-        for entry in entries:
-            if entry.is_file() and entry.name.lower().endswith((".tif", ".tiff")):
-                img_list_name.append(entry.name)
-
-    img_list_name.sort()
+    # list all the slices in the input directory (only the header of the first one is read)
+    input_stack = VirtualStack.from_folder(main_input_path)
+    img_list_name = [file.name for file in input_stack.files]
     # img_list_name = fnmatch.filter(os.listdir(main_input_path), "*.tif*")
     # img_list_name.sort()
 
     # find the h, w and depth of the image
-    subj_depth = len(img_list_name)
-    fname_input_img = os.path.join(main_input_path, img_list_name[0])
-    img = tifffile.imread(fname_input_img)
-    subj_height = img.shape[0]
-    subj_width = img.shape[1]
+    subj_depth = len(input_stack)
+    subj_height, subj_width = input_stack.slice_shape[:2]
 
     print(
         "the main input has the size of ", subj_height, "x", subj_width, "x", subj_depth
@@ -53,6 +113,9 @@ def run_stacking(
     # image patch size used in the first script to create patches and save them in generate_patches folder
     PATCH_SIZE = 512
 
+    # empty patches (not saved by ace_deploy_model) are read as zeros
+    empty_patches = miracl_seg_patch_manifest.load_empty_patches(input_path)
+
     def image_stacking(image_mode, image_type):
         # height = floor(subj_height / PATCH_SIZE) + 1
         # width = floor(subj_width / PATCH_SIZE) + 1
@@ -62,63 +125,93 @@ def run_stacking(
         width = subj_width // PATCH_SIZE + 1 * (subj_width % PATCH_SIZE > 0)
         depth = subj_depth // PATCH_SIZE + 1 * (subj_depth % PATCH_SIZE > 0)
 
-        cnt_depth = 1
-        # for each subject we have 4 depth (0-3); each depth has multiple 512^3 image patches
-        for d in range(depth):
-            img = np.zeros(
-                (PATCH_SIZE, height * PATCH_SIZE, width * PATCH_SIZE), dtype=image_type
-            )
-            cnt_img = 0
-
-            for h in range(height):
-                for w in range(width):
-                    filename = os.path.join(
-                        input_path,
-                        image_mode
-                        + "patch"
-                        + "_"
-                        + str(d)
-                        + "_"
-                        + str(cnt_img)
-                        + ".tiff",
-                    )
-                    print("reading ", filename)
-
-                    cnt_img += 1
-
-                    img_temp = tifffile.imread(filename)
-
-                    img = img[: img_temp.shape[0], :, :]
+        # number of slices stacked at once; two chunks are in memory (one read, one saved)
+        slice_bytes = height * PATCH_SIZE * width * PATCH_SIZE * np.dtype(image_type).itemsize
+        chunk_depth = int(min(PATCH_SIZE, max(1, memory_gb * 1024**3 // (2 * slice_bytes))))
 
-                    img[
-                        :,
-                        h * PATCH_SIZE:h * PATCH_SIZE + PATCH_SIZE,
-                        w * PATCH_SIZE:w * PATCH_SIZE + PATCH_SIZE,
-                    ] = img_temp
-
-            for z in range(img_temp.shape[0]):
-                img_main = img[z, :subj_height, :subj_width]
-
-                if cnt_depth <= subj_depth:
-                    img_filename = os.path.join(
-                        output_path, image_mode + img_list_name[cnt_depth - 1]
-                    )
-                    print("saving img: ", img_filename)
-                    tifffile.imwrite(
-                        img_filename,
-                        img_main.astype(image_type),
-                        metadata={
-                            "DimensionOrder": "YX",
-                            "SizeC": 1,
-                            "SizeT": 1,
-                            "SizeX": width,
-                            "SizeY": height,
-                        },
+        vol = None
+        if chunked_volume:
+            vol = create_chunked_volume(
+                output_path, image_mode, image_type, (subj_depth, subj_height, subj_width), voxel_size
+            )
+            # whole chunks of the volume are written at once
+            vol_chunk_depth = vol.level(0).chunks[0]
+            if chunk_depth >= vol_chunk_depth:
+                chunk_depth -= chunk_depth % vol_chunk_depth
+        print(f"  stacking {chunk_depth} slices at once")
+
+        chunks = [
+            np.zeros((chunk_depth, height * PATCH_SIZE, width * PATCH_SIZE), dtype=image_type)
+            for _ in range(2)
+        ]
+        pending = [[], []]
+        cnt_chunk = 0
+
+        with ThreadPoolExecutor(max_workers=n_workers) as writer:
+            # for each subject we have 4 depth (0-3); each depth has multiple 512^3 image patches
+            for d in range(depth):
+                depth_slices = min(PATCH_SIZE, subj_depth - d * PATCH_SIZE)
+
+                for z0 in range(0, depth_slices, chunk_depth):
+                    z1 = min(z0 + chunk_depth, depth_slices)
+
+                    # wait until the slices of the chunk read two chunks ago are saved
+                    for future in pending[cnt_chunk % 2]:
+                        future.result()
+                    img = chunks[cnt_chunk % 2][: z1 - z0]
+
+                    print(f"reading slices {z0}-{z1 - 1} of the patches of depth {d}")
+                    parallel_map(
+                        read_patch_chunk,
+                        (
+                            (
+                                os.path.join(
+                                    input_path,
+                                    image_mode
+                                    + "patch"
+                                    + "_"
+                                    + str(d)
+                                    + "_"
+                                    + str(h * width + w)
+                                    + ".tiff",
+                                ),
+                                img,
+                                h,
+                                w,
+                                z0,
+                                z1,
+                                empty_patches,
+                                PATCH_SIZE,
+                            )
+                            for h in range(height)
+                            for w in range(width)
+                        ),
+                        n_workers=n_workers,
+                        backend="thread",
                     )
 
-                cnt_depth += 1
-
-            del img_main
+                    pending[cnt_chunk % 2] = [
+                        writer.submit(
+                            save_slice,
+                            os.path.join(
+                                output_path, image_mode + img_list_name[d * PATCH_SIZE + z]
+                            ),
+                            img[z - z0, :subj_height, :subj_width],
+                            image_type,
+                            width,
+                            height,
+                        )
+                        for z in range(z0, z1)
+                    ]
+                    if vol is not None:
+                        vol[d * PATCH_SIZE + z0:d * PATCH_SIZE + z1] = img[:, :subj_height, :subj_width]
+                    cnt_chunk += 1
+
+            for future in pending[0] + pending[1]:
+                future.result()
+
+        if vol is not None:
+            vol.build_pyramid(CHUNKED_VOLUME_LEVELS, n_workers=n_workers)
 
     print("stacking images")
     if MC_flag:
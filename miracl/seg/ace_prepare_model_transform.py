@@ -113,7 +113,9 @@ def generate_model_transforms(chosen_model, cfg_path_var):
         def __call__(self, image_dict):
             # load the .tiff files they are HxWxD
             # img_path = image_dict['image']
-            image_dict["image"] = tifffile.imread(image_dict["image"])
+            # (patches from the streaming pipeline are already loaded)
+            if not isinstance(image_dict["image"], np.ndarray):
+                image_dict["image"] = tifffile.imread(image_dict["image"])
             # print('img_path: ', img_path)
             # change the order axis of the image from DHW to HWD
             image_dict["image"] = np.moveaxis(image_dict["image"], 0, 2)
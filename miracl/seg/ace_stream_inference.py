@@ -0,0 +1,467 @@
+"""
+This code runs the ACE segmentation as a single streaming pipeline: patch
+generation (ace_generate_patch), model inference (ace_deploy_model) and patch
+stacking (ace_patch_stacking) without the round trips of the patches through
+.tiff files
+
+    reader thread: reads a slab of 512 slices, computes the brain mask and
+                   splits the slab into 512^3 patches
+    main thread:   runs the model(s) on the patches with enough brain
+    writer thread: stacks the output patches of a slab and saves its slices
+
+The threads are connected by bounded queues, so reading, inference and writing
+overlap while only a few slabs are held in memory: the output slabs are kept in
+memory if they fit in the stacking memory (as ace_patch_stacking), else they are
+memory-mapped to temporary files of the output folder. The patches are only saved
+to generated_patches/ if requested: the input patches for debugging, the output
+patches for the instance segmentation (which reads them).
+"""
+# load libraries
+import json
+import os
+import queue
+import threading
+from pathlib import Path
+
+import numpy as np
+from monai.data import list_data_collate
+
+from miracl.seg import ace_deploy_model, ace_generate_patch, ace_patch_stacking, miracl_seg_patch_manifest
+from miracl.utilfn.miracl_utilfn_virtual_stack import VirtualStack
+
+# image patch size used by the models
+PATCH_SIZE = 512
+# number of windows run through the model at once (as ace_deploy_model)
+SW_BATCH_SIZE = 4
+PATCHES_SUBFOLDER = "generated_patches"
+
+# marks the end of a queue
+_DONE = object()
+
+
+# -------------------------------------------------------
+# reader: slabs of slices to patches
+# -------------------------------------------------------
+def read_patches(stack, patch_queue, percentage_brain_patch, patches_dir=None, n_threads=4):
+    """
+    Puts (patch name, patch (ZYX, uint16), percentage of brain) of each patch in
+    patch_queue, one slab of PATCH_SIZE slices at a time. The patches and their
+    names are the same as the ones saved by ace_generate_patch.
+
+    :param stack: virtual stack of the slices
+    :param patch_queue: bounded queue of the patches
+    :param percentage_brain_patch: dict filled with the percentage of brain of each patch
+    :param patches_dir: folder to save the input patches to (default: not saved)
+    :param n_threads: number of threads reading and masking slices
+    """
+    for idx1, z in enumerate(range(0, len(stack), PATCH_SIZE)):
+        img_batch, percentage_brain = ace_generate_patch.read_slab(
+            stack, z, PATCH_SIZE, n_workers=n_threads
+        )
+
+        print(f"  Read slab {idx1} ({img_batch.shape[0]} patches)")
+        for i in range(img_batch.shape[0]):
+            name = "patch_" + str(idx1) + "_" + str(i) + ".tiff"
+            patch = img_batch[i]
+            percentage = percentage_brain[i]
+            percentage_brain_patch[name] = percentage
+
+            if patches_dir is not None:
+                ace_generate_patch.save_patch(Path(patches_dir) / name, patch, PATCH_SIZE)
+            patch_queue.put((name, patch, percentage))
+
+        del img_batch
+
+
+def _read_patches_thread(*args, **kwargs):
+    # errors are passed to the consumer through the queue
+    patch_queue = args[1]
+    try:
+        read_patches(*args, **kwargs)
+    except BaseException as e:
+        patch_queue.put(e)
+    patch_queue.put(_DONE)
+
+
+# -------------------------------------------------------
+# data loader: patches to batches of the model inputs
+# -------------------------------------------------------
+def iter_batches(
+    patch_queue,
+    test_transforms,
+    batch_size,
+    percentage_brain_patch_skip,
+    data_dicts,
+    writer,
+):
+    """
+    Yields batches of transformed patches (as the DataLoader of ace_deploy_model).
+    Patches with too little brain are not run through the model, they are
+    directly passed to the writer as empty outputs (once the outputs of the
+    patches before them are saved, so that the slabs are completed in order).
+
+    :param patch_queue: bounded queue of the patches (see read_patches)
+    :param test_transforms: transforms of the model inputs
+    :param batch_size: number of patches per batch
+    :param percentage_brain_patch_skip: patches with this percentage of brain or less are skipped
+    :param data_dicts: list extended with the data dict ({"image": patch name}) of each patch
+    :param writer: writer of the outputs (see SlabWriter)
+    """
+    batch, empty = [], []
+    while True:
+        item = patch_queue.get()
+        if item is _DONE:
+            break
+        if isinstance(item, BaseException):
+            raise item
+
+        name, patch, percentage = item
+        if percentage <= percentage_brain_patch_skip:
+            if batch:
+                empty.append(name)
+            else:
+                writer.save_empty(name)
+            continue
+
+        data_dicts.append({"image": name})
+        batch.append(test_transforms({"image": patch}))
+        if len(batch) == batch_size:
+            # the outputs of the batch are saved when the next one is requested
+            yield list_data_collate(batch)
+            batch = []
+            for name in empty:
+                writer.save_empty(name)
+            empty = []
+
+    if batch:
+        yield list_data_collate(batch)
+    for name in empty:
+        writer.save_empty(name)
+
+
+# -------------------------------------------------------
+# writer: output patches to slices
+# -------------------------------------------------------
+class SlabWriter(ace_deploy_model.TiffPatchSaver):
+    """
+    Stacks the model outputs of the patches into slabs and saves the slices of
+    each complete slab (the same slices as ace_patch_stacking) in a writer thread
+
+    At most memory_gb of output slabs (being stacked, queued or written) are held
+    in memory; if a single slab does not fit, the slabs are memory-mapped to
+    temporary files instead (two at a time: one stacked, one written)
+
+    :param output_folder: folder of the output slices
+    :param slice_names: names of the input slices
+    :param slice_shape: (height, width) of the input slices
+    :param model_prefix: model name used in the output names, e.g. "unet_"
+    :param MC_flag: whether the outputs are MC dropout outputs (uncertainty and mean)
+    :param patches_dir: folder to also save the output patches to (default: not saved)
+    :param memory_gb: memory (GB) of the output slabs
+    :param chunked_volume: also save the outputs as chunked volumes (see ace_patch_stacking)
+    :param voxel_size: voxel size (ZYX) in um of the chunked volumes
+    """
+
+    def __init__(
+        self,
+        output_folder,
+        slice_names,
+        slice_shape,
+        model_prefix,
+        MC_flag,
+        patches_dir=None,
+        memory_gb=ace_patch_stacking.STACKING_MEMORY_GB,
+        chunked_volume=False,
+        voxel_size=(1.0, 1.0, 1.0),
+    ):
+        self.output_folder = Path(output_folder)
+        self.slice_names = list(slice_names)
+        self.subj_height, self.subj_width = slice_shape
+        self.height = -(-self.subj_height // PATCH_SIZE)
+        self.width = -(-self.subj_width // PATCH_SIZE)
+        self.model_prefix = model_prefix
+        self.MC_flag = MC_flag
+        self.patches_dir = patches_dir
+        if MC_flag:
+            self.image_types = {
+                "uncertainty_" + model_prefix: "float32",
+                "MC_" + model_prefix: "uint8",
+            }
+        else:
+            self.image_types = {"out_": "uint8"}
+
+        self.volumes = {}
+        if chunked_volume:
+            self.volumes = {
+                image_mode: ace_patch_stacking.create_chunked_volume(
+                    self.output_folder,
+                    image_mode,
+                    image_type,
+                    (len(self.slice_names), self.subj_height, self.subj_width),
+                    voxel_size,
+                )
+                for image_mode, image_type in self.image_types.items()
+            }
+
+        self.slab_shape = (PATCH_SIZE, self.height * PATCH_SIZE, self.width * PATCH_SIZE)
+        slab_bytes = int(np.prod(self.slab_shape)) * sum(
+            np.dtype(image_type).itemsize for image_type in self.image_types.values()
+        )
+        n_slabs = int(memory_gb * 1024**3 // slab_bytes)
+        self.memmap = n_slabs == 0
+        if self.memmap:
+            print(f"  Output slabs ({slab_bytes / 1024**3:.1f} GB) are memory-mapped to {self.output_folder}")
+            n_slabs = 2
+        # free slab buffers; the queue of complete slabs is bounded by them
+        self.slots = threading.Semaphore(n_slabs)
+
+        self.slabs = {}
+        self.n_patches = {}
+        self.empty_patches = {}
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_slabs, daemon=True)
+        self.thread.start()
+
+    # same signatures as the functions saving .tiff patches in ace_deploy_model
+    def save_tiff(self, img_list, output_path, path):
+        if self.patches_dir is not None:
+            super().save_tiff(img_list, self.patches_dir, path)
+        self.add_patch(os.path.split(path["image"])[1], {"out_": img_list[0]})
+
+    def save_tiff_MC_dropout(self, img_list, output_path, path, model_name):
+        if self.patches_dir is not None:
+            super().save_tiff_MC_dropout(img_list, self.patches_dir, path, model_name)
+        self.add_patch(
+            os.path.split(path["image"])[1],
+            {"uncertainty_" + model_name: img_list[0], "MC_" + model_name: img_list[1]},
+        )
+
+    def save_empty(self, name):
+        """Empty output of a patch that is not run through the model (not saved,
+        listed in the manifest of the empty patches)"""
+        self.empty_patches[name] = (PATCH_SIZE, PATCH_SIZE, PATCH_SIZE)
+        self.add_patch(name, {})
+
+    def add_patch(self, name, imgs):
+        """
+        Places the outputs (HWD, as returned by the model) of a patch in its slab;
+        the slab is queued for writing once all its patches are added
+        """
+        if self.error is not None:
+            raise self.error
+
+        d, i = [int(n) for n in name[len("patch_") : -len(".tiff")].split("_")]
+        h, w = divmod(i, self.width)
+        if d not in self.slabs:
+            self.slabs[d] = self._new_slab(d)
+            self.n_patches[d] = 0
+
+        for image_mode, img in imgs.items():
+            # reorder the axis of the model output from HWD to DHW (ZYX)
+            img = np.array(img)
+            img = np.moveaxis(img, 1, 0)
+            img = np.moveaxis(img, 2, 0)
+            self.slabs[d][image_mode][
+                :,
+                h * PATCH_SIZE : (h + 1) * PATCH_SIZE,
+                w * PATCH_SIZE : (w + 1) * PATCH_SIZE,
+            ] = img
+
+        self.n_patches[d] += 1
+        if self.n_patches[d] == self.height * self.width:
+            self.queue.put((d, self.slabs.pop(d)))
+            del self.n_patches[d]
+
+    def _new_slab(self, d):
+        """Empty output slab of depth d, once a slab buffer is free"""
+        self.slots.acquire()
+        if not self.memmap:
+            return {
+                image_mode: np.zeros(self.slab_shape, dtype=image_type)
+                for image_mode, image_type in self.image_types.items()
+            }
+        return {
+            image_mode: np.memmap(
+                self.output_folder / f".{image_mode}slab_{d}.tmp", dtype=image_type, mode="w+", shape=self.slab_shape
+            )
+            for image_mode, image_type in self.image_types.items()
+        }
+
+    def _free_slab(self, slab):
+        files = [img.filename for img in slab.values() if isinstance(img, np.memmap)]
+        slab.clear()
+        for file in files:
+            os.remove(file)
+        self.slots.release()
+
+    def _write_slabs(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                return
+
+            d, slab = item
+            try:
+                if self.error is None:
+                    self._write_slab(d, slab)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self._free_slab(slab)
+
+    def _write_slab(self, d, slab):
+        n_slices = min(PATCH_SIZE, len(self.slice_names) - d * PATCH_SIZE)
+        for image_mode, img in slab.items():
+            for z in range(n_slices):
+                ace_patch_stacking.save_slice(
+                    self.output_folder / (image_mode + self.slice_names[d * PATCH_SIZE + z]),
+                    img[z, : self.subj_height, : self.subj_width],
+                    self.image_types[image_mode],
+                    self.width,
+                    self.height,
+                )
+            if image_mode in self.volumes:
+                self.volumes[image_mode][d * PATCH_SIZE : d * PATCH_SIZE + n_slices] = img[
+                    :n_slices, : self.subj_height, : self.subj_width
+                ]
+        print(f"  Saved slices of slab {d}")
+
+    def close(self):
+        """Waits for the queued slabs to be written"""
+        self.queue.put(_DONE)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.slabs:
+            for slab in self.slabs.values():
+                self._free_slab(slab)
+            raise RuntimeError(f"Missing model outputs of slabs: {sorted(self.slabs)}")
+        for vol in self.volumes.values():
+            vol.build_pyramid(ace_patch_stacking.CHUNKED_VOLUME_LEVELS)
+
+
+# -------------------------------------------------------
+# streaming pipeline
+# -------------------------------------------------------
+def run_streaming(
+    input_folder,
+    output_folder,
+    chosen_model,
+    batch_size_var,
+    forward_passes_var,
+    gpu_index,
+    binarization_threshold,
+    percentage_brain_patch_skip,
+    device_type="gpu",
+    cpu_threads=None,
+    cpu_precision="fp32",
+    cpu_compile="none",
+    keep_patches=False,
+    output_patches=False,
+    queue_size=2,
+    n_threads=4,
+    memory_gb=ace_patch_stacking.STACKING_MEMORY_GB,
+    chunked_volume=False,
+    voxel_size=(1.0, 1.0, 1.0),
+):
+    """
+    Segments the slices in input_folder and saves the output slices to output_folder
+    (same outputs as ace_generate_patch, ace_deploy_model and ace_patch_stacking)
+
+    :param keep_patches: save the input and output patches to generated_patches/ (debugging)
+    :param output_patches: save the output patches to generated_patches/ (instance segmentation)
+    :param queue_size: max number of patches read ahead of the inference
+    :param n_threads: number of threads reading and masking slices
+    :param memory_gb: memory (GB) of the input and output slabs (see SlabWriter)
+    :param chunked_volume: also save the outputs as chunked volumes (seg_final_<output>.zarr)
+    :param voxel_size: voxel size (ZYX) in um of the chunked volumes
+    returns: path to generated_patches/ (with the percentage of brain of each patch)
+    """
+    output_folder = Path(output_folder)
+    patches_dir = output_folder / PATCHES_SUBFOLDER
+    patches_dir.mkdir(parents=True, exist_ok=True)
+
+    stack = VirtualStack.from_folder(input_folder)
+    slice_shape = stack.slice_shape
+    print(f"  Streaming {len(stack)} slices of shape {slice_shape} from {input_folder}")
+
+    CFG_PATH = Path(os.environ["MIRACL_HOME"]) / "seg/config_unetr.yml"
+    MC_flag = True if forward_passes_var > 0 else False
+    model_out, test_transforms, post_pred, cfg, device, cpu_opts = ace_deploy_model.prepare_inference(
+        chosen_model,
+        CFG_PATH,
+        binarization_threshold,
+        gpu_index,
+        device_type=device_type,
+        cpu_threads=cpu_threads,
+        cpu_precision=cpu_precision,
+        cpu_compile=cpu_compile,
+    )
+
+    # the reader holds up to two input slabs (uint16): the one read and the one whose patches are queued
+    padded_shape = [-(-n // PATCH_SIZE) * PATCH_SIZE for n in slice_shape[:2]]
+    input_slabs_gb = 2 * PATCH_SIZE * int(np.prod(padded_shape)) * 2 / 1024**3
+
+    writer = SlabWriter(
+        output_folder,
+        [file.name for file in stack.files],
+        slice_shape,
+        chosen_model + "_",
+        MC_flag,
+        patches_dir=patches_dir if keep_patches or output_patches else None,
+        memory_gb=max(memory_gb - input_slabs_gb, 0),
+        chunked_volume=chunked_volume,
+        voxel_size=voxel_size,
+    )
+
+    patch_queue = queue.Queue(maxsize=queue_size)
+    percentage_brain_patch = {}
+    reader = threading.Thread(
+        target=_read_patches_thread,
+        args=(stack, patch_queue, percentage_brain_patch),
+        kwargs={
+            "patches_dir": patches_dir if keep_patches else None,
+            "n_threads": n_threads,
+        },
+        daemon=True,
+    )
+    reader.start()
+
+    data_dicts_test = []
+    ace_deploy_model.run_inference(
+        chosen_model,
+        MC_flag,
+        model_out,
+        patches_dir,
+        batch_size_var,
+        SW_BATCH_SIZE,
+        forward_passes_var,
+        data_dicts_test,
+        post_pred,
+        cfg,
+        device,
+        iter_batches(
+            patch_queue,
+            test_transforms,
+            batch_size_var,
+            percentage_brain_patch_skip,
+            data_dicts_test,
+            writer,
+        ),
+        cpu_opts=cpu_opts,
+        saver=writer,
+    )
+    reader.join()
+    writer.close()
+
+    # save percentage of brain in each patch as json
+    with open(patches_dir / "percentage_brain_patch.json", "w") as f:
+        json.dump(percentage_brain_patch, f, indent=4)
+
+    # empty outputs are not saved, they are read as zeros by the instance segmentation
+    miracl_seg_patch_manifest.save_empty_patches(patches_dir, writer.empty_patches)
+
+    print(f"  In total, {len(percentage_brain_patch)} patches have been segmented!")
+
+    return patches_dir
@@ -12,6 +12,7 @@ from miracl.seg import (
     miracl_instance_segmentation_interface,
     miracl_instance_segmentation_parser,
     miracl_seg_count_neurons_json,
+    miracl_seg_neuron_table,
     ace_finetune_model,
 )
 
@@ -74,6 +75,10 @@ def run_count_neurons_json(parser, args):
     miracl_seg_count_neurons_json.main(args)
 
 
+def run_neuron_table(parser, args):
+    miracl_seg_neuron_table.main(args)
+
+
 def get_parser():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
@@ -180,6 +185,19 @@ def get_parser():
 
     parser_count_neurons_json.set_defaults(func=run_count_neurons_json)
 
+    # neuron_table
+    neuron_table_parser = miracl_seg_neuron_table.parsefn()
+    parser_neuron_table = subparsers.add_parser(
+        miracl_seg_neuron_table.PROG_NAME,
+        parents=[neuron_table_parser],
+        add_help=False,
+        usage=neuron_table_parser.usage,
+        description=neuron_table_parser.description,
+        help="Convert neuron info json to a neuron table",
+    )
+
+    parser_neuron_table.set_defaults(func=run_neuron_table)
+
     return parser
 
 
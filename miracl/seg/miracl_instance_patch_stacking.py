@@ -1,13 +1,16 @@
-import json
 import multiprocessing
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 import tifffile as tiff
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
+from miracl.seg import miracl_seg_patch_manifest
+from miracl.seg.miracl_seg_neuron_table import NeuronTable
+from miracl.utilfn.miracl_utilfn_parallel import parallel_map
+
 CPU_LOAD = 0.7
 
 
@@ -17,6 +20,7 @@ def tiff_parallel_loading(
     input_patch_dir: Path,
     depth: int,
     ncpus: int = int(multiprocessing.cpu_count() * CPU_LOAD),
+    empty_patches: Optional[Dict[str, Tuple[int, int, int]]] = None,
 ) -> List[Tuple[np.ndarray, int, int, Path]]:
     """Load in image patches in parallel. Sort images based on their
     height and width in the overall images. This is used to load all patches
@@ -34,6 +38,9 @@ def tiff_parallel_loading(
     :param ncpus: Number of threads to use for parallel loading,
         defaults to int(multiprocessing.cpu_count() * CPU_LOAD)
     :type ncpus: int, optional
+    :param empty_patches: Shape of the empty (not saved) patches indexed by patch name,
+        defaults to None
+    :type empty_patches: Optional[Dict[str, Tuple[int, int, int]]], optional
     :return: A list of tuples containing the image, height index, width index and path to the image.
         The tuples are sorted for easier stacking.
     :rtype: List[Tuple[np.ndarray, int, int, Path]]
@@ -59,6 +66,7 @@ def tiff_parallel_loading(
             args=arg,
             input_patch_dir=input_patch_dir,
             depth=depth,
+            empty_patches=empty_patches,
         )
         for arg in args
     )
@@ -80,8 +88,9 @@ def _load_tif_single(
     args: Dict[str, int],
     input_patch_dir: Path,
     depth: int,
+    empty_patches: Optional[Dict[str, Tuple[int, int, int]]] = None,
 ) -> Tuple[np.ndarray, int, int, Path]:
-    """Load a single tiff image patch. Used by the parallel
+    """Load a single tiff image patch (zeros for empty patches). Used by the parallel
     loading function.
 
     :param args: Information needed to load the correct patch (height, width, index)
@@ -90,17 +99,255 @@ def _load_tif_single(
     :type input_patch_dir: Path
     :param depth: Current depth multiple of the image.
     :type depth: int
+    :param empty_patches: Shape of the empty (not saved) patches indexed by patch name,
+        defaults to None
+    :type empty_patches: Optional[Dict[str, Tuple[int, int, int]]], optional
     :return: Numpy array of the image, height index, width index and path to the image.
         Used by the parallel loading function to sort the image patches.
     :rtype: Tuple[np.ndarray, int, int, Path]
     """
-    img_path = input_patch_dir / (
-        "CC_patch_" + str(depth) + "_" + str(args["cnt_img"]) + ".tiff"
-    )
-    img = tiff.imread(img_path)
+    img_path = input_patch_dir / _patch_name(depth, args["cnt_img"])
+    img = miracl_seg_patch_manifest.read_patch(img_path, empty_patches or {}, np.uint16)
     return (img, args["h"], args["w"], img_path)
 
 
+def _patch_name(depth: int, cnt_img: int) -> str:
+    return "CC_patch_" + str(depth) + "_" + str(cnt_img) + ".tiff"
+
+
+def _read_faces(
+    img_path: Path,
+    empty_patches: Optional[Dict[str, Tuple[int, int, int]]] = None,
+) -> Dict[str, np.ndarray]:
+    """Read the six border faces of a CC patch. Only the faces are read
+    from memory-mapped (uncompressed) patches; empty patches are not read.
+
+    :param img_path: Path to the CC patch.
+    :type img_path: Path
+    :param empty_patches: Shape of the empty (not saved) patches indexed by patch name,
+        defaults to None
+    :type empty_patches: Optional[Dict[str, Tuple[int, int, int]]], optional
+    :return: First and last z slices ("z0", "z1"), rows ("y0", "y1")
+        and columns ("x0", "x1") of the patch.
+    :rtype: Dict[str, np.ndarray]
+    """
+    if miracl_seg_patch_manifest.patch_name(img_path) in (empty_patches or {}):
+        img = miracl_seg_patch_manifest.read_patch(img_path, empty_patches, np.int64)
+    else:
+        try:
+            img = tiff.memmap(img_path, mode="r")
+        except ValueError:
+            # compressed or non-contiguous patch
+            img = tiff.imread(img_path)
+
+    faces = {
+        "z0": img[0],
+        "z1": img[-1],
+        "y0": img[:, 0, :],
+        "y1": img[:, -1, :],
+        "x0": img[:, :, 0],
+        "x1": img[:, :, -1],
+    }
+    faces = {key: np.array(face, dtype=np.int64) for key, face in faces.items()}
+    del img
+    return faces
+
+
+def _touching_labels(face_a: np.ndarray, face_b: np.ndarray) -> np.ndarray:
+    """Pairs of labels touching across the border between two adjacent faces
+    (full connectivity, as used by `measure.label`).
+
+    :param face_a: Labels on one side of the border.
+    :type face_a: np.ndarray
+    :param face_b: Labels on the other side of the border (same shape).
+    :type face_b: np.ndarray
+    :return: Unique (n, 2) pairs of touching labels.
+    :rtype: np.ndarray
+    """
+    pairs = []
+    shifts = (-1, 0, 1)
+    for s0 in shifts:
+        for s1 in shifts:
+            sl_a = tuple(slice(max(s, 0), n + min(s, 0)) for s, n in zip((s0, s1), face_a.shape))
+            sl_b = tuple(slice(max(-s, 0), n + min(-s, 0)) for s, n in zip((s0, s1), face_b.shape))
+            a = face_a[sl_a]
+            b = face_b[sl_b]
+            mask = (a > 0) & (b > 0)
+            pairs.append(np.stack([a[mask], b[mask]], axis=1))
+
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def find_border_equivalences(
+    height_multiples: int,
+    width_multiples: int,
+    depth_multiples: int,
+    input_patch_dir: Path,
+    label_offsets: Dict[str, int],
+    ncpus: int,
+    empty_patches: Optional[Dict[str, Tuple[int, int, int]]] = None,
+) -> np.ndarray:
+    """Find labels of adjacent CC patches that belong to the same neuron.
+    Streams over the depth multiples; only the border faces of the patches
+    of one depth (and the last z slice of the previous depth) are kept in memory.
+
+    :param height_multiples: Number of times the patch size fits into the height of the image.
+    :type height_multiples: int
+    :param width_multiples: Number of times the patch size fits into the width of the image.
+    :type width_multiples: int
+    :param depth_multiples: Number of times the patch size fits into the depth of the image.
+    :type depth_multiples: int
+    :param input_patch_dir: Location of stored CC patches.
+    :type input_patch_dir: Path
+    :param label_offsets: Offset of the (global) neuron ids of each patch indexed by file name.
+    :type label_offsets: Dict[str, int]
+    :param ncpus: Number of threads to use for parallel loading of the faces.
+    :type ncpus: int
+    :param empty_patches: Shape of the empty (not saved) patches indexed by patch name,
+        defaults to None
+    :type empty_patches: Optional[Dict[str, Tuple[int, int, int]]], optional
+    :return: (n, 2) pairs of equivalent global neuron ids.
+    :rtype: np.ndarray
+    """
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    prev_last_slice = None
+    for d in range(depth_multiples):
+        names = [
+            _patch_name(d, h * width_multiples + w)
+            for h in range(height_multiples)
+            for w in range(width_multiples)
+        ]
+        all_faces = parallel_map(
+            _read_faces,
+            ((input_patch_dir / name, empty_patches) for name in names),
+            n_workers=ncpus,
+            backend="thread",
+        )
+
+        # patch labels to global neuron ids
+        for name, faces in zip(names, all_faces):
+            for face in faces.values():
+                face[face > 0] += label_offsets[name]
+
+        grid = [
+            all_faces[h * width_multiples : (h + 1) * width_multiples]
+            for h in range(height_multiples)
+        ]
+
+        # borders between patches along the height
+        for h in range(height_multiples - 1):
+            pairs.append(
+                _touching_labels(
+                    np.concatenate([faces["y1"] for faces in grid[h]], axis=1),
+                    np.concatenate([faces["y0"] for faces in grid[h + 1]], axis=1),
+                )
+            )
+
+        # borders between patches along the width
+        for w in range(width_multiples - 1):
+            pairs.append(
+                _touching_labels(
+                    np.concatenate([row[w]["x1"] for row in grid], axis=1),
+                    np.concatenate([row[w + 1]["x0"] for row in grid], axis=1),
+                )
+            )
+
+        # border with the previous depth
+        first_slice = np.block([[faces["z0"] for faces in row] for row in grid])
+        if prev_last_slice is not None:
+            pairs.append(_touching_labels(prev_last_slice, first_slice))
+        prev_last_slice = np.block([[faces["z1"] for faces in row] for row in grid])
+
+    return np.concatenate(pairs)
+
+
+def merge_equivalent_labels(pairs: np.ndarray, num_labels: int) -> np.ndarray:
+    """Union-find of equivalent labels. Each set of equivalent labels is
+    merged into a single label; labels are renumbered consecutively in the
+    order of their smallest equivalent label.
+
+    :param pairs: (n, 2) pairs of equivalent labels (1 to num_labels).
+    :type pairs: np.ndarray
+    :param num_labels: Number of labels.
+    :type num_labels: int
+    :return: Lookup table from label to merged label (background stays 0).
+    :rtype: np.ndarray
+    """
+    parent = np.arange(num_labels + 1, dtype=np.int64)
+    a, b = pairs[:, 0], pairs[:, 1]
+    while True:
+        # path compression
+        while True:
+            grand_parent = parent[parent]
+            if np.array_equal(grand_parent, parent):
+                break
+            parent = grand_parent
+
+        root_a, root_b = parent[a], parent[b]
+        diff = root_a != root_b
+        if not np.any(diff):
+            break
+
+        # union: link the larger root to the smallest root it is equivalent to
+        np.minimum.at(
+            parent,
+            np.maximum(root_a, root_b)[diff],
+            np.minimum(root_a, root_b)[diff],
+        )
+
+    # renumber the roots consecutively
+    _, lut = np.unique(parent, return_inverse=True)
+    return lut.astype(np.int64)
+
+
+def merge_neuron_table(neuron_table: NeuronTable, label_lut: np.ndarray) -> NeuronTable:
+    """Merge the rows of neurons split across patches. The area is summed,
+    the centroid is the area-weighted mean and the bbox is the union of the
+    parts; other properties and the offset are those of the first part.
+
+    :param neuron_table: Table with global neuron ids (sorted) and patch offsets.
+    :type neuron_table: NeuronTable
+    :param label_lut: Lookup table from global neuron id to merged neuron id.
+    :type label_lut: np.ndarray
+    :return: Table with one row per merged neuron.
+    :rtype: NeuronTable
+    """
+    if len(neuron_table) == 0:
+        return neuron_table
+
+    merged_ids, first, inverse = np.unique(
+        label_lut[neuron_table["id"]], return_index=True, return_inverse=True
+    )
+    merged = neuron_table.select(first)
+    merged["id"] = merged_ids
+
+    area = neuron_table["area"]
+    merged_area = np.bincount(inverse, weights=area)
+    merged["area"] = merged_area
+
+    offset = neuron_table["offset"]
+    global_centroid = neuron_table["centroid"] + offset
+    merged["centroid"] = (
+        np.stack(
+            [
+                np.bincount(inverse, weights=area * global_centroid[:, i])
+                for i in range(3)
+            ],
+            axis=1,
+        )
+        / merged_area[:, None]
+        - merged["offset"]
+    )
+
+    global_bbox = neuron_table["bbox"] + np.tile(offset, 2)
+    merged_bbox = global_bbox[first].copy()
+    np.minimum.at(merged_bbox[:, :3], inverse, global_bbox[:, :3])
+    np.maximum.at(merged_bbox[:, 3:], inverse, global_bbox[:, 3:])
+    merged["bbox"] = merged_bbox - np.tile(merged["offset"], 2)
+
+    return merged
+
+
 def image_stacking(
     subj_w: int,
     subj_h: int,
@@ -110,12 +357,13 @@ def image_stacking(
     input_patch_dir: Path,
     output_path: Path,
     img_list_name: List[Path],
-    neuron_info_by_file: Dict[str, Dict[str, float]],
+    neuron_info_by_file: Dict[str, Dict[str, Any]],
     ncpus: int = int(multiprocessing.cpu_count() * CPU_LOAD),
 ):
     """Stacks images together onen depth multiple at a time, and saves slices.
-    Updates the neuron info dict with the new neuron ids based on running count
-    of neurons found in each patch.
+    Neurons split across patch borders are merged first (see
+    `find_border_equivalences`), so that each neuron has a single id in the
+    slices and a single row in the neuron table (neuron_info_final.npz).
 
     :param subj_w: Width of the original image slice
     :type subj_w: int
@@ -135,9 +383,9 @@ def image_stacking(
     :param img_list_name: Slice names of the original image used for saving
         CC slices with the same format
     :type img_list_name: List[Path]
-    :param neuron_info_by_file: Neuron information calculated during CC
-        indexed by file name
-    :type neuron_info_by_file: Dict[str, Dict[str, float]]
+    :param neuron_info_by_file: Neuron count and table ("total_neurons", "neuron_info")
+        calculated during CC indexed by file name
+    :type neuron_info_by_file: Dict[str, Dict[str, Any]]
     :param ncpus: Number of threads to use for parallel loading of image patches,
         defaults to int(multiprocessing.cpu_count() * CPU_LOAD)
     :type ncpus: int, optional
@@ -146,8 +394,38 @@ def image_stacking(
     width_multiples = subj_w // patch_size + 1 * (subj_w % patch_size > 0)
     depth_multiples = subj_depth // patch_size + 1 * (subj_depth % patch_size > 0)
 
-    depth_tracker = 1
+    # global neuron ids: patch ids offset by the running cell count
+    label_offsets = dict()
+    patch_offsets = dict()
     running_cell_count = 0
+    for d in range(depth_multiples):
+        for h in range(height_multiples):
+            for w in range(width_multiples):
+                fname = _patch_name(d, h * width_multiples + w)
+                label_offsets[fname] = running_cell_count
+                patch_offsets[fname] = (d * patch_size, h * patch_size, w * patch_size)
+                running_cell_count += neuron_info_by_file[fname]["total_neurons"]
+
+    # empty patches (not saved) are read as zeros
+    empty_patches = miracl_seg_patch_manifest.load_empty_patches(input_patch_dir)
+
+    print("Merging neurons across patch borders...")
+    pairs = find_border_equivalences(
+        height_multiples=height_multiples,
+        width_multiples=width_multiples,
+        depth_multiples=depth_multiples,
+        input_patch_dir=input_patch_dir,
+        label_offsets=label_offsets,
+        ncpus=ncpus,
+        empty_patches=empty_patches,
+    )
+    label_lut = merge_equivalent_labels(pairs, running_cell_count)
+    print(
+        f"  {running_cell_count} patch neurons merged into {label_lut.max()} neurons"
+    )
+
+    depth_tracker = 1
+    stacked_tables = []
     for d in range(depth_multiples):
         img_one_depth = np.zeros(
             (patch_size, height_multiples * patch_size, width_multiples * patch_size),
@@ -160,6 +438,7 @@ def image_stacking(
             input_patch_dir=input_patch_dir,
             depth=d,
             ncpus=ncpus,
+            empty_patches=empty_patches,
         )
 
         for h in range(height_multiples):
@@ -173,50 +452,40 @@ def image_stacking(
                     img_list[h][w][2] == w
                 ), f"Width index mismatch: {img_list[h][w][2]} != {w}"
 
-                # update image based on running cell count
+                # crop the image if it is larger than the original image
+                img_one_depth = img_one_depth[: img_temp.shape[0], :, :]
+
+                # empty patches are all zero, no neurons to add
                 fname = img_list[h][w][3].name
+                if miracl_seg_patch_manifest.patch_name(fname) in empty_patches:
+                    continue
+
+                # update image with the merged neuron ids
                 curr_cells = neuron_info_by_file[fname]["total_neurons"]
                 assert curr_cells == np.max(
                     img_temp
                 ), f"Cell count mismatch: {curr_cells} != {np.max(img_temp)}"
                 img_mask = img_temp > 0
-                img_temp[img_mask] += running_cell_count
-
-                # add running cell count to each neuron in the dict
-                old_neuron_ids = [
-                    neuron_id
-                    for neuron_id, _ in neuron_info_by_file[fname][
-                        "neuron_info"
-                    ].items()
+                img_merged = np.zeros(img_temp.shape, dtype=image_type)
+                img_merged[img_mask] = label_lut[
+                    img_temp[img_mask].astype(np.int64) + label_offsets[fname]
                 ]
 
-                temp_dict = dict()
-                for neuron_id, neuron_info in neuron_info_by_file[fname][
-                    "neuron_info"
-                ].items():
-                    new_neuron_id = int(neuron_id) + running_cell_count
-                    temp_dict[new_neuron_id] = neuron_info
-
-                    neuron_info_by_file[fname]["height"] = h * patch_size
-                    neuron_info_by_file[fname]["width"] = w * patch_size
-                    neuron_info_by_file[fname]["depth"] = d * patch_size
-
-                neuron_info_by_file[fname]["neuron_info"].update(temp_dict)
-
-                # remove old neuron ids (strings)
-                for neuron_id in old_neuron_ids:
-                    neuron_info_by_file[fname]["neuron_info"].pop(neuron_id, None)
-
-                running_cell_count += curr_cells
-
-                # crop the image if it is larger than the original image
-                img_one_depth = img_one_depth[: img_temp.shape[0], :, :]
+                # global neuron ids and patch location
+                neuron_table = neuron_info_by_file[fname]["neuron_info"].select(
+                    slice(None)
+                )
+                neuron_table["id"] = neuron_table["id"] + label_offsets[fname]
+                neuron_table["offset"] = np.tile(
+                    patch_offsets[fname], (len(neuron_table), 1)
+                )
+                stacked_tables.append(neuron_table)
 
                 img_one_depth[
                     :,
                     h * patch_size : (h + 1) * patch_size,
                     w * patch_size : (w + 1) * patch_size,
-                ] = img_temp
+                ] = img_merged
 
         for z in tqdm(range(img_one_depth.shape[0])):
             img_save_slice = img_one_depth[z, :subj_h, :subj_w]
@@ -240,36 +509,21 @@ def image_stacking(
 
         del img_save_slice
 
-    # save the neuron info dict
-    with open(
-        input_patch_dir / "neuron_info_from_patches_post_stacking.json", "w"
-    ) as f:
-        json.dump(neuron_info_by_file, f, indent=4)
-
-    # merge the data into a single json file
-    final_neuron_info_dict = dict()
-    for fname, neuron_info in neuron_info_by_file.items():
-        for neuron_id, neuron_props in neuron_info["neuron_info"].items():
-            final_neuron_info_dict[neuron_id] = neuron_props
-            final_neuron_info_dict[neuron_id]["depth"] = neuron_info["depth"]
-            final_neuron_info_dict[neuron_id]["height"] = neuron_info["height"]
-            final_neuron_info_dict[neuron_id]["width"] = neuron_info["width"]
-
-    with open(
-        input_patch_dir / "neuron_info_final.json", "w"
-    ) as f:
-        json.dump(final_neuron_info_dict, f, indent=4)
+    # merge the neuron tables of all patches into a single table
+    merge_neuron_table(NeuronTable.concat(stacked_tables), label_lut).save(
+        input_patch_dir / "neuron_info_final.npz"
+    )
 
 
 def run_stacking(
     patches_dir: Path,
     raw_input_dir: Path,
     output_dir: Path,
-    neuron_info_by_file: Dict[str, Dict[str, float]],
+    neuron_info_by_file: Dict[str, Dict[str, Any]],
     ncpus: int,
 ):
     """Main function of stacking the patches into a single image.
-    Also updates the neuron info dict with the new neuron ids.
+    Also updates the neuron tables with the new neuron ids.
 
     :param patches_dir: Location of CC patches
     :type patches_dir: Path
@@ -277,9 +531,9 @@ def run_stacking(
     :type raw_input_dir: Path
     :param output_dir: Destination folder for the stacked image slices
     :type output_dir: Path
-    :param neuron_info_by_file: Neuron information calculated during CC
-        indexed by file name
-    :type neuron_info_by_file: Dict[str, Dict[str, float]]
+    :param neuron_info_by_file: Neuron count and table ("total_neurons", "neuron_info")
+        calculated during CC indexed by file name
+    :type neuron_info_by_file: Dict[str, Dict[str, Any]]
     :param ncpus: Number of threads to use for parallel loading of images
     :type ncpus: int
     """
@@ -304,7 +558,13 @@ def run_stacking(
     subj_w = img.shape[1]
 
     print(f"the main input has the size of {subj_h} x {subj_w} x {subj_depth}")
-    patch_size = tiff.imread(list(patches_dir.glob("*.tiff"))[0]).shape[0]
+    # patch size from the header of a saved patch (or from the empty patches)
+    saved_patches = list(patches_dir.glob("*.tiff"))
+    if saved_patches:
+        with tiff.TiffFile(saved_patches[0]) as tif:
+            patch_size = tif.series[0].shape[0]
+    else:
+        patch_size = next(iter(miracl_seg_patch_manifest.load_empty_patches(patches_dir).values()))[0]
 
     image_stacking(
         subj_w=subj_w,
@@ -1,23 +1,28 @@
 import json
-import multiprocessing
 import re
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import List, Tuple
 
 import numpy as np
 import tifffile
-from joblib import Parallel, delayed
+from scipy import ndimage
 from skimage import measure
 from tqdm import tqdm
 
 from miracl.seg import (
     miracl_instance_patch_stacking,
     miracl_instance_segmentation_parser,
+    miracl_seg_neuron_table,
+    miracl_seg_patch_manifest,
 )
+from miracl.utilfn.miracl_utilfn_parallel import get_ncpus, parallel_map
 
 ACE_MATCH_PATTERN = re.compile(r"(patch_.*)")
 ACE_REPLACE_PATTERN = re.compile(r"(.*)patch_.*")
 
+# properties computed for all labels at once (without regionprops)
+FAST_PROPS = ("label", "area", "centroid", "bbox")
+
 
 def get_brain_patch_percentage_json(dir: Path) -> dict:
     """Get the brain patch percentage from the JSON file.
@@ -48,14 +53,103 @@ def get_all_model_outputs(dir: Path, pattern: str) -> List[Path]:
     return sorted(list(dir.glob(pattern)))
 
 
+def compute_region_props(
+    label_img: np.ndarray,
+    num_labels: int,
+    props: List[str],
+) -> miracl_seg_neuron_table.NeuronTable:
+    """Compute region properties of all labels of a label image.
+    Area, centroid and bbox are computed for all labels at once with
+    `bincount` and `ndimage.find_objects`; only other properties use
+    `skimage.measure.regionprops`.
+
+    :param label_img: Label image with labels 1..num_labels (e.g. from `measure.label`).
+    :type label_img: np.ndarray
+    :param num_labels: Number of labels in the image.
+    :type num_labels: int
+    :param props: Properties to compute for each neuron.
+    :type props: List[str]
+    :return: Table with the region properties of each label (same values as regionprops).
+    :rtype: NeuronTable
+    """
+
+    if num_labels == 0:
+        return miracl_seg_neuron_table.NeuronTable.empty()
+
+    columns = {"id": np.arange(1, num_labels + 1, dtype=np.int64)}
+
+    # voxel coordinates of each label
+    flat_idx = np.flatnonzero(label_img)
+    flat_labels = label_img.ravel()[flat_idx]
+    coords = np.unravel_index(flat_idx, label_img.shape)
+
+    area = np.bincount(flat_labels, minlength=num_labels + 1)[1:]
+    if "area" in props:
+        columns["area"] = area.astype(np.float64)
+
+    if "centroid" in props:
+        columns["centroid"] = np.stack(
+            [
+                np.bincount(flat_labels, weights=coord, minlength=num_labels + 1)[1:]
+                / area
+                for coord in coords
+            ],
+            axis=1,
+        )
+
+    if "bbox" in props:
+        slices = ndimage.find_objects(label_img, max_label=num_labels)
+        columns["bbox"] = np.array(
+            [
+                [s.start for s in obj_slices] + [s.stop for s in obj_slices]
+                for obj_slices in slices
+            ],
+            dtype=np.int64,
+        )
+
+    # generic (slow) path for other properties
+    other_props = [prop for prop in props if prop not in FAST_PROPS]
+    if other_props:
+        other_table = miracl_seg_neuron_table.NeuronTable.from_regionprops(
+            regions=measure.regionprops(label_image=label_img), props=other_props
+        )
+        for prop in other_props:
+            if prop in other_table.columns:
+                columns[prop] = other_table[prop]
+
+    return miracl_seg_neuron_table.NeuronTable(columns)
+
+
+def is_skipped_patch(
+    input_file: Path,
+    percentage_brain_patch: dict,
+    percentage_brain_patch_skip: float,
+) -> bool:
+    """Whether a patch has too little brain to be processed.
+
+    :param input_file: Model output patch.
+    :type input_file: Path
+    :param percentage_brain_patch: Portion of the patch that is brain.
+    :type percentage_brain_patch: dict
+    :param percentage_brain_patch_skip: Minimum percentage of brain patch to not skip.
+    :type percentage_brain_patch_skip: float
+    :return: True if the patch is skipped (empty).
+    :rtype: bool
+    """
+    original_img_name = re.findall(ACE_MATCH_PATTERN, str(input_file))[0]
+    return (
+        percentage_brain_patch.get(original_img_name, 100.0)
+        < percentage_brain_patch_skip * 100.0
+    )
+
+
 def process_single_file(
     output_folder: Path,
     input_file: Path,
     percentage_brain_patch: dict,
     percentage_brain_patch_skip: float,
     props: List[str],
-    img_size: Optional[Tuple[int, int, int]] = None,
-) -> Tuple[int, Path, Dict[str, Dict[str, float]]]:
+) -> Tuple[int, Path, miracl_seg_neuron_table.NeuronTable]:
     """Load and process a single file.
     Performs CC analysis on the segmentation output.
     Also takes into account the running total number of cells in the brain.
@@ -70,38 +164,18 @@ def process_single_file(
     :type percentage_brain_patch_skip: float
     :param props: Properties to compute for each nejuron
     :type props: List[str]
-    :param img_size: Size of the image.
-    :type img_size: Optional[Tuple[int, int, int]]
-    :return: Total number of cells in brain patch and Path to saved patch.
-    :rtype: Tuple[int, Path]
+    :return: Total number of cells in brain patch, Path to saved patch (not
+        saved for skipped patches) and the region properties of its neurons.
+    :rtype: Tuple[int, Path, NeuronTable]
     """
 
-    original_img_name = re.findall(ACE_MATCH_PATTERN, str(input_file))[0]
     save_cc_file = output_folder / str(input_file).replace(
         re.findall(ACE_REPLACE_PATTERN, str(input_file))[0], "CC_"
     )
 
-    if (
-        percentage_brain_patch.get(original_img_name, 100.0)
-        < percentage_brain_patch_skip * 100.0
-    ):
-        if img_size is None:
-            seg_img = tifffile.imread(input_file)
-            img_size = seg_img.shape
-        # save an empty file of the same size
-        tifffile.imwrite(
-            save_cc_file,
-            np.zeros(img_size, dtype=np.uint16),
-            metadata={
-                "DimensionOrder": "ZYX",
-                "SizeC": 1,
-                "SizeT": 1,
-                "SizeZ": img_size[0],
-                "SizeY": img_size[1],
-                "SizeX": img_size[2],
-            },
-        )
-        return 0, save_cc_file, dict()
+    if is_skipped_patch(input_file, percentage_brain_patch, percentage_brain_patch_skip):
+        # nothing to save, the patch is listed as empty (see miracl_seg_patch_manifest)
+        return 0, save_cc_file, miracl_seg_neuron_table.NeuronTable.empty()
 
     # load in the file
     seg_img = tifffile.imread(input_file)
@@ -110,35 +184,10 @@ def process_single_file(
     seg_img_cc, num_cells = measure.label(seg_img.astype(np.bool_), return_num=True)
 
     # compute region properties
-    region_props_out = measure.regionprops(
-        label_image=seg_img_cc,
+    neuron_table = compute_region_props(
+        label_img=seg_img_cc, num_labels=num_cells, props=props
     )
 
-    neuron_info_dict = dict()
-    for region in region_props_out:
-        neuron_info_dict[str(region["label"])] = dict()
-        for prop in props:
-            if prop == "label":
-                continue
-            if hasattr(region[prop], "__iter__"):
-                if np.issubdtype(type(region[prop][0]), np.integer):
-                    neuron_info_dict[str(region["label"])][prop] = list(
-                        map(int, region[prop])
-                    )
-                elif np.issubdtype(type(region[prop][0]), np.floating):
-                    neuron_info_dict[str(region["label"])][prop] = list(
-                        map(float, region[prop])
-                    )
-                else:
-                    neuron_info_dict[str(region["label"])][prop] = region[prop]
-            else:
-                if np.issubdtype(type(region[prop]), np.integer):
-                    neuron_info_dict[str(region["label"])][prop] = int(region[prop])
-                elif np.issubdtype(type(region[prop]), np.floating):
-                    neuron_info_dict[str(region["label"])][prop] = float(region[prop])
-                else:
-                    neuron_info_dict[str(region["label"])][prop] = region[prop]
-
     # save the connected components image
     tifffile.imwrite(
         save_cc_file,
@@ -152,7 +201,7 @@ def process_single_file(
             "SizeX": seg_img.shape[2],
         },
     )
-    return num_cells, save_cc_file, neuron_info_dict
+    return num_cells, save_cc_file, neuron_table
 
 
 def validate_args(args):
@@ -190,8 +239,7 @@ def main(args):
     print(f"  Stack patches:               {no_stack}")
     print(f"  CPU load:                    {cpu_load}\n")
 
-    cpus = multiprocessing.cpu_count()
-    ncpus = int(cpu_load * cpus)
+    ncpus = get_ncpus(cpu_load)
 
     if percentage_brain_patch_skip > 0.0:
         percentage_brain_patch = get_brain_patch_percentage_json(dir=input_folder)
@@ -204,22 +252,27 @@ def main(args):
     all_output_files = get_all_model_outputs(dir=input_folder, pattern=glob_pattern)
     print(f"Number of files: {len(all_output_files)}")
 
-    img_size = tifffile.imread(all_output_files[0]).shape
+    with tifffile.TiffFile(all_output_files[0]) as tif:
+        img_size = tif.series[0].shape
     print(f"Image size: {img_size}")
 
-    parallel_res = Parallel(n_jobs=ncpus, backend="threading")(
-        delayed(process_single_file)(
-            output_folder=cc_patch_output_folder,
-            input_file=output_file,
-            percentage_brain_patch=percentage_brain_patch,
-            percentage_brain_patch_skip=percentage_brain_patch_skip,
-            props=props,
-            img_size=img_size,
-        )
-        for output_file in tqdm(all_output_files)
+    # CC labelling & region props hold the GIL, patches are processed in a process pool
+    parallel_res = parallel_map(
+        process_single_file,
+        (
+            (
+                cc_patch_output_folder,
+                output_file,
+                percentage_brain_patch,
+                percentage_brain_patch_skip,
+                props,
+            )
+            for output_file in tqdm(all_output_files)
+        ),
+        n_workers=ncpus,
     )
 
-    # format the dict to save it
+    # neuron tables indexed by patch
     neuron_info_by_file = dict()
     for cell_count, file, neuron_info in parallel_res:
         neuron_info_by_file[file.name] = {
@@ -227,9 +280,30 @@ def main(args):
             "neuron_info": neuron_info,
         }
 
-    # save file as json in output dir
-    with open(cc_patch_output_folder / "neuron_info_from_patches_pre_stacking.json", "w") as f:
-        json.dump(neuron_info_by_file, f, indent=5)
+    # empty patches are not saved: the patches listed as empty by the ACE
+    # segmentation and the skipped patches are listed as empty CC patches
+    empty_patches = dict()
+    for name, shape in miracl_seg_patch_manifest.load_empty_patches(input_folder).items():
+        neuron_info_by_file["CC_" + name] = {
+            "total_neurons": 0,
+            "neuron_info": miracl_seg_neuron_table.NeuronTable.empty(),
+        }
+        empty_patches[name] = shape
+    for output_file in all_output_files:
+        if is_skipped_patch(output_file, percentage_brain_patch, percentage_brain_patch_skip):
+            empty_patches[output_file.name] = img_size
+    miracl_seg_patch_manifest.save_empty_patches(cc_patch_output_folder, empty_patches)
+    print(f"Number of empty patches: {len(empty_patches)}")
+
+    # save the (un-stacked) neuron tables of all patches, patch ids are local to each patch
+    pre_stacking_tables = []
+    for fname, neuron_info in neuron_info_by_file.items():
+        table = neuron_info["neuron_info"].select(slice(None))
+        table["patch"] = np.full(len(table), fname)
+        pre_stacking_tables.append(table)
+    miracl_seg_neuron_table.NeuronTable.concat(pre_stacking_tables).save(
+        cc_patch_output_folder / "neuron_info_from_patches_pre_stacking.npz"
+    )
 
     # do patch stacking on the completed files
     if no_stack:
@@ -65,7 +65,8 @@ class MIRACLInstanceSegParser(argparse.ArgumentParser):
             required=False,
             nargs="+",
             default=["area", "centroid", "bbox", "label"],
-            help="Properties to compute for each neuron (default: %(default)s)",
+            help="""Properties to compute for each neuron (default: %(default)s).
+            Properties other than area, centroid, bbox and label use skimage regionprops and are slower""",
         )
         # Parser for glob pattern i.e. pattern to match files
         optional_args.add_argument(
@@ -1,15 +1,16 @@
 import argparse
-import json
-import multiprocessing as mp
 import os
 import time
-from contextlib import closing
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
+from typing import List, Tuple, Union
 
 import numpy as np
 import pandas as pd
-import tifffile as tiff
+
+from miracl.lbls.miracl_lbls_ontology import load_ontology
+from miracl.seg.miracl_seg_neuron_table import NeuronTable, load_neuron_table
+from miracl.utilfn.miracl_utilfn_virtual_stack import VirtualStack, find_slices, read_header
+from miracl.utilfn.miracl_utilfn_parallel import get_ncpus
 
 ATLAS_DIR = Path(os.environ.get("aradir"))
 PROG_NAME = "count_neurons"
@@ -44,7 +45,8 @@ def parsefn():
     required_args.add_argument(
         "--neuron-info-dict",
         type=str,
-        help="Path to the neuron info dict from instance segmentation (neuron_info_final.json)",
+        help="""Path to the neuron table from instance segmentation (neuron_info_final.npz).
+        Legacy neuron info json files (neuron_info_final.json) are also accepted""",
         required=True,
     )
     optional_args = parser.add_argument_group("optional arguments")
@@ -155,16 +157,12 @@ def validate_inputs(
     labels_dir = Path(labels_dir)
 
     assert labels_dir.exists(), f"Labels directory does not exist: {labels_dir}"
-    label_files = sorted(labels_dir.glob("*.tif"))
+    label_files = find_slices(labels_dir, pattern="*.tif")
     num_label_slices = len(label_files)
-    assert (
-        num_label_slices > 0
-    ), f"No *.tif files found in labels directory: {labels_dir}"
     print(f"Found {num_label_slices} tif files in labels directory")
 
-    # load in single tif from labels dir
-    lbls = tiff.imread(label_files[0])
-    lbls_shape = (num_label_slices, *lbls.shape)
+    # shape of the label slices from the header of the first one
+    lbls_shape = (num_label_slices, *read_header(label_files[0])[0])
 
     # ensure output directory exists
     output_dir = Path(output_dir)
@@ -208,29 +206,28 @@ def validate_inputs(
 
 
 def save_results(
-    result_dict: Dict[int, Dict[str, int]],
+    result_dict: NeuronTable,
     output_dir: Path,
     hemi: str,
 ):
     """Save the final results to a CSV file that includes atlas information about regions.
 
     :param result_dict: Result of the feature extraction containing neuron information and label
-    :type result_dict: Dict[int, Dict[str, int]]
+    :type result_dict: NeuronTable
     :param output_dir: Directory to save CSV file
     :type output_dir: Path
     :param hemi: Half or whole brain atlas
     :type hemi: str
     """
     # load it atlas csv
-    graph = pd.read_csv(ATLAS_DIR / f"ara_mouse_structure_graph_hemi_{hemi}.csv")
+    graph = load_ontology(csv=ATLAS_DIR / f"ara_mouse_structure_graph_hemi_{hemi}.csv")
 
     # create dataframe from neuron info
     neuron_df = pd.DataFrame(
         dict(
-            NeuronID=[k for k in result_dict.keys()],
-            Area=[v["area"] for v in result_dict.values()],
-            Centroid=[v["centroid"] for v in result_dict.values()],
-            LabelID=[v["label_val"] for v in result_dict.values()],
+            NeuronID=result_dict["id"],
+            Area=result_dict["area"],
+            LabelID=result_dict["label"],
         )
     )
 
@@ -249,21 +246,15 @@ def save_results(
     )
 
     # save results to csv
-    count_df = count_df[count_df.LabelID.isin(graph.id)]
-
-    # make dicts
-    name_dict = dict(zip(graph.id, graph.name))
-    acronym_dict = dict(zip(graph.id, graph.acronym))
-    parent_id_dict = dict(zip(graph.id, graph.parent_structure_id))
-    path_dict = dict(zip(graph.id, graph.structure_id_path))
-    depth_dict = dict(zip(graph.id, graph.depth))
+    count_df = count_df[graph.contains(count_df.LabelID.values)]
 
     # add columns from atlas
-    count_df["LabelName"] = count_df["LabelID"].map(name_dict)
-    count_df["LabelAbrv"] = count_df["LabelID"].map(acronym_dict)
-    count_df["ParentID"] = count_df["LabelID"].map(parent_id_dict)
-    count_df["IDPath"] = count_df["LabelID"].map(path_dict)
-    count_df["Depth"] = count_df["LabelID"].map(depth_dict)
+    label_ids = count_df["LabelID"].values
+    count_df["LabelName"] = graph.column("name", label_ids)
+    count_df["LabelAbrv"] = graph.column("acronym", label_ids)
+    count_df["ParentID"] = graph.column("parent_structure_id", label_ids)
+    count_df["IDPath"] = graph.column("structure_id_path", label_ids)
+    count_df["Depth"] = graph.column("depth", label_ids)
 
     count_df.columns = [c[0] + "_" + c[1] if c[1] else c[0] for c in count_df.columns]
     count_df = count_df.rename(
@@ -299,150 +290,26 @@ def save_results(
     print(f"Features saved to: {count_csv_path}")
 
 
-def _init_label(shared_arr_: Tuple[mp.RawArray, np.dtype, Tuple[int, int, int]]):
-    """Allocate the shared array to global variables for reference
-    in the parallel function.
-
-    :param shared_arr_: The shared array pointer is a global variable so that it
-    can be accessed by the child processes. It is a tuple (pointer, dtype, shape).
-    :type shared_arr_: Tuple[mp.RawArray, np.dtype, Tuple[int, int, int]]
-    """
-    global global_shared_arr_label
-    global_shared_arr_label = shared_arr_
-
-
-def shared_to_numpy(
-    shared_arr: mp.RawArray, dtype: np.dtype, shape: Tuple[int, int, int]
-):
-    """Get a NumPy array from a shared memory buffer, with a given dtype and shape.
-    No copy is involved, the array reflects the underlying shared buffer.
-
-    :param shared_arr: The shared array pointer.
-    :type shared_arr: mp.RawArray
-    :param dtype: The data type of the array.
-    :type dtype: np.dtype
-    :param shape: The shape of the array.
-    :type shape: Tuple[int, int, int]
-    :return: The NumPy array view of the shared memory buffer.
-    :rtype: np.ndarray
-    """
-    return np.frombuffer(shared_arr, dtype=dtype).reshape(shape)
-
-
-def create_shared_array(
-    dtype: np.dtype, shape: Tuple[int, int, int]
-) -> Tuple[mp.RawArray, np.ndarray]:
-    """Create a new shared array. Return the shared array pointer, and a NumPy array view to it.
-    Note that the buffer values are not initialized.
-
-    :param dtype: Data type of initialized array
-    :type dtype: np.dtype
-    :param shape: Shape of initialized array
-    :type shape: Tuple[int, int, int]
-    :return: Shared array pointer and numpy array with data from shared array
-    :rtype: Tuple[mp.RawArray, np.ndarray]
-    """
-    dtype = np.dtype(dtype)
-    # Get a ctype type from the NumPy dtype.
-    cdtype = np.ctypeslib.as_ctypes_type(dtype)
-    # Create the RawArray instance.
-    shared_arr = mp.RawArray(cdtype, shape[0] * shape[1] * shape[2])
-    # Get a NumPy array view.
-    arr = shared_to_numpy(shared_arr=shared_arr, dtype=dtype, shape=shape)
-    return shared_arr, arr
-
-
-def _load_slice(file: Path, slice: int):
-    """Load in a slice of an image and place it in a shared
-    memory array
-
-    :param file: Location of slice to load
-    :type file: Path
-    :param slice: Depth index of slice to place in
-    shared array
-    :type slice: int
-    """
-    img = tiff.imread(file)
-    arr = shared_to_numpy(*global_shared_arr_label)
-    arr[slice, :, :] = img
-
-
-def load_image_parallel(
-    files: List[Path],
-    shape: Tuple[int, int, int],
-    dtype: np.dtype,
-    ncpus: int,
-    pool_args: Dict[str, Any],
-    verbose: bool = False,
-) -> Tuple[mp.RawArray, np.ndarray]:
-    """Load in large 3d images in parallel slice-by-slice. This function
-    uses a shared memory array for each process to write the contents of the
-    image slices to.
-
-    :param files: Slice filenames
-    :type files: List[Path]
-    :param shape: Shape of overall 3D image
-    :type shape: Tuple[int, int, int]
-    :param dtype: Data type to store in shared array
-    :type dtype: np.dtype
-    :param ncpus: Number of processes to load in data in parallel
-    :type ncpus: int
-    :param pool_args: Arguments needed to initialize the pool of workers
-    :type pool_args: Dict[str, Any]
-    :param verbose: Print out more information, defaults to False
-    :type verbose: bool, optional
-    :return: The pointer to the shared array in memory and the numpy view of the data
-    :rtype: Tuple[mp.RawArray, np.ndarray]
-    """
-    start = time.perf_counter()
-    if verbose:
-        print("Loading in array")
-    shared_arr, arr = create_shared_array(dtype=dtype, shape=shape)
-    if verbose:
-        print(f"Done creating array... in {time.perf_counter() - start} seconds")
-    # fill in the array
-    arr[:] = np.zeros(shape, dtype=dtype)
-
-    with closing(
-        mp.Pool(
-            ncpus, initializer=pool_args["init"], initargs=((shared_arr, dtype, shape),)
-        )
-    ) as p:
-        # Call parallel_function in parallel.
-        p.starmap(
-            _load_slice,
-            ((file, slice) for slice, file in enumerate(files)),
-        )
-    # Close the processes.
-    p.join()
-
-    if verbose:
-        print("Done filling array...")
-        print(f"Time taken: {time.perf_counter() - start}")
-
-    return shared_arr, arr
-
-
 def get_neuron_labels(
-    neuron_info_dict: Dict[int, Dict[str, int]],
-    arr_label: np.ndarray,
+    neuron_table: NeuronTable,
+    arr_label: Union[np.ndarray, VirtualStack],
     output_dir: Path,
     min_area: int,
     max_area: int,
     skip: int,
     verbose: bool = False,
-) -> Dict[int, Dict[str, int]]:
+) -> NeuronTable:
     """Get neuron labels by indexing the label array at the centroid of
-    each neuron. Note: the dictionary will be the same as the input
-    but with an additional key `label_val` representing the region the
-    neuron belongs to. Any neurons that have their centroid in the background
-    (i.e., label=0) are removed.
-
-    :param neuron_info_dict: Neuron information indexed by neuron ID
-    :type neuron_info_dict: Dict[int, Dict[str, int]]
-    :param arr_label: Label array to index
-    :type arr_label: np.ndarray
-    :param output_dir: Location to save labeled json file
+    each neuron. Note: the table will be the same as the input but with
+    the `label` column set to the region the neuron belongs to. Any neurons
+    that have their centroid in the background (i.e., label=0) are removed.
+
+    :param neuron_table: Neuron information (one row per neuron)
+    :type neuron_table: NeuronTable
+    :param arr_label: Label array to index (a lazy stack only reads the slices
+        containing centroids)
+    :type arr_label: Union[np.ndarray, VirtualStack]
+    :param output_dir: Location to save labeled neuron table
     :type output_dir: Path
     :param min_area: Minimum voxel area needed to consider a neuron
     :type min_area: int
@@ -453,7 +320,7 @@ def get_neuron_labels(
     :param verbose: Print out more information, defaults to False
     :type verbose: bool, optional
     :return: Neuron information with label information added.
-    :rtype: Dict[int, Dict[str, int]]
+    :rtype: NeuronTable
     """
     start = time.perf_counter()
     if verbose:
@@ -462,44 +329,31 @@ def get_neuron_labels(
     min_slice = skip
     max_slice = arr_label.shape[0] - skip
 
-    # loop over all regions, then neurons
-    for neuron_id, neuron_stats in neuron_info_dict.items():
-        # get the centroid
-        centroid = tuple(map(round, neuron_stats["centroid"]))
-
-        # check that the centroid is not in the skipping region
-        if (
-            centroid[0] + neuron_stats["depth"] < min_slice
-            or centroid[0] + neuron_stats["depth"] >= max_slice
-        ):
-            continue
-
-        # get the label value of the atlas where the centroid is
-        label_val = arr_label[
-            centroid[0] + neuron_stats["depth"],
-            centroid[1] + neuron_stats["height"],
-            centroid[2] + neuron_stats["width"],
-        ]
-        if (
-            neuron_stats["area"] >= min_area
-            and neuron_stats["area"] <= max_area
-            and int(label_val) > 0
-        ):
-            # save that information to the centroid
-            neuron_stats["label_val"] = int(label_val)
-
-    remove = [k for k, v in neuron_info_dict.items() if "label_val" not in v.keys()]
-    for k in remove:
-        neuron_info_dict.pop(k, None)
-
-    # save to json
-    with open(output_dir / "neuron_info_final_with_label.json", "w") as f:
-        json.dump(neuron_info_dict, f, indent=4)
+    # centroid voxel of each neuron in the whole image
+    # (rounded before adding the patch offset, half to even as round())
+    coords = np.rint(neuron_table["centroid"]).astype(np.int64) + neuron_table["offset"]
+
+    # check that the centroid is not in the skipping region (or in the
+    # padding of the patches outside of the image)
+    keep = (coords[:, 0] >= min_slice) & (coords[:, 0] < max_slice)
+    keep &= np.all((coords >= 0) & (coords < arr_label.shape), axis=1)
+    keep &= (neuron_table["area"] >= min_area) & (neuron_table["area"] <= max_area)
+
+    # get the label value of the atlas where the centroid is
+    label_val = np.zeros(len(neuron_table), dtype=np.int64)
+    label_val[keep] = arr_label[coords[keep, 0], coords[keep, 1], coords[keep, 2]]
+    keep &= label_val > 0
+
+    neuron_table = neuron_table.select(keep)
+    neuron_table["label"] = label_val[keep]
+
+    # save the table
+    neuron_table.save(output_dir / "neuron_info_final_with_label.npz")
 
     if verbose:
         print(f"Time taken: {time.perf_counter() - start}")
 
-    return neuron_info_dict
+    return neuron_table
 
 
 def main(args):
@@ -536,28 +390,21 @@ def main(args):
         neuron_info_dict_path=neuron_info_dict_path,
     )
 
-    cpus = mp.cpu_count()
-    ncpus = int(cpu_load * cpus)
+    ncpus = get_ncpus(cpu_load)
 
     print("Computing Feature extraction...")
 
-    shared_arr_label, arr_label = load_image_parallel(
-        files=label_files,
-        shape=label_shape,
-        dtype=np.uint16,
-        ncpus=ncpus,
-        pool_args={
-            "init": _init_label,
-        },
-        verbose=verbose,
-    )
+    # label slices are only decoded where neuron centroids are looked up
+    arr_label = VirtualStack(label_files, n_threads=ncpus)
+    assert (
+        arr_label.shape == label_shape
+    ), f"Label slices shape {arr_label.shape} does not match {label_shape}"
 
-    # load in neuron info dict
-    with open(neuron_info_dict_path, "r") as f:
-        neuron_info_dict = json.load(f)
+    # load in neuron table
+    neuron_table = load_neuron_table(neuron_info_dict_path)
 
     neuron_info_with_label = get_neuron_labels(
-        neuron_info_dict=neuron_info_dict,
+        neuron_table=neuron_table,
         arr_label=arr_label,
         output_dir=output_dir,
         verbose=verbose,
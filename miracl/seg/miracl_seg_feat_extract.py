@@ -5,18 +5,19 @@
 
 import argparse
 import logging
-import multiprocessing
 import os
 import sys
 from datetime import datetime
 
 import numpy as np
 import pandas as pd
-import scipy as sp
 import tifffile as tiff
-from joblib import Parallel, delayed
 from scipy import ndimage
-from skimage.measure import regionprops
+
+from miracl.lbls.miracl_lbls_ontology import load_ontology
+from miracl.seg.miracl_instance_patch_stacking import _touching_labels, merge_equivalent_labels
+from miracl.utilfn.miracl_utilfn_parallel import get_ncpus, parallel_map, shared_arrays
+from miracl.utilfn.miracl_utilfn_resampled_labels import ResampledLabels
 
 
 # ---------
@@ -44,6 +45,17 @@ def helpmsg(name=None):
                 Will extract features from allen labels within ROI
                 Should be in clarity space
 
+        a. Assignment of the objects (segmentation values) to the labels (def = split):
+
+                split:    objects crossing labels are split, each part is counted in its label
+                centroid: objects are counted in the label at their centroid
+                majority: objects are counted in the label of most of their voxels
+
+                (objects of a binary segmentation, e.g. 0/1 or 0/255, are its connected components
+                for centroid & majority)
+
+        mem. Memory (GB) of the slabs of the segmentation read at once by all workers (def = 8)
+
     ------
 
     Main Outputs
@@ -61,6 +73,10 @@ def parsefn():
     parser.add_argument('-s', '--seg', type=str, help="segmentation tif", required=True)
     parser.add_argument('-l', '--lbl', type=str, help="label annotations", required=True)
     parser.add_argument('-m', '--mask', type=str, help="ROI mask")
+    parser.add_argument('-a', '--assign', type=str, default="split", choices=ASSIGN_MODES,
+                        help="assignment of the objects to the labels")
+    parser.add_argument('-mem', '--memory', type=float, default=FEAT_MEMORY_GB,
+                        help="memory (GB) of the slabs of the segmentation read at once by all workers")
 
     # parser.add_argument("-h", "--help", action="help", help="Show this help message and exit")
 
@@ -74,7 +90,17 @@ def parse_inputs(parser, args):
     inseg = args.seg
     inlbls = args.lbl
 
-    return inseg, inlbls
+    assign = args.assign
+    memory = args.memory
+
+    return inseg, inlbls, assign, memory
+
+
+# ---------
+# Parameters
+
+ASSIGN_MODES = ["split", "centroid", "majority"]
+FEAT_MEMORY_GB = 8.0
 
 
 # ---------
@@ -117,116 +143,203 @@ def scriptlog(logname):
 # ---------
 
 def upsampleswplbls(seg, lbls):
-    segx = seg.shape[1]
-    segy = seg.shape[2]
-    segz = seg.shape[0]
+    # lazy view of the labels upsampled (or swapped) to the segmentation, read by slabs
+    return ResampledLabels(lbls, seg.shape)
 
-    lblsx = lbls.shape[1]
-    lblsy = lbls.shape[2]
-    lblsz = lbls.shape[0]
 
-    if segx != lblsx:
+# ---------
+# Get region prop fn
 
-        if segx == lblsy:
+def slabvalues(seg, z0, z1):
+    # first (at most 3) values of the segmentation slices z0:z1
+    return np.unique(np.asarray(seg[z0:z1]))[:3]
 
-            print('Swapping x-y')
-            reslbls = np.swapaxes(lbls, 1, 2)
 
-        else:
+def isbinary(seg, slabs, ncpus):
+    '''
+	True if the segmentation has at most one non-zero value (e.g. 0/1 or 0/255 masks)
+	'''
 
-            if segx > lblsx:
+    values = parallel_map(slabvalues, ((seg, z0, z1) for z0, z1 in slabs), ncpus)
 
-                print('Upsampling labels to clarity resolution')
+    return len(np.unique(np.concatenate(values))) <= 2
 
-            else:
 
-                print('Downsampling labels to voxelized clarity resolution')
+def featslab(seg, reslbls, z0, z1, assign, label=False):
+    '''
+	Single pass over the segmentation slices z0:z1 & their resampled labels
 
-            rx = float(segx) / lblsx
-            ry = float(segy) / lblsy
-            rz = float(segz) / lblsz
+	Returns the number of voxels of each label & the voxels of each
+	(object, label) pair ("split" & "majority") or the number of voxels & the
+	sum of the coordinates of each object ("centroid")
 
-            reslbls = sp.ndimage.zoom(lbls, (rz, rx, ry), order=0)
+	With label, the objects are the connected components of the slab (numbered
+	from 1, full connectivity) & the labels of its first & last slices are also
+	returned to merge the objects crossing slabs
+	'''
 
-            print('Segmentation shape:', seg.shape)
+    sys.stdout.write("\r processing slices %d - %d ... " % (z0, z1))
+    sys.stdout.flush()
 
-            print('Resampled labels shape:', reslbls.shape)
+    seg = np.asarray(seg[z0:z1])
+    lbls = reslbls[z0:z1]
 
-            resx = reslbls.shape[1]
+    lblvox = np.unique(lbls[lbls > 0], return_counts=True)
 
-            if segx != resx:
-                print('Swapping x-y')
-                reslbls = np.swapaxes(reslbls, 1, 2)
+    borders = None
+    if label:
+        seg, nobjs = ndimage.label(seg != 0, structure=np.ones((3, 3, 3)))
+        borders = (nobjs, seg[0].copy(), seg[-1].copy())
 
-    else:
+    fg = seg != 0
+    objs = seg[fg].astype(np.int64)
 
-        if segz != lblsz:
+    if assign == "centroid":
+        coords = np.nonzero(fg)
+        ids, inv, counts = np.unique(objs, return_inverse=True, return_counts=True)
+        sums = np.stack([np.bincount(inv, weights=c, minlength=len(ids)) for c in coords], axis=1)
+        sums[:, 0] += z0 * counts
+        return lblvox, (ids, counts, sums), borders
 
-            if segx > lblsx:
+    pairs = np.stack([objs, lbls[fg].astype(np.int64)], axis=1)
+    pairs, counts = np.unique(pairs, axis=0, return_counts=True)
 
-                print('Upsampling labels to clarity resolution')
+    return lblvox, (pairs, counts), borders
 
-            else:
 
-                print('Downsampling labels to voxelized clarity resolution')
+def objectids(objres, assign):
+    # view of the object ids of the features of a slab
+    return objres[0] if assign == "centroid" else objres[0][:, 0]
 
-            rx = float(segx) / lblsx
-            ry = float(segy) / lblsy
-            rz = float(segz) / lblsz
 
-            reslbls = sp.ndimage.zoom(lbls, (rz, rx, ry), order=0)
+def labelslabs(seg, reslbls, slabs, assign, ncpus):
+    '''
+	Features of the connected components of a binary segmentation: the slabs are
+	labelled separately & the components crossing slabs are merged (union-find),
+	as for the cells in miracl_seg_voxelize_parallel.countcells
+	'''
+
+    res, pairs = [], [np.zeros((0, 2), dtype=np.int64)]
+    nobjs = 0
+    prevlast = None
+    # ncpus slabs at a time: only the border slices of the labels are kept
+    for b in range(0, len(slabs), ncpus):
+        batch = parallel_map(featslab, ((seg, reslbls, z0, z1, assign, True) for z0, z1 in slabs[b:b + ncpus]),
+                             ncpus)
+        for lblvox, objres, (slabobjs, first, last) in batch:
+            # slab objects to global objects
+            first = np.where(first > 0, first.astype(np.int64) + nobjs, 0)
+            last = np.where(last > 0, last.astype(np.int64) + nobjs, 0)
+            if prevlast is not None:
+                pairs.append(_touching_labels(prevlast, first))
+            prevlast = last
+            ids = objectids(objres, assign)
+            ids += nobjs
+            res.append((lblvox, objres))
+            nobjs += slabobjs
+
+    lut = merge_equivalent_labels(np.concatenate(pairs), nobjs)
+    for _, objres in res:
+        ids = objectids(objres, assign)
+        ids[:] = lut[ids]
+
+    return res
+
+
+def mergecounts(keys, counts, axis=None):
+    '''
+	Sums the counts (or rows of counts) of equal keys
+	'''
 
-        else:
+    keys, inv = np.unique(keys, axis=axis, return_inverse=True)
+    inv = inv.ravel()
+    if counts.ndim == 1:
+        return keys, np.bincount(inv, weights=counts, minlength=len(keys))
 
-            reslbls = lbls
+    return keys, np.stack([np.bincount(inv, weights=c, minlength=len(keys)) for c in counts.T], axis=1)
 
-    return reslbls
 
+def assignobjects(res, reslbls, assign):
+    '''
+	Region (label) & volume (number of voxels) of each object
 
-# ---------
-# Get region prop fn
+	"split": objects are split by the label boundaries (each part is an object),
+	"majority": objects are assigned to the label of most of their voxels,
+	"centroid": objects are assigned to the label at their centroid
+	'''
 
-def computearea(seg, lbls, l):
-    sys.stdout.write("\r processing label %d ... " % l)
-    sys.stdout.flush()
+    if assign == "centroid":
+        ids, counts, sums = (np.concatenate(r) for r in zip(*res))
+        ids, merged = mergecounts(ids, np.column_stack([counts, sums]))
+        counts, sums = merged[:, 0], merged[:, 1:]
+        centroids = np.floor(sums / counts[:, None] + 0.5).astype(np.intp)
+        centroids = np.minimum(centroids, np.array(reslbls.shape) - 1)
+        regions = reslbls.at(*centroids.T)
+        return regions, counts
 
-    # print 'processing label ', l
-
-    lbl = lbls == l
-    numvox = np.sum(lbl)
-    mask = np.zeros(seg.shape, dtype=np.uint16)
-    mask[lbl] = seg[lbl]
-
-    if np.max(mask) > 0:
-        areas = (prop.area for prop in regionprops(mask))
-        areas = np.array(list(areas))
-        avgarea = np.nanmean(areas)
-        stdarea = np.nanstd(areas)
-        maxarea = np.nanmax(areas)
-        cellnum = len(list(areas))
-        celldens = (float(cellnum) / numvox) * 1e3  # assuming 1um res
-    else:
-        avgarea = 0
-        stdarea = 0
-        maxarea = 0
-        cellnum = 0
-        celldens = 0
+    pairs, counts = (np.concatenate(r) for r in zip(*res))
+    pairs, counts = mergecounts(pairs, counts, axis=0)
 
-    return avgarea, stdarea, maxarea, cellnum, celldens
+    if assign == "split" or len(pairs) == 0:
+        return pairs[:, 1], counts
+
+    # label with the most voxels of each object (smallest label if tied)
+    order = np.lexsort((pairs[:, 1], -counts, pairs[:, 0]))
+    pairs, counts = pairs[order], counts[order]
+    first = np.flatnonzero(np.r_[True, pairs[1:, 0] != pairs[:-1, 0]])
+    volumes = np.add.reduceat(counts, first)
+
+    return pairs[first, 1], volumes
 
 
 # ---------
 # Run feat extract for all lbls
 
-def runalllblspar(seg, lbls, ncpus, alllbls):
-    allprops = Parallel(n_jobs=ncpus, backend='threading')(
-        delayed(computearea)(seg, lbls, l) for i, l in enumerate(alllbls))
-    allprops = np.asarray(allprops)
-    allareas = allprops[:, 0]
-    allstdareas = allprops[:, 1]
-    allmaxareas = allprops[:, 2]
-    allnums = allprops[:, 3]
-    alldens = allprops[:, 4]
+def runalllblspar(seg, lbls, ncpus, alllbls, assign="split", memory=FEAT_MEMORY_GB, tmp_dir=None):
+    '''
+	Computes the features of all labels in one pass over the segmentation, by
+	slabs of slices processed in parallel (the labels are resampled slab by slab);
+	seg & lbls are shared with the workers through files in tmp_dir
+	'''
+
+    # (+ the connected components of the slabs of binary segmentations)
+    voxel_bytes = seg.dtype.itemsize + lbls.dtype.itemsize + 8 + (4 if assign != "split" else 0)
+    slice_bytes = int(np.prod(seg.shape[1:])) * voxel_bytes
+    depth = max(1, int(memory * 1024 ** 3 / (ncpus * slice_bytes)))
+    slabs = [(z0, min(z0 + depth, seg.shape[0])) for z0 in range(0, seg.shape[0], depth)]
+
+    # objects & labels are counted in a process pool sharing seg & lbls as memmaps
+    with shared_arrays(seg, lbls, tmp_dir=tmp_dir) as (seg, lbls):
+        # upsample or swap if needed
+        reslbls = upsampleswplbls(seg, lbls)
+        if assign != "split" and isbinary(seg, slabs, ncpus):
+            # the objects of a binary segmentation are its connected components
+            print('Labelling the objects of the binary segmentation')
+            res = labelslabs(seg, reslbls, slabs, assign, ncpus)
+        else:
+            res = parallel_map(featslab, ((seg, reslbls, z0, z1, assign) for z0, z1 in slabs), ncpus)
+        regions, volumes = assignobjects([r[1] for r in res], reslbls, assign)
+
+    # voxels of each label
+    lblids, lblvox = mergecounts(*(np.concatenate(r) for r in zip(*[r[0] for r in res])))
+    pos = np.minimum(np.searchsorted(lblids, alllbls), max(len(lblids) - 1, 0))
+    numvox = np.where(lblids[pos] == alllbls, lblvox[pos], 0) if len(lblids) else np.zeros(len(alllbls))
+
+    # grouped reductions of the objects of each label
+    pos = np.minimum(np.searchsorted(alllbls, regions), len(alllbls) - 1)
+    inlbls = alllbls[pos] == regions
+    pos, volumes = pos[inlbls], volumes[inlbls].astype(np.float64)
+
+    allnums = np.bincount(pos, minlength=len(alllbls)).astype(np.float64)
+    found = allnums > 0
+    allareas = np.bincount(pos, weights=volumes, minlength=len(alllbls))
+    allareas[found] /= allnums[found]
+    allstdareas = np.bincount(pos, weights=(volumes - allareas[pos]) ** 2, minlength=len(alllbls))
+    allstdareas[found] = np.sqrt(allstdareas[found] / allnums[found])
+    allmaxareas = np.zeros(len(alllbls))
+    np.maximum.at(allmaxareas, pos, volumes)
+    alldens = np.zeros(len(alllbls))
+    alldens[found] = allnums[found] / numvox[found] * 1e3  # assuming 1um res
 
     return allareas, allstdareas, allmaxareas, allnums, alldens
 
@@ -250,15 +363,17 @@ def main(args):
     startTime = datetime.now()
 
     cpuload = 0.95
-    cpus = multiprocessing.cpu_count()
-    ncpus = int(cpuload * cpus)  # 95% of cores used
+    ncpus = get_ncpus(cpuload)  # 95% of cores used
 
     parser = parsefn()
-    inseg, inlbls = parse_inputs(parser, args)
+    inseg, inlbls, assign, memory = parse_inputs(parser, args)
 
-    # open seg
+    # open seg (read by slabs if it can be memory-mapped)
     print("Reading segmentation")
-    seg = tiff.imread(inseg)
+    try:
+        seg = tiff.memmap(inseg, mode='r')
+    except ValueError:
+        seg = tiff.imread(inseg)
 
     # open lbls
     print("Reading labels")
@@ -273,9 +388,6 @@ def main(args):
         # get all lbls
         alllbls = getlblvals(lbls)
 
-        # upsample or swap if needed
-        reslbls = upsampleswplbls(seg, lbls)
-
     else:
 
         inmas = args.mask
@@ -285,12 +397,15 @@ def main(args):
 
         # get all lbls
         alllbls = getlblvals(maslbls)
+        lbls = maslbls
 
-        # upsample or swap if needed
-        reslbls = upsampleswplbls(seg, maslbls)
+    # features are written next to the segmentation
+    segdir = os.path.dirname(os.path.realpath(inseg))
 
+    # labels are upsampled or swapped if needed, slab by slab
     print("Computing Feature extraction...")
-    [allareas, allstdareas, allmaxareas, allnums, alldens] = runalllblspar(seg, reslbls, ncpus, alllbls)
+    [allareas, allstdareas, allmaxareas, allnums, alldens] = runalllblspar(seg, lbls, ncpus, alllbls, assign, memory,
+                                                                           tmp_dir=segdir)
 
     print('\n Exporting features to csv file')
 
@@ -300,11 +415,11 @@ def main(args):
 
     if np.max(alllbls) > 20000:
 
-        graph = pd.read_csv('%s/atlases/ara/ara_mouse_structure_graph_hemi_split.csv' % atlases_home)
+        graph = load_ontology(csv='%s/atlases/ara/ara_mouse_structure_graph_hemi_split.csv' % atlases_home)
 
     else:
 
-        graph = pd.read_csv('%s/atlases/ara/ara_mouse_structure_graph_hemi_combined.csv' % atlases_home)
+        graph = load_ontology(csv='%s/atlases/ara/ara_mouse_structure_graph_hemi_combined.csv' % atlases_home)
 
     # get attributes
     # names = graph.name[graph.id.isin(alllbls)]
@@ -323,30 +438,19 @@ def main(args):
     propsdf = pd.DataFrame(
         dict(LabelID=alllbls, Count=allnums, Density=alldens, VolumeAvg=allareas, VolumeStd=allstdareas,
              VolumeMax=allmaxareas))
-    propsdf = propsdf[propsdf.LabelID.isin(graph.id)]
-
-    # make dicts
-    name_dic = dict(zip(graph.id, graph.name))
-    abrv_dic = dict(zip(graph.id, graph.acronym))
-    parents_dic = dict(zip(graph.id, graph.parent_structure_id))
-    paths_dic = dict(zip(graph.id, graph.structure_id_path))
-
-    propsdf['LabelName'] = propsdf.LabelID
-    propsdf['LabelAbrv'] = propsdf.LabelID
-    propsdf['ParentID'] = propsdf.LabelID
-    propsdf['IDPath'] = propsdf.LabelID
+    propsdf = propsdf[graph.contains(propsdf.LabelID.values)]
 
-    propsdf = propsdf.replace({'LabelName': name_dic})
-    propsdf = propsdf.replace({'LabelAbrv': abrv_dic})
-    propsdf = propsdf.replace({'IDPath': paths_dic})
-    propsdf['ParentID'] = propsdf.ParentID.map(parents_dic)
+    # add label info
+    lblids = propsdf.LabelID.values
+    propsdf['LabelName'] = graph.name(lblids)
+    propsdf['LabelAbrv'] = graph.acronym(lblids)
+    propsdf['ParentID'] = graph.parent(lblids)
+    propsdf['IDPath'] = graph.column('structure_id_path', lblids)
 
     cols = ['LabelID', 'LabelAbrv', 'LabelName', 'ParentID', 'IDPath', 'Count', 'Density', 'VolumeAvg', 'VolumeStd',
             'VolumeMax']
     propsdf = propsdf[cols]
 
-    segdir = os.path.dirname(os.path.realpath(inseg))
-
     propscsv = "%s/clarity_segmentation_features_ara_labels.csv" % segdir
     propsdf.to_csv(propscsv)
 
@@ -9,10 +9,12 @@ import sys
 
 import numpy as np
 import pandas as pd
-import scipy as sp
 import tifffile as tiff
-from skimage.measure import regionprops
 from miracl.conv import  miracl_conv_gui_options as gui_opts
+from miracl.lbls.miracl_lbls_ontology import load_ontology
+from miracl.utilfn.miracl_utilfn_resampled_labels import ResampledLabels
+
+SLAB_MEMORY_GB = 4.0
 
 
 # import commands
@@ -100,70 +102,33 @@ def parse_inputs(parser, args):
 # ---------
 
 def upsampleswplbls(seg, lbls):
-    segx = seg.shape[1]
-    segy = seg.shape[2]
-    segz = seg.shape[0]
-
-    lblsx = lbls.shape[1]
-    lblsy = lbls.shape[2]
-    lblsz = lbls.shape[0]
-
-    if segx != lblsx:
-
-        if segx == lblsy:
-
-            print ('Swapping x-y')
-            reslbls = np.swapaxes(lbls, 1, 2)
-
-        else:
-
-            if segx > lblsx:
-
-                print('Upsampling labels to clarity resolution')
-
-            else:
-
-                print('Downsampling labels to voxelized clarity resolution')
-
-            rx = float(segx) / lblsx
-            ry = float(segy) / lblsy
-            rz = float(segz) / lblsz
-
-            reslbls = sp.ndimage.zoom(lbls, (rz, rx, ry), order=0)
-
-            print('Segmentation shape:', seg.shape)
-
-            print('Resampled labels shape:', reslbls.shape)
+    # lazy view of the labels upsampled (or swapped) to the segmentation, read by slabs
+    return ResampledLabels(lbls, seg.shape)
 
-            resx = reslbls.shape[1]
 
-            if segx != resx:
-                print ('Swapping x-y')
-                reslbls = np.swapaxes(reslbls, 1, 2)
+def labelcounts(voldata, reslbls, memory=SLAB_MEMORY_GB):
+    """
+    Number of voxels & of cells (distinct segmentation values) of each label,
+    in one pass over slabs of the segmentation & of its resampled labels
+    (labels & values are read as uint16)
+    """
+    depth = max(1, int(memory * 1024 ** 3 / (np.prod(reslbls.shape[1:]) * 8)))
 
-    else:
+    areas = np.zeros(2 ** 16, dtype=np.int64)
+    cells = np.zeros(0, dtype=np.int64)
+    for z0, slab in reslbls.iter_slabs(depth):
+        lbl = slab.astype(np.uint16)
+        vol = np.asarray(voldata[z0:z0 + len(slab)]).astype(np.uint16)
+        areas += np.bincount(lbl.ravel(), minlength=2 ** 16)
 
-        if segz != lblsz:
+        # (label, value) pairs of the cells
+        fg = (lbl > 0) & (vol > 0)
+        cells = np.union1d(cells, (lbl[fg].astype(np.int64) << 16) | vol[fg])
 
-            if segx > lblsx:
+    labels = np.flatnonzero(areas[1:]) + 1
+    cellnums = np.bincount(cells >> 16, minlength=2 ** 16)[labels]
 
-                print('Upsampling labels to clarity resolution')
-
-            else:
-
-                print('Downsampling labels to voxelized clarity resolution')
-
-            rx = float(segx) / lblsx
-            ry = float(segy) / lblsy
-            rz = float(segz) / lblsz
-
-            reslbls = sp.ndimage.zoom(lbls, (rz, rx, ry), order=0)
-
-        else:
-
-            reslbls = lbls
-
-    return reslbls
+    return labels, areas[labels], cellnums
 
 
 def getlblvals(lbls):
@@ -184,27 +149,25 @@ def main(args):
     # extract stats
     print(" Extracting stats from input volume using registered labels ...\n")
 
-    # read invol
+    # read invol (read by slabs if it can be memory-mapped)
     # invol = nib.load(invol)
     # voldata = invol.get_data()
-    voldata = tiff.imread(invol)
+    try:
+        voldata = tiff.memmap(invol, mode='r')
+    except ValueError:
+        voldata = tiff.imread(invol)
 
     # read lbls
     # inlbls = nib.load(lbls)
     # lbldata = inlbls.get_data()
     lbldata = tiff.imread(lbls)
 
-    # upsample or swap if needed
+    # upsample or swap if needed (lazily, the labels are resampled slab by slab)
     reslbls = upsampleswplbls(voldata, lbldata)
 
-    reslbldata = reslbls.astype(np.uint16)
-
     # get lbl vals
     # alllbls = getlblvals(reslbldata)
 
-    # compute regionprops
-    props = regionprops(reslbldata, intensity_image=voldata)
-
     # Extract the mean intensities
 
     print(" Computing region properties \n ")
@@ -215,24 +178,9 @@ def main(args):
 
     # max_int = np.array([prop.max_intensity for prop in props])
     # min_int = np.array([prop.min_intensity for prop in props])
-    areas = np.array([prop.area for prop in props])
-    labels = np.array([prop.label for prop in props])
-
-    cellnums = labels.copy()
-
-    # for l, lbl in enumerate(alllbls):
-    for l, lbl in enumerate(labels):
-
-        # print("\r processing label:", lbl)
-
-        mask = np.zeros(voldata.shape, dtype=np.uint16)
-        mask[reslbldata == lbl] = voldata[reslbldata == lbl]
 
-        if np.max(mask) > 0:
-            lbl_areas = [prop.area for prop in regionprops(mask)]
-            cellnums[l] = len(list(lbl_areas))
-        else:
-            cellnums[l] = 0
+    # areas & cell counts of all labels in one pass
+    labels, areas, cellnums = labelcounts(voldata, reslbls)
 
     # make dataframe 
     # cols = ['LabelID', 'Mean_int', 'Max_int', 'Min_int']
@@ -245,10 +193,8 @@ def main(args):
     miracl_home = os.environ['MIRACL_HOME']
 
     # combined or split labels
-    if hemi == "combined":
-        annot_csv = pd.read_csv('%s/atlases/ara/ara_mouse_structure_graph_hemi_combined.csv' % miracl_home)
-    else:
-        annot_csv = pd.read_csv('%s/atlases/ara/ara_mouse_structure_graph_hemi_split.csv' % miracl_home)
+    hemi_csv = "combined" if hemi == "combined" else "split"
+    annot_csv = load_ontology(csv='%s/atlases/ara/ara_mouse_structure_graph_hemi_%s.csv' % (miracl_home, hemi_csv)).df
 
     # extract labels at certain depth only
     if label_depth is not None:
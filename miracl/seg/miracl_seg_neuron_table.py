@@ -0,0 +1,279 @@
+import argparse
+import json
+import struct
+import zipfile
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+import numpy as np
+
+PROG_NAME = "neuron_table"
+FULL_PROG_NAME = f"miracl seg {PROG_NAME}"
+
+# core columns with their dtype, number of values per neuron and fill value
+# (used for columns that are missing, e.g. bbox for neurons found per region)
+CORE_COLUMNS = {
+    "id": (np.int64, None, 0),
+    "area": (np.float64, None, 0),
+    "centroid": (np.float64, 3, np.nan),
+    "bbox": (np.int64, 6, -1),
+    "offset": (np.int64, 3, 0),
+    "label": (np.int64, None, 0),
+}
+
+# keys of the legacy json neuron info dicts
+JSON_OFFSET_KEYS = ("depth", "height", "width")
+JSON_LABEL_KEY = "label_val"
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(
+        prog=FULL_PROG_NAME,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+    Converts a legacy neuron info json file (e.g. neuron_info_final.json) to a
+    columnar neuron table (.npz) that can be memory-mapped""",
+        add_help=False,
+    )
+    required_args = parser.add_argument_group("required arguments")
+    required_args.add_argument(
+        "-i",
+        "--input",
+        type=str,
+        help="Path to the neuron info json file",
+        required=True,
+    )
+    optional_args = parser.add_argument_group("optional arguments")
+    optional_args.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="Output neuron table (default: input file with a .npz suffix)",
+        required=False,
+        default=None,
+    )
+    optional_args.add_argument(
+        "-h", "--help", action="help", help="show this help message and exit"
+    )
+
+    return parser
+
+
+class NeuronTable:
+    """Columnar table of neuron features. Each column is a typed numpy array
+    with one row per neuron (e.g. `centroid` has shape (n, 3)).
+
+    Core columns:
+        id: neuron id
+        area: number of voxels
+        centroid: (z, y, x) centroid, relative to `offset`
+        bbox: (min_z, min_y, min_x, max_z, max_y, max_x) bounding box, relative to `offset`
+        offset: (depth, height, width) of the patch the neuron was found in
+        label: label (region or cluster) the neuron belongs to, 0 if unlabeled
+
+    Extra numeric region properties are stored as additional columns.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        n = len(columns["id"]) if "id" in columns else 0
+        for name, (dtype, width, fill) in CORE_COLUMNS.items():
+            if name not in columns:
+                shape = (n,) if width is None else (n, width)
+                columns[name] = np.full(shape, fill, dtype=dtype)
+        for name, column in columns.items():
+            if len(column) != n:
+                raise ValueError(
+                    f"Column {name} has {len(column)} rows, expected {n}"
+                )
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(self.columns["id"])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def __setitem__(self, name: str, column: np.ndarray):
+        if len(column) != len(self):
+            raise ValueError(
+                f"Column {name} has {len(column)} rows, expected {len(self)}"
+            )
+        self.columns[name] = column
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.columns.keys())
+
+    def select(self, rows: np.ndarray) -> "NeuronTable":
+        """Table with a subset of rows (boolean mask or indices)"""
+        return NeuronTable(
+            {name: np.asarray(column[rows]) for name, column in self.columns.items()}
+        )
+
+    @staticmethod
+    def empty() -> "NeuronTable":
+        return NeuronTable({"id": np.zeros(0, dtype=np.int64)})
+
+    @staticmethod
+    def concat(tables: Iterable["NeuronTable"]) -> "NeuronTable":
+        """Concatenates tables, keeping the columns common to all (non-empty) tables"""
+        tables = [t for t in tables if len(t) > 0]
+        if not tables:
+            return NeuronTable.empty()
+        names = [
+            name for name in tables[0].names if all(name in t.columns for t in tables)
+        ]
+        return NeuronTable(
+            {name: np.concatenate([t[name] for t in tables]) for name in names}
+        )
+
+    @staticmethod
+    def from_regionprops(regions: List, props: List[str]) -> "NeuronTable":
+        """Table from skimage regionprops; non-numeric properties are skipped"""
+        if not regions:
+            return NeuronTable.empty()
+        columns = {"id": np.array([region["label"] for region in regions], dtype=np.int64)}
+        for prop in props:
+            if prop == "label":
+                continue
+            column = np.asarray([region[prop] for region in regions])
+            if column.dtype.kind not in "biuf":
+                print(f"Skipping non-numeric neuron property: {prop}")
+                continue
+            dtype = CORE_COLUMNS.get(prop, (column.dtype,))[0]
+            columns[prop] = column.astype(dtype)
+
+        return NeuronTable(columns)
+
+    @staticmethod
+    def from_dict(neuron_info_dict: Dict[str, Dict]) -> "NeuronTable":
+        """Table from a legacy neuron info dict (neuron id -> properties)"""
+        ids = np.array([int(k) for k in neuron_info_dict.keys()], dtype=np.int64)
+        values = list(neuron_info_dict.values())
+        columns = {"id": ids}
+        if not values:
+            return NeuronTable(columns)
+
+        if all(key in values[0] for key in JSON_OFFSET_KEYS):
+            columns["offset"] = np.array(
+                [[v[key] for key in JSON_OFFSET_KEYS] for v in values], dtype=np.int64
+            )
+        if JSON_LABEL_KEY in values[0] or any(JSON_LABEL_KEY in v for v in values):
+            columns["label"] = np.array(
+                [v.get(JSON_LABEL_KEY, 0) for v in values], dtype=np.int64
+            )
+
+        skip = set(JSON_OFFSET_KEYS) | {JSON_LABEL_KEY, "label"}
+        for key in values[0].keys():
+            if key in skip:
+                continue
+            column = np.asarray([v[key] for v in values])
+            if column.dtype.kind not in "biuf":
+                print(f"Skipping non-numeric neuron property: {key}")
+                continue
+            dtype = CORE_COLUMNS.get(key, (column.dtype,))[0]
+            columns[key] = column.astype(dtype)
+
+        return NeuronTable(columns)
+
+    def to_dict(self) -> Dict[int, Dict]:
+        """Legacy neuron info dict (neuron id -> properties)"""
+        res = dict()
+        for i, neuron_id in enumerate(self.columns["id"]):
+            res[int(neuron_id)] = {
+                name: column[i].tolist()
+                for name, column in self.columns.items()
+                if name != "id"
+            }
+        return res
+
+    def save(self, path: Union[str, Path]) -> Path:
+        """Saves the table as an uncompressed .npz (one .npy per column) so
+        that columns can be memory-mapped when loading"""
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **self.columns)
+        tmp_path.replace(path)
+        return path
+
+    @staticmethod
+    def load(path: Union[str, Path], mmap: bool = True) -> "NeuronTable":
+        """Loads a table saved with `save`; columns are read-only memory maps
+        unless mmap is False"""
+        path = Path(path)
+        if not mmap:
+            with np.load(path) as data:
+                return NeuronTable({name: data[name] for name in data.files})
+        return NeuronTable(_memmap_npz(path))
+
+
+def _memmap_npz(path: Path) -> Dict[str, np.ndarray]:
+    """Memory-maps every (uncompressed) array of an .npz file"""
+    columns = dict()
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as f:
+        for info in zf.infolist():
+            name = info.filename[: -len(".npy")]
+            if info.compress_type != zipfile.ZIP_STORED:
+                # compressed member, cannot be mapped
+                columns[name] = np.load(zf.open(info))
+                continue
+
+            # skip the local file header to the .npy data
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_len, extra_len = struct.unpack("<HH", header[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+
+            if np.lib.format.read_magic(f) == (1, 0):
+                read_header = np.lib.format.read_array_header_1_0
+            else:
+                read_header = np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            if np.prod(shape) == 0:
+                columns[name] = np.zeros(shape, dtype=dtype)
+                continue
+            columns[name] = np.memmap(
+                path,
+                dtype=dtype,
+                mode="r",
+                offset=f.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+
+    return columns
+
+
+def load_neuron_table(path: Union[str, Path], mmap: bool = True) -> NeuronTable:
+    """Loads a neuron table (.npz) or a legacy neuron info json file"""
+    path = Path(path)
+    if path.suffix == ".json":
+        with open(path, "r") as f:
+            return NeuronTable.from_dict(json.load(f))
+    return NeuronTable.load(path, mmap=mmap)
+
+
+def convert_json(json_path: Union[str, Path], out_path: Optional[Union[str, Path]] = None) -> Path:
+    """Converts a legacy neuron info json file to a neuron table (.npz)"""
+    json_path = Path(json_path)
+    out_path = Path(out_path) if out_path is not None else json_path.with_suffix(".npz")
+
+    table = load_neuron_table(json_path)
+    table.save(out_path)
+
+    print(f"Converted {len(table)} neurons to: {out_path}")
+    return out_path
+
+
+def main(args):
+    input_path = Path(args.input)
+    assert input_path.exists(), f"Neuron info json does not exist: {input_path}"
+
+    convert_json(input_path, args.output)
+
+
+if __name__ == "__main__":
+    parser = parsefn()
+    args = parser.parse_args()
+    main(args)
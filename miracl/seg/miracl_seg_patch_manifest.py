@@ -0,0 +1,77 @@
+"""
+Sparse manifest of the empty (all zero) patches of the ACE segmentation
+
+Patches with too little brain are not run through the model. Instead of
+loading them and saving all zero outputs, they are listed with their shape in
+empty_patches.json, next to the patches:
+
+    {"patch_0_1.tiff": [512, 512, 512], ...}
+
+Readers of the patches (patch stacking, connected components, ...) treat the
+listed patches as implicit zeros, whatever the prefix of the file
+(out_, MC_<model>_, uncertainty_<model>_, CC_):
+
+    empty_patches = load_empty_patches(patches_dir)
+    img = read_patch(patches_dir / "out_patch_0_1.tiff", empty_patches, "uint8")
+"""
+# load libraries
+import json
+import re
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+EMPTY_PATCHES_JSON = "empty_patches.json"
+PATCH_NAME_PATTERN = re.compile(r"(patch_.*)")
+
+
+def patch_name(fname):
+    """
+    Returns the name of the input patch of a (prefixed) patch file,
+    e.g. out_patch_0_1.tiff -> patch_0_1.tiff
+    """
+    return re.findall(PATCH_NAME_PATTERN, Path(fname).name)[0]
+
+
+def save_empty_patches(patches_dir, empty_patches):
+    """
+    Saves the manifest of the empty patches
+
+    :param patches_dir: folder of the patches
+    :param empty_patches: dict of the shape (ZYX) of each empty patch (by patch name)
+    """
+    empty_patches = {
+        patch_name(name): [int(n) for n in shape] for name, shape in empty_patches.items()
+    }
+    with open(Path(patches_dir) / EMPTY_PATCHES_JSON, "w") as f:
+        json.dump(empty_patches, f, indent=4)
+
+
+def load_empty_patches(patches_dir):
+    """
+    Returns the shape (ZYX) of each empty patch (by patch name);
+    empty if the manifest does not exist (all patches saved)
+    """
+    manifest = Path(patches_dir) / EMPTY_PATCHES_JSON
+    if not manifest.exists():
+        return {}
+
+    with open(manifest) as f:
+        return {name: tuple(shape) for name, shape in json.load(f).items()}
+
+
+def read_patch(fname, empty_patches, dtype=None):
+    """
+    Reads a patch file; empty patches are returned as (read-only) zeros without
+    touching the disk
+
+    :param fname: path to the (prefixed) patch file
+    :param empty_patches: manifest of the empty patches (see load_empty_patches)
+    :param dtype: data type of the empty patches (default: uint8)
+    """
+    shape = empty_patches.get(patch_name(fname))
+    if shape is not None:
+        return np.broadcast_to(np.zeros((), dtype=dtype or np.uint8), shape)
+
+    return tifffile.imread(fname)
@@ -0,0 +1,42 @@
+"""
+Stacks 2D tif slices (e.g. the ACE segmentation output in seg_final/) into a 3D volume
+without Fiji
+
+The slices are either:
+    read lazily as a z-stack (VirtualStack), decoding a slice only when it is indexed
+    streamed into a memory-mapped BigTIFF (stack_slices)
+
+Memory use is bounded by the number of slices decoded at the same time (thread pool).
+"""
+# load libraries
+import tifffile
+
+from miracl.utilfn.miracl_utilfn_virtual_stack import VirtualStack, find_slices
+
+# previous name of the virtual stack
+LazyZStack = VirtualStack
+
+
+# -------------------------------------------------------
+# stream to BigTIFF
+# -------------------------------------------------------
+def stack_slices(files, out_tif, n_threads=4, buffer=16):
+    """
+    Streams 2D tif slices into a memory-mapped (uncompressed) BigTIFF z-stack
+
+    :param files: sorted slice files
+    :param out_tif: output stacked tif
+    :param n_threads: number of threads decoding slices
+    :param buffer: max number of decoded slices held in memory
+    returns: path to the stacked tif
+    """
+    stack = VirtualStack(files)
+    print(f"  stacking {len(stack)} slices of shape {stack.slice_shape} into {out_tif}")
+
+    out = tifffile.memmap(out_tif, shape=stack.shape, dtype=stack.dtype, bigtiff=True)
+    for z, img in stack.iter_slices(n_threads=n_threads, buffer=buffer):
+        out[z] = img
+    out.flush()
+    del out
+
+    return out_tif
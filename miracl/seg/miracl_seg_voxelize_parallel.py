@@ -5,7 +5,6 @@
 
 import argparse
 import logging
-import multiprocessing
 import os
 import sys
 import warnings
@@ -19,10 +18,14 @@ import nibabel as nib
 import numpy as np
 import scipy as sp
 import tifffile as tiff
-from joblib import Parallel, delayed
 from scipy import ndimage
 from skimage.feature import peak_local_max
-from math import floor
+from math import floor, lcm
+
+from miracl.seg.miracl_instance_patch_stacking import _touching_labels, merge_equivalent_labels
+from miracl.utilfn.miracl_utilfn_chunked_volume import ChunkedVolume, is_chunked_volume
+from miracl.utilfn.miracl_utilfn_parallel import get_ncpus, parallel_map, shared_arrays
+from miracl.utilfn.miracl_utilfn_virtual_stack import VirtualStack
 
 # ---------
 # help fn
@@ -32,11 +35,11 @@ def helpmsg(name=None):
 
 	Voxelizes segmentation results into density maps with Allen atlas resolution
 
-	example: miracl seg voxelize -s seg_sparse.tif -v 10 -d 5 -vx 1 -vz 1
+	example: miracl seg voxelize -s seg_sparse.tif -v 10 -d 5 -vx 1 -vz 1 -m cells
 
       arguments (required):
 
-        s.  Segmentation tif file
+        s.  Segmentation tif file, folder of segmentation tif slices or chunked volume (.zarr)
 
       optional arguments:
 
@@ -44,6 +47,14 @@ def helpmsg(name=None):
         d.  Down sample ratio (def = 2) - recommend 2 =< ratio =< 5
         vx. voxel size (x, y dims) in um
         vz. voxel size (z dim) in um
+        f.  Prefix of the slices to read if s is a folder (e.g. out_) (def = all tif slices)
+        o.  Output folder (def = folder of the segmentation tif / slices folder)
+        m.  Voxelization mode (def = peaks):
+              peaks:  peaks of the convolved segmentation, detected slice by slice
+              voxels: number of segmented voxels in each output voxel
+              cells:  number of segmented cells (3D connected components) with their
+                      centroid in each output voxel (exact count)
+        mem. Memory (GB) of the slabs of the segmentation read at once by all workers (def = 8)
 
     -----
 
@@ -60,11 +71,18 @@ def helpmsg(name=None):
 
 def parsefn():
     parser = argparse.ArgumentParser(description='', usage=helpmsg(), add_help=False)
-    parser.add_argument('-s', '--seg', type=str, help="binary segmentation tif", required=True)
+    parser.add_argument('-s', '--seg', type=str, help="binary segmentation tif, folder of tif slices or chunked volume (.zarr)",
+                        required=True)
     parser.add_argument('-d', '--down', type=int, help="down-sample ratio (should be the same as what used in registration")
     parser.add_argument('-v', '--res', type=int, choices=[10, 25, 50], help="voxel size")
     parser.add_argument('-vx', default=1, type=float, help="voxel size (x, y dims) in um")
     parser.add_argument('-vz', default=1, type=float, help="voxel size (z dim) in um")
+    parser.add_argument('-f', '--filter', default="", type=str,
+                        help="prefix of the tif slices to read if --seg is a folder (e.g. out_)")
+    parser.add_argument('-o', '--outdir', type=str, help="output folder")
+    parser.add_argument('-m', '--mode', default="peaks", choices=VOX_MODES, help="voxelization mode")
+    parser.add_argument('-mem', '--memory', default=VOX_MEMORY_GB, type=float,
+                        help="memory (GB) of the slabs of the segmentation read at once by all workers")
     # parser.add_argument("-h", "--help", action="help", help="Show this help message and exit")
 
     return parser
@@ -82,7 +100,13 @@ def parse_inputs(parser, args):
     vx = args.vx
     vz = args.vz
 
-    return seg, res, down, vx, vz
+    slice_filter = args.filter
+    outdir = args.outdir
+
+    mode = args.mode
+    memory = args.memory
+
+    return seg, res, down, vx, vz, slice_filter, outdir, mode, memory
 
 
 # ---------
@@ -90,8 +114,10 @@ def parse_inputs(parser, args):
 
 # radius = 1
 cpuload = 0.95
-cpus = multiprocessing.cpu_count()
-ncpus = int(cpuload * cpus)  # 95% of cores used2
+ncpus = get_ncpus(cpuload)  # 95% of cores used
+
+VOX_MODES = ["peaks", "voxels", "cells"]
+VOX_MEMORY_GB = 8.0
 
 
 # ---------
@@ -134,48 +160,204 @@ def scriptlog(logname):
 # ---------
 # Define convolution fn
 
-def vox(segflt, kernel, down, i, radius):
+def voxslice(slf, kernel, down):
     '''
-	Convolves image with input kernel then downsamples 
+	Convolves a slice with input kernel, downsamples it & keeps the values
+	at the peaks of its distance transform
 	'''
 
-    # sys.stdout.write("\r processing slice %d ... " % i)
-    # sys.stdout.flush()
-
     # downsample ratio
     dr = 1.0 / down
 
-    slf = segflt[i, :, :]
-
     cvmean = cv2.filter2D(slf, -1, kernel)
     circv = sp.ndimage.zoom(cvmean, dr, order=0)
 
     distance = ndimage.distance_transform_edt(circv)
     # local_maxi = peak_local_max(distance, indices=False, min_distance=dist, exclude_border=False, labels=circv)
-    local_maxi = peak_local_max(distance, indices=False, footprint=np.ones((10, 10)), exclude_border=False,
-                                labels=circv)
+    peaks = peak_local_max(distance, footprint=np.ones((10, 10)), exclude_border=False, labels=circv)
+    local_maxi = np.zeros(distance.shape, dtype=bool)
+    local_maxi[tuple(peaks.T)] = True
     conncomp = ndimage.label(local_maxi)[0]
-    conncomp = np.multiply((conncomp > 0), circv)	
+    conncomp = np.multiply((conncomp > 0), circv)
 
     return conncomp
 
 
+def vox(segflt, kernel, down, i, radius):
+    '''
+	Convolves image with input kernel then downsamples 
+	'''
+
+    # sys.stdout.write("\r processing slice %d ... " % i)
+    # sys.stdout.flush()
+
+    return voxslice(segflt[i, :, :], kernel, down)
+
+
+# ---------
+# Block-wise voxelization
+
+def readseg(seg, slice_filter=""):
+    '''
+	Opens the segmentation without decoding it: a chunked volume, a folder of
+	slices or a tif file (memory-mapped if possible, else read to memory)
+	'''
+
+    if is_chunked_volume(seg):
+        # full resolution level, decoded by slabs of chunks
+        return ChunkedVolume(seg)
+    if os.path.isdir(seg):
+        # slices are decoded lazily by the workers
+        return VirtualStack.from_folder(seg, slice_filter)
+    try:
+        return tiff.memmap(seg, mode='r')
+    except ValueError:
+        # compressed or non-contiguous tif
+        return tiff.imread(seg)
+
+
+def outshape(shape, down):
+    '''
+	Shape of the voxelized map (as zooming by 1 / down)
+	'''
+
+    return tuple(max(1, int(round(n * (1.0 / down)))) for n in shape)
+
+
+def slabdepth(segflt, down, ncpus, memory, voxel_bytes):
+    '''
+	Depth of the slabs read by each worker (a multiple of down & of the chunk depth)
+	so that ncpus slabs fit in memory (GB)
+	'''
+
+    unit = down
+    if isinstance(segflt, ChunkedVolume):
+        unit = lcm(down, segflt.levels[0].chunks[0])
+    slice_bytes = int(np.prod(segflt.shape[1:])) * voxel_bytes
+    depth = int(memory * 1024 ** 3 / (ncpus * slice_bytes)) // unit * unit
+
+    return max(unit, depth)
+
+
+def readslices(segflt, zs):
+    '''
+	Reads slices zs (sorted) of the segmentation
+	'''
+
+    if isinstance(segflt, ChunkedVolume):
+        # each chunk is decoded once
+        slab = segflt[zs[0]:zs[-1] + 1]
+        return [slab[z - zs[0]] for z in zs]
+
+    return [np.asarray(segflt[z]) for z in zs]
+
+
+def voxpeaks(segflt, zs, kernel, down):
+    '''
+	Convolves, downsamples & detects the peaks of slices zs
+	'''
+
+    return [voxslice(slf, kernel, down) for slf in readslices(segflt, zs)]
+
+
+def blockcount(fg, down, shape):
+    '''
+	Counts the voxels of a binary slab in each block of down x down x down voxels
+	(strided block reduction); the y & x voxels past the last block of the
+	output shape are counted in the last block
+	'''
+
+    counts = np.add.reduceat(fg, np.arange(0, fg.shape[0], down), axis=0, dtype=np.uint32)
+    counts = np.add.reduceat(counts, np.arange(shape[0]) * down, axis=1)
+    counts = np.add.reduceat(counts, np.arange(shape[1]) * down, axis=2)
+
+    return counts
+
+
+def voxvoxels(segflt, z0, z1, down, shape):
+    '''
+	Number of segmented voxels in each output voxel of slab z0:z1
+	'''
+
+    fg = np.asarray(segflt[z0:z1]) != 0
+    if not fg.any():
+        return np.zeros((-(-(z1 - z0) // down),) + shape, dtype=np.uint32)
+
+    return blockcount(fg, down, shape)
+
+
+def voxcells(segflt, z0, z1):
+    '''
+	Labels the cells (3D connected components, full connectivity) of slab z0:z1
+
+	Returns the number of voxels & the sum of the (z, y, x) coordinates of each
+	cell & the labels of the first & last slices of the slab
+	'''
+
+    labels, nlbls = ndimage.label(np.asarray(segflt[z0:z1]) != 0, structure=np.ones((3, 3, 3)))
+
+    coords = np.nonzero(labels)
+    lbls = labels[coords]
+    counts = np.bincount(lbls, minlength=nlbls + 1)[1:]
+    sums = np.stack([np.bincount(lbls, weights=c, minlength=nlbls + 1)[1:] for c in coords], axis=1)
+    sums[:, 0] += z0 * counts
+
+    return counts, sums, labels[0].copy(), labels[-1].copy()
+
+
+def countcells(segflt, ncpus, slabs):
+    '''
+	Finds the cells of the segmentation slab by slab, merges the cells crossing
+	slabs & returns their centroids
+	'''
+
+    counts, sums, pairs = [], [], [np.zeros((0, 2), dtype=np.int64)]
+    nlbls = 0
+    prevlast = None
+    # ncpus slabs at a time: only the border slices of the labels are kept
+    for b in range(0, len(slabs), ncpus):
+        res = parallel_map(voxcells, ((segflt, z0, z1) for z0, z1 in slabs[b:b + ncpus]), ncpus)
+        for slabcounts, slabsums, first, last in res:
+            # slab labels to global labels
+            first = np.where(first > 0, first.astype(np.int64) + nlbls, 0)
+            last = np.where(last > 0, last.astype(np.int64) + nlbls, 0)
+            if prevlast is not None:
+                pairs.append(_touching_labels(prevlast, first))
+            prevlast = last
+            counts.append(slabcounts)
+            sums.append(slabsums)
+            nlbls += len(slabcounts)
+
+    lut = merge_equivalent_labels(np.concatenate(pairs), nlbls)[1:]
+    ncells = int(lut.max(initial=0))
+    counts = np.bincount(lut, weights=np.concatenate(counts), minlength=ncells + 1)[1:]
+    sums = np.concatenate(sums)
+    sums = np.stack([np.bincount(lut, weights=sums[:, i], minlength=ncells + 1)[1:] for i in range(3)], axis=1)
+
+    return sums / counts[:, None]
+
+
 # ---------
 # Vox seg
 
-def parcomputevox(seg, radius, ncpus, down, outvox):
+def parcomputevox(seg, radius, ncpus, down, outvox, slice_filter="", mode="peaks", memory=VOX_MEMORY_GB):
     '''
 	Setups up convolution kernel & computes
 	"Vox" fn in parallel
+
+	The segmentation is read by slabs of slices in a pool of processes & the
+	voxelized map is written to outvox as it is computed (peak memory is bounded
+	by memory GB). Modes: peaks of the convolved slices ("peaks", only the slices
+	kept by the downsampling in z are processed), number of segmented voxels
+	("voxels") or exact number of cells ("cells") in each output voxel
 	'''
 
     filename = os.path.basename(seg)
 
     print("\n Creating voxelized maps from Clarity segmentations for %s" % filename)
 
-    # read data
-    segtif = tiff.imread("%s" % seg)
-    segflt = segtif
+    # read data (lazily if possible)
+    segflt = readseg(seg, slice_filter)
 
     # ---------
     # Setup kernel
@@ -187,24 +369,50 @@ def parcomputevox(seg, radius, ncpus, down, outvox):
 
     # ---------
     sx = segflt.shape[0]
-
-    print("\n Computing in parallel using %d cpus" % ncpus)
-
-    # convolve image with kernel
-    res = []
-    res = Parallel(n_jobs=ncpus, backend='threading')(delayed(vox)(segflt, kernel, down, i, radius) for i in range(sx))
-
-    marray = np.asarray(res)
-
-    # downsample ratio
-    dr = 1.0 / down
-
-    # down in z 
-    # dz = 0.1;
-    marray = sp.ndimage.zoom(marray, (dr, 1, 1), order=0)
-
-    # save stack
-    tiff.imsave(outvox, marray, bigtiff=True)
+    shape = outshape(segflt.shape, down)
+
+    voxel_bytes = segflt.dtype.itemsize + (2 if mode == "voxels" else 8)
+    depth = slabdepth(segflt, down, ncpus, memory, voxel_bytes)
+    slabs = [(z0, min(z0 + depth, sx)) for z0 in range(0, sx, depth)]
+
+    print("\n Computing %s in parallel using %d cpus (slabs of %d slices)" % (mode, ncpus, depth))
+
+    # voxelized map, written slab by slab
+    dtype = segflt.dtype if mode == "peaks" else np.min_scalar_type(8 * down ** 3)
+    marray = tiff.memmap(outvox, shape=shape, dtype=dtype, bigtiff=True)
+
+    # a segmentation read to memory is shared with the workers as a memmap
+    with shared_arrays(segflt, tmp_dir=os.path.dirname(os.path.abspath(outvox))) as (segflt,):
+        if mode == "peaks":
+            # slices kept by the (nearest neighbour) downsampling in z
+            zidx = sp.ndimage.zoom(np.arange(sx, dtype=np.float64), 1.0 / down, order=0).astype(int)
+            tasks = [(z0, z1, np.flatnonzero((zidx >= z0) & (zidx < z1))) for z0, z1 in slabs]
+            tasks = [task for task in tasks if len(task[2])]
+            for b in range(0, len(tasks), ncpus):
+                res = parallel_map(
+                    voxpeaks,
+                    ((segflt, zidx[outz], kernel, down) for z0, z1, outz in tasks[b:b + ncpus]),
+                    ncpus,
+                )
+                for (z0, z1, outz), slcs in zip(tasks[b:b + ncpus], res):
+                    marray[outz] = slcs
+
+        elif mode == "voxels":
+            for b in range(0, len(slabs), ncpus):
+                res = parallel_map(voxvoxels, ((segflt, z0, z1, down, shape[1:]) for z0, z1 in slabs[b:b + ncpus]), ncpus)
+                for (z0, z1), counts in zip(slabs[b:b + ncpus], res):
+                    # the voxels past the last output slice are counted in it
+                    for i, slc in enumerate(counts):
+                        marray[min(z0 // down + i, shape[0] - 1)] += slc.astype(dtype)
+
+        else:
+            centroids = countcells(segflt, ncpus, slabs)
+            print("\n %d cells found" % len(centroids))
+            idx = np.floor((centroids + 0.5) / down).astype(np.int64)
+            idx = np.minimum(idx, np.array(shape) - 1)
+            np.add.at(marray, tuple(idx.T), 1)
+
+    marray.flush()
 
     return marray
 
@@ -243,7 +451,7 @@ def main(args):
 
     parser = parsefn()
 
-    seg, res, down, vx, vz = parse_inputs(parser, args)
+    seg, res, down, vx, vz, slice_filter, outdir, mode, memory = parse_inputs(parser, args)
 
     print("The following arguments are being used:")
     print(f"  seg:  {seg}")
@@ -251,16 +459,34 @@ def main(args):
     print(f"  down: {down}")
     print(f"  vx:   {vx}")
     print(f"  vz:   {vz}")
+    print(f"  filter: {slice_filter}")
+    print(f"  mode: {mode}")
+    print(f"  memory: {memory}")
+
+    if is_chunked_volume(seg):
+        # chunked volume of the segmentation (e.g. seg_final_out.zarr of the ACE flow)
+        segindir = os.path.dirname(os.path.realpath(seg))
+        base = os.path.basename(os.path.realpath(seg))
+        fstr = (base, "")
+        seg_type = "seg"
+    elif os.path.isdir(seg):
+        # folder of segmented slices (e.g. seg_final/ of the ACE flow)
+        segindir = os.path.realpath(seg)
+        base = os.path.basename(segindir)
+        fstr = (base, "")
+        seg_type = "seg"
+    else:
+        segindir = os.path.dirname(os.path.realpath(seg))
 
-    segdir = os.path.dirname(os.path.realpath(seg))
-
+        base = os.path.basename(seg)
 
-    base = os.path.basename(seg)
+        fstr = os.path.splitext(base)
 
-    fstr = os.path.splitext(base)
+        # Check if string contains '_' and if False use 'undefined' as type
+        seg_type = fstr[0].split("_")[1] if "_" in fstr[0] else "undefined"
 
-    # Check if string contains '_' and if False use 'undefined' as type
-    seg_type = fstr[0].split("_")[1] if "_" in fstr[0] else "undefined"
+    segdir = os.path.realpath(outdir) if outdir else segindir
+    os.makedirs(segdir, exist_ok=True)
 
     # outvox = '%s/voxelized_seg_%s.tiff' % (segdir, seg_type)
     # outvoxnii = '%s/voxelized_seg_%s.nii.gz' % (segdir, seg_type)
@@ -280,12 +506,18 @@ def main(args):
     # set radius = downsample_ratio / 2
     radius = floor(down / 2)
 
-    # Check if a Fiji (.ijm) file exists in target directory. If True,
-    # voxelization is being run as part of the ACE flow so the segmented
-    # tif should not be renamed
-    segbasebin = base if list(Path(segdir).glob("*.ijm")) else base.replace("seg", "seg_bin")
-
-    segbin = segdir + "/" + segbasebin
+    # A folder of slices is read as is (ACE flow). Otherwise check if a
+    # Fiji (.ijm) file exists in target directory. If True, the segmented
+    # tif was stacked by an older ACE flow so it should not be renamed
+    if is_chunked_volume(seg):
+        segbasebin = base
+        segbin = os.path.realpath(seg)
+    elif os.path.isdir(seg):
+        segbasebin = base
+        segbin = segindir
+    else:
+        segbasebin = base if list(Path(segindir).glob("*.ijm")) else base.replace("seg", "seg_bin")
+        segbin = segindir + "/" + segbasebin
 
     outvoxbin = '%s/voxelized_seg_%s.tiff' % (segdir, seg_type)
     outvoxniibin = '%s/voxelized_seg_%s.nii.gz' % (segdir, seg_type)
@@ -301,7 +533,7 @@ def main(args):
 
     if not os.path.exists(outvoxbin):
 
-        marraybin = parcomputevox(segbin, radius, ncpus, down, outvoxbin)
+        marraybin = parcomputevox(segbin, radius, ncpus, down, outvoxbin, slice_filter, mode, memory)
 
         savenvoxnii(marraybin, outvoxniibin, down, vx, vz)
 
@@ -1,6 +1,5 @@
 import argparse
 import json
-import multiprocessing
 import os
 from collections import defaultdict
 from pathlib import Path
@@ -10,7 +9,10 @@ import numpy as np
 import pandas as pd
 import skimage.measure
 import tifffile as tiff
-from joblib import Parallel, delayed
+from scipy import ndimage
+
+from miracl.seg.miracl_seg_neuron_table import NeuronTable
+from miracl.utilfn.miracl_utilfn_parallel import get_ncpus, parallel_map, shared_arrays
 
 ATLAS_DIR = Path(os.environ.get("aradir"))
 PROG_NAME = "ace_neuron_count"
@@ -164,19 +166,21 @@ class BoundingBoxes:
     @staticmethod
     def get_bbox(slice_path: Path, depth: int):
         slice_img = tiff.imread(slice_path)
-        unique_lables = set(slice_img.ravel())
+
+        # compact the (possibly large) label values to 1..n for find_objects
+        region_ids, compact_img = np.unique(slice_img, return_inverse=True)
+        compact_img = compact_img.reshape(slice_img.shape) + 1
         label_bboxes = dict()
 
-        for region_id in unique_lables:
+        for region_id, obj_slices in zip(region_ids, ndimage.find_objects(compact_img)):
             if region_id == 0:
                 continue
-            indices = np.nonzero(slice_img == region_id)
 
-            # get the min and max of the indices
-            min_coords = np.min(indices, axis=1)
-            max_coords = np.max(indices, axis=1)
+            # min and max (inclusive) of the indices
+            min_coords = [s.start for s in obj_slices]
+            max_coords = [s.stop - 1 for s in obj_slices]
             bbox = (*min_coords, *max_coords)
-            
+
             label_bboxes[region_id] = bbox
         return label_bboxes, depth
 
@@ -270,11 +274,32 @@ class NeuronInfo:
             for neuron_id, neuron_stats in neuron_info_dict.items():
                 res_dict[int(neuron_id + current_neuron_num)] = neuron_stats
             current_neuron_num += len(neuron_info_dict)
-        # save to json
-        with open(output_dir / "neuron_info.json", "w") as f:
-            json.dump(res_dict, f, indent=4)
+        # save as a neuron table
+        NeuronTable.from_dict(res_dict).save(output_dir / "neuron_info.npz")
         return res_dict
 
+    @staticmethod
+    def get_label_values(centroids: np.ndarray, label_files: List[Path]) -> np.ndarray:
+        """Label values at the (rounded) centroids. Centroids are grouped by
+        slice so that each label slice is read only once.
+
+        :param centroids: (n, 3) centroids (z, y, x)
+        :type centroids: np.ndarray
+        :param label_files: Label tifs (one per z)
+        :type label_files: List[Path]
+        :return: Label value of each centroid
+        :rtype: np.ndarray
+        """
+        coords = np.rint(centroids).astype(np.int64).reshape(-1, 3)
+        label_vals = np.zeros(len(coords), dtype=np.int64)
+        order = np.argsort(coords[:, 0], kind="stable")
+        depths, starts = np.unique(coords[order, 0], return_index=True)
+        for depth, rows in zip(depths, np.split(order, starts[1:])):
+            arr_label = tiff.imread(str(label_files[depth]))
+            label_vals[rows] = arr_label[coords[rows, 1], coords[rows, 2]]
+
+        return label_vals
+
 
 def main(args):
     seg_dir = args.seg
@@ -294,8 +319,7 @@ def main(args):
         cpu_load=cpu_load,
     )
 
-    cpus = multiprocessing.cpu_count()
-    ncpus = int(cpu_load * cpus)
+    ncpus = get_ncpus(cpu_load)
 
     print("Computing neuron count...")
 
@@ -305,11 +329,10 @@ def main(args):
 
     # get bounding box
     print("Getting bbox")
-    boxes = Parallel(n_jobs=ncpus, backend="threading")(
-        delayed(BoundingBoxes.get_bbox)(
-            label_slice,
-            depth,
-        ) for depth, label_slice in enumerate(label_files)
+    boxes = parallel_map(
+        BoundingBoxes.get_bbox,
+        ((label_slice, depth) for depth, label_slice in enumerate(label_files)),
+        n_workers=ncpus,
     )
     
     region_bbox_dict = BoundingBoxes.export_boxes(boxes, output_dir)
@@ -317,34 +340,26 @@ def main(args):
     # load in memmap
     img = tiff.memmap(seg_dir)
 
-    # loop over each region
-    neuron_info = Parallel(n_jobs=ncpus, backend="threading")(
-        delayed(NeuronInfo.computation_per_region)(region_id, region_bbox_dict, min_area, img) for region_id in region_bbox_dict.keys()
-    )
+    # loop over each region (CC labelling & regionprops in a process pool mapping the same memmap)
+    with shared_arrays(img, tmp_dir=output_dir) as (img,):
+        neuron_info = parallel_map(
+            NeuronInfo.computation_per_region,
+            ((region_id, region_bbox_dict, min_area, img) for region_id in region_bbox_dict.keys()),
+            n_workers=ncpus,
+        )
 
     neuron_info_dict = NeuronInfo.export_neuron_info(neuron_info, output_dir)
 
-    # loop over all regions, then neurons
-    for neuron_id, neuron_stats in neuron_info_dict.items():
-        # get the centroid
-        centroid = tuple(map(round, neuron_stats["centroid"]))
-        # get the label value of the atlas where the centroid is
-        arr_label = tiff.imread(str(label_files[centroid[0]]))
-        label_val = arr_label[
-            centroid[1],
-            centroid[2],
-        ]
-        if int(label_val) > 0:
-            # save that information to the centroid
-            neuron_stats["label_val"] = int(label_val)
-    
-    remove = [k for k, v in neuron_info_dict.items() if "label_val" not in v.keys()]
-    for k in remove:
-        neuron_info_dict.pop(k, None)
+    # get the label value of the atlas where the centroid of each neuron is
+    neuron_table = NeuronTable.from_dict(neuron_info_dict)
+    neuron_table["label"] = NeuronInfo.get_label_values(
+        neuron_table["centroid"], label_files
+    )
 
-    # save to json
-    with open(output_dir / "neuron_info_with_label.json", "w") as f:
-        json.dump(neuron_info_dict, f, indent=4)
+    # save the labeled neurons as a neuron table
+    neuron_table.select(neuron_table["label"] > 0).save(
+        output_dir / "neuron_info_with_label.npz"
+    )
 
 
 if __name__ == "__main__":
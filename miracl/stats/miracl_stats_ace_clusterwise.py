@@ -11,16 +11,15 @@ import pickle
 import nibabel as nib
 import sys
 import multiprocessing
-from nilearn.maskers import NiftiMasker
-from nilearn.image import concat_imgs, smooth_img
+from nilearn.image import smooth_img
 from sklearn.feature_selection import VarianceThreshold
 import fnmatch
 import numpy as np
-from mne.stats import spatio_temporal_cluster_test, ttest_ind_no_p
+from mne.stats import ttest_ind_no_p
 from sklearn.feature_extraction.image import grid_to_graph
+from scipy.sparse.csgraph import connected_components
 from joblib import Parallel, delayed
 from datetime import datetime
-import mne
 import scipy.ndimage as scp
 from scipy.stats import mannwhitneyu, ttest_ind, kruskal, f_oneway
 from miracl.flow.miracl_workflow_ace_parser import ACEWorkflowParser
@@ -105,192 +104,141 @@ def stat_fun_kruskal(args1, args2):
     return kruskal(args1, args2)[0]
 
 
-def cluster_fn(
-    slice,
-    all_vols_imgs,
-    mask_img_array,
-    mask_img,
+# -------------------------------------------------------
+# 3D TFCE permutation engine
+# -------------------------------------------------------
+def f_stat_batch(data, in_control):
+    """
+    One-way ANOVA F-values (two groups) of every voxel for a batch of group assignments.
+
+    data: (subjects x voxels) array, centred per voxel
+    in_control: (assignments x subjects) boolean array, True for subjects in the control group
+    returns: (assignments x voxels) array of F-values (0 where undefined)
+    """
+    n_subj = data.shape[0]
+    grp = in_control.astype(data.dtype)
+    n_1 = grp.sum(axis=1, keepdims=True)
+    n_2 = n_subj - n_1
+
+    total = data.sum(axis=0)
+    total_sq = np.square(data).sum(axis=0)
+    sum_1 = grp @ data
+    sum_2 = total - sum_1
+
+    ss_groups = np.square(sum_1) / n_1 + np.square(sum_2) / n_2
+    ss_between = ss_groups - np.square(total) / n_subj
+    ss_within = total_sq - ss_groups
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        f_vals = ss_between / (ss_within / (n_subj - 2))
+    f_vals[np.isnan(f_vals)] = 0
+
+    return f_vals
+
+
+def tfce_transform(stat, adjacency, start, step, h_power, e_power, include=None):
+    """
+    Threshold-free cluster enhancement of a voxel statistic over a sparse adjacency graph
+    (same Riemann sum as mne's TFCE: score += h^H * dh * extent^E for every threshold step).
+    """
+    scores = np.zeros(stat.shape, dtype=np.float64)
+    finite = stat[np.isfinite(stat)]
+    if finite.size == 0:
+        return scores
+
+    if include is None:
+        include = np.ones(stat.shape, dtype=bool)
+
+    prev_thresh = 0.0
+    for thresh in np.arange(start, finite.max(), step, float):
+        x_in = np.flatnonzero((stat > thresh) & include)
+        if x_in.size == 0:
+            break
+        _, labels = connected_components(adjacency[x_in][:, x_in], directed=False)
+        extent = np.bincount(labels)[labels]
+        scores[x_in] += abs(thresh) ** h_power * abs(thresh - prev_thresh) * extent ** e_power
+        prev_thresh = thresh
+
+    return scores
+
+
+def null_max_tfce(data, adjacency, orders, n_control, threshold_tfce, include, batch_size):
+    """Max TFCE score of every permutation in orders, computing F-values batch_size permutations at a time"""
+    h0 = np.zeros(len(orders))
+    rows = np.arange(min(batch_size, len(orders)))[:, None]
+
+    for b in range(0, len(orders), batch_size):
+        batch = orders[b : b + batch_size]
+        in_control = np.zeros((len(batch), data.shape[0]), dtype=bool)
+        in_control[rows[: len(batch)], batch[:, :n_control]] = True
+
+        for i, f_perm in enumerate(f_stat_batch(data, in_control)):
+            h0[b + i] = tfce_transform(f_perm, adjacency, include=include, **threshold_tfce).max()
+
+    return h0
+
+
+def tfce_permutation_test(
+    data,
+    n_control,
+    adjacency,
     num_perm,
-    f_obs_slices,
-    cluster_pv_slices,
-    mask_diff_mean_arr,
-    mask_diff_mean,
-    tfce_start,
-    tfce_step,
-    tfce_h,
-    tfce_e,
-    ncpus,
-    stp,
-    control_imgs,
-    out_dir,
+    threshold_tfce,
+    step_down_p=0,
+    n_jobs=1,
+    batch_size=32,
+    seed=None,
 ):
-    # sys.stdout.write("\r statistcal test on slice #%d ..." % slice)
-    sys.stdout.flush()
-
-    # print("statistcal test on slice #", slice, "...")
-    # print("------------------------------------")
-
-    all_vols_slices = []
-    for img in all_vols_imgs:
-        # img = nib.load(file)
-        img_slice = img.slicer[slice : slice + 1, :, :]
-        # print("image slice shape: ", img_slice.shape)
-        all_vols_slices.append(img_slice)
-
-    # create an adj where each pixel is connected to its neighbors and also mask the image to only work on where brain is
-    # adj = grid_to_graph(mask_img_array.shape[1], mask_img_array.shape[2], mask=mask_img_array[slice, :, :])
-
-    adj = grid_to_graph(
-        mask_diff_mean_arr.shape[1],
-        mask_diff_mean_arr.shape[2],
-        mask=mask_diff_mean_arr[slice, :, :],
-    )
-    print("adj shape: ", adj.shape)
-
-    # check if the data contains at least thr voxel inside the brain
-    thr = 50
-    if adj.shape[0] > thr:
-        # create nifti masker
-        print("Applying NiftiMasker")
-        # nifti_masker = NiftiMasker(mask_img=mask_img.slicer[slice:slice+1, :, :], standardize=False, memory='nilearn_cache')
-        nilearn_cache_dir = str(Path(out_dir) / "nilearn_cache")
-        nifti_masker = NiftiMasker(
-            mask_img=mask_diff_mean.slicer[slice : slice + 1, :, :],
-            standardize=True,
-            memory=nilearn_cache_dir,
-        )
-
-        # apply nifit masker
-        data = nifti_masker.fit_transform(concat_imgs(all_vols_slices))
-        print("data shape: ", data.shape)
-
-        eps = 0.001
-
-        if data.max() > eps:
-            # variance threshold
-            # print('Applying VarianceThreshold')
-
-            # print('min var', np.var(data, axis=1).min())
-            # print('mean var', np.var(data, axis=1).mean())
-            # print('max var', np.var(data, axis=1).max())
-
-            # var = np.var(data, axis=1).mean()
-
-            # variance_threshold = VarianceThreshold(threshold=var)
-            # thresh_data = variance_threshold.fit_transform(data)
-
-            thresh_data = data
-            # print('thresh_data shape: ', thresh_data.shape)
-
-            # preparing the data for cluster test; data should be subject x time x spatial info
-            thresh_data = np.expand_dims(thresh_data, axis=1)
-            print("thresh_data shape: ", thresh_data.shape)
-
-            # raise ValueError
-            # Permutation Cluster Test
-            mne.set_cache_dir(nilearn_cache_dir)
-
-            ############ applying simple stats tests voxel-wise for debugging
-            # t_stats_temp, p_value_temp = ttest_ind(thresh_data[0:len(control_imgs),], thresh_data[len(control_imgs):,], equal_var=False)
-            # print("applying voxelwise ttest: min: ",
-            #       np.min(t_stats_temp),
-            #       " max: ", np.max(t_stats_temp),
-            #       " min p value: ", np.min(p_value_temp),
-            #       " N voxels sig: ", np.sum(p_value_temp < 0.05))
-
-            # t_stats_temp, p_value_temp = mannwhitneyu(thresh_data[0:len(control_imgs),], thresh_data[len(control_imgs):,],
-            #                             alternative='two-sided')
-            # print("applying voxelwise mannwhitneyu: min: ",
-            #       np.min(t_stats_temp),
-            #       " max: ", np.max(t_stats_temp),
-            #       " min p value: ", np.min(p_value_temp),
-            #       " N voxels sig: ", np.sum(p_value_temp < 0.05))
-            # t_stats_temp, p_value_temp = kruskal(thresh_data[0:len(control_imgs),], thresh_data[len(control_imgs):,])
-            # print("applying voxelwise kruskal: min: ",
-            #        np.min(t_stats_temp),
-            #        " max: ", np.max(t_stats_temp),
-            #        " min p value: ", np.min(p_value_temp),
-            #        " N voxels sig: ", np.sum(p_value_temp < 0.05))
-            # t_stats_temp, p_value_temp = f_oneway(thresh_data[0:len(control_imgs),], thresh_data[len(control_imgs):,])
-            # print("applying voxelwise f_oneway: min: ",
-            #       np.min(t_stats_temp),
-            #       " max: ", np.max(t_stats_temp),
-            #       " min p value: ", np.min(p_value_temp),
-            #       " N voxels sig: ", np.sum(p_value_temp < 0.05))
-            ######################
-
-            threshold_tfce = dict(
-                start=float(tfce_start),
-                step=float(tfce_step),
-                h_power=tfce_h,
-                e_power=tfce_e,
-            )  # h=1 ans e = 1 to find more
-            f_obs, clusters, cluster_pv, H0 = spatio_temporal_cluster_test(
-                [thresh_data[0 : len(control_imgs),], thresh_data[len(control_imgs) :,]],
-                # thresh_data[len(control_imgs):,],
-                threshold=threshold_tfce,
-                adjacency=adj,
-                out_type="mask",
-                n_permutations=num_perm,
-                buffer_size=100000,
-                tail=0,
-                n_jobs=ncpus,
-                # stat_fun=stat_fun_kruskal,
-                step_down_p=stp,
-                # max_step = 50,
-                # t_power = 0
+    """
+    Two-group F-test with TFCE and max-statistic permutation inference over a 3D voxel graph
+
+    data: (subjects x voxels) masked data, control subjects first
+    adjacency: sparse (voxels x voxels) adjacency of the masked voxels
+    threshold_tfce: dict with start, step, h_power and e_power
+
+    Permutations are split across n_jobs worker processes (one level of parallelism)
+    and their F-values computed batch_size at a time as one matrix product.
+
+    returns: TFCE scores, voxel-wise corrected p-values and the null distribution H0
+    """
+    data = np.asarray(data, dtype=np.float64)
+    data = data - data.mean(axis=0)
+    adjacency = adjacency.tocsr()
+    n_subj = data.shape[0]
+
+    in_control = np.zeros((1, n_subj), dtype=bool)
+    in_control[0, :n_control] = True
+    tfce_obs = tfce_transform(f_stat_batch(data, in_control)[0], adjacency, **threshold_tfce)
+
+    rng = np.random.default_rng(seed)
+    orders = np.array([rng.permutation(n_subj) for _ in range(num_perm - 1)]).reshape(-1, n_subj)
+    order_chunks = [chunk for chunk in np.array_split(orders, max(n_jobs, 1)) if len(chunk)]
+
+    include = None
+    n_removed = 1
+    total_removed = 0
+    while n_removed > 0:
+        h0 = Parallel(n_jobs=n_jobs)(
+            delayed(null_max_tfce)(
+                data, adjacency, chunk, n_control, threshold_tfce, include, batch_size
             )
-
-            cluster_pv = -1 * np.log10(cluster_pv)  # 0.05 woll be -1.3
-            if cluster_pv.max() > 1.3:
-                print("H0 is rejected!")
-            print("Max p value on slice #", slice, ": ", cluster_pv.max())
-
-            # print('Applying niftimasker inverse transform')
-            print("------------------------------------")
-            p_values = np.expand_dims(cluster_pv, axis=0)
-            f_obs = np.nan_to_num(f_obs)
-
-            # pvals_unmasked = nifti_masker.inverse_transform(variance_threshold.inverse_transform(p_values))
-            pvals_unmasked = nifti_masker.inverse_transform(p_values)
-            # pvals_unmasked has the shape of (1, height, width, 1)
-            pvals_unmasked = pvals_unmasked.get_fdata()[0, :, :, 0]
-            # f_obs_unmasked = nifti_masker.inverse_transform(variance_threshold.inverse_transform(f_obs))
-            f_obs_unmasked = nifti_masker.inverse_transform(f_obs)
-            f_obs_unmasked = f_obs_unmasked.get_fdata()[0, :, :, 0]
-
-            # f_obs_slices.append(f_obs_unmasked)
-            # cluster_pv_slices.append(pvals_unmasked)
-            # clusters_slices.append(clusters)
-            # H0_slices.append(H0)
-
-        else:
-            print("this slice contains values less than %f ... skipping stats" % eps)
-            print("------------------------------------")
-            f_obs_unmasked = np.zeros((img_slice.shape[1], img_slice.shape[2]))
-            pvals_unmasked = np.zeros((img_slice.shape[1], img_slice.shape[2]))
-
-            # f_obs_slices.append(f_obs_unmasked)
-            # cluster_pv_slices.append(pvals_unmasked)
-            # clusters_slices.append([])
-            # H0_slices.append([])
-
-    else:
-        print(
-            "this slice contains less than %d voxels inside the brain ... skipping stats"
-            % thr
+            for chunk in order_chunks
         )
-        print("------------------------------------")
-        f_obs_unmasked = np.zeros((img_slice.shape[1], img_slice.shape[2]))
-        pvals_unmasked = np.zeros((img_slice.shape[1], img_slice.shape[2]))
+        h0 = np.concatenate([[tfce_obs.max()]] + h0)
 
-        # f_obs_slices.append(f_obs_unmasked)
-        # cluster_pv_slices.append(pvals_unmasked)
-        # clusters_slices.append([])
-        # H0_slices.append([])
+        # fraction of the null distribution at least as large as each voxel score
+        h0_sorted = np.sort(h0)
+        p_values = (h0.size - np.searchsorted(h0_sorted, tfce_obs, side="left")) / h0.size
 
-    f_obs_slices[slice, :, :] = f_obs_unmasked
-    cluster_pv_slices[slice, :, :] = pvals_unmasked
+        # step-down-in-jumps: exclude significant voxels from subsequent permutations
+        to_remove = p_values < step_down_p
+        n_removed = to_remove.sum() - total_removed
+        total_removed = to_remove.sum()
+        include = ~to_remove
+        if n_removed > 0:
+            print("step-down: excluding %d voxels from next permutations" % n_removed)
+
+    return tfce_obs, p_values, h0
 
 
 def main(args, output_dir_arg):
@@ -566,88 +514,78 @@ def main(args, output_dir_arg):
         os.path.join(out_dir, "mask_diff_mean.nii.gz"),
     )
     print("mask_diff_mean shape: ", mask_diff_mean_arr.shape)
-    mask_diff_mean = nib.load(os.path.join(out_dir, "mask_diff_mean.nii.gz"))
 
     # -------------------------------------------------------
     # start statistics
     # -------------------------------------------------------
-    # concatenate two groups images
+    # concatenate two groups images into a subjects x voxels matrix of the masked data
     all_vols = control_imgs + trt_imgs
-    # print(all_vols)
     all_vols = [os.path.join(out_dir, file) for file in all_vols]
-    all_vols_imgs = [nib.load(file) for file in all_vols]
-    # all_vols = concat_imgs(all_vols)
 
-    temp_img = nib.load(os.path.join(out_dir, control_imgs[0]))
+    temp_img = nib.load(all_vols[0])
+    stat_mask = mask_diff_mean_arr.astype(bool)
 
-    # -------------------------------------------------------
-    # Parallelize clustering function
-    # -------------------------------------------------------
+    f_obs_vol = np.zeros(temp_img.shape[:3], dtype=np.float32)
+    cluster_pv_vol = np.zeros(temp_img.shape[:3], dtype=np.float32)
+    clusters, H0 = [], []
 
-    # statistics results
+    # check if the data contains at least thr voxels inside the mask
+    thr = 50
+    if stat_mask.sum() > thr:
+        data = np.stack(
+            [nib.load(file).get_fdata(dtype=np.float32)[stat_mask] for file in all_vols]
+        )
+        print("data shape: ", data.shape)
 
-    clusters_slices, H0_slices = [], []
+        # one 3D adjacency where each voxel is connected to its neighbours within the mask
+        adj = grid_to_graph(*stat_mask.shape, mask=stat_mask)
+        print("adj shape: ", adj.shape)
+
+        threshold_tfce = dict(
+            start=float(tfce_start),
+            step=float(tfce_step),
+            h_power=tfce_h,
+            e_power=tfce_e,
+        )  # h=1 ans e = 1 to find more
+
+        print("Running TFCE permutations in parallel using %s cpus ..." % ncpus)
+        f_obs, cluster_pv, H0 = tfce_permutation_test(
+            data,
+            len(control_imgs),
+            adj,
+            num_perm,
+            threshold_tfce,
+            step_down_p=stp,
+            n_jobs=ncpus,
+        )
 
-    f_memap = os.path.join(out_dir, "tmp_f_array_memmap.map")
-    p_memap = os.path.join(out_dir, "tmp_p_array_memmap.map")
+        cluster_pv = -1 * np.log10(cluster_pv)  # 0.05 woll be -1.3
+        if cluster_pv.max() > 1.3:
+            print("H0 is rejected!")
+        print("Max p value: ", cluster_pv.max())
 
-    f_obs_slices = np.memmap(
-        f_memap,
-        dtype=np.float32,
-        shape=(temp_img.shape[0], temp_img.shape[1], temp_img.shape[2]),
-        mode="w+",
-    )
-    cluster_pv_slices = np.memmap(
-        p_memap,
-        dtype=np.float32,
-        shape=(temp_img.shape[0], temp_img.shape[1], temp_img.shape[2]),
-        mode="w+",
-    )
+        f_obs_vol[stat_mask] = np.nan_to_num(f_obs)
+        cluster_pv_vol[stat_mask] = cluster_pv
 
-    print("Running in parallel using %s cpus ..." % ncpus)
-
-    # Parallel(n_jobs=ncpus, backend="threading")(delayed(cluster_fn)(
-    Parallel(n_jobs=ncpus)(
-        delayed(cluster_fn)(
-            s,
-            all_vols_imgs,
-            mask_img_array,
-            mask_img,
-            num_perm,
-            f_obs_slices,
-            cluster_pv_slices,
-            mask_diff_mean_arr,
-            mask_diff_mean,
-            tfce_start,
-            tfce_step,
-            tfce_h,
-            tfce_e,
-            ncpus,
-            stp,
-            control_imgs,
-            out_dir,
+    else:
+        print(
+            "the mask contains less than %d voxels inside the brain ... skipping stats"
+            % thr
         )
-        for s in range(temp_img.shape[0])
-    )
-    # s, all_vols_imgs, mask_img_array, mask_img, num_perm, f_obs_slices, cluster_pv_slices) for s in range(221,225))
 
     print("saving Nifti files")
     nib.save(
-        nib.Nifti1Image(f_obs_slices, temp_img.affine, temp_img.header),
+        nib.Nifti1Image(f_obs_vol, temp_img.affine, temp_img.header),
         os.path.join(out_dir, "f_obs.nii.gz"),
     )
     nib.save(
-        nib.Nifti1Image(cluster_pv_slices, temp_img.affine, temp_img.header),
+        nib.Nifti1Image(cluster_pv_vol, temp_img.affine, temp_img.header),
         os.path.join(out_dir, "p_values.nii.gz"),
     )
     print("saving results into a pickle file")
 
     with open(os.path.join(out_dir, "results.pickle"), "wb") as f:
-        pickle.dump([f_obs_slices, clusters_slices, cluster_pv_slices, H0_slices], f)
-
-    # remove tmp memmaps
-    os.remove(f_memap)
-    os.remove(p_memap)
+        pickle.dump([f_obs_vol, clusters, cluster_pv_vol, H0], f)
 
     end_str = f"\n  Parallel cluster permutation-based stats done in {datetime.now() - startTime} ... Have a good day!\n"
 
@@ -24,6 +24,8 @@ from scipy.stats import pearsonr
 from skimage import measure
 from sklearn.utils import resample
 
+from miracl.lbls.miracl_lbls_ontology import load_ontology
+
 # # -------------------------------------------------------
 # # create parser
 # # -------------------------------------------------------
@@ -132,11 +134,9 @@ def main(args, output_dir_arg, p_value_arg, stats_arg, mean_diff_arg):
 
     lbl_dir = os.environ["aradir"]
 
-    annotation_lbls = pd.read_csv(
-        os.path.join(lbl_dir, "ara_mouse_structure_graph_hemi_combined.csv"),
+    annotation_lbls = load_ontology(
+        csv=os.path.join(lbl_dir, "ara_mouse_structure_graph_hemi_combined.csv"),
     )
-    selected_columns = ["id", "name"]
-    annotation_lbls = annotation_lbls[selected_columns]
 
     # Display the DataFrame
     # print(annotation_lbls['lbl_name'])
@@ -310,13 +310,7 @@ def main(args, output_dir_arg, p_value_arg, stats_arg, mean_diff_arg):
         cluster_lbls.sort()
         cluster_lbl_values, counts = np.unique(cluster_lbls, return_counts=True)
         cluster_lbl_areas_percent = counts / data["area"][i]
-        cluster_lbl_names = []
-        for value in cluster_lbl_values:
-            try:
-                cluster_name = list(annotation_lbls["id"]).index(value)
-                cluster_lbl_names.append(annotation_lbls["name"][cluster_name])
-            except ValueError:
-                cluster_lbl_names.append("unknown")
+        cluster_lbl_names = list(annotation_lbls.name(cluster_lbl_values, default="unknown"))
         data["cluster_lbl_values"][i] = cluster_lbl_values
         data["cluster_lbl_names"][i] = cluster_lbl_names
         data["cluster_lbl_areas_percent"][i] = cluster_lbl_areas_percent
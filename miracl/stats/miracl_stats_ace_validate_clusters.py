@@ -12,7 +12,9 @@ import scipy.ndimage as scp
 from scipy.stats import mannwhitneyu
 from skimage import measure
 
+from ..lbls.miracl_lbls_ontology import Ontology, load_ontology
 from ..seg.miracl_seg_count_neurons_json import main as count_neurons_with_json
+from ..seg.miracl_seg_neuron_table import load_neuron_table
 from .miracl_stats_ace_cluster_neuron_count import main as count_neurons_without_json
 
 ATLAS_DIR = Path(os.environ.get("aradir"))
@@ -100,8 +102,8 @@ def parsefn():
     )
     optional_args.add_argument(
         "--neuron-info-dir",
-        help="""path to directory containing neuron information json files (if available)
-    names of the json files should be the same as the subject names""",
+        help="""path to directory containing neuron tables (<subject>_neuron_info.npz) or
+    legacy neuron information json files (<subject>_neuron_info.json) (if available)""",
         default=None,
     )
     optional_args.add_argument(
@@ -156,7 +158,7 @@ class AtlasLoader:
     @staticmethod
     def load_atlas(
         atlas_dir: Path, out_dir: Path, hemi: str, side: str, img_res: int = 25
-    ) -> Tuple[np.ndarray, pd.DataFrame]:
+    ) -> Tuple[np.ndarray, Ontology]:
         ann_dir = atlas_dir / "annotation"
 
         # load the atlas
@@ -168,11 +170,9 @@ class AtlasLoader:
         ann_img = nib.load(ann_dir / ann_filename)
         ann_img_array = ann_img.get_fdata()
         
-        annotation_lbls = pd.read_csv(
-            atlas_dir / f"ara_mouse_structure_graph_hemi_{hemi}.csv",
+        annotation_lbls = load_ontology(
+            csv=atlas_dir / f"ara_mouse_structure_graph_hemi_{hemi}.csv",
         )
-        selected_columns = ["id", "name"]
-        annotation_lbls = annotation_lbls[selected_columns]
 
         ann_img_array = ann_img_array.astype(np.int_)
         return ann_img_array, annotation_lbls
@@ -387,7 +387,7 @@ class NeuronCounter:
             count_neurons_with_json(count_neurons_json_namespace)
 
             treated_subj_list_json_paths_with_counts.append(
-                out_dir / subj.name / "neuron_info_final_with_label.json"
+                out_dir / subj.name / "neuron_info_final_with_label.npz"
             )
 
         control_subj_list_json_paths_with_counts = []
@@ -407,7 +407,7 @@ class NeuronCounter:
             count_neurons_with_json(count_neurons_json_namespace)
 
             control_subj_list_json_paths_with_counts.append(
-                out_dir / subj.name / "neuron_info_final_with_label.json"
+                out_dir / subj.name / "neuron_info_final_with_label.npz"
             )
 
         return (
@@ -430,7 +430,7 @@ class NeuronCounter:
         treated_subj_list_json_paths = []
         for idx, subj in enumerate(treated_subj_list_paths):
             treated_subj_list_json_paths.append(
-                out_dir / subj.name / "neuron_info_with_label.json"
+                out_dir / subj.name / "neuron_info_with_label.npz"
             )
 
             count_neurons_json_namespace = argparse.Namespace(
@@ -448,7 +448,7 @@ class NeuronCounter:
         control_subj_list_json_paths = []
         for idx, subj in enumerate(control_subj_list_paths):
             control_subj_list_json_paths.append(
-                out_dir / subj.name / "neuron_info_with_label.json"
+                out_dir / subj.name / "neuron_info_with_label.npz"
             )
 
             count_neurons_json_namespace = argparse.Namespace(
@@ -473,7 +473,7 @@ class NeuronCounter:
         labeled_pval_array: Optional[np.ndarray] = None,
         f_stat_array: Optional[np.ndarray] = None,
         atlas_annotation_array: Optional[np.ndarray] = None,
-        atlas_annotation_lbls_df: Optional[pd.DataFrame] = None,
+        atlas_annotation_lbls: Optional[Ontology] = None,
     ) -> pd.DataFrame:
 
         # ensure label array is same shape as annotation
@@ -549,15 +549,9 @@ class NeuronCounter:
             cluster_lbls.sort()
             cluster_lbl_values, counts = np.unique(cluster_lbls, return_counts=True)
             cluster_lbl_areas_percent = counts / data["area"][i]
-            cluster_lbl_names = []
-            for value in cluster_lbl_values:
-                try:
-                    cluster_name = list(atlas_annotation_lbls_df["id"]).index(value)
-                    cluster_lbl_names.append(
-                        atlas_annotation_lbls_df["name"][cluster_name]
-                    )
-                except ValueError:
-                    cluster_lbl_names.append("unknown")
+            cluster_lbl_names = list(
+                atlas_annotation_lbls.name(cluster_lbl_values, default="unknown")
+            )
             data.iloc[i, data.columns.get_loc("cluster_lbl_values")] = [
                 [cluster_lbl_values]
             ]
@@ -588,18 +582,15 @@ class NeuronCounter:
         clusters = sig_clusters_summary_csv["label"]
         sig_clusters_summary_csv[f"neuron_count_{subj}"] = 0
 
-        with open(neuron_json, "r") as f:
-            neuron_json_dict = json.load(f)
+        # number of neurons per cluster label
+        neuron_labels = load_neuron_table(neuron_json)["label"]
+        cluster_labels, counts = np.unique(neuron_labels, return_counts=True)
+        counts_dict = dict(zip(cluster_labels.tolist(), counts.tolist()))
 
         for i, cluster in enumerate(clusters):
-            neurons = []
-            for neuron_id, stats in neuron_json_dict.items():
-                if stats["label_val"] == cluster:
-                    neurons.append(neuron_id)
-
             sig_clusters_summary_csv.iloc[
                 i, sig_clusters_summary_csv.columns.get_loc(f"neuron_count_{subj}")
-            ] = len(neurons)
+            ] = counts_dict.get(int(cluster), 0)
         try:
             with open(Path(neuron_json).parent / "label_bboxes.json", "r") as f:
                 bbox_dict = json.load(f)
@@ -800,7 +791,7 @@ class ValidateClustersInterface:
 
         self.treated_subj_list_json_paths = (
             [
-                self.neuron_info_dir / f"{subj.name}_neuron_info.json"
+                self._get_neuron_info_path(subj)
                 for subj in self.treated_subj_list_paths
             ]
             if self.neuron_info_dir is not None
@@ -809,15 +800,23 @@ class ValidateClustersInterface:
 
         self.control_subj_list_json_paths = (
             [
-                self.neuron_info_dir / f"{subj.name}_neuron_info.json"
+                self._get_neuron_info_path(subj)
                 for subj in self.control_subj_list_paths
             ]
             if self.neuron_info_dir is not None
             else [None] * n_subj_control
         )
 
+    def _get_neuron_info_path(self, subj: Path) -> Path:
+        """Neuron table of a subject, falls back to a legacy json file"""
+        neuron_info_path = self.neuron_info_dir / f"{subj.name}_neuron_info.npz"
+        legacy_path = neuron_info_path.with_suffix(".json")
+        if not neuron_info_path.exists() and legacy_path.exists():
+            return legacy_path
+        return neuron_info_path
+
     def _load_atlas(self):
-        self.ann_img_array, self.annotation_lbls_df = AtlasLoader.load_atlas(
+        self.ann_img_array, self.annotation_lbls = AtlasLoader.load_atlas(
             atlas_dir=self.atlas_dir,
             out_dir=self.out_dir,
             img_res=self.vox_size,
@@ -846,7 +845,7 @@ class ValidateClustersInterface:
             f_stat_array=f_stat_array,
             out_dir=self.out_dir,
             atlas_annotation_array=self.ann_img_array,
-            atlas_annotation_lbls_df=self.annotation_lbls_df,
+            atlas_annotation_lbls=self.annotation_lbls,
         )
 
         # warp clusters to original space treated
@@ -16,8 +16,9 @@ from miracl.utilfn.depends_manager import add_paths
 from miracl import ATLAS_DIR
 
 from miracl.lbls.miracl_lbls_get_graph_info import get_lbl_info
+from miracl.lbls.miracl_lbls_ontology import load_ontology
 from miracl.utilfn.miracl_utilfn_extract_lbl import extract_label
-from miracl.lbls.miracl_lbls_generate_parents_at_depth import get_parent_data
+from miracl.lbls.miracl_lbls_generate_parents_at_depth import get_parent_data, relabel
 
 ### Inputs #########
 
@@ -138,35 +139,39 @@ def projpvalonatlas(atlas, atlas_legend, pval_csv, output, thresh=None):
     atlas_img = nii.get_data()
 
     # load atlas lookup table, pval table
-    atlas_df = pd.read_csv(atlas_legend)
+    atlas_ontology = load_ontology(csv=atlas_legend)
     pval_df = pd.read_csv(pval_csv)
 
-    # create dictionary that stores depth of each arrat
-    depth_arr_dict = {}
+    # p-values to project and their (allen_id, row) at each depth
+    pvals = []
+    depth_rows = {}
 
-    # generate blank image
-    res = np.zeros(atlas_img.shape)
     # for each region in the csv result file
     for index, row in pval_df.iterrows():
         region = row['region'][1:]
         # get the corresponding atlas_id value in the split atlas
         # if the value isnt nan, extract and go
         if pd.notna(row['pvalue']) and row['pvalue'] < thresh:
-            allen_id = atlas_df.loc[atlas_df['acronym'] == region, 'id'].iloc[0]
-
-            name = atlas_df.loc[atlas_df['acronym'] == region, 'name'].iloc[0]
+            allen_id = atlas_ontology.id_of(region, "acronym")
 
             # extract the depth, use the information to get the voxels with the ROI
             lbl_info = get_lbl_info(region)
             depth = lbl_info['depth'][0]
 
-            # if allen atlas at depth doesnt exist, create it
-            if depth not in depth_arr_dict:
-                depth_arr_dict[depth] = get_parent_data(depth)
-            depth_arr = depth_arr_dict[depth]
+            depth_rows.setdefault(depth, []).append((allen_id, len(pvals)))
+            pvals.append(row['pvalue'])
 
-            # set all corresponding voxels to the p-value
-            res[depth_arr == allen_id] = row['pvalue']
+    # last p-value row covering each voxel (-1: none), one lookup per depth
+    last_row = np.full(atlas_img.shape, -1, dtype=np.int64)
+    for depth, rows in depth_rows.items():
+        allen_ids, row_nums = zip(*rows)
+        depth_arr = get_parent_data(depth)
+        np.maximum(last_row, relabel(depth_arr, allen_ids, row_nums, fill=-1, dtype=np.int64), out=last_row)
+
+    # set all corresponding voxels to the p-value
+    res = np.zeros(atlas_img.shape)
+    covered = last_row >= 0
+    res[covered] = np.asarray(pvals)[last_row[covered]]
 
     # store nifti as result
     newnii = nib.Nifti1Image(res, nii.affine)
@@ -13,6 +13,7 @@ import numpy as np
 import pandas as pd
 import scipy.stats as stats
 from miracl.utilfn.depends_manager import add_paths
+from miracl.lbls.miracl_lbls_generate_parents_at_depth import relabel
 
 ### Inputs #########
 
@@ -207,17 +208,9 @@ def projpvalonatlas(atlas, pars, ipsi, tt_pval, outdir):
     # replace intensities with p-values
     for p, par in enumerate(pars):
 
-        newimg = np.ones(img.shape)
-
-        for t, ttx in enumerate(tt_pval[p]):
-            orgipsi = ipsi[t]
-            idxip = (img == orgipsi)
-            newimg[idxip] = tt_pval[p][t]
-
-            # # if want both sides
-            # orgcont = contra[w]
-            # idxcont = (img == orgcont)
-            # newimg[idxcont] = tt_pval[p][w]
+        # ipsi lbls -> p-values lookup table (other voxels: 1)
+        newimg = relabel(img, ipsi[:len(tt_pval[p])], tt_pval[p], fill=1, dtype=np.float64)
+        # (pass the contra lbls too if want both sides)
 
         # save new nifti
         mat = np.eye(4) * 0.025
@@ -16,7 +16,6 @@ from joblib import Parallel, delayed
 import numpy as np
 from datetime import datetime
 import subprocess
-import itertools
 from miracl.utilfn import miracl_utilfn_endstatement as end_statement
 import warnings
 
@@ -41,7 +40,8 @@ def helpmsg():
         optional arguments:
 
         g. Gaussian resampling sigma (in voxels)
-        n. number of permutations
+        p. stats test: ttest (parametric) or mannw (non-parametric)
+        m. memory budget (in GB) for each block of voxels processed at once (default: 2)
 
     '''
 
@@ -55,6 +55,8 @@ def parsefn():
     parser.add_argument('-g', '--sigma', type=int, help="resample Gaussian sigma", default=2)
     parser.add_argument('-p', '--param', type=str, help="stats test: ttest (parametric) or mannw (non-parametric)",
                         default='ttest')
+    parser.add_argument('-m', '--mem_budget', type=float,
+                        help="memory budget (in GB) for each block of voxels processed at once", default=2.0)
     # parser.add_argument('-n', '--num_perm', type=int, help="number of permutations", default=1000)
 
     return parser
@@ -70,9 +72,10 @@ def parse_inputs(parser, args):
     out_dir = args.out_dir
     sigma = args.sigma
     param = args.param
+    mem_budget = args.mem_budget
     # num_perm = args.num_perm
 
-    return control_dir, treated_dir, seg_type, out_dir, sigma, param
+    return control_dir, treated_dir, seg_type, out_dir, sigma, param, mem_budget
 
 
 def smooth_vox(v, vox, seg_type, out_dir, sigma, nv, group):
@@ -87,6 +90,58 @@ def smooth_vox(v, vox, seg_type, out_dir, sigma, nv, group):
                           stderr=subprocess.STDOUT)
 
 
+def _stats_block(control_vals, treated_vals, param):
+    """Two-sample test along the subject axis of a (voxels x subjects) block."""
+    if param == 'ttest':
+        t, p = stats.ttest_ind(control_vals, treated_vals, axis=1, equal_var=False)
+        return p
+
+    # scipy picks 'exact' vs 'asymptotic' once for the whole block if any value is tied,
+    # so split tied / untied voxels to get the same p-values as testing each voxel alone
+    p = np.ones(control_vals.shape[0], dtype=np.float64)
+    n_c, n_t = control_vals.shape[1], treated_vals.shape[1]
+    if n_c > 8 and n_t > 8:
+        t, p = stats.mannwhitneyu(control_vals, treated_vals, axis=1, method='asymptotic')
+        return p
+
+    all_vals = np.sort(np.concatenate((control_vals, treated_vals), axis=1), axis=1)
+    tied = np.any(np.diff(all_vals, axis=1) == 0, axis=1)
+    for method, rows in (('asymptotic', tied), ('exact', ~tied)):
+        if np.any(rows):
+            t, p[rows] = stats.mannwhitneyu(control_vals[rows], treated_vals[rows], axis=1, method=method)
+
+    return p
+
+
+def compute_voxel_stats(stack_control, stack_trt, mask, param, mem_budget=2.0):
+    """Computes voxel-wise p-values for all voxels inside the mask
+
+    Voxels are processed in vectorized blocks sized to fit within mem_budget (GB).
+    Voxels outside the mask (or with undefined stats) get a p-value of 1.
+
+    Returns a flat float64 array of p-values in C order of the mask shape
+    """
+    in_mask = np.flatnonzero(mask.ravel() == 1)
+    p_array = np.ones(mask.size, dtype=np.float64)
+
+    n_subj = stack_control.shape[-1] + stack_trt.shape[-1]
+    # values, sorted copy and ranks held per voxel
+    vox_bytes = 4 * n_subj * np.dtype(np.float64).itemsize
+    block_size = max(1, int(mem_budget * 1024 ** 3 // vox_bytes))
+
+    for start in range(0, in_mask.size, block_size):
+        block = in_mask[start:start + block_size]
+        sys.stdout.write("\rprocessing voxels %d-%d of %d in mask ... " % (start, start + block.size, in_mask.size))
+        sys.stdout.flush()
+
+        x, y, z = np.unravel_index(block, mask.shape)
+        p_array[block] = _stats_block(stack_control[x, y, z, :], stack_trt[x, y, z, :], param)
+
+    p_array[np.isnan(p_array)] = 1.0
+
+    return p_array
+
+
 def main(args):
     start_time = datetime.now()
     cpu_load = 0.9
@@ -94,7 +149,7 @@ def main(args):
     n_cpus = int(cpu_load * cpus)  # 95% of cores used2
 
     parser = parsefn()
-    control_dir, treated_dir, seg_type, out_dir, sigma, param = parse_inputs(parser, args)
+    control_dir, treated_dir, seg_type, out_dir, sigma, param, mem_budget = parse_inputs(parser, args)
 
     # create out dir
     if not os.path.exists(out_dir):
@@ -183,47 +238,12 @@ def main(args):
                               stdout=subprocess.PIPE,
                               stderr=subprocess.PIPE)
 
-    def mann(stack_control, stack_trt, mask, vl, param, xdim):
-        sys.stdout.write("\rprocessing voxel %d %d %d ... " % (vl[0], vl[1], vl[2]))
-        # rem = int((xdim - vl[0]/xdim) * 100)
-        # sys.stdout.write("\r%d percent remaining..." % rem)
-        sys.stdout.flush()
-
-        # mask_res = ndimage.zoom(mask, 1.0/sigma)
-        # mask_res[mask_res > 0.5] = 1
-        mv = mask[vl[0], vl[1], vl[2]]
-
-        if mv == 1:
-            control_vals = stack_control[vl[0], vl[1], vl[2], :]
-            treated_vals = stack_trt[vl[0], vl[1], vl[2], :]
-
-            try:
-                if param == 'ttest':
-                    t, p = stats.ttest_ind(control_vals, treated_vals, equal_var=False)
-                else:
-                    t, p = stats.mannwhitneyu(control_vals, treated_vals)
-            except ValueError:
-                p = 1.0
-        else:
-            p = 1.0
-
-        return p
-
-    cpuload = 0.9
-    cpus = multiprocessing.cpu_count()
-    ncpus = int(cpuload * cpus)  # 95% of cores used
-
     print('Reading 4D stack')
     stack_control_img = nib.load(four_dim_control)
     stack_control = stack_control_img.get_data()
     stack_trt_img = nib.load(four_dim_trt)
     stack_trt = stack_trt_img.get_data()
 
-    xdim = stack_control_img.shape[0]
-    x_dim = range(stack_control_img.shape[0])
-    y_dim = range(stack_control_img.shape[1])
-    z_dim = range(stack_control_img.shape[2])
-
     mask_res = os.path.join(out_dir, 'mask_res.nii.gz')
     subprocess.check_call('ResampleImage 3 %s %s %s 0 0' % (mask_file, mask_res, nv),
                           shell=True,
@@ -236,18 +256,16 @@ def main(args):
     mask_img = nib.load(mask_res)
     mask = mask_img.get_data()
 
-    vox_list = list(itertools.product(x_dim, y_dim, z_dim))
-
     print('Computing voxel-wise stats')
-    res = []
-    res = Parallel(n_jobs=ncpus, backend='threading')(delayed(mann)(stack_control, stack_trt, mask, vl, param, xdim) for vl in vox_list)
-    p_array = np.asarray(res, dtype=np.float64)
-    p_array[np.isnan(p_array)] = 1.0
+    p_array = compute_voxel_stats(stack_control, stack_trt, mask, param, mem_budget)
     print('Done voxel-wise stats')
 
-    print('FDR correcting')
+    print('FDR correcting (within brain mask)')
     p_array[p_array == 0] = 1.0
-    rej, corr_pvals = smm.fdrcorrection(p_array, alpha=0.05)
+    corr_pvals = np.ones_like(p_array)
+    in_mask = mask.ravel() == 1
+    if np.any(in_mask):
+        rej, corr_pvals[in_mask] = smm.fdrcorrection(p_array[in_mask], alpha=0.05)
     corr_pvals[np.isnan(corr_pvals)] = 1.0
     # corr_pvals = np.nan_to_num(corr_pvals, nan=1.0)
 
@@ -1,7 +1,7 @@
 import sys
 import argparse
 from miracl.utilfn import miracl_utilfn_endstatement, miracl_utilfn_create_brainmask, miracl_utilfn_extract_lbl, \
-    miracl_utilfn_int_corr_tiffs
+    miracl_utilfn_int_corr_tiffs, miracl_utilfn_chunked_volume
 
 
 def run_endstatement(parser, args):
@@ -20,6 +20,10 @@ def run_int_corr(parser, args):
     miracl_utilfn_int_corr_tiffs.main(args)
 
 
+def run_chunked_volume(parser, args):
+    miracl_utilfn_chunked_volume.main(args)
+
+
 def get_parser():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
@@ -51,6 +55,13 @@ def get_parser():
                                             help='Intensity correct tiff stack')
     parser_int_corr.set_defaults(func=run_int_corr)
 
+    # chunked_volume
+    chunked_volume_parser = miracl_utilfn_chunked_volume.parsefn()
+    parser_chunked_volume = subparsers.add_parser('chunked_volume', parents=[chunked_volume_parser], add_help=False,
+                                                  usage=chunked_volume_parser.usage,
+                                                  help='Convert tiff stack to chunked multi-resolution volume')
+    parser_chunked_volume.set_defaults(func=run_chunked_volume)
+
     return parser
 
 
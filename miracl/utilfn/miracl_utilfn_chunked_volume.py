@@ -0,0 +1,572 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+Chunked, compressed & multi-resolution volume store (OME-Zarr layout)
+
+Volumes (ZYX) are saved as a folder of zlib compressed chunks, one sub-folder per
+resolution level (0 = full resolution, each level down-sampled by 2 in z, y & x):
+
+    clarity.zarr/
+        .zgroup, .zattrs          multiscales metadata (voxel size of each level)
+        0/.zarray, 0/z/y/x        full resolution chunks
+        1/.zarray, 1/z/y/x        2x down-sampled chunks
+        ...
+
+The layout follows zarr v2 / OME-NGFF 0.4, so stores can also be opened with
+zarr, napari or Fiji (n5-viewer), but only numpy and the standard library are
+needed here. Chunks that only hold zeros are not saved.
+
+Any sub-block of any level is read without touching the rest of the data:
+
+    vol = ChunkedVolume.create("seg.zarr", shape, "uint8", voxel_size=(5, 5, 5))
+    vol[z0:z1] = slab                   # write (e.g. slab by slab)
+    vol.build_pyramid(n_levels=4)       # down-sampled levels
+    block = vol[100:200, 1000:2000, :]  # full resolution sub-block
+    low = vol.level(3)[:]               # 8x down-sampled volume
+"""
+
+import argparse
+import json
+import os
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+from miracl.utilfn.miracl_utilfn_parallel import get_ncpus, parallel_map
+from miracl.utilfn.miracl_utilfn_virtual_stack import VirtualStack, find_slices
+
+ZARR_EXTENSION = ".zarr"
+DEFAULT_CHUNKS = (64, 256, 256)
+DOWNSAMPLING_MODES = ("mean", "max", "nearest")
+COMPRESSION_LEVEL = 1
+
+
+def helpmsg():
+    return '''
+
+    Converts a 3D tif, or a folder of 2D tif slices, to a chunked multi-resolution volume (.zarr)
+
+    Sub-blocks and down-sampled levels of the volume can then be read without
+    reading the full resolution data
+
+    Example: miracl utils chunked_volume -i seg_final -o seg_final.zarr -f MC_ -vx 5 -vz 5 -l 4 -m max
+        '''
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(description=helpmsg(), formatter_class=argparse.RawTextHelpFormatter,
+                                     add_help=False,
+                                     usage='%(prog)s -i [input tif / tif folder] -o [ output .zarr ] -l [ levels ] '
+                                           '-m [ down-sampling mode ]')
+
+    required = parser.add_argument_group('required arguments')
+    required.add_argument('-i', '--input', type=str, required=True, metavar='',
+                          help="Input 3D tif or folder of tif slices")
+
+    optional = parser.add_argument_group('optional arguments')
+    optional.add_argument('-o', '--output', type=str, metavar='', default=None,
+                          help="Output volume (default: <input>.zarr)")
+    optional.add_argument('-f', '--filter', type=str, metavar='', default="",
+                          help="Prefix of the tif slices to read if the input is a folder (default: all tif slices)")
+    optional.add_argument('-vx', '--resx', type=float, metavar='', default=1.0,
+                          help="Resolution in x-y plane in um (default: %(default)s)")
+    optional.add_argument('-vz', '--resz', type=float, metavar='', default=1.0,
+                          help="Thickness (z-axis resolution) in um (default: %(default)s)")
+    optional.add_argument('-l', '--levels', type=int, metavar='', default=4,
+                          help="Number of resolution levels (default: %(default)s)")
+    optional.add_argument('-m', '--mode', type=str, metavar='', default="mean", choices=DOWNSAMPLING_MODES,
+                          help="Down-sampling of the levels: mean (intensities), max (segmentations) "
+                               "or nearest (labels) (default: %(default)s)")
+    optional.add_argument('-c', '--chunks', type=int, nargs=3, metavar='', default=list(DEFAULT_CHUNKS),
+                          help="Chunk size (z y x) (default: %(default)s)")
+    optional.add_argument("-h", "--help", action="help", help="Show this help message and exit")
+
+    return parser
+
+
+# ---------
+# helpers
+
+def is_chunked_volume(path):
+    """
+    True if path is a chunked volume (folder with multiscales metadata)
+    """
+    return (Path(path) / ".zattrs").is_file() and (Path(path) / "0" / ".zarray").is_file()
+
+
+def chunked_volume_path(output_path, image_mode, wildcard=False):
+    """
+    Path of the chunked volume of the image_mode slices of an output folder
+    (e.g. seg_final + out_ -> seg_final_out.zarr)
+
+    :param output_path: output folder of the slices
+    :param image_mode: prefix of the slices (out_, MC_unet_, ...)
+    :param wildcard: return the glob pattern of the volumes of all the prefixes
+        starting with image_mode (e.g. MC_ -> seg_final_MC*.zarr)
+    """
+    return (str(output_path).rstrip(os.sep) + "_" + image_mode.rstrip("_") +
+            ("*" if wildcard else "") + ZARR_EXTENSION)
+
+
+def _normalize_index(index, shape):
+    """
+    Splits a (basic) numpy index into the bounds to read (start, stop per axis)
+    and the index to apply to the block read
+    """
+    if not isinstance(index, tuple):
+        index = (index,)
+    if any(i is Ellipsis for i in index):
+        e = index.index(Ellipsis)
+        index = index[:e] + (slice(None),) * (len(shape) - len(index) + 1) + index[e + 1:]
+    if len(index) > len(shape):
+        raise IndexError(f"too many indices for a volume of shape {shape}")
+    index = index + (slice(None),) * (len(shape) - len(index))
+
+    bounds, local = [], []
+    for i, n in zip(index, shape):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(n)
+            if step < 0:
+                raise IndexError("negative steps are not supported")
+            stop = max(start, stop)
+            bounds.append((start, stop))
+            local.append(slice(None, None, step))
+        else:
+            i = int(i)
+            if not -n <= i < n:
+                raise IndexError(f"index {i} is out of bounds for axis with size {n}")
+            i = i % n
+            bounds.append((i, i + 1))
+            local.append(0)
+
+    return bounds, tuple(local)
+
+
+def _downsample(block, mode):
+    """
+    Down-samples a block by 2 in each axis (odd sizes: the last voxel is kept)
+    """
+    if mode == "nearest":
+        return block[::2, ::2, ::2]
+
+    # pad to even sizes with the edge voxels
+    pad = [(0, n % 2) for n in block.shape]
+    if any(p for _, p in pad):
+        block = np.pad(block, pad, mode="edge")
+    z, y, x = (n // 2 for n in block.shape)
+    block = block.reshape(z, 2, y, 2, x, 2)
+
+    if mode == "max":
+        return block.max(axis=(1, 3, 5))
+
+    mean = block.mean(axis=(1, 3, 5), dtype=np.float64)
+    if block.dtype.kind in "ui":
+        mean = np.rint(mean)
+    return mean.astype(block.dtype)
+
+
+# ---------
+# one resolution level
+
+class ChunkedArray:
+    """
+    One resolution level of a chunked volume (zarr v2 array)
+
+    Reads and writes go through numpy style indexing (ints & slices); chunks are
+    (de)compressed by a pool of n_threads threads. Writes covering part of a
+    chunk read it first, so concurrent writes should not share chunks.
+    """
+
+    def __init__(self, path, n_threads=4):
+        self.path = Path(path)
+        self.n_threads = n_threads
+        with open(self.path / ".zarray") as f:
+            meta = json.load(f)
+        self.shape = tuple(meta["shape"])
+        self.chunks = tuple(meta["chunks"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.fill_value = meta["fill_value"] or 0
+        self.separator = meta.get("dimension_separator", ".")
+
+    @classmethod
+    def create(cls, path, shape, dtype, chunks=DEFAULT_CHUNKS, n_threads=4):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        chunks = tuple(min(int(c), int(n)) or 1 for c, n in zip(chunks, shape))
+        meta = {
+            "zarr_format": 2,
+            "shape": [int(n) for n in shape],
+            "chunks": list(chunks),
+            "dtype": np.dtype(dtype).str,
+            "compressor": {"id": "zlib", "level": COMPRESSION_LEVEL},
+            "fill_value": 0,
+            "order": "C",
+            "filters": None,
+            "dimension_separator": "/",
+        }
+        with open(path / ".zarray", "w") as f:
+            json.dump(meta, f, indent=4)
+
+        return cls(path, n_threads=n_threads)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f"ChunkedArray({str(self.path)!r}, shape={self.shape}, dtype={self.dtype}, chunks={self.chunks})"
+
+    def chunk_file(self, chunk_index):
+        return self.path / self.separator.join(str(i) for i in chunk_index)
+
+    def read_chunk(self, chunk_index):
+        """
+        Returns a (full size) chunk; missing chunks are filled with the fill value
+        """
+        fname = self.chunk_file(chunk_index)
+        if not fname.is_file():
+            return np.full(self.chunks, self.fill_value, dtype=self.dtype)
+        with open(fname, "rb") as f:
+            data = zlib.decompress(f.read())
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.chunks)
+
+    def write_chunk(self, chunk_index, chunk):
+        """
+        Saves a (full size) chunk; chunks with only the fill value are removed
+        """
+        fname = self.chunk_file(chunk_index)
+        if not np.any(chunk != self.fill_value):
+            if fname.is_file():
+                fname.unlink()
+            return
+        fname.parent.mkdir(parents=True, exist_ok=True)
+        data = zlib.compress(np.ascontiguousarray(chunk, dtype=self.dtype).tobytes(), COMPRESSION_LEVEL)
+        # write then rename so that readers never see a partial chunk
+        tmp = fname.with_name(fname.name + ".partial")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, fname)
+
+    def _chunks_in(self, bounds):
+        """
+        Yields the index of each chunk overlapping the bounds with the
+        overlap in the chunk and in the bounds
+        """
+        ranges = [
+            range(start // c, -(-stop // c)) for (start, stop), c in zip(bounds, self.chunks)
+        ]
+        for chunk_index in product(*ranges):
+            in_chunk, in_block = [], []
+            for i, (start, stop), c in zip(chunk_index, bounds, self.chunks):
+                lo, hi = max(start, i * c), min(stop, (i + 1) * c)
+                in_chunk.append(slice(lo - i * c, hi - i * c))
+                in_block.append(slice(lo - start, hi - start))
+            yield chunk_index, tuple(in_chunk), tuple(in_block)
+
+    def _map(self, fn, items):
+        if self.n_threads <= 1 or len(items) <= 1:
+            return [fn(*item) for item in items]
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            return list(executor.map(lambda item: fn(*item), items))
+
+    def __getitem__(self, index):
+        bounds, local = _normalize_index(index, self.shape)
+        out = np.empty([stop - start for start, stop in bounds], dtype=self.dtype)
+
+        def read(chunk_index, in_chunk, in_block):
+            out[in_block] = self.read_chunk(chunk_index)[in_chunk]
+
+        self._map(read, list(self._chunks_in(bounds)))
+        return out[local]
+
+    def __setitem__(self, index, value):
+        bounds, local = _normalize_index(index, self.shape)
+        if any(isinstance(i, slice) and i.step not in (None, 1) for i in local):
+            raise IndexError("strided writes are not supported")
+        # the value as a view of the full block (no copy): axes indexed by an int are restored
+        block_shape = [stop - start for start, stop in bounds]
+        value = np.broadcast_to(value, [n for n, i in zip(block_shape, local) if isinstance(i, slice)])
+        block = value[tuple(slice(None) if isinstance(i, slice) else np.newaxis for i in local)]
+
+        def write(chunk_index, in_chunk, in_block):
+            full = all(s.stop - s.start == c for s, c in zip(in_chunk, self.chunks))
+            chunk = (
+                np.empty(self.chunks, dtype=self.dtype) if full else self.read_chunk(chunk_index).copy()
+            )
+            chunk[in_chunk] = block[in_block]
+            self.write_chunk(chunk_index, chunk)
+
+        self._map(write, list(self._chunks_in(bounds)))
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+    def iter_slabs(self, depth=None):
+        """
+        Yields (z0, slab) in z order, by slabs of depth slices (default: chunk depth)
+        """
+        depth = depth or self.chunks[0]
+        for z0 in range(0, self.shape[0], depth):
+            yield z0, self[z0:z0 + depth]
+
+
+# ---------
+# multi-resolution volume
+
+class ChunkedVolume:
+    """
+    Chunked multi-resolution volume (OME-Zarr multiscales group)
+
+    Indexing the volume reads / writes the full resolution level (level 0)
+    """
+
+    def __init__(self, path, n_threads=4):
+        self.path = Path(path)
+        self.n_threads = n_threads
+        if not is_chunked_volume(self.path):
+            raise FileNotFoundError(f"Not a chunked volume: {self.path}")
+        with open(self.path / ".zattrs") as f:
+            self.attrs = json.load(f)
+        self.levels = [
+            ChunkedArray(self.path / dataset["path"], n_threads=n_threads)
+            for dataset in self.attrs["multiscales"][0]["datasets"]
+        ]
+
+    @classmethod
+    def create(cls, path, shape, dtype, chunks=DEFAULT_CHUNKS, voxel_size=(1.0, 1.0, 1.0),
+               downsampling="mean", n_threads=4):
+        """
+        Creates an empty (all zero) volume with only the full resolution level
+
+        :param path: output folder (e.g. seg_final.zarr), replaced if it exists
+        :param shape: shape (ZYX) of the full resolution level
+        :param dtype: data type
+        :param chunks: chunk size (ZYX)
+        :param voxel_size: voxel size (ZYX) in um of the full resolution level
+        :param downsampling: down-sampling of the levels (see build_pyramid): mean, max or nearest
+        """
+        if downsampling not in DOWNSAMPLING_MODES:
+            raise ValueError(f"Unknown down-sampling mode: {downsampling} (choose from {DOWNSAMPLING_MODES})")
+        path = Path(path)
+        if path.exists():
+            if not is_chunked_volume(path):
+                raise FileExistsError(f"{path} exists and is not a chunked volume")
+            _remove_volume(path)
+        path.mkdir(parents=True)
+
+        with open(path / ".zgroup", "w") as f:
+            json.dump({"zarr_format": 2}, f, indent=4)
+        ChunkedArray.create(path / "0", shape, dtype, chunks, n_threads=n_threads)
+        cls._save_attrs(path, path.stem, [[float(v) for v in voxel_size]], downsampling)
+
+        return cls(path, n_threads=n_threads)
+
+    @staticmethod
+    def _save_attrs(path, name, scales, downsampling):
+        attrs = {
+            "multiscales": [
+                {
+                    "version": "0.4",
+                    "name": name,
+                    "axes": [{"name": axis, "type": "space", "unit": "micrometer"} for axis in "zyx"],
+                    "datasets": [
+                        {"path": str(level), "coordinateTransformations": [{"type": "scale", "scale": scale}]}
+                        for level, scale in enumerate(scales)
+                    ],
+                    "type": downsampling,
+                }
+            ]
+        }
+        with open(Path(path) / ".zattrs", "w") as f:
+            json.dump(attrs, f, indent=4)
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    @property
+    def dtype(self):
+        return self.levels[0].dtype
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def n_levels(self):
+        return len(self.levels)
+
+    @property
+    def downsampling(self):
+        return self.attrs["multiscales"][0].get("type", "mean")
+
+    def voxel_size(self, level=0):
+        """
+        Voxel size (ZYX) in um of a level
+        """
+        dataset = self.attrs["multiscales"][0]["datasets"][level]
+        return tuple(dataset["coordinateTransformations"][0]["scale"])
+
+    def level(self, level):
+        return self.levels[level]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f"ChunkedVolume({str(self.path)!r}, shape={self.shape}, dtype={self.dtype}, levels={self.n_levels})"
+
+    def __getitem__(self, index):
+        return self.levels[0][index]
+
+    def __setitem__(self, index, value):
+        self.levels[0][index] = value
+
+    def __array__(self, dtype=None, copy=None):
+        return self.levels[0].__array__(dtype)
+
+    def iter_slabs(self, depth=None, level=0):
+        return self.levels[level].iter_slabs(depth)
+
+    def build_pyramid(self, n_levels=4, n_workers=4):
+        """
+        (Re)computes the down-sampled levels 1 .. n_levels - 1 from the full
+        resolution level, each level from the previous one chunk by chunk (each
+        output chunk is down-sampled from the (up to) 8 chunks it covers)
+
+        :param n_levels: total number of levels (including the full resolution)
+        :param n_workers: number of chunks down-sampled in parallel (threads)
+        """
+        scales = [list(self.voxel_size(0))]
+        for level in range(1, self.n_levels):
+            _remove_volume(self.levels[level].path)
+        self.levels = self.levels[:1]
+
+        for level in range(1, n_levels):
+            src = self.levels[-1]
+            shape = tuple(-(-n // 2) for n in src.shape)
+            if min(src.shape) < 2:
+                break
+            print(f"  computing level {level} of {self.path.name}: {shape}")
+            dst = ChunkedArray.create(self.path / str(level), shape, self.dtype, src.chunks, self.n_threads)
+
+            parallel_map(
+                _downsample_chunk,
+                ((src, dst, bounds, self.downsampling) for _, _, bounds in dst._chunks_in(
+                    [(0, n) for n in shape])),
+                n_workers=n_workers,
+                backend="thread",
+            )
+            self.levels.append(dst)
+            scales.append([2 * s for s in scales[-1]])
+
+        self._save_attrs(self.path, self.attrs["multiscales"][0]["name"], scales, self.downsampling)
+        with open(self.path / ".zattrs") as f:
+            self.attrs = json.load(f)
+
+
+def _downsample_chunk(src, dst, bounds, mode):
+    # bounds: slices of the output chunk in dst
+    dst[bounds] = _downsample(src[tuple(slice(2 * b.start, 2 * b.stop) for b in bounds)], mode)
+
+
+def _remove_volume(path):
+    """
+    Removes a chunked volume / level (only chunk and metadata files)
+    """
+    path = Path(path)
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            os.remove(os.path.join(root, name))
+        os.rmdir(root)
+
+
+# ---------
+# conversion
+
+def slices_to_volume(files, out_path, voxel_size=(1.0, 1.0, 1.0), n_levels=4, downsampling="mean",
+                     chunks=DEFAULT_CHUNKS, n_threads=4):
+    """
+    Streams 2D tif slices into a chunked volume, one chunk deep slab at a time
+
+    :param files: sorted slice files
+    :param out_path: output volume (e.g. clarity.zarr)
+    :param voxel_size: voxel size (ZYX) in um
+    :param n_levels: number of resolution levels
+    :param downsampling: down-sampling of the levels: mean, max or nearest
+    :param chunks: chunk size (ZYX)
+    :param n_threads: number of threads decoding slices / compressing chunks
+    returns: the chunked volume
+    """
+    stack = VirtualStack(files, n_threads=n_threads)
+    print(f"  saving {len(stack)} slices of shape {stack.slice_shape} to {out_path}")
+    vol = ChunkedVolume.create(out_path, stack.shape, stack.dtype, chunks, voxel_size, downsampling, n_threads)
+
+    depth = vol.level(0).chunks[0]
+    slab = np.empty((depth, *stack.slice_shape), dtype=stack.dtype)
+    for z, img in stack.iter_slices(n_threads=n_threads, buffer=depth):
+        slab[z % depth] = img
+        if (z + 1) % depth == 0 or z + 1 == len(stack):
+            z0 = z - z % depth
+            vol[z0:z + 1] = slab[:z + 1 - z0]
+
+    vol.build_pyramid(n_levels, n_workers=n_threads)
+    return vol
+
+
+def tif_to_volume(tif, out_path, voxel_size=(1.0, 1.0, 1.0), n_levels=4, downsampling="mean",
+                  chunks=DEFAULT_CHUNKS, n_threads=4):
+    """
+    Saves a 3D tif to a chunked volume (memory-mapped when the tif is not compressed)
+    """
+    try:
+        img = tifffile.memmap(tif, mode="r")
+    except ValueError:
+        img = tifffile.imread(tif)
+    vol = ChunkedVolume.create(out_path, img.shape, img.dtype, chunks, voxel_size, downsampling, n_threads)
+
+    depth = vol.level(0).chunks[0]
+    for z0 in range(0, img.shape[0], depth):
+        vol[z0:z0 + depth] = img[z0:z0 + depth]
+    del img
+
+    vol.build_pyramid(n_levels, n_workers=n_threads)
+    return vol
+
+
+# ---------
+# main fn
+
+def main(args):
+    parser = parsefn()
+    args = parser.parse_args(args) if isinstance(args, list) else args
+
+    in_path = Path(args.input)
+    out_path = Path(args.output) if args.output else in_path.with_suffix(ZARR_EXTENSION)
+    voxel_size = (args.resz, args.resx, args.resx)
+    ncpus = get_ncpus()
+
+    if in_path.is_dir():
+        vol = slices_to_volume(find_slices(in_path, args.filter), out_path, voxel_size, args.levels, args.mode,
+                               args.chunks, ncpus)
+    else:
+        vol = tif_to_volume(in_path, out_path, voxel_size, args.levels, args.mode, args.chunks, ncpus)
+
+    print(f"\n chunked volume saved: {vol}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
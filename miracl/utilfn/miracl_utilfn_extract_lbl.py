@@ -7,12 +7,11 @@ import argparse
 import os
 import subprocess
 import sys
-import pandas as pd
 import nibabel as nib
 import numpy as np
 import scipy
 
-from miracl import ATLAS_DIR
+from miracl.lbls.miracl_lbls_ontology import load_ontology
 
 
 def helpmsg():
@@ -109,13 +108,10 @@ def get_label_id(label, side='combined'):
     ''' Return the label id for a given Allen atlas label acronym. 
     '''
     # read Allen ontology
-    if side == "combined":
-        annot_csv = pd.read_csv('%s/ara/ara_mouse_structure_graph_hemi_combined.csv' % ATLAS_DIR)
-    else:
-        annot_csv = pd.read_csv('%s/ara/ara_mouse_structure_graph_hemi_split.csv' % ATLAS_DIR)
+    annot_csv = load_ontology("combined" if side == "combined" else "split")
 
     # outlbl to lblid
-    lbl_id = annot_csv.id[annot_csv.acronym == "%s" % label].values[0]
+    lbl_id = annot_csv.id_of("%s" % label, "acronym")
 
     return lbl_id
 
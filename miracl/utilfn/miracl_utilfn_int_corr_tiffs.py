@@ -4,10 +4,8 @@
 # coding: utf-8
 
 import argparse
-import glob
 import multiprocessing
 import os
-import re
 import subprocess
 import sys
 from argparse import RawTextHelpFormatter
@@ -19,6 +17,7 @@ import tifffile as tiff
 from joblib import Parallel, delayed
 
 from miracl.utilfn import miracl_utilfn_endstatement as statement
+from miracl.utilfn.miracl_utilfn_virtual_stack import VirtualStack
 from .depends_manager import add_paths
 
 
@@ -213,14 +212,7 @@ def biascorrnii(nii, maskimg, segment, hist, conv, niicorr, mask, field):
             shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
 
-def numericalsort(value):
-    numbers = re.compile(r'(\d+)')
-    parts = numbers.split(value)
-    parts[1::2] = map(int, parts[1::2])
-    return parts
-
-
-def applycorr(i, tif, outdir, biasres, down, mulpower, maskimg, maskres=None):
+def applycorr(i, stack, outdir, biasres, down, mulpower, maskimg, maskres=None):
     sys.stdout.write("\r processing slice %d ..." % i)
     sys.stdout.flush()
 
@@ -231,7 +223,7 @@ def applycorr(i, tif, outdir, biasres, down, mulpower, maskimg, maskres=None):
         maskslice = maskres[:, :, i - 1]
         masksliceres = scipy.ndimage.interpolation.zoom(maskslice, down, order=1)
 
-    tifimg = tiff.imread(tif)
+    tifimg = stack.read_slice(i)
 
     if tifimg.shape != biassliceres.shape:
         array = np.full(tifimg.shape, biassliceres.min(), tifimg.dtype)
@@ -254,7 +246,7 @@ def applycorr(i, tif, outdir, biasres, down, mulpower, maskimg, maskres=None):
 
     corrtif = corrtif.astype(tifimg.dtype)
 
-    tifcorrfile = os.path.join(outdir, os.path.basename(tif))
+    tifcorrfile = os.path.join(outdir, stack.files[i].name)
 
     tiff.imsave(tifcorrfile, corrtif)
 
@@ -299,11 +291,11 @@ def main(args):
         else:
             maskres = None
 
-        # sort files
+        # sort files (slices are decoded when they are corrected)
         if chanp is None:
-            file_list = sorted(glob.glob("%s/*.tif" % indir), key=numericalsort)
+            stack = VirtualStack.from_folder(indir, pattern="*.tif", sort="numerical")
         else:
-            file_list = sorted(glob.glob("%s/*%s%01d*.tif" % (indir, chanp, chann)), key=numericalsort)
+            stack = VirtualStack.from_folder(indir, pattern="*%s%01d*.tif" % (chanp, chann), sort="numerical")
 
         cpuload = 0.95
         cpus = multiprocessing.cpu_count()
@@ -312,8 +304,8 @@ def main(args):
         print("\n Correcting TIFF images in parallel using %02d cpus" % ncpus)
 
         Parallel(n_jobs=ncpus, backend='threading')(
-            delayed(applycorr)(i, tif, outdir, biasres, down, mulpower, maskimg, maskres)
-            for i, tif in enumerate(file_list))
+            delayed(applycorr)(i, stack, outdir, biasres, down, mulpower, maskimg, maskres)
+            for i in range(len(stack)))
 
         # print("\n Intensity correction done in %s ... Have a good day!\n" % (datetime.now() - starttime))
 
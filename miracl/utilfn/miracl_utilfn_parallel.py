@@ -0,0 +1,140 @@
+"""
+Shared execution layer for CPU-bound loops (connected components, region
+properties, convolutions, ...) that hold the GIL
+
+Work is run in a pool of processes (default) or threads:
+
+    ncpus = get_ncpus(cpu_load=0.95)
+    with shared_arrays(seg, lbls) as (seg, lbls):
+        res = parallel_map(computearea, ((seg, lbls, l) for l in alllbls), ncpus)
+
+Volumes are passed to the workers as read-only memory maps (by file name, not
+pickled). The policy can be changed without code changes with:
+
+    MIRACL_NUM_WORKERS       fixed number of workers (overrides the cpu load)
+    MIRACL_PARALLEL_BACKEND  "process" (default) or "thread"
+    JOBLIB_TEMP_FOLDER       folder of the shared arrays (when the caller
+                             does not pass one)
+"""
+
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+from joblib import Parallel, delayed
+
+NUM_WORKERS_ENV = "MIRACL_NUM_WORKERS"
+BACKEND_ENV = "MIRACL_PARALLEL_BACKEND"
+TEMP_FOLDER_ENV = "JOBLIB_TEMP_FOLDER"
+BACKENDS = {"process": "loky", "thread": "threading"}
+
+
+def available_cpus() -> int:
+    """Number of cpus this process may run on (affinity / cgroup aware when possible)"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_ncpus(cpu_load: float = 0.95, n_workers: Optional[int] = None) -> int:
+    """Number of workers to use
+
+    :param cpu_load: fraction of the available cpus to use
+    :type cpu_load: float
+    :param n_workers: fixed number of workers, overrides cpu_load
+    :type n_workers: Optional[int]
+    :return: number of workers (at least 1); MIRACL_NUM_WORKERS overrides both arguments
+    :rtype: int
+    """
+    env_workers = os.environ.get(NUM_WORKERS_ENV)
+    if env_workers:
+        n_workers = int(env_workers)
+    if n_workers is None:
+        n_workers = int(cpu_load * available_cpus())
+
+    return max(1, n_workers)
+
+
+def get_backend(backend: Optional[str] = None) -> str:
+    """Parallel backend ("process" or "thread"); MIRACL_PARALLEL_BACKEND is used if not given"""
+    backend = backend or os.environ.get(BACKEND_ENV) or "process"
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Unknown parallel backend: {backend} (choose from {list(BACKENDS)})"
+        )
+
+    return backend
+
+
+def parallel_map(
+    fn: Callable,
+    args: Iterable[Sequence[Any]],
+    n_workers: int,
+    backend: Optional[str] = None,
+) -> List[Any]:
+    """Runs fn(*arg) for each arg in parallel and returns the results in order
+
+    Functions run with the process backend need to be importable (module
+    level); large arrays should be passed through `shared_arrays`.
+
+    :param fn: function to run
+    :type fn: Callable
+    :param args: positional arguments of each call
+    :type args: Iterable[Sequence[Any]]
+    :param n_workers: number of workers (see `get_ncpus`)
+    :type n_workers: int
+    :param backend: "process" or "thread" (default: MIRACL_PARALLEL_BACKEND or "process")
+    :type backend: Optional[str]
+    :return: results of each call
+    :rtype: List[Any]
+    """
+    backend = get_backend(backend)
+
+    # no pool needed for a single worker
+    if n_workers <= 1:
+        return [fn(*arg) for arg in args]
+
+    return Parallel(n_jobs=n_workers, backend=BACKENDS[backend])(
+        delayed(fn)(*arg) for arg in args
+    )
+
+
+@contextmanager
+def shared_arrays(*arrays: Any, tmp_dir: Optional[str] = None) -> Iterator[List[Any]]:
+    """Shares arrays with workers as read-only memory maps
+
+    Arrays are dumped once to a temporary folder and the workers of the process
+    backend map the same files instead of receiving pickled copies. Whole-brain
+    volumes may not fit the system temp dir (often a small partition or a
+    tmpfs held in memory): callers pass a folder next to their outputs. Memory maps
+    (e.g. from tifffile.memmap) and other objects (e.g. lazy stacks) are passed
+    through unchanged. The files are removed on exit.
+
+    :param arrays: arrays to share
+    :param tmp_dir: parent folder of the temporary files (default: $JOBLIB_TEMP_FOLDER,
+        else the system temp dir)
+    :type tmp_dir: Optional[str]
+    :return: read-only memory maps of the arrays
+    :rtype: List[Any]
+    """
+    tmp_dir = tmp_dir or os.environ.get(TEMP_FOLDER_ENV) or None
+    share_dir = None
+    shared = []
+    try:
+        for i, arr in enumerate(arrays):
+            if not isinstance(arr, np.ndarray) or isinstance(arr, np.memmap):
+                shared.append(arr)
+                continue
+            if share_dir is None:
+                share_dir = tempfile.mkdtemp(prefix="miracl_shared_", dir=tmp_dir)
+            path = os.path.join(share_dir, f"array_{i}.npy")
+            np.save(path, arr)
+            shared.append(np.load(path, mmap_mode="r"))
+        yield shared
+    finally:
+        del shared
+        if share_dir is not None:
+            shutil.rmtree(share_dir, ignore_errors=True)
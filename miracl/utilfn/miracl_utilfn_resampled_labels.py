@@ -0,0 +1,166 @@
+"""
+Lazy nearest neighbour resampling of registered labels to the shape of a
+segmentation / clarity volume
+
+Upsampling the labels with sp.ndimage.zoom(lbls, (rz, rx, ry), order=0) makes a
+full resolution copy of the labels (often larger than the memory). The view
+computes the label voxel of each output voxel from integer index maps (the
+same voxels as zoom with order 0, swapping x-y if needed) and reads only the
+labels of the requested block:
+
+    reslbls = ResampledLabels(lbls, seg.shape)
+    reslbls[z0:z1]                    # labels of a slab of the segmentation
+    for z0, slab in reslbls.iter_slabs(64):
+        ...
+    reslbls.at(zs, xs, ys)            # labels at voxels (integer arrays)
+"""
+
+import numpy as np
+from scipy import ndimage
+
+
+def zoom_index(n, ratio):
+    """
+    Source index of each output index of an axis of n voxels zoomed by ratio
+    with nearest neighbour interpolation (as ndimage.zoom with order=0)
+    """
+    return ndimage.zoom(np.arange(n, dtype=np.float64), ratio, order=0).astype(np.intp)
+
+
+def resample_index(shape, lbls_shape, verbose=True):
+    """
+    Nearest neighbour mapping of a volume of shape (z, x, y) to labels of shape
+    lbls_shape, as the upsampleswplbls functions: labels with the x and y
+    dimensions of the volume swapped are swapped, other labels are zoomed to
+    the volume (and swapped if the zoomed x dimension still does not match)
+
+    :param shape: shape of the segmentation / clarity volume
+    :param lbls_shape: shape of the labels
+    :param verbose: print the resampling steps
+    :return: (swap, zi, xi, yi): output voxel (z, x, y) has the label
+        lbls[zi[z], xi[x], yi[y]] if not swap, else lbls[zi[z], yi[y], xi[x]]
+    """
+    segz, segx, segy = shape
+    lblsz, lblsx, lblsy = lbls_shape
+
+    def log(*msg):
+        if verbose:
+            print(*msg)
+
+    def zoom_indices():
+        if segx > lblsx:
+            log('Upsampling labels to clarity resolution')
+        else:
+            log('Downsampling labels to voxelized clarity resolution')
+
+        rx = float(segx) / lblsx
+        ry = float(segy) / lblsy
+        rz = float(segz) / lblsz
+
+        return zoom_index(lblsz, rz), zoom_index(lblsx, rx), zoom_index(lblsy, ry)
+
+    zi, xi, yi = np.arange(lblsz), np.arange(lblsx), np.arange(lblsy)
+
+    if segx != lblsx:
+
+        if segx == lblsy:
+            log('Swapping x-y')
+            return True, zi, yi, xi
+
+        zi, xi, yi = zoom_indices()
+
+        log('Segmentation shape:', tuple(shape))
+        log('Resampled labels shape:', (len(zi), len(xi), len(yi)))
+
+        if segx != len(xi):
+            log('Swapping x-y')
+            return True, zi, yi, xi
+
+        return False, zi, xi, yi
+
+    if segz != lblsz:
+        return (False,) + zoom_indices()
+
+    return False, zi, xi, yi
+
+
+class ResampledLabels:
+    """
+    Read-only view of labels resampled (nearest neighbour) to a volume shape
+
+    Indexing (ints, slices or 1D integer arrays, each selecting along its own
+    axis) returns the resampled labels of the block; only the label slices
+    mapped to the block are read
+
+    :param lbls: labels (array or memory map)
+    :param shape: shape of the segmentation / clarity volume
+    :param verbose: print the resampling steps
+    """
+
+    def __init__(self, lbls, shape, verbose=True):
+        self.lbls = lbls
+        self.swap, self.zi, self.xi, self.yi = resample_index(shape, lbls.shape, verbose)
+
+    @property
+    def shape(self):
+        return len(self.zi), len(self.xi), len(self.yi)
+
+    @property
+    def dtype(self):
+        return self.lbls.dtype
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return len(self.zi)
+
+    def __repr__(self):
+        return f"ResampledLabels(shape={self.shape}, labels shape={self.lbls.shape}, swap={self.swap})"
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        if len(index) > 3:
+            raise IndexError(f"too many indices for a 3D volume: {len(index)}")
+        index = index + (slice(None),) * (3 - len(index))
+
+        # label voxels of the selected output voxels along each axis
+        sels = [m[i] for m, i in zip((self.zi, self.xi, self.yi), index)]
+        scalar = tuple(0 if np.ndim(s) == 0 else slice(None) for s in sels)
+        zsel, xsel, ysel = (np.atleast_1d(s) for s in sels)
+
+        # each label slice is read once (slices are repeated when upsampling)
+        zsrc, zinv = np.unique(zsel, return_inverse=True)
+        block = np.asarray(self.lbls[zsrc])
+        if self.swap:
+            block = block[:, ysel][:, :, xsel].swapaxes(1, 2)
+        else:
+            block = block[:, xsel][:, :, ysel]
+
+        return block[zinv.ravel()][scalar]
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+    def at(self, z, x, y):
+        """
+        Labels at the voxels (z, x, y) (integer arrays of the same shape)
+        """
+        z, x, y = self.zi[z], self.xi[x], self.yi[y]
+        if self.swap:
+            return np.asarray(self.lbls[z, y, x])
+
+        return np.asarray(self.lbls[z, x, y])
+
+    def iter_slabs(self, depth):
+        """
+        Yields (z0, slab) in z order, by slabs of depth slices
+        """
+        for z0 in range(0, len(self), depth):
+            yield z0, self[z0:z0 + depth]
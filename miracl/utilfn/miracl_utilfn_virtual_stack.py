@@ -0,0 +1,261 @@
+"""
+Lazy virtual z-stack of a folder of 2D tif slices (raw CLARITY data, segmentations,
+warped labels, ...)
+
+The folder is exposed as a read-only (z, y, x) array: only the header of the
+first slice is read on creation and slices are decoded when they are indexed:
+
+    stack = VirtualStack.from_folder("cells/", sort="numerical", cache_size=8)
+    stack.shape, stack.dtype      # from the (cached) header of the first slice
+    img = stack[100]              # one slice
+    block = stack[100:164, :512]  # sub-block, slices decoded in parallel
+    for z, img in stack.iter_slices(n_threads=8):  # prefetching iterator
+        ...
+
+Decoded slices can be kept in a LRU cache (cache_size slices), e.g. when
+browsing slices or reading overlapping slabs.
+"""
+
+import fnmatch
+import os
+import re
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+TIF_EXTENSIONS = (".tif", ".tiff")
+SORT_KEYS = ("name", "numerical")
+
+
+def numerical_sort_key(name):
+    """
+    Sort key ordering the numbers in a file name by value, e.g. slice_2 < slice_10
+    """
+    parts = re.split(r"(\d+)", str(name))
+    parts[1::2] = map(int, parts[1::2])
+    return parts
+
+
+def find_slices(folder, prefix="", pattern="*", sort="name"):
+    """
+    Returns the sorted tif/tiff slices in folder whose names start with prefix
+    and match the (glob) pattern
+
+    :param folder: folder of the slices
+    :param prefix: prefix of the slice names (e.g. out_)
+    :param pattern: glob pattern of the slice names (e.g. *C001*)
+    :param sort: "name" (the z order used by ace_patch_stacking) or "numerical"
+        (numbers ordered by value, the z order used by the conversion)
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Unknown sort key: {sort} (choose from {SORT_KEYS})")
+    with os.scandir(folder) as entries:
+        files = [
+            Path(entry.path)
+            for entry in entries
+            if entry.is_file()
+            and entry.name.startswith(prefix)
+            and entry.name.lower().endswith(TIF_EXTENSIONS)
+            and fnmatch.fnmatchcase(entry.name, pattern)
+        ]
+    if not files:
+        raise FileNotFoundError(
+            f"No tif slices starting with '{prefix}' and matching '{pattern}' found in: {folder}"
+        )
+
+    key = (lambda file: file.name) if sort == "name" else (lambda file: numerical_sort_key(file.name))
+    return sorted(files, key=key)
+
+
+@lru_cache(maxsize=1024)
+def _read_header(fname, mtime_ns, size):
+    # (shape, dtype) of the first page; cached while the file is unchanged
+    with tifffile.TiffFile(fname) as tif:
+        page = tif.pages[0]
+        return tuple(page.shape), np.dtype(page.dtype)
+
+
+def read_header(fname):
+    """
+    Returns the (shape, dtype) of a slice without decoding it
+    """
+    stat = os.stat(fname)
+    return _read_header(str(fname), stat.st_mtime_ns, stat.st_size)
+
+
+class VirtualStack:
+    """
+    Read-only (z, y, x) stack of 2D tif slices
+
+    Only the header of the first slice is read on creation, slices are decoded
+    when indexed (e.g. stack[z], stack[z, :, :], stack[z0:z1] or stack[[z0, z1]])
+
+    Indexing with integer arrays (stack[zs, ys, xs]) gathers single voxels,
+    decoding only the slices in zs (once each, with a pool of n_threads threads)
+
+    :param files: sorted slice files
+    :param n_threads: number of threads decoding slices of a block
+    :param cache_size: number of decoded slices kept in memory (LRU, default: none)
+    """
+
+    def __init__(self, files, n_threads=4, cache_size=0):
+        self.files = [Path(file) for file in files]
+        if not self.files:
+            raise ValueError("A virtual stack needs at least one slice")
+        self.n_threads = n_threads
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.slice_shape, self.dtype = read_header(self.files[0])
+
+    @classmethod
+    def from_folder(cls, folder, prefix="", pattern="*", sort="name", **kwargs):
+        """
+        Virtual stack of the tif slices of a folder (see find_slices)
+        """
+        return cls(find_slices(folder, prefix, pattern, sort), **kwargs)
+
+    # the cache and lock are not shared with (process) workers
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_cache"] = OrderedDict()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return (len(self.files), *self.slice_shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return len(self.files)
+
+    def __repr__(self):
+        folder = self.files[0].parent
+        return f"VirtualStack({str(folder)!r}, shape={self.shape}, dtype={self.dtype})"
+
+    def read_slice(self, z):
+        """
+        Returns slice z (read-only if it is cached)
+        """
+        z = range(len(self))[z]
+        if self.cache_size > 0:
+            with self._lock:
+                if z in self._cache:
+                    self._cache.move_to_end(z)
+                    return self._cache[z]
+
+        img = tifffile.imread(self.files[z])
+        if img.shape != self.slice_shape:
+            raise ValueError(
+                f"Slice {self.files[z]} has shape {img.shape}, expected {self.slice_shape}"
+            )
+        img = img.astype(self.dtype, copy=False)
+
+        if self.cache_size > 0:
+            img.flags.writeable = False
+            with self._lock:
+                self._cache[z] = img
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return img
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        z, rest = index[0], index[1:]
+
+        if isinstance(z, np.ndarray) and z.ndim == 1 and len(rest) == 2:
+            return self.gather(z, *rest)
+
+        if isinstance(z, (int, np.integer)):
+            return self.read_slice(int(z))[rest]
+
+        zs = range(len(self))[z] if isinstance(z, slice) else [range(len(self))[i] for i in z]
+        # shape of the (y, x) index applied to a slice
+        out_shape = np.broadcast_to(np.zeros((), dtype=self.dtype), self.slice_shape)[rest].shape
+        out = np.empty((len(zs), *out_shape), dtype=self.dtype)
+
+        def read(i, z_i):
+            out[i] = self.read_slice(z_i)[rest]
+
+        if self.n_threads <= 1 or len(zs) <= 1:
+            for i, z_i in enumerate(zs):
+                read(i, z_i)
+        else:
+            with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+                list(executor.map(read, range(len(zs)), zs))
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+    def gather(self, zs, ys, xs):
+        """
+        Returns the voxels at (zs, ys, xs) (integer arrays of the same length);
+        only one slice per worker thread is held in memory
+        """
+        zs, ys, xs = (np.asarray(i, dtype=np.int64) for i in (zs, ys, xs))
+        out = np.zeros(len(zs), dtype=self.dtype)
+        if len(zs) == 0:
+            return out
+
+        # group the voxels by slice
+        order = np.argsort(zs, kind="stable")
+        z_unique, starts = np.unique(zs[order], return_index=True)
+        groups = np.split(order, starts[1:])
+
+        def gather_slice(z, rows):
+            return rows, self.read_slice(int(z))[ys[rows], xs[rows]]
+
+        with ThreadPoolExecutor(max_workers=max(1, self.n_threads)) as executor:
+            for rows, values in executor.map(gather_slice, z_unique, groups):
+                out[rows] = values
+
+        return out
+
+    def iter_slices(self, n_threads=4, buffer=16, start=0, stop=None):
+        """
+        Yields (z, slice) in z order, decoding up to `buffer` slices ahead with
+        a pool of n_threads threads
+        """
+        buffer = max(buffer, n_threads, 1)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+            for z in range(len(self))[start:stop]:
+                pending.append((z, executor.submit(self.read_slice, z)))
+                if len(pending) >= buffer:
+                    z_done, future = pending.popleft()
+                    yield z_done, future.result()
+            while pending:
+                z_done, future = pending.popleft()
+                yield z_done, future.result()
+
+    def iter_slabs(self, depth, n_threads=4):
+        """
+        Yields (z0, slab) in z order with slabs of (at most) depth slices; the
+        slices of the next slab are decoded while the current one is processed
+        """
+        slab = None
+        for z, img in self.iter_slices(n_threads=n_threads, buffer=depth + n_threads):
+            if z % depth == 0:
+                slab = np.empty((min(depth, len(self) - z), *self.slice_shape), dtype=self.dtype)
+            slab[z % depth] = img
+            if z % depth == len(slab) - 1:
+                yield z - z % depth, slab
@@ -6,7 +6,9 @@ from pathlib import Path
 from unittest import mock
 from unittest.mock import mock_open
 
+import numpy as np
 import pytest
+import tifffile
 
 from miracl.flow import miracl_workflow_ace_interface as ACE
 
@@ -90,35 +92,39 @@ class TestAceInterfaceStackTiffs:
         ACE.StackTiffs.check_folders(Path(""), stacked)
         assert not mock_unlink.called
 
-    @mock.patch(ACE_PATH + ".subprocess.Popen")
-    def test_ace_stack_tiffs_stack_subprocess(self, mock_subprocess):
-        fiji = Path(DIR + "/fiji.ijm")
-        stacked = Path(DIR + "/stacked.tif")
-        seg_output = Path(DIR + "/seg_output")
-        with mock.patch(ACE_PATH + ".open", mock_open()) as open_mock:
-            ACE.StackTiffs.stacking(fiji, stacked, seg_output)
-        assert mock_subprocess.called
+    def make_slices(self, seg_output, prefix, n_slices=3):
+        seg_output.mkdir(exist_ok=True)
+        for z in range(n_slices):
+            tifffile.imwrite(
+                seg_output / f"{prefix}slice_{z:02d}.tif",
+                np.full((4, 5), z, dtype=np.uint8),
+            )
+
+    @pytest.mark.parametrize("is_mc,prefix", [(False, "out_"), (True, "MC_")])
+    def test_ace_stack_tiffs_stack_filter(self, tmp_path, is_mc, prefix):
+        seg_output = tmp_path / "seg_final"
+        self.make_slices(seg_output, prefix)
+        self.make_slices(seg_output, "uncertainty_", n_slices=2)
+        stacked = tmp_path / "stacked.tif"
+
+        ACE.StackTiffs.stacking(stacked, seg_output, is_mc)
+        stack = tifffile.imread(stacked)
+
+        assert stack.shape == (3, 4, 5)
+        assert list(stack[:, 0, 0]) == [0, 1, 2]
 
     @mock.patch(ACE_PATH + ".subprocess.Popen")
-    def test_ace_stack_tiffs_stack_subprocess_cmd(self, mock_subprocess):
-        fiji = Path(DIR + "/fiji.ijm")
-        stacked = Path(DIR + "/stacked.tif")
-        seg_output = Path(DIR + "/seg_output")
-        with mock.patch(ACE_PATH + ".open", mock_open()) as open_mock:
-            ACE.StackTiffs.stacking(fiji, stacked, seg_output)
-        assert "Fiji" in mock_subprocess.call_args_list[0][0][0]
+    def test_ace_stack_tiffs_stack_no_fiji(self, mock_subprocess, tmp_path):
+        seg_output = tmp_path / "seg_final"
+        self.make_slices(seg_output, "out_")
 
-    def test_ace_stack_tiffs_stack_open(self):
-        with mock.patch(ACE_PATH + ".open", mock_open()) as open_mock:
-            ACE.StackTiffs.stacking("fiji", "stacked", "output")
-        open_mock.assert_called_once_with("fiji", "w")
+        ACE.StackTiffs.stacking(tmp_path / "stacked.tif", seg_output, False)
 
-    def test_ace_stack_tiffs_stack_write(self):
-        with mock.patch(ACE_PATH + ".open", mock_open()) as open_mock:
-            ACE.StackTiffs.stacking("fiji", "stacked", "output")
-        assert "File.openSequence(" in open_mock().write.call_args_list[0][0][0]
-        assert 'saveAs("Tiff",' in open_mock().write.call_args_list[1][0][0]
-        open_mock().write.assert_called_with("close();\n")
+        assert not mock_subprocess.called
+
+    def test_ace_stack_tiffs_stack_no_slices(self, tmp_path):
+        with pytest.raises(FileNotFoundError):
+            ACE.StackTiffs.stacking(tmp_path / "stacked.tif", tmp_path, False)
 
 
 class TestAceInterfaceGetVoxSegTif:
@@ -333,6 +339,13 @@ class TestAceInterfaceACESegmentation:
 
         assert mock_seg_interface.called
 
+    @mock.patch("miracl.seg.ace_interface.main")
+    def test_ace_segment_output_patches(self, mock_seg_interface):
+        args = Namespace(sa_model_type="test", no_instance_segmentation=True)
+        ACE.ACESegmentation().segment(args)
+
+        mock_seg_interface.assert_called_once_with(args=args, output_patches=False)
+
 
 class TestAceInterfaceACEConversion:
     @mock.patch(ACE_PATH + ".subprocess.Popen")
@@ -615,6 +628,35 @@ class TestAceInterfaceACEVoxelization:
 
         assert popen_mock.called
 
+    @mock.patch(ACE_PATH + ".subprocess.Popen")
+    def test_ace_voxelize_slices_cmd(self, popen_mock):
+        args = Namespace(
+            rca_voxel_size=5, ctn_down=1, sa_resolution=(1.4, 1.4, 5), rva_downsample=5
+        )
+        ACE.ACEVoxelization().voxelize(
+            args, "seg_final", slice_filter="out_", out_dir="vox_final"
+        )
+        cmd = popen_mock.call_args_list[0][0][0]
+
+        assert "--seg seg_final" in cmd
+        assert "--filter out_" in cmd
+        assert "--outdir vox_final" in cmd
+        assert "--mode" not in cmd
+
+    @mock.patch(ACE_PATH + ".subprocess.Popen")
+    def test_ace_voxelize_mode_cmd(self, popen_mock):
+        args = Namespace(
+            rca_voxel_size=5,
+            ctn_down=1,
+            sa_resolution=(1.4, 1.4, 5),
+            rva_downsample=5,
+            rva_mode="cells",
+        )
+        ACE.ACEVoxelization().voxelize(args, "seg_final", out_dir="vox_final")
+        cmd = popen_mock.call_args_list[0][0][0]
+
+        assert "--mode cells" in cmd
+
 
 class TestAceInterfaceACEWarping:
     @mock.patch(ACE_PATH + ".subprocess.Popen")
@@ -2559,6 +2601,328 @@ class TestAceInterfaceACEWorkflows:
             "miracl stats heatmap_group -s 1 2 3 4 5 -f 10 10 -g1 ctrl_dir/ ctrl_dir/subj1/cells -g2 exp_dir/ exp_dir/subj1/cells"
         )
 
+    @mock.patch(ACE_PATH + ".SubjectScheduler.run")
+    def test_ace_comparison_workflow_subject_paths(
+        self, mock_run, tmp_path, monkeypatch
+    ):
+        for group in ["ctrl_dir", "exp_dir"]:
+            (tmp_path / group / "subj1" / "cells").mkdir(parents=True)
+        monkeypatch.chdir(tmp_path)
+        args = Namespace(
+            ctn_down=5,
+            rca_voxel_size=10,
+            sa_output_folder="sa_output_dir/",
+            control=["ctrl_dir/", "ctrl_dir/subj1/cells"],
+            treated=["exp_dir/", "exp_dir/subj1/cells"],
+            rca_allen_label="my_labels.nii.gz",
+            rca_allen_atlas="None",
+            rwc_input_folder=None,
+            ps_subjects=2,
+            ps_segmentation=1,
+            ps_registration=None,
+        )
+        mock_run.return_value = [{"status": "failed"}] * 2
+
+        with pytest.raises(RuntimeError):
+            ACE.ACEWorkflows(
+                None, None, None, None, None, None, None, None, None
+            )._execute_comparison_workflow(args)
+
+        jobs = mock_run.call_args[0][1]
+        assert [job["args"].rca_allen_label for job in jobs] == [
+            str(tmp_path / "my_labels.nii.gz")
+        ] * 2
+        assert [job["args"].rca_allen_atlas for job in jobs] == ["None"] * 2
+        assert [job["args"].rwc_input_folder for job in jobs] == [None] * 2
+        assert args.rca_allen_label == "my_labels.nii.gz"
+
+    @pytest.mark.parametrize(
+        "monte_carlo, image_mode", [(0, "out_"), (10, "MC_unet_")]
+    )
+    @mock.patch(ACE_PATH + ".GetVoxSegTif.create_orientation_file")
+    @mock.patch(ACE_PATH + ".GetVoxSegTif.check_warping_requirements")
+    def test_ace_voxelize_and_warp_chunked_volume(
+        self, mock_check_warping, mock_orientation, tmp_path, monte_carlo, image_mode
+    ):
+        seg_folder = tmp_path / "seg_final"
+        seg_folder.mkdir()
+        chunked_volume = tmp_path / f"seg_final_{image_mode.rstrip('_')}.zarr"
+        chunked_volume.mkdir()
+        warp_folder = tmp_path / "warp_final"
+        warp_folder.mkdir()
+        (warp_folder / "clar_voxelized_seg.nii.gz").touch()
+        mock_check_warping.return_value = ("voxelized_seg.nii.gz", "ort2std.txt")
+        args = Namespace(
+            sa_monte_carlo=monte_carlo, sa_chunked_volume=True, rca_orient_code="ALS"
+        )
+        stage_cache = mock.Mock()
+        stage_cache.is_valid.return_value = False
+        voxelization = mock.Mock()
+
+        ACE.ACEWorkflows(
+            segmentation=None,
+            instance_segmentation=None,
+            conversion=None,
+            registration=None,
+            voxelization=voxelization,
+            warping=mock.Mock(),
+            stats=None,
+            heatmap=None,
+            validate_clusters=None,
+        )._voxelize_and_warp(
+            args,
+            stage_cache,
+            seg_folder,
+            tmp_path / "reg_final",
+            tmp_path / "vox_final",
+            warp_folder,
+        )
+
+        voxelization.voxelize.assert_called_once_with(
+            args, chunked_volume, slice_filter="", out_dir=tmp_path / "vox_final"
+        )
+
+
+class TestAceInterfaceInstanceSegmentationChecker:
+    def make_seg_folder(self, tmp_path, neuron_info_file):
+        seg_folder = tmp_path / "seg_final"
+        (seg_folder / "cc_slices").mkdir(parents=True)
+        (seg_folder / "cc_slices" / "CC_slice_0.tif").write_bytes(b"0")
+        cc_patches = seg_folder / "generated_patches" / "cc_patches"
+        cc_patches.mkdir(parents=True)
+        (cc_patches / neuron_info_file).write_bytes(b"0")
+        return seg_folder
+
+    def make_args(self):
+        return Namespace(
+            no_instance_segmentation=False, rerun_instance_segmentation=False
+        )
+
+    def test_ace_instance_seg_checker_neuron_table(self, tmp_path):
+        seg_folder = self.make_seg_folder(tmp_path, "neuron_info_final.npz")
+
+        assert not ACE.InstanceSegmentationChecker.check_instance_segmentation(
+            self.make_args(), seg_folder
+        )
+
+    def test_ace_instance_seg_checker_legacy_json(self, tmp_path):
+        seg_folder = self.make_seg_folder(tmp_path, "neuron_info_final.json")
+
+        assert ACE.InstanceSegmentationChecker.check_instance_segmentation(
+            self.make_args(), seg_folder
+        )
+        assert not (seg_folder / "cc_slices" / "CC_slice_0.tif").exists()
+
+
+class TestAceInterfaceSegmentationCheckerStreaming:
+    def make_args(self, no_instance_segmentation):
+        return Namespace(
+            rerun_segmentation=False,
+            sa_stream=True,
+            sa_keep_patches=False,
+            no_instance_segmentation=no_instance_segmentation,
+        )
+
+    def make_seg_folder(self, tmp_path):
+        seg_folder = tmp_path / "seg_final"
+        (seg_folder / "generated_patches").mkdir(parents=True)
+        (seg_folder / "generated_patches" / "percentage_brain_patch.json").write_text("{}")
+        (seg_folder / "out_slice_0.tif").write_bytes(b"0")
+        return seg_folder
+
+    def test_ace_seg_checker_streaming_without_patches(self, tmp_path):
+        seg_folder = self.make_seg_folder(tmp_path)
+
+        assert not ACE.SegmentationChecker.check_segmentation(
+            self.make_args(no_instance_segmentation=True), seg_folder
+        )
+
+    def test_ace_seg_checker_streaming_missing_patches(self, tmp_path):
+        seg_folder = self.make_seg_folder(tmp_path)
+
+        # the instance segmentation needs the output patches
+        assert ACE.SegmentationChecker.check_segmentation(
+            self.make_args(no_instance_segmentation=False), seg_folder
+        )
+
+
+class TestAceInterfaceStageCache:
+    def make_args(self, raw_dir, **kwargs):
+        args = Namespace(
+            single=raw_dir,
+            sa_output_folder="out",
+            sa_model_type="unet",
+            sa_resolution=[1.4, 1.4, 5.0],
+            sa_monte_carlo=0,
+            sa_percentage_brain_patch_skip=0.0,
+            sa_gpu_index=0,
+            ctn_down=5,
+            rca_voxel_size=10,
+            rca_orient_code="ALS",
+            rva_downsample=10,
+            rwc_voxel_size=25,
+        )
+        for name, value in kwargs.items():
+            setattr(args, name, value)
+        return args
+
+    def make_cache(self, tmp_path):
+        raw_dir = tmp_path / "cells"
+        raw_dir.mkdir()
+        (raw_dir / "slice_0.tif").write_bytes(b"0" * 10)
+        out_dir = tmp_path / "out"
+        out_dir.mkdir()
+        cache = ACE.StageCache(out_dir)
+        args = self.make_args(raw_dir)
+        for stage in ACE.StageCache.STAGES:
+            cache.record(stage, args, True)
+        return cache, args, raw_dir, out_dir
+
+    def test_ace_stage_cache_no_record(self, tmp_path):
+        cache = ACE.StageCache(tmp_path)
+
+        assert cache.is_valid("segmentation", self.make_args(tmp_path)) is None
+
+    def test_ace_stage_cache_valid_after_reload(self, tmp_path):
+        _, args, _, out_dir = self.make_cache(tmp_path)
+        cache = ACE.StageCache(out_dir)
+
+        assert (out_dir / ACE.StageCache.MANIFEST_NAME).is_file()
+        assert all(cache.is_valid(stage, args) for stage in ACE.StageCache.STAGES)
+
+    def test_ace_stage_cache_ignored_param(self, tmp_path):
+        cache, args, _, _ = self.make_cache(tmp_path)
+        args.sa_gpu_index = 1
+
+        assert cache.is_valid("segmentation", args)
+
+    def test_ace_stage_cache_changed_param_invalidates_downstream(self, tmp_path):
+        cache, args, _, _ = self.make_cache(tmp_path)
+        args.ctn_down = 10
+
+        assert cache.is_valid("segmentation", args)
+        assert not cache.is_valid("conversion", args)
+
+        cache.record("conversion", args, True)
+
+        assert not cache.is_valid("registration", args)
+        assert cache.is_valid("voxelization", args)
+
+    def test_ace_stage_cache_changed_input(self, tmp_path):
+        cache, args, raw_dir, out_dir = self.make_cache(tmp_path)
+        (raw_dir / "slice_1.tif").write_bytes(b"1" * 10)
+        cache = ACE.StageCache(out_dir)
+
+        assert not cache.is_valid("segmentation", args)
+        assert not cache.is_valid("conversion", args)
+
+    def test_ace_stage_cache_skipped_stage_keeps_downstream(self, tmp_path):
+        cache, args, _, _ = self.make_cache(tmp_path)
+        cache.record("segmentation", args, False)
+
+        assert cache.is_valid("voxelization", args)
+
+    def test_ace_stage_cache_checker_skip(self, tmp_path):
+        cache, args, _, out_dir = self.make_cache(tmp_path)
+        args.rerun_conversion = False
+
+        assert not ACE.ConversionChecker.check_conversion(args, out_dir, cache)
+
+    def test_ace_stage_cache_checker_rerun_changed(self, tmp_path):
+        cache, args, _, out_dir = self.make_cache(tmp_path)
+        args.rerun_registration = False
+        args.rca_hemi = "split"
+        reg_folder = out_dir / "reg_final"
+
+        assert ACE.RegistrationChecker.check_registration(args, reg_folder, cache)
+        assert (out_dir / "clar_allen_reg").is_dir()
+
+    def test_ace_stage_cache_missing_chunked_volume(self, tmp_path):
+        cache, args, _, out_dir = self.make_cache(tmp_path)
+        args.rerun_segmentation = False
+        args.sa_chunked_volume = True
+        seg_folder = out_dir / "seg_final"
+        seg_folder.mkdir()
+
+        # cached segmentation without the requested chunked volume
+        assert cache.is_valid("segmentation", args)
+        assert ACE.SegmentationChecker.check_segmentation(args, seg_folder, cache)
+
+        chunked_volume = out_dir / "seg_final_out.zarr"
+        (chunked_volume / "0").mkdir(parents=True)
+        (chunked_volume / ".zattrs").write_text("{}")
+        (chunked_volume / "0" / ".zarray").write_text("{}")
+
+        assert not ACE.SegmentationChecker.check_segmentation(args, seg_folder, cache)
+
+
+def _scheduler_job(job, resources):
+    with resources["registration"]:
+        print(f"running {job['subject']}")
+    if job["subject"] == "bad":
+        raise ValueError("bad subject")
+    return job["subject"]
+
+
+def _scheduler_cwd_job(job, resources):
+    return Path.cwd()
+
+
+class TestAceInterfaceSubjectScheduler:
+    def make_jobs(self, tmp_path, subjects):
+        return [
+            {
+                "subject": subject,
+                "work_dir": tmp_path / subject,
+                "log_file": tmp_path / subject / "ace_flow_subject.log",
+            }
+            for subject in subjects
+        ]
+
+    @pytest.mark.parametrize("max_subjects", [1, 2])
+    def test_ace_scheduler_results_in_job_order(self, tmp_path, max_subjects):
+        jobs = self.make_jobs(tmp_path, ["subj1", "subj2", "subj3"])
+        results = ACE.SubjectScheduler(
+            max_subjects=max_subjects, resource_caps={"registration": 1}
+        ).run(_scheduler_job, jobs)
+
+        assert [result["status"] for result in results] == ["done"] * 3
+        assert [result["result"] for result in results] == ["subj1", "subj2", "subj3"]
+
+    @pytest.mark.parametrize("max_subjects", [1, 2])
+    def test_ace_scheduler_failure_isolated(self, tmp_path, max_subjects):
+        jobs = self.make_jobs(tmp_path, ["subj1", "bad", "subj3"])
+        results = ACE.SubjectScheduler(
+            max_subjects=max_subjects, resource_caps={"registration": 1}
+        ).run(_scheduler_job, jobs)
+
+        assert [result["status"] for result in results] == ["done", "failed", "done"]
+        assert "ValueError: bad subject" in results[1]["error"]
+
+    def test_ace_scheduler_subject_logs(self, tmp_path):
+        jobs = self.make_jobs(tmp_path, ["subj1", "bad"])
+        ACE.SubjectScheduler(
+            max_subjects=2, resource_caps={"registration": 1}
+        ).run(_scheduler_job, jobs)
+
+        assert "running subj1" in jobs[0]["log_file"].read_text()
+        assert "ValueError: bad subject" in jobs[1]["log_file"].read_text()
+        assert "subj1" not in jobs[1]["log_file"].read_text()
+
+    @pytest.mark.parametrize("max_subjects", [1, 2])
+    def test_ace_scheduler_work_dir(self, tmp_path, max_subjects):
+        jobs = self.make_jobs(tmp_path, ["subj1", "subj2"])
+        results = ACE.SubjectScheduler(max_subjects=max_subjects).run(
+            _scheduler_cwd_job, jobs
+        )
+
+        # subjects only run in their own folder in parallel
+        if max_subjects == 1:
+            expected = [Path.cwd()] * 2
+        else:
+            expected = [job["work_dir"] for job in jobs]
+        assert [result["result"] for result in results] == expected
+
 
 class TestAceInterfaceMain:
     def decorator(function):
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from miracl.lbls import miracl_lbls_ontology as ONT
+
+GRAPH = """id,atlas_id,name,acronym,parent_structure_id,depth,structure_id_path,color_hex_triplet
+997,-1.0,root,root,,0,/997/,FFFFFF
+8,0.0,Basic cell groups and regions,grey,997.0,1,/997/8/,BFDAE3
+567,70.0,Cerebrum,CH,8.0,2,/997/8/567/,
+477,,Striatum,STR,567.0,3,/997/8/567/477/,98D6F9
+672,79.0,Caudoputamen,CP,477.0,4,/997/8/567/477/672/,80CDF8
+"""
+
+
+@pytest.fixture
+def graph_csv(tmp_path):
+    csv = tmp_path / "graph.csv"
+    csv.write_text(GRAPH)
+    return csv
+
+
+@pytest.fixture
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(ONT, "_cache", {})
+
+
+def assert_ontology_equal(ontology, expected):
+    pd.testing.assert_frame_equal(ontology.df, expected.df)
+    assert np.array_equal(ontology.pathmat, expected.pathmat)
+    assert np.array_equal(ontology.pathlens, expected.pathlens)
+
+
+class TestOntology:
+    def test_ontology_lookups(self, graph_csv):
+        ontology = ONT.Ontology.from_csv(graph_csv, sidecar=False)
+
+        assert ontology.id_of("CP") == 672
+        assert ontology.id_of("Striatum") == 477
+        assert ontology.name(np.array([672, 5]), default="unknown").tolist() == [
+            "Caudoputamen",
+            "unknown",
+        ]
+        assert ontology.path(672).tolist() == [997, 8, 567, 477, 672]
+        assert ontology.ancestor_at_depth(672, 2) == 567
+        assert ontology.descendants("STR").tolist() == [477, 672]
+
+    def test_ontology_sidecar_round_trip(self, graph_csv, tmp_path):
+        ontology = ONT.Ontology.from_csv(graph_csv, sidecar=False)
+        npz = tmp_path / "graph.npz"
+        stamp = np.array([ONT.SIDECAR_VERSION, 0, 0], dtype=np.int64)
+        ontology.to_npz(npz, stamp)
+
+        assert_ontology_equal(ONT.Ontology.from_npz(npz, stamp), ontology)
+
+    def test_ontology_sidecar_stale(self, graph_csv, tmp_path):
+        ontology = ONT.Ontology.from_csv(graph_csv, sidecar=False)
+        npz = tmp_path / "graph.npz"
+        ontology.to_npz(npz, np.array([ONT.SIDECAR_VERSION, 0, 0], dtype=np.int64))
+
+        with pytest.raises(ONT.StaleSidecarError):
+            ONT.Ontology.from_npz(npz, np.array([ONT.SIDECAR_VERSION, 1, 0]))
+
+    def test_load_ontology_reads_sidecar(self, graph_csv, fresh_cache, monkeypatch):
+        ontology = ONT.load_ontology(csv=graph_csv)
+        assert (graph_csv.parent / "graph.csv.npz").is_file()
+
+        def read_csv(*args, **kwargs):
+            raise AssertionError("the csv was read instead of its sidecar")
+
+        monkeypatch.setattr(ONT, "_cache", {})
+        monkeypatch.setattr(ONT.pd, "read_csv", read_csv)
+
+        assert_ontology_equal(ONT.load_ontology(csv=graph_csv), ontology)
+
+    def test_load_ontology_stale_sidecar(self, graph_csv, fresh_cache):
+        ONT.load_ontology(csv=graph_csv)
+        graph_csv.write_text(GRAPH.replace("Caudoputamen", "Caudate putamen"))
+
+        assert ONT.load_ontology(csv=graph_csv).name(672) == "Caudate putamen"